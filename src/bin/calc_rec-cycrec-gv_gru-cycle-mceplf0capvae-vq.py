@@ -11,15 +11,21 @@ import logging
 import math
 import os
 import sys
+import time
+from distutils.util import strtobool
 
 import numpy as np
 import torch
 import torch.multiprocessing as mp
 
-from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, nn_search_batch
+from vcneuvoco import GRU_VAE_ENCODER, GRU_VAE_ENCODER_PAIR, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, nn_search_batch
+from vcneuvoco import freeze_model
 from utils import find_files, read_hdf5, read_txt, write_hdf5, check_hdf5
+from utils import write_shard, merge_shards, pad_edge_batch
 
 from dtw_c import dtw_c as dtw
+from metrics import MetricBatch, MetricStats, merge_moments, moments_mean_var
+from decode_pool import worker_devices, device_scope, file_lengths, longest_first, run_pool
 
 import torch.nn.functional as F
 import h5py
@@ -40,10 +46,21 @@ def main():
                         type=str, help="configure file")
     parser.add_argument("--n_gpus", default=1,
                         type=int, help="number of gpus")
+    parser.add_argument("--n_cpu_workers", default=0,
+        type=int, help="number of cpu decoding workers (pinned to disjoint core sets) in addition to gpu workers")
+    parser.add_argument("--cpus_per_job", default=None,
+        type=int, help="number of cpu cores (and compute threads) of each decoding worker (if None, the available cores are divided)")
     parser.add_argument("--outdir", required=True,
                         type=str, help="directory to save log")
     parser.add_argument("--string_path", required=True,
                         type=str, help="path of h5 generated feature")
+    parser.add_argument("--fuse_enc", default=None,
+                        type=strtobool, help="run mcep and excit. encoders as one fused encoder (if not autoregressive/bidirectional), "\
+                            "if None only on gpu workers, as it is not faster on cpu")
+    parser.add_argument("--batch_size_utt", default=8,
+                        type=int, help="number of utterances decoded in a padded batch")
+    parser.add_argument("--incremental", default=False,
+                        type=strtobool, help="update the stored rec. GV statistics of the speaker with only the training utterances not yet accumulated in them")
     # other setting
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
@@ -98,12 +115,6 @@ def main():
         logging.error("--feats should be directory or list.")
         sys.exit(1)
 
-    # prepare the file list for parallel decoding
-    feat_lists = np.array_split(feat_list, args.n_gpus)
-    feat_lists = [f_list.tolist() for f_list in feat_lists]
-    for i in range(args.n_gpus):
-        logging.info('%d: %d' % (i+1, len(feat_lists[i])))
-
     spk_list = config.spk_list.split('@')
     n_spk = len(spk_list)
     spk_idx = spk_list.index(args.spk)
@@ -125,117 +136,160 @@ def main():
     model_name = os.path.basename(os.path.dirname(args.model)).split('_')[1]
     logging.info('mdl_name: '+model_name)
 
+    string_path = model_name+"-"+str(config.detach)+"-"+str(config.n_half_cyc)+"-"+str(config.lat_dim)+"-"+str(config.ctr_size)\
+                    +"-"+str(config.spkidtr_dim)+"-"+str(config.ar_enc)+"-"+str(config.ar_dec)+"-"+str(config.ar_f0)+"-"+model_epoch
+    logging.info(string_path)
+
+    # rec. GV statistics of the speaker are stored as mergeable moments (count, sum, sum of squares) together with
+    # the list of accumulated training utterances, so that they can be updated with new utterances only
+    string_gv = ["/recgv_n_"+string_path, "/recgv_sum_"+string_path, "/recgv_sumsq_"+string_path]
+    string_files = "/recgv_files_"+string_path
+    gv_moments_prev = None
+    gv_files_prev = []
+    if args.incremental and check_hdf5(spk_stat, string_files):
+        gv_moments_prev = tuple(read_hdf5(spk_stat, string_gv_) for string_gv_ in string_gv)
+        gv_files_prev = [x.decode() for x in read_hdf5(spk_stat, string_files)]
+        gv_files_set = set(gv_files_prev)
+        feat_list = [x for x in feat_list if x not in gv_files_set]
+        logging.info("incremental rec. GV stats: %d accumulated utterances, %d utterances to be decoded" % \
+                        (len(gv_files_prev), len(feat_list)))
+    gv_files = [x for x in feat_list if 'tr' in x.split('/')[1].split('_')[0]]
+
+    # decoding workers on gpus and/or cpu core sets, pulling utterances from a central queue longest-first
+    devices = worker_devices(args.n_gpus, args.n_cpu_workers, cpus_per_job=args.cpus_per_job)
+    feat_lengths = file_lengths(feat_list, "/feat_mceplf0cap")
+
     logging.info(config)
-    # define gpu decode function
-    def gpu_decode(feat_list, gpu, cvlist=None, mcdpow_cvlist=None, mcdpowstd_cvlist=None, mcd_cvlist=None, \
-                    mcdstd_cvlist=None, cvlist_dv=None, mcdpow_cvlist_dv=None, mcdpowstd_cvlist_dv=None, \
-                    mcd_cvlist_dv=None, mcdstd_cvlist_dv=None, \
-                    f0rmse_cvlist=None, f0corr_cvlist=None, caprmse_cvlist=None, \
-                    f0rmse_cvlist_dv=None, f0corr_cvlist_dv=None, caprmse_cvlist_dv=None, \
-                    cvlist_cyc=None, mcdpow_cvlist_cyc=None, mcdpowstd_cvlist_cyc=None, mcd_cvlist_cyc=None, \
-                    mcdstd_cvlist_cyc=None, cvlist_cyc_dv=None, mcdpow_cvlist_cyc_dv=None, mcdpowstd_cvlist_cyc_dv=None, \
-                    mcd_cvlist_cyc_dv=None, mcdstd_cvlist_cyc_dv=None, \
-                    f0rmse_cvlist_cyc=None, f0corr_cvlist_cyc=None, caprmse_cvlist_cyc=None, \
-                    f0rmse_cvlist_cyc_dv=None, f0corr_cvlist_cyc_dv=None, caprmse_cvlist_cyc_dv=None):
-        with torch.cuda.device(gpu):
-            # define model and load parameters
+    # bidirectional GRUs would see the padded frames of shorter utterances in a batch, so decode them one by one
+    if config.bi_enc or config.bi_dec or config.bi_lf0:
+        batch_size_utt = 1
+    else:
+        batch_size_utt = args.batch_size_utt
+    logging.info("utterances per batch: %d" % (batch_size_utt))
+
+    # define models and load parameters on a device
+    def load_models(device):
+        with torch.no_grad():
+            model_encoder_mcep = GRU_VAE_ENCODER(
+                in_dim=config.mcep_dim+config.excit_dim,
+                n_spk=n_spk,
+                lat_dim=config.lat_dim,
+                hidden_layers=config.hidden_layers_enc,
+                hidden_units=config.hidden_units_enc,
+                kernel_size=config.kernel_size_enc,
+                dilation_size=config.dilation_size_enc,
+                causal_conv=config.causal_conv_enc,
+                bi=config.bi_enc,
+                cont=False,
+                pad_first=True,
+                right_size=config.right_size,
+                ar=config.ar_enc)
+            logging.info(model_encoder_mcep)
+            model_decoder_mcep = GRU_SPEC_DECODER(
+                feat_dim=config.lat_dim,
+                out_dim=config.mcep_dim,
+                n_spk=n_spk,
+                hidden_layers=config.hidden_layers_dec,
+                hidden_units=config.hidden_units_dec,
+                kernel_size=config.kernel_size_dec,
+                dilation_size=config.dilation_size_dec,
+                causal_conv=config.causal_conv_dec,
+                bi=config.bi_dec,
+                spkidtr_dim=config.spkidtr_dim,
+                pad_first=True,
+                ar=config.ar_dec)
+            logging.info(model_decoder_mcep)
+            model_encoder_excit = GRU_VAE_ENCODER(
+                in_dim=config.mcep_dim+config.excit_dim,
+                n_spk=n_spk,
+                lat_dim=config.lat_dim_e,
+                hidden_layers=config.hidden_layers_enc,
+                hidden_units=config.hidden_units_enc,
+                kernel_size=config.kernel_size_enc,
+                dilation_size=config.dilation_size_enc,
+                causal_conv=config.causal_conv_enc,
+                bi=config.bi_enc,
+                cont=False,
+                pad_first=True,
+                right_size=config.right_size,
+                ar=config.ar_enc)
+            logging.info(model_encoder_excit)
+            model_decoder_excit = GRU_EXCIT_DECODER(
+                feat_dim=config.lat_dim_e,
+                cap_dim=config.cap_dim,
+                n_spk=n_spk,
+                hidden_layers=config.hidden_layers_lf0,
+                hidden_units=config.hidden_units_lf0,
+                kernel_size=config.kernel_size_lf0,
+                dilation_size=config.dilation_size_lf0,
+                causal_conv=config.causal_conv_lf0,
+                bi=config.bi_lf0,
+                spkidtr_dim=config.spkidtr_dim,
+                pad_first=True,
+                ar=config.ar_f0)
+            logging.info(model_decoder_excit)
+            model_vq = torch.nn.Embedding(config.ctr_size, config.lat_dim)
+            logging.info(model_vq)
+            checkpoint = torch.load(args.model, map_location="cpu")
+            if checkpoint.get("frozen", False):
+                # frozen model of freeze_model.py
+                for model in [model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit]:
+                    freeze_model(model)
+            model_encoder_mcep.load_state_dict(checkpoint["model_encoder_mcep"])
+            model_decoder_mcep.load_state_dict(checkpoint["model_decoder_mcep"])
+            model_encoder_excit.load_state_dict(checkpoint["model_encoder_excit"])
+            model_decoder_excit.load_state_dict(checkpoint["model_decoder_excit"])
+            model_vq.load_state_dict(checkpoint["model_vq"])
+            model_encoder_mcep.to(device)
+            model_decoder_mcep.to(device)
+            model_encoder_excit.to(device)
+            model_decoder_excit.to(device)
+            model_vq.to(device)
+            model_encoder_mcep.eval()
+            model_decoder_mcep.eval()
+            model_encoder_excit.eval()
+            model_decoder_excit.eval()
+            model_vq.eval()
+            for param in model_encoder_mcep.parameters():
+                param.requires_grad = False
+            for param in model_decoder_mcep.parameters():
+                param.requires_grad = False
+            for param in model_encoder_excit.parameters():
+                param.requires_grad = False
+            for param in model_decoder_excit.parameters():
+                param.requires_grad = False
+            model_decoder_mcep.precompute_spk_table()
+            model_decoder_excit.precompute_spk_table()
+            model_encoder_pair = GRU_VAE_ENCODER_PAIR(model_encoder_mcep, model_encoder_excit, \
+                                    fuse=args.fuse_enc if args.fuse_enc is not None else device.type == "cuda")
+            logging.info("fused mcep/excit encoders: %s" % (model_encoder_pair.fused))
+            model_encoder_pair.to(device)
+            model_encoder_pair.eval()
+            for param in model_vq.parameters():
+                param.requires_grad = False
+        return model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_vq, model_encoder_pair
+
+    # define decode function of a worker
+    def worker_decode(feat_list, device, queue=None, models=None):
+        metric_stats = MetricStats()
+        metric_batch = MetricBatch(metric_stats)
+        with device_scope(device):
+            # models are loaded once per worker, or shared by the cpu workers
+            if models is None:
+                models = load_models(device)
+            model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_vq, model_encoder_pair = models
             with torch.no_grad():
-                model_encoder_mcep = GRU_VAE_ENCODER(
-                    in_dim=config.mcep_dim+config.excit_dim,
-                    n_spk=n_spk,
-                    lat_dim=config.lat_dim,
-                    hidden_layers=config.hidden_layers_enc,
-                    hidden_units=config.hidden_units_enc,
-                    kernel_size=config.kernel_size_enc,
-                    dilation_size=config.dilation_size_enc,
-                    causal_conv=config.causal_conv_enc,
-                    bi=config.bi_enc,
-                    cont=False,
-                    pad_first=True,
-                    right_size=config.right_size,
-                    ar=config.ar_enc)
-                logging.info(model_encoder_mcep)
-                model_decoder_mcep = GRU_SPEC_DECODER(
-                    feat_dim=config.lat_dim,
-                    out_dim=config.mcep_dim,
-                    n_spk=n_spk,
-                    hidden_layers=config.hidden_layers_dec,
-                    hidden_units=config.hidden_units_dec,
-                    kernel_size=config.kernel_size_dec,
-                    dilation_size=config.dilation_size_dec,
-                    causal_conv=config.causal_conv_dec,
-                    bi=config.bi_dec,
-                    spkidtr_dim=config.spkidtr_dim,
-                    pad_first=True,
-                    ar=config.ar_dec)
-                logging.info(model_decoder_mcep)
-                model_encoder_excit = GRU_VAE_ENCODER(
-                    in_dim=config.mcep_dim+config.excit_dim,
-                    n_spk=n_spk,
-                    lat_dim=config.lat_dim_e,
-                    hidden_layers=config.hidden_layers_enc,
-                    hidden_units=config.hidden_units_enc,
-                    kernel_size=config.kernel_size_enc,
-                    dilation_size=config.dilation_size_enc,
-                    causal_conv=config.causal_conv_enc,
-                    bi=config.bi_enc,
-                    cont=False,
-                    pad_first=True,
-                    right_size=config.right_size,
-                    ar=config.ar_enc)
-                logging.info(model_encoder_excit)
-                model_decoder_excit = GRU_EXCIT_DECODER(
-                    feat_dim=config.lat_dim_e,
-                    cap_dim=config.cap_dim,
-                    n_spk=n_spk,
-                    hidden_layers=config.hidden_layers_lf0,
-                    hidden_units=config.hidden_units_lf0,
-                    kernel_size=config.kernel_size_lf0,
-                    dilation_size=config.dilation_size_lf0,
-                    causal_conv=config.causal_conv_lf0,
-                    bi=config.bi_lf0,
-                    spkidtr_dim=config.spkidtr_dim,
-                    pad_first=True,
-                    ar=config.ar_f0)
-                logging.info(model_decoder_excit)
-                model_vq = torch.nn.Embedding(config.ctr_size, config.lat_dim)
-                logging.info(model_vq)
-                model_encoder_mcep.load_state_dict(torch.load(args.model)["model_encoder_mcep"])
-                model_decoder_mcep.load_state_dict(torch.load(args.model)["model_decoder_mcep"])
-                model_encoder_excit.load_state_dict(torch.load(args.model)["model_encoder_excit"])
-                model_decoder_excit.load_state_dict(torch.load(args.model)["model_decoder_excit"])
-                model_vq.load_state_dict(torch.load(args.model)["model_vq"])
-                model_encoder_mcep.cuda()
-                model_decoder_mcep.cuda()
-                model_encoder_excit.cuda()
-                model_decoder_excit.cuda()
-                model_vq.cuda()
-                model_encoder_mcep.eval()
-                model_decoder_mcep.eval()
-                model_encoder_excit.eval()
-                model_decoder_excit.eval()
-                model_vq.eval()
-                for param in model_encoder_mcep.parameters():
-                    param.requires_grad = False
-                for param in model_decoder_mcep.parameters():
-                    param.requires_grad = False
-                for param in model_encoder_excit.parameters():
-                    param.requires_grad = False
-                for param in model_decoder_excit.parameters():
-                    param.requires_grad = False
-                for param in model_vq.parameters():
-                    param.requires_grad = False
                 if config.ar_enc:
-                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim)).cuda()
-                    yz_in_e = torch.zeros((1, 1, n_spk+config.lat_dim_e)).cuda()
+                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim)).to(device)
+                    yz_in_e = torch.zeros((1, 1, n_spk+config.lat_dim_e)).to(device)
                 if config.ar_dec or config.ar_f0:
                     mean_stats = torch.FloatTensor(read_hdf5(config.stats, "/mean_"+config.string_path.replace("/","")))
                     scale_stats = torch.FloatTensor(read_hdf5(config.stats, "/scale_"+config.string_path.replace("/","")))
                 if config.ar_dec:
-                    x_in = ((torch.zeros((1, 1, config.mcep_dim))-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]).cuda()
+                    x_in = ((torch.zeros((1, 1, config.mcep_dim))-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]).to(device)
                 if config.ar_f0:
                     e_in = torch.cat((torch.zeros(1,1,1), (torch.zeros(1,1,1)-mean_stats[1:2])/scale_stats[1:2], \
-                                    torch.zeros(1,1,1), (torch.zeros(1,1,config.cap_dim)-mean_stats[3:config.excit_dim])/scale_stats[3:config.excit_dim]), 2).cuda()
+                                    torch.zeros(1,1,1), (torch.zeros(1,1,config.cap_dim)-mean_stats[3:config.excit_dim])/scale_stats[3:config.excit_dim]), 2).to(device)
             count = 0
             pad_left = (model_encoder_mcep.pad_left + model_decoder_mcep.pad_left)*2
             pad_right = (model_encoder_mcep.pad_right + model_decoder_mcep.pad_right)*2
@@ -247,102 +301,79 @@ def main():
             outpad_rights[1] = outpad_rights[0]-model_decoder_mcep.pad_right
             outpad_lefts[2] = outpad_lefts[1]-model_encoder_mcep.pad_left
             outpad_rights[2] = outpad_rights[1]-model_encoder_mcep.pad_right
-            for feat_file in feat_list:
-                # convert mcep
-                logging.info("recmcep " + feat_file)
-
-                feat_org = read_hdf5(feat_file, "/feat_mceplf0cap")
+            shard_name = os.path.join(shard_dir, "shard-%d.h5" % os.getpid())
+            for batch_files in feat_list:
+                # convert mcep of a padded batch of utterances (of similar lengths, longest first)
+                n_batch = len(batch_files)
+                logging.info("recmcep " + " ".join(batch_files))
+
+                feat_orgs = [read_hdf5(feat_file, "/feat_mceplf0cap") for feat_file in batch_files]
+                feat_org, flens = pad_edge_batch(feat_orgs)
                 logging.info(feat_org.shape)
 
                 with torch.no_grad():
-                    feat = F.pad(torch.FloatTensor(feat_org).cuda().unsqueeze(0).transpose(1,2), (pad_left,pad_right), "replicate").transpose(1,2)
+                    feat = F.pad(torch.FloatTensor(feat_org).to(device).transpose(1,2), (pad_left,pad_right), "replicate").transpose(1,2)
 
                     if config.ar_enc:
-                        spk_logits, lat_src, _, _ = model_encoder_mcep(feat, yz_in=yz_in)
-                        spk_logits_e, lat_src_e, _, _ = model_encoder_excit(feat, yz_in=yz_in)
+                        spk_logits, lat_src, _, _ = model_encoder_mcep(feat, yz_in=yz_in.repeat(n_batch,1,1))
+                        spk_logits_e, lat_src_e, _, _ = model_encoder_excit(feat, yz_in=yz_in.repeat(n_batch,1,1))
                     else:
-                        spk_logits, lat_src, _ = model_encoder_mcep(feat)
-                        spk_logits_e, lat_src_e, _ = model_encoder_excit(feat)
-                    idx_vq = nn_search_batch(lat_src, model_vq.weight)
+                        (spk_logits, lat_src, _), (spk_logits_e, lat_src_e, _) = model_encoder_pair(feat)
+                    idx_vq, idx_vq_e = torch.chunk(nn_search_batch(torch.cat((lat_src, lat_src_e), 0), model_vq.weight), 2, 0)
                     lat_src = model_vq(idx_vq)
-                    if outpad_rights[0] > 0:
-                        unique, counts = np.unique(idx_vq[:,outpad_lefts[0]:-outpad_rights[0]].cpu().data.numpy(), return_counts=True)
-                    else:
-                        unique, counts = np.unique(idx_vq[:,outpad_lefts[0]:].cpu().data.numpy(), return_counts=True)
-                    logging.info("input vq")
-                    logging.info(dict(zip(unique, counts)))
-                    idx_vq_e = nn_search_batch(lat_src_e, model_vq.weight)
                     lat_src_e = model_vq(idx_vq_e)
-                    if outpad_rights[0] > 0:
-                        unique, counts = np.unique(idx_vq_e[:,outpad_lefts[0]:-outpad_rights[0]].cpu().data.numpy(), return_counts=True)
-                    else:
-                        unique, counts = np.unique(idx_vq_e[:,outpad_lefts[0]:].cpu().data.numpy(), return_counts=True)
-                    logging.info("input vq_e")
-                    logging.info(dict(zip(unique, counts)))
-                    logging.info('input spkpost')
-                    if outpad_rights[0] > 0:
-                        logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[0]:-outpad_rights[0]], dim=-1), 1))
-                    else:
-                        logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[0]:], dim=-1), 1))
-                    logging.info('input spkpost_e')
-                    if outpad_rights[0] > 0:
-                        logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[0]:-outpad_rights[0]], dim=-1), 1))
-                    else:
-                        logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[0]:], dim=-1), 1))
-
-                    src_code = (torch.ones((1, lat_src.shape[1]))*spk_idx).cuda().long()
+                    for k in range(n_batch):
+                        unique, counts = np.unique(idx_vq[k,outpad_lefts[0]:outpad_lefts[0]+flens[k]].cpu().data.numpy(), return_counts=True)
+                        logging.info("input vq")
+                        logging.info(dict(zip(unique, counts)))
+                        unique, counts = np.unique(idx_vq_e[k,outpad_lefts[0]:outpad_lefts[0]+flens[k]].cpu().data.numpy(), return_counts=True)
+                        logging.info("input vq_e")
+                        logging.info(dict(zip(unique, counts)))
+                        logging.info('input spkpost')
+                        logging.info(torch.mean(F.softmax(spk_logits[k:k+1,outpad_lefts[0]:outpad_lefts[0]+flens[k]], dim=-1), 1))
+                        logging.info('input spkpost_e')
+                        logging.info(torch.mean(F.softmax(spk_logits_e[k:k+1,outpad_lefts[0]:outpad_lefts[0]+flens[k]], dim=-1), 1))
+
+                    src_code = (torch.ones((n_batch, lat_src.shape[1]))*spk_idx).to(device).long()
 
                     if config.ar_dec:
-                        cvmcep_src, _, _ = model_decoder_mcep(src_code, lat_src, x_in=x_in)
+                        cvmcep_src, _, _ = model_decoder_mcep(src_code, lat_src, x_in=x_in.repeat(n_batch,1,1))
                     else:
                         cvmcep_src, _ = model_decoder_mcep(src_code, lat_src)
                     if config.ar_f0:
-                        cvlf0_src, _, _ = model_decoder_excit(src_code, lat_src_e, e_in=e_in)
+                        cvlf0_src, _, _ = model_decoder_excit(src_code, lat_src_e, e_in=e_in.repeat(n_batch,1,1))
                     else:
                         cvlf0_src, _ = model_decoder_excit(src_code, lat_src_e)
 
                     cv_feat = torch.cat((cvlf0_src, cvmcep_src), 2)
                     if config.ar_enc:
-                        spk_logits, lat_rec, _, _ = model_encoder_mcep(cv_feat, yz_in=yz_in)
-                        spk_logits_e, lat_rec_e, _, _ = model_encoder_excit(cv_feat, yz_in=yz_in)
+                        spk_logits, lat_rec, _, _ = model_encoder_mcep(cv_feat, yz_in=yz_in.repeat(n_batch,1,1))
+                        spk_logits_e, lat_rec_e, _, _ = model_encoder_excit(cv_feat, yz_in=yz_in.repeat(n_batch,1,1))
                     else:
-                        spk_logits, lat_rec, _ = model_encoder_mcep(cv_feat)
-                        spk_logits_e, lat_rec_e, _ = model_encoder_excit(cv_feat)
-                    idx_vq = nn_search_batch(lat_rec, model_vq.weight)
+                        (spk_logits, lat_rec, _), (spk_logits_e, lat_rec_e, _) = model_encoder_pair(cv_feat)
+                    idx_vq, idx_vq_e = torch.chunk(nn_search_batch(torch.cat((lat_rec, lat_rec_e), 0), model_vq.weight), 2, 0)
                     lat_rec = model_vq(idx_vq)
-                    if outpad_rights[2] > 0:
-                        unique, counts = np.unique(idx_vq[:,outpad_lefts[2]:-outpad_rights[2]].cpu().data.numpy(), return_counts=True)
-                    else:
-                        unique, counts = np.unique(idx_vq[:,outpad_lefts[2]:].cpu().data.numpy(), return_counts=True)
-                    logging.info("input vq")
-                    logging.info(dict(zip(unique, counts)))
-                    idx_vq_e = nn_search_batch(lat_rec_e, model_vq.weight)
                     lat_rec_e = model_vq(idx_vq_e)
-                    if outpad_rights[2] > 0:
-                        unique, counts = np.unique(idx_vq_e[:,outpad_lefts[2]:-outpad_rights[2]].cpu().data.numpy(), return_counts=True)
-                    else:
-                        unique, counts = np.unique(idx_vq_e[:,outpad_lefts[2]:].cpu().data.numpy(), return_counts=True)
-                    logging.info("input vq_e")
-                    logging.info(dict(zip(unique, counts)))
-                    logging.info('rec spkpost')
-                    if outpad_rights[2] > 0:
-                        logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:-outpad_rights[2]], dim=-1), 1))
-                    else:
-                        logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:], dim=-1), 1))
-                    logging.info('rec spkpost_e')
-                    if outpad_rights[2] > 0:
-                        logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[2]:-outpad_rights[2]], dim=-1), 1))
-                    else:
-                        logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[2]:], dim=-1), 1))
-
-                    src_code = (torch.ones((1, lat_rec.shape[1]))*spk_idx).cuda().long()
+                    for k in range(n_batch):
+                        unique, counts = np.unique(idx_vq[k,outpad_lefts[2]:outpad_lefts[2]+flens[k]].cpu().data.numpy(), return_counts=True)
+                        logging.info("input vq")
+                        logging.info(dict(zip(unique, counts)))
+                        unique, counts = np.unique(idx_vq_e[k,outpad_lefts[2]:outpad_lefts[2]+flens[k]].cpu().data.numpy(), return_counts=True)
+                        logging.info("input vq_e")
+                        logging.info(dict(zip(unique, counts)))
+                        logging.info('rec spkpost')
+                        logging.info(torch.mean(F.softmax(spk_logits[k:k+1,outpad_lefts[2]:outpad_lefts[2]+flens[k]], dim=-1), 1))
+                        logging.info('rec spkpost_e')
+                        logging.info(torch.mean(F.softmax(spk_logits_e[k:k+1,outpad_lefts[2]:outpad_lefts[2]+flens[k]], dim=-1), 1))
+
+                    src_code = (torch.ones((n_batch, lat_rec.shape[1]))*spk_idx).to(device).long()
 
                     if config.ar_dec:
-                        cvmcep_cyc, _, _ = model_decoder_mcep(src_code, lat_rec, x_in=x_in)
+                        cvmcep_cyc, _, _ = model_decoder_mcep(src_code, lat_rec, x_in=x_in.repeat(n_batch,1,1))
                     else:
                         cvmcep_cyc, _ = model_decoder_mcep(src_code, lat_rec)
                     if config.ar_f0:
-                        cvlf0_cyc, _, _ = model_decoder_excit(src_code, lat_rec_e, e_in=e_in)
+                        cvlf0_cyc, _, _ = model_decoder_excit(src_code, lat_rec_e, e_in=e_in.repeat(n_batch,1,1))
                     else:
                         cvlf0_cyc, _ = model_decoder_excit(src_code, lat_rec_e)
 
@@ -353,295 +384,156 @@ def main():
                         cvmcep_src = cvmcep_src[:,outpad_lefts[1]:]
                         cvlf0_src = cvlf0_src[:,outpad_lefts[1]:]
 
-                    feat_rec = torch.cat((torch.round(cvlf0_src[:,:,:1]), cvlf0_src[:,:,1:2], \
+                    feat_recs = torch.cat((torch.round(cvlf0_src[:,:,:1]), cvlf0_src[:,:,1:2], \
                                             torch.round(cvlf0_src[:,:,2:3]), cvlf0_src[:,:,3:], cvmcep_src), \
-                                                2)[0].cpu().data.numpy()
-                    feat_cyc = torch.cat((torch.round(cvlf0_cyc[:,:,:1]), cvlf0_cyc[:,:,1:2], \
+                                                2).cpu().data.numpy()
+                    feat_cycs = torch.cat((torch.round(cvlf0_cyc[:,:,:1]), cvlf0_cyc[:,:,1:2], \
                                             torch.round(cvlf0_cyc[:,:,2:3]), cvlf0_cyc[:,:,3:], cvmcep_cyc), \
-                                                2)[0].cpu().data.numpy()
-
-                    cvmcep_src = np.array(cvmcep_src[0].cpu().data.numpy(), dtype=np.float64)
-                    cvlf0_src = np.array(cvlf0_src[0].cpu().data.numpy(), dtype=np.float64)
-
-                    cvmcep_cyc = np.array(cvmcep_cyc[0].cpu().data.numpy(), dtype=np.float64)
-                    cvlf0_cyc = np.array(cvlf0_cyc[0].cpu().data.numpy(), dtype=np.float64)
-
-                logging.info(cvlf0_src.shape)
-                logging.info(cvmcep_src.shape)
-
-                logging.info(cvlf0_cyc.shape)
-                logging.info(cvmcep_cyc.shape)
-
-                mcep = np.array(feat_org[:,-model_decoder_mcep.out_dim:])
-                f0 = np.array(np.rint(feat_org[:,0])*np.exp(feat_org[:,1]))
-                codeap = np.array(np.rint(feat_org[:,2:3])*(-np.exp(feat_org[:,3:feat_org.shape[-1]-model_decoder_mcep.out_dim])))
+                                                2).cpu().data.numpy()
+
+                    cvmcep_srcs = np.array(cvmcep_src.cpu().data.numpy(), dtype=np.float64)
+                    cvlf0_srcs = np.array(cvlf0_src.cpu().data.numpy(), dtype=np.float64)
+
+                    cvmcep_cycs = np.array(cvmcep_cyc.cpu().data.numpy(), dtype=np.float64)
+                    cvlf0_cycs = np.array(cvlf0_cyc.cpu().data.numpy(), dtype=np.float64)
+
+                for k, feat_file in enumerate(batch_files):
+                    # valid frames of each utterance in the padded batch
+                    feat_org = feat_orgs[k]
+                    feat_rec = feat_recs[k,:flens[k]]
+                    feat_cyc = feat_cycs[k,:flens[k]]
+                    cvmcep_src = cvmcep_srcs[k,:flens[k]]
+                    cvlf0_src = cvlf0_srcs[k,:flens[k]]
+                    cvmcep_cyc = cvmcep_cycs[k,:flens[k]]
+                    cvlf0_cyc = cvlf0_cycs[k,:flens[k]]
+                    logging.info(feat_file)
+                    logging.info(cvlf0_src.shape)
+                    logging.info(cvmcep_src.shape)
+
+                    logging.info(cvlf0_cyc.shape)
+                    logging.info(cvmcep_cyc.shape)
+                    mcep = np.array(feat_org[:,-model_decoder_mcep.out_dim:])
+                    f0 = np.array(np.rint(feat_org[:,0])*np.exp(feat_org[:,1]))
+                    codeap = np.array(np.rint(feat_org[:,2:3])*(-np.exp(feat_org[:,3:feat_org.shape[-1]-model_decoder_mcep.out_dim])))
  
-                cvf0_src = np.array(np.rint(cvlf0_src[:,0])*np.exp(cvlf0_src[:,1]))
-                cvcodeap_src = np.array(np.rint(cvlf0_src[:,2:3])*(-np.exp(cvlf0_src[:,3:])))
-                f0_rmse = np.sqrt(np.mean((cvf0_src-f0)**2))
-                logging.info('F0_rmse_rec: %lf Hz' % (f0_rmse))
-                cvf0_src_mean = np.mean(cvf0_src)
-                f0_mean = np.mean(f0)
-                f0_corr = np.sum((cvf0_src-cvf0_src_mean)*(f0-f0_mean))/\
-                            (np.sqrt(np.sum((cvf0_src-cvf0_src_mean)**2))*np.sqrt(np.sum((f0-f0_mean)**2)))
-                logging.info('F0_corr_rec: %lf' % (f0_corr))
-
-                codeap_rmse = np.sqrt(np.mean((cvcodeap_src-codeap)**2, axis=0))
-                for i in range(codeap_rmse.shape[-1]):
-                    logging.info('codeap-%d_rmse_rec: %lf dB' % (i+1, codeap_rmse[i]))
-
-                cvf0_cyc = np.array(np.rint(cvlf0_cyc[:,0])*np.exp(cvlf0_cyc[:,1]))
-                cvcodeap_cyc = np.array(np.rint(cvlf0_cyc[:,2:3])*(-np.exp(cvlf0_cyc[:,3:])))
-                f0_rmse_cyc = np.sqrt(np.mean((cvf0_cyc-f0)**2))
-                logging.info('F0_rmse_cyc: %lf Hz' % (f0_rmse_cyc))
-                cvf0_cyc_mean = np.mean(cvf0_cyc)
-                f0_mean = np.mean(f0)
-                f0_corr_cyc = np.sum((cvf0_cyc-cvf0_cyc_mean)*(f0-f0_mean))/\
-                            (np.sqrt(np.sum((cvf0_cyc-cvf0_cyc_mean)**2))*np.sqrt(np.sum((f0-f0_mean)**2)))
-                logging.info('F0_corr_cyc: %lf' % (f0_corr_cyc))
-
-                codeap_rmse_cyc = np.sqrt(np.mean((cvcodeap_cyc-codeap)**2, axis=0))
-                for i in range(codeap_rmse_cyc.shape[-1]):
-                    logging.info('codeap-%d_rmse_cyc: %lf dB' % (i+1, codeap_rmse_cyc[i]))
-
-                spcidx = read_hdf5(feat_file, "/spcidx_range")[0]
-
-                _, _, _, mcdpow_arr = dtw.dtw_org_to_trg(np.array(cvmcep_src[np.array(spcidx),:], \
-                                            dtype=np.float64), np.array(mcep[np.array(spcidx),:], dtype=np.float64))
-                _, _, _, mcd_arr = dtw.dtw_org_to_trg(np.array(cvmcep_src[np.array(spcidx),1:], \
-                                            dtype=np.float64), np.array(mcep[np.array(spcidx),1:], dtype=np.float64))
-                mcdpow_mean = np.mean(mcdpow_arr)
-                mcdpow_std = np.std(mcdpow_arr)
-                mcd_mean = np.mean(mcd_arr)
-                mcd_std = np.std(mcd_arr)
-                logging.info("mcdpow_rec: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                logging.info("mcd_rec: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-
-                _, _, _, mcdpow_arr = dtw.dtw_org_to_trg(np.array(cvmcep_cyc[np.array(spcidx),:], \
-                                            dtype=np.float64), np.array(mcep[np.array(spcidx),:], dtype=np.float64))
-                _, _, _, mcd_arr = dtw.dtw_org_to_trg(np.array(cvmcep_cyc[np.array(spcidx),1:], \
-                                            dtype=np.float64), np.array(mcep[np.array(spcidx),1:], dtype=np.float64))
-                mcdpow_mean_cyc = np.mean(mcdpow_arr)
-                mcdpow_std_cyc = np.std(mcdpow_arr)
-                mcd_mean_cyc = np.mean(mcd_arr)
-                mcd_std_cyc = np.std(mcd_arr)
-                logging.info("mcdpow_cyc: %.6f dB +- %.6f" % (mcdpow_mean_cyc, mcdpow_std_cyc))
-                logging.info("mcd_cyc: %.6f dB +- %.6f" % (mcd_mean_cyc, mcd_std_cyc))
+                    cvf0_src = np.array(np.rint(cvlf0_src[:,0])*np.exp(cvlf0_src[:,1]))
+                    cvcodeap_src = np.array(np.rint(cvlf0_src[:,2:3])*(-np.exp(cvlf0_src[:,3:])))
+                    cvf0_cyc = np.array(np.rint(cvlf0_cyc[:,0])*np.exp(cvlf0_cyc[:,1]))
+                    cvcodeap_cyc = np.array(np.rint(cvlf0_cyc[:,2:3])*(-np.exp(cvlf0_cyc[:,3:])))
+
+                    spcidx = read_hdf5(feat_file, "/spcidx_range")[0]
+
+                    mcdpow_frames = []
+                    mcd_frames = []
+                    for cvmcep_ in [cvmcep_src, cvmcep_cyc]:
+                        _, _, _, mcdpow_arr = dtw.dtw_org_to_trg(np.array(cvmcep_[np.array(spcidx),:], \
+                                                    dtype=np.float64), np.array(mcep[np.array(spcidx),:], dtype=np.float64))
+                        _, _, _, mcd_arr = dtw.dtw_org_to_trg(np.array(cvmcep_[np.array(spcidx),1:], \
+                                                    dtype=np.float64), np.array(mcep[np.array(spcidx),1:], dtype=np.float64))
+                        mcdpow_frames.append(mcdpow_arr)
+                        mcd_frames.append(mcd_arr)
             
-                logging.info('org f0')
-                logging.info(f0[10:15])
-                logging.info('rec f0')
-                logging.info(cvf0_src[10:15])
-                logging.info('cyc f0')
-                logging.info(cvf0_cyc[10:15])
-                logging.info('org cap')
-                logging.info(codeap[10:15])
-                logging.info('rec cap')
-                logging.info(cvcodeap_src[10:15])
-                logging.info('cyc cap')
-                logging.info(cvcodeap_cyc[10:15])
-
-                dataset = feat_file.split('/')[1].split('_')[0]
-                if 'tr' in dataset:
-                    logging.info('trn')
-                    f0rmse_cvlist.append(f0_rmse)
-                    f0corr_cvlist.append(f0_corr)
-                    caprmse_cvlist.append(codeap_rmse)
-                    mcdpow_cvlist.append(mcdpow_mean)
-                    mcdpow_cvlist.append(mcdpow_mean)
-                    mcdpowstd_cvlist.append(mcdpow_std)
-                    mcd_cvlist.append(mcd_mean)
-                    mcdstd_cvlist.append(mcd_std)
-                    cvlist.append(np.var(cvmcep_src[:,1:], axis=0))
-                    logging.info(len(cvlist))
-                    f0rmse_cvlist_cyc.append(f0_rmse_cyc)
-                    f0corr_cvlist_cyc.append(f0_corr_cyc)
-                    caprmse_cvlist_cyc.append(codeap_rmse_cyc)
-                    mcdpow_cvlist_cyc.append(mcdpow_mean_cyc)
-                    mcdpow_cvlist_cyc.append(mcdpow_mean_cyc)
-                    mcdpowstd_cvlist_cyc.append(mcdpow_std_cyc)
-                    mcd_cvlist_cyc.append(mcd_mean_cyc)
-                    mcdstd_cvlist_cyc.append(mcd_std_cyc)
-                    cvlist_cyc.append(np.var(cvmcep_cyc[:,1:], axis=0))
-                elif 'dv' in dataset:
-                    logging.info('dev')
-                    f0rmse_cvlist_dv.append(f0_rmse)
-                    f0corr_cvlist_dv.append(f0_corr)
-                    caprmse_cvlist_dv.append(codeap_rmse)
-                    mcdpow_cvlist_dv.append(mcdpow_mean)
-                    mcdpowstd_cvlist_dv.append(mcdpow_std)
-                    mcd_cvlist_dv.append(mcd_mean)
-                    mcdstd_cvlist_dv.append(mcd_std)
-                    cvlist_dv.append(np.var(cvmcep_src[:,1:], axis=0))
-                    logging.info(len(cvlist_dv))
-                    f0rmse_cvlist_cyc_dv.append(f0_rmse_cyc)
-                    f0corr_cvlist_cyc_dv.append(f0_corr_cyc)
-                    caprmse_cvlist_cyc_dv.append(codeap_rmse_cyc)
-                    mcdpow_cvlist_cyc_dv.append(mcdpow_mean_cyc)
-                    mcdpow_cvlist_cyc_dv.append(mcdpow_mean_cyc)
-                    mcdpowstd_cvlist_cyc_dv.append(mcdpow_std_cyc)
-                    mcd_cvlist_cyc_dv.append(mcd_mean_cyc)
-                    mcdstd_cvlist_cyc_dv.append(mcd_std_cyc)
-                    cvlist_cyc_dv.append(np.var(cvmcep_cyc[:,1:], axis=0))
-
-                logging.info('write rec to h5')
-                outh5dir = os.path.join(os.path.dirname(os.path.dirname(feat_file)), args.spk+"-"+args.spk)
-                if not os.path.exists(outh5dir):
-                    os.makedirs(outh5dir)
-                feat_file = os.path.join(outh5dir, os.path.basename(feat_file))
-                logging.info(feat_file + ' ' + args.string_path)
-                logging.info(feat_rec.shape)
-                write_hdf5(feat_file, args.string_path, feat_rec)
-
-                logging.info('write cyc to h5')
-                outh5dir = os.path.join(os.path.dirname(os.path.dirname(feat_file)), args.spk+"-"+args.spk+"-"+args.spk)
-                if not os.path.exists(outh5dir):
-                    os.makedirs(outh5dir)
-                feat_file = os.path.join(outh5dir, os.path.basename(feat_file))
-                logging.info(feat_file + ' ' + args.string_path)
-                logging.info(feat_cyc.shape)
-                write_hdf5(feat_file, args.string_path, feat_cyc)
-
-                count += 1
-                #if count >= 5:
-                #    break
-
+                    logging.info('org f0')
+                    logging.info(f0[10:15])
+                    logging.info('rec f0')
+                    logging.info(cvf0_src[10:15])
+                    logging.info('cyc f0')
+                    logging.info(cvf0_cyc[10:15])
+                    logging.info('org cap')
+                    logging.info(codeap[10:15])
+                    logging.info('rec cap')
+                    logging.info(cvcodeap_src[10:15])
+                    logging.info('cyc cap')
+                    logging.info(cvcodeap_cyc[10:15])
+
+                    dataset = feat_file.split('/')[1].split('_')[0]
+                    if 'tr' in dataset:
+                        logging.info('trn')
+                        suffix = ""
+                    elif 'dv' in dataset:
+                        logging.info('dev')
+                        suffix = "_dv"
+                    else:
+                        suffix = None
+                    if suffix is not None:
+                        for name, cvmcep_, cvf0_, cvcodeap_, mcdpow_arr, mcd_arr in zip(["rec", "cyc"], [cvmcep_src, cvmcep_cyc], \
+                                [cvf0_src, cvf0_cyc], [cvcodeap_src, cvcodeap_cyc], mcdpow_frames, mcd_frames):
+                            metric_batch.append(name+suffix, os.path.basename(feat_file), args.spk, f0_ref=f0, f0_est=cvf0_, \
+                                codeap_ref=codeap, codeap_est=cvcodeap_, mcdpow_frames=mcdpow_arr, mcd_frames=mcd_arr, gv_est=cvmcep_)
+
+                    logging.info('write rec to h5')
+                    outh5dir = os.path.join(os.path.dirname(os.path.dirname(feat_file)), args.spk+"-"+args.spk)
+                    if not os.path.exists(outh5dir):
+                        os.makedirs(outh5dir)
+                    feat_file = os.path.join(outh5dir, os.path.basename(feat_file))
+                    logging.info(feat_file + ' ' + args.string_path)
+                    logging.info(feat_rec.shape)
+                    write_shard(shard_name, feat_file, args.string_path, feat_rec)
+
+                    logging.info('write cyc to h5')
+                    outh5dir = os.path.join(os.path.dirname(os.path.dirname(feat_file)), args.spk+"-"+args.spk+"-"+args.spk)
+                    if not os.path.exists(outh5dir):
+                        os.makedirs(outh5dir)
+                    feat_file = os.path.join(outh5dir, os.path.basename(feat_file))
+                    logging.info(feat_file + ' ' + args.string_path)
+                    logging.info(feat_cyc.shape)
+                    write_shard(shard_name, feat_file, args.string_path, feat_cyc)
+
+                    count += 1
+                    #if count >= 5:
+                    #    break
+            metric_batch.flush()
+            queue.put(metric_stats)
+
+
+    # reconstructed features are written to sidecar shards of each worker, then committed after all workers finish
+    shard_dir = os.path.join(args.outdir, "shards")
+    if os.path.exists(shard_dir):
+        for shard_name in find_files(shard_dir, "*.h5"):
+            os.remove(shard_name)
+    else:
+        os.makedirs(shard_dir)
 
     # parallel decode training
-    with mp.Manager() as manager:
-        gpu = 0
-        processes = []
-        cvlist = manager.list()
-        mcd_cvlist = manager.list()
-        mcdstd_cvlist = manager.list()
-        mcdpow_cvlist = manager.list()
-        mcdpowstd_cvlist = manager.list()
-        f0rmse_cvlist = manager.list()
-        f0corr_cvlist = manager.list()
-        caprmse_cvlist = manager.list()
-        cvlist_dv = manager.list()
-        mcd_cvlist_dv = manager.list()
-        mcdstd_cvlist_dv = manager.list()
-        mcdpow_cvlist_dv = manager.list()
-        mcdpowstd_cvlist_dv = manager.list()
-        f0rmse_cvlist_dv = manager.list()
-        f0corr_cvlist_dv = manager.list()
-        caprmse_cvlist_dv = manager.list()
-        cvlist_cyc = manager.list()
-        mcd_cvlist_cyc = manager.list()
-        mcdstd_cvlist_cyc = manager.list()
-        mcdpow_cvlist_cyc = manager.list()
-        mcdpowstd_cvlist_cyc = manager.list()
-        f0rmse_cvlist_cyc = manager.list()
-        f0corr_cvlist_cyc = manager.list()
-        caprmse_cvlist_cyc = manager.list()
-        cvlist_cyc_dv = manager.list()
-        mcd_cvlist_cyc_dv = manager.list()
-        mcdstd_cvlist_cyc_dv = manager.list()
-        mcdpow_cvlist_cyc_dv = manager.list()
-        mcdpowstd_cvlist_cyc_dv = manager.list()
-        f0rmse_cvlist_cyc_dv = manager.list()
-        f0corr_cvlist_cyc_dv = manager.list()
-        caprmse_cvlist_cyc_dv = manager.list()
-        for i, feat_list in enumerate(feat_lists):
-            logging.info(i)
-            p = mp.Process(target=gpu_decode, args=(feat_list, gpu, cvlist, mcdpow_cvlist, mcdpowstd_cvlist, \
-                                                    mcd_cvlist, mcdstd_cvlist, cvlist_dv, mcdpow_cvlist_dv, \
-                                                    mcdpowstd_cvlist_dv, mcd_cvlist_dv, mcdstd_cvlist_dv,\
-                                                    f0rmse_cvlist, f0corr_cvlist, caprmse_cvlist,\
-                                                    f0rmse_cvlist_dv, f0corr_cvlist_dv, caprmse_cvlist_dv,\
-                                                    cvlist_cyc, mcdpow_cvlist_cyc, mcdpowstd_cvlist_cyc, \
-                                                    mcd_cvlist_cyc, mcdstd_cvlist_cyc, cvlist_cyc_dv, mcdpow_cvlist_cyc_dv, \
-                                                    mcdpowstd_cvlist_cyc_dv, mcd_cvlist_cyc_dv, mcdstd_cvlist_cyc_dv,\
-                                                    f0rmse_cvlist_cyc, f0corr_cvlist_cyc, caprmse_cvlist_cyc,\
-                                                    f0rmse_cvlist_cyc_dv, f0corr_cvlist_cyc_dv, caprmse_cvlist_cyc_dv,))
-            p.start()
-            processes.append(p)
-            gpu += 1
-            if (i + 1) % args.n_gpus == 0:
-                gpu = 0
-        # wait for all process
-        for p in processes:
-            p.join()
-
-        # calculate cv_gv statistics
-        if len(mcdpow_cvlist) > 0:
-            logging.info("mcdpow_rec: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist)), \
-                        np.std(np.array(mcdpow_cvlist)),np.mean(np.array(mcdpowstd_cvlist)),\
-                        np.std(np.array(mcdpowstd_cvlist))))
-            logging.info("mcd_rec: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist)), \
-                        np.std(np.array(mcd_cvlist)),np.mean(np.array(mcdstd_cvlist)),\
-                        np.std(np.array(mcdstd_cvlist))))
-            cvgv_mean = np.mean(np.array(cvlist), axis=0)
-            cvgv_var = np.var(np.array(cvlist), axis=0)
-            logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean)))), \
-                                        np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean))))))
-            logging.info("f0rmse_rec: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist)),np.std(np.array(f0rmse_cvlist))))
-            logging.info("f0corr_rec: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist)),np.std(np.array(f0corr_cvlist))))
-            caprmse_cvlist = np.array(caprmse_cvlist)
-            for i in range(caprmse_cvlist.shape[-1]):
-                logging.info("caprmse-%d_rec: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist[:,i]),np.std(caprmse_cvlist[:,i])))
-            logging.info("mcdpow_cyc: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_cyc)), \
-                        np.std(np.array(mcdpow_cvlist_cyc)),np.mean(np.array(mcdpowstd_cvlist_cyc)),\
-                        np.std(np.array(mcdpowstd_cvlist_cyc))))
-            logging.info("mcd_cyc: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_cyc)), \
-                        np.std(np.array(mcd_cvlist_cyc)),np.mean(np.array(mcdstd_cvlist_cyc)),\
-                        np.std(np.array(mcdstd_cvlist_cyc))))
-            cvgv_mean = np.mean(np.array(cvlist_cyc), axis=0)
-            cvgv_var = np.var(np.array(cvlist_cyc), axis=0)
-            logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean)))), \
-                                        np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean))))))
-            logging.info("f0rmse_cyc: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_cyc)),np.std(np.array(f0rmse_cvlist_cyc))))
-            logging.info("f0corr_cyc: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_cyc)),np.std(np.array(f0corr_cvlist_cyc))))
-            caprmse_cvlist_cyc = np.array(caprmse_cvlist_cyc)
-            for i in range(caprmse_cvlist_cyc.shape[-1]):
-                logging.info("caprmse-%d_cyc: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist_cyc[:,i]),np.std(caprmse_cvlist_cyc[:,i])))
-
-            cvgv_mean = np.mean(np.array(np.r_[cvlist,cvlist_cyc]), axis=0)
-            cvgv_var = np.var(np.array(np.r_[cvlist,cvlist_cyc]), axis=0)
+    metric_stats = MetricStats()
+    for result in run_pool(worker_decode, longest_first(feat_list, feat_lengths, batch_size_utt), devices, load_models=load_models):
+        metric_stats.merge(result)
+
+    # commit sidecar shards to feature store
+    start = time.time()
+    n_commit = merge_shards(sorted(find_files(shard_dir, "*.h5")))
+    logging.info("commit %d datasets to feature store: %.3f sec" % (n_commit, time.time()-start))
+
+    # calculate cv_gv statistics
+    if metric_stats.count("rec", "mcdpow") > 0:
+        for group in ["rec", "cyc", ["rec", "cyc"]]:
+            if not isinstance(group, list):
+                metric_stats.log_summary(group)
+            cvgv_mean = metric_stats.summary(group)["gv"][0]
             logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean)))), \
                                         np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean))))))
 
-            string_path = model_name+"-"+str(config.detach)+"-"+str(config.n_half_cyc)+"-"+str(config.lat_dim)+"-"+str(config.ctr_size)\
-                            +"-"+str(config.spkidtr_dim)+"-"+str(config.ar_enc)+"-"+str(config.ar_dec)+"-"+str(config.ar_f0)+"-"+model_epoch
-            logging.info(string_path)
-
-            string_mean = "/recgv_mean_"+string_path
-            string_var = "/recgv_var_"+string_path
-            write_hdf5(spk_stat, string_mean, cvgv_mean)
-            write_hdf5(spk_stat, string_var, cvgv_var)
-
-        if len(mcdpow_cvlist_dv) > 0:
-            logging.info("mcdpow_rec_dv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_dv)), \
-                        np.std(np.array(mcdpow_cvlist_dv)),np.mean(np.array(mcdpowstd_cvlist_dv)),\
-                        np.std(np.array(mcdpowstd_cvlist_dv))))
-            logging.info("mcd_rec_dv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_dv)), \
-                        np.std(np.array(mcd_cvlist_dv)),np.mean(np.array(mcdstd_cvlist_dv)),\
-                        np.std(np.array(mcdstd_cvlist_dv))))
-            cvgv_mean = np.mean(np.array(cvlist_dv), axis=0)
-            cvgv_var = np.var(np.array(cvlist_dv), axis=0)
+    # update rec. GV statistics of the speaker with the moments of the decoded training utterances
+    gv_moments = merge_moments([gv_moments_prev, metric_stats.moments(["rec", "cyc"]).get("gv")])
+    if gv_moments is not None:
+        cvgv_mean, cvgv_var = moments_mean_var(gv_moments)
+        logging.info("rec. GV stats of %d utterances (%d new)" % (len(gv_files_prev)+len(gv_files), len(gv_files)))
+        string_mean = "/recgv_mean_"+string_path
+        string_var = "/recgv_var_"+string_path
+        write_hdf5(spk_stat, string_mean, cvgv_mean)
+        write_hdf5(spk_stat, string_var, cvgv_var)
+        for string_gv_, gv_moment in zip(string_gv, gv_moments):
+            write_hdf5(spk_stat, string_gv_, gv_moment)
+        write_hdf5(spk_stat, string_files, np.array(gv_files_prev+gv_files, dtype="S"))
+
+    if metric_stats.count("rec_dv", "mcdpow") > 0:
+        for group in ["rec_dv", "cyc_dv"]:
+            metric_stats.log_summary(group)
+            cvgv_mean = metric_stats.summary(group)["gv"][0]
             logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean)))), \
                                         np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean))))))
-            logging.info("f0rmse_rec_dv: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_dv)),np.std(np.array(f0rmse_cvlist_dv))))
-            logging.info("f0corr_rec_dv: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_dv)),np.std(np.array(f0corr_cvlist_dv))))
-            caprmse_cvlist_dv = np.array(caprmse_cvlist_dv)
-            for i in range(caprmse_cvlist.shape[-1]):
-                logging.info("caprmse-%d_rec_dv: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist_dv[:,i]),np.std(caprmse_cvlist_dv[:,i])))
-            logging.info("mcdpow_cyc_dv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_cyc_dv)), \
-                        np.std(np.array(mcdpow_cvlist_cyc_dv)),np.mean(np.array(mcdpowstd_cvlist_cyc_dv)),\
-                        np.std(np.array(mcdpowstd_cvlist_cyc_dv))))
-            logging.info("mcd_cyc_dv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_cyc_dv)), \
-                        np.std(np.array(mcd_cvlist_cyc_dv)),np.mean(np.array(mcdstd_cvlist_cyc_dv)),\
-                        np.std(np.array(mcdstd_cvlist_cyc_dv))))
-            cvgv_mean = np.mean(np.array(cvlist_cyc_dv), axis=0)
-            cvgv_var = np.var(np.array(cvlist_cyc_dv), axis=0)
-            logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean)))), \
-                                        np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean))))))
-            logging.info("f0rmse_cyc_dv: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_cyc_dv)),np.std(np.array(f0rmse_cvlist_cyc_dv))))
-            logging.info("f0corr_cyc_dv: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_cyc_dv)),np.std(np.array(f0corr_cvlist_cyc_dv))))
-            caprmse_cvlist_cyc_dv = np.array(caprmse_cvlist_cyc_dv)
-            for i in range(caprmse_cvlist_cyc_dv.shape[-1]):
-                logging.info("caprmse-%d_cyc_dv: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist_cyc_dv[:,i]),np.std(caprmse_cvlist_cyc_dv[:,i])))
+
+    metric_stats.write_json(os.path.join(args.outdir, "metrics.json"))
 
 
 if __name__ == "__main__":
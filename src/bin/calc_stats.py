@@ -18,6 +18,7 @@ from utils import check_hdf5
 from utils import read_hdf5
 from utils import read_txt
 from utils import write_hdf5
+from cpu_governor import govern_worker, partition_cores
 
 from multiprocessing import Array
 
@@ -38,6 +39,9 @@ def main():
     parser.add_argument(
         "--n_jobs", default=10,
         type=int, help="number of parallel jobs")
+    parser.add_argument(
+        "--cpus_per_job", default=None,
+        type=int, help="number of cpu cores (and compute threads) of each job (if None, the available cores are divided)")
     parser.add_argument(
         "--verbose", default=1,
         type=int, help="log message level")
@@ -70,6 +74,7 @@ def main():
     logging.info("number of training utterances = "+str(len(filenames)))
 
     def calc_stats(filenames, cpu, feat_mceplf0cap_list, feat_orglf0_list, varmcep_list, f0_list, melsp_list, varmelsp_list):
+        govern_worker(core_sets[cpu-1])
         feat_mceplf0cap_arr = None
         feat_orglf0_arr = None
         varmcep_arr = None
@@ -144,6 +149,9 @@ def main():
     for i in range(len(feat_lists)):
         logging.info("%d %d" % (i+1, len(feat_lists[i])))
 
+    # partition cpu cores across jobs to avoid oversubscription of compute threads
+    core_sets = partition_cores(len(feat_lists), cpus_per_job=args.cpus_per_job)
+
     # multi processing
     with mp.Manager() as manager:
         processes = []
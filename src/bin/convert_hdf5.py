@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import logging
+import numpy as np
+
+from utils import find_files
+from utils import read_txt
+from utils import convert_hdf5, read_hdf5_multi
+
+import h5py
+
+HDF5_DTYPE = "float32"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="converting existing feature files to float32/chunked/compressed hdf5 storage.")
+
+    parser.add_argument("--expdir", required=True,
+        type=str, help="directory to save the log")
+    parser.add_argument(
+        "--feats", required=True,
+        type=str, help="directory or list of hdf5 feature files")
+    parser.add_argument(
+        "--hdf5_dtype", default=HDF5_DTYPE,
+        type=str, help="storage dtype of floating-point features (float32 or float64)")
+    parser.add_argument(
+        "--chunk_frames", default=None,
+        type=int, help="number of frames per hdf5 chunk (if None, contiguous or auto-chunked with compression)")
+    parser.add_argument(
+        "--compression", default=None,
+        type=str, help="hdf5 compression filter (lzf or gzip)")
+    parser.add_argument(
+        "--n_jobs", default=10,
+        type=int, help="number of parallel jobs")
+    parser.add_argument(
+        "--verbose", default=1,
+        type=int, help="log message level")
+
+    args = parser.parse_args()
+
+    # set log level
+    if args.verbose == 1:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S',
+                            filename=args.expdir + "/convert_hdf5.log")
+        logging.getLogger().addHandler(logging.StreamHandler())
+    elif args.verbose > 1:
+        logging.basicConfig(level=logging.DEBUG,
+                            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S',
+                            filename=args.expdir + "/convert_hdf5.log")
+        logging.getLogger().addHandler(logging.StreamHandler())
+    else:
+        logging.basicConfig(level=logging.WARN,
+                            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S',
+                            filename=args.expdir + "/convert_hdf5.log")
+        logging.getLogger().addHandler(logging.StreamHandler())
+        logging.warn("logging is disabled.")
+
+    # read list
+    if os.path.isdir(args.feats):
+        file_list = sorted(find_files(args.feats, "*.h5"))
+    elif os.path.isfile(args.feats):
+        file_list = read_txt(args.feats)
+    else:
+        logging.error("--feats should be directory or list.")
+        sys.exit(1)
+
+    def read_all(hdf5_name):
+        hdf5_paths = []
+        with h5py.File(hdf5_name, "r") as hdf5_file:
+            hdf5_file.visititems(lambda name, obj: hdf5_paths.append(name) if isinstance(obj, h5py.Dataset) else None)
+        return read_hdf5_multi(hdf5_name, hdf5_paths)
+
+    def convert(cpu, hdf5_list, arr):
+        size_org = 0
+        size_cv = 0
+        read_time_org = 0
+        read_time_cv = 0
+        conv_time = 0
+        for hdf5_name in hdf5_list:
+            start = time.time()
+            read_all(hdf5_name)
+            read_time_org += time.time() - start
+
+            start = time.time()
+            size_org_, size_cv_ = convert_hdf5(hdf5_name, dtype=np.dtype(args.hdf5_dtype), \
+                                    chunk_frames=args.chunk_frames, compression=args.compression)
+            conv_time += time.time() - start
+            size_org += size_org_
+            size_cv += size_cv_
+
+            start = time.time()
+            read_all(hdf5_name)
+            read_time_cv += time.time() - start
+            logging.info("cpu-%d %s %d --> %d bytes" % (cpu+1, hdf5_name, size_org_, size_cv_))
+        arr[0] += len(hdf5_list)
+        arr[1] += size_org
+        arr[2] += size_cv
+        arr[3] += read_time_org
+        arr[4] += read_time_cv
+        arr[5] += conv_time
+
+    # divie list
+    file_lists = np.array_split(file_list, args.n_jobs)
+    file_lists = [f_list.tolist() for f_list in file_lists]
+
+    # multi processing
+    processes = []
+    arr = mp.Array('d', 6)
+    for i, f in enumerate(file_lists):
+        p = mp.Process(target=convert, args=(i, f, arr,))
+        p.start()
+        processes.append(p)
+
+    # wait for all process
+    for p in processes:
+        p.join()
+
+    # disk footprint and read/write throughput
+    logging.info("number of files = %d" % (arr[0]))
+    logging.info("disk footprint = %.3f MB --> %.3f MB (%.2f %%)" % (arr[1]/1e6, arr[2]/1e6, 100*arr[2]/max(arr[1], 1)))
+    logging.info("read throughput = %.3f MB/s --> %.3f MB/s (%.6f --> %.6f sec / file)" % (arr[1]/1e6/max(arr[3], 1e-9), \
+                    arr[2]/1e6/max(arr[4], 1e-9), arr[3]/max(arr[0], 1), arr[4]/max(arr[0], 1)))
+    logging.info("convert time = %.6f sec / file" % (arr[5]/max(arr[0], 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,9 +29,11 @@ from utils import write_hdf5
 
 import soundfile as sf
 
-from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER
+from vcneuvoco import GRU_VAE_ENCODER, GRU_VAE_ENCODER_PAIR, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, freeze_model
 from feature_extract import convert_f0, convert_continuos_f0, low_pass_filter, mod_pow
 from dtw_c import dtw_c as dtw
+from metrics import MetricBatch, MetricStats
+from decode_pool import worker_devices, device_scope, file_lengths, longest_first, run_pool
 
 import pysptk as ps
 import pyworld as pw
@@ -72,8 +74,15 @@ def main():
                         type=str, help="speaker target")
     parser.add_argument("--n_gpus", default=N_GPUS,
                         type=int, help="number of gpus")
+    parser.add_argument("--n_cpu_workers", default=0,
+        type=int, help="number of cpu decoding workers (pinned to disjoint core sets) in addition to gpu workers")
+    parser.add_argument("--cpus_per_job", default=None,
+        type=int, help="number of cpu cores (and compute threads) of each decoding worker (if None, the available cores are divided)")
     parser.add_argument("--string_path", required=True,
                         type=str, help="directory to save generated samples")
+    parser.add_argument("--fuse_enc", default=None,
+                        type=strtobool, help="run mcep and excit. encoders as one fused encoder (if not autoregressive/bidirectional), "\
+                            "if None only on gpu workers, as it is not faster on cpu")
     # other setting
     parser.add_argument("--n_interp", default=0,
                         type=int, help="number of interpolation points if using cont. spk-code (if 0, just rec. and cv.)")
@@ -173,111 +182,124 @@ def main():
             gv_mean_trgs.append(read_hdf5(stats_list[i], "/gv_range_mean")[1:])
             cvgv_means.append(read_hdf5(stats_list[i], "/gv_range_mean")[1:])
 
-    # prepare the file list for parallel decoding
-    feat_lists = np.array_split(feat_list, args.n_gpus)
-    feat_lists = [f_list.tolist() for f_list in feat_lists]
-    for i in range(args.n_gpus):
-        logging.info('gpu: %d'+str(i+1)+' : '+str(len(feat_lists[i])))
+    # decoding workers on gpus and/or cpu core sets, pulling utterances from a central queue longest-first
+    devices = worker_devices(args.n_gpus, args.n_cpu_workers, cpus_per_job=args.cpus_per_job)
+    feat_lengths = file_lengths(feat_list, config.string_path)
 
     ### GRU-RNN decoding ###
     logging.info(config)
-    def decode_RNN(feat_list, gpu, cvlist=None,
-            mcd_cvlist_src=None, mcdstd_cvlist_src=None, mcdpow_cvlist_src=None, mcdpowstd_cvlist_src=None,\
-            f0rmse_cvlist_src=None, f0corr_cvlist_src=None, caprmse_cvlist_src=None,\
-            mcd_cvlist_cyc=None, mcdstd_cvlist_cyc=None, mcdpow_cvlist_cyc=None, mcdpowstd_cvlist_cyc=None,\
-            f0rmse_cvlist_cyc=None, f0corr_cvlist_cyc=None, caprmse_cvlist_cyc=None,\
-            f0rmse_cvlist_cv=None, f0corr_cvlist_cv=None, \
-            mcd_cvlist=None, mcdstd_cvlist=None, mcdpow_cvlist=None, mcdpowstd_cvlist=None, \
-            lat_dist_rmse_list=None, lat_dist_cosim_list=None):
-        with torch.cuda.device(gpu):
-            # define model and load parameters
+    # define models and load parameters on a device
+    def load_models(device):
+        with torch.no_grad():
+            model_encoder_mcep = GRU_VAE_ENCODER(
+                in_dim=config.mcep_dim+config.excit_dim,
+                n_spk=n_spk,
+                lat_dim=config.lat_dim,
+                hidden_layers=config.hidden_layers_enc,
+                hidden_units=config.hidden_units_enc,
+                kernel_size=config.kernel_size_enc,
+                dilation_size=config.dilation_size_enc,
+                causal_conv=config.causal_conv_enc,
+                bi=config.bi_enc,
+                pad_first=True,
+                ar=config.ar_enc)
+            logging.info(model_encoder_mcep)
+            model_decoder_mcep = GRU_SPEC_DECODER(
+                feat_dim=config.lat_dim,
+                out_dim=config.mcep_dim,
+                n_spk=n_spk,
+                hidden_layers=config.hidden_layers_dec,
+                hidden_units=config.hidden_units_dec,
+                kernel_size=config.kernel_size_dec,
+                dilation_size=config.dilation_size_dec,
+                causal_conv=config.causal_conv_dec,
+                bi=config.bi_dec,
+                spkidtr_dim=config.spkidtr_dim,
+                pad_first=True,
+                diff=config.diff,
+                ar=config.ar_dec)
+            logging.info(model_decoder_mcep)
+            model_encoder_excit = GRU_VAE_ENCODER(
+                in_dim=config.mcep_dim+config.excit_dim,
+                n_spk=n_spk,
+                lat_dim=config.lat_dim,
+                hidden_layers=config.hidden_layers_enc,
+                hidden_units=config.hidden_units_enc,
+                kernel_size=config.kernel_size_enc,
+                dilation_size=config.dilation_size_enc,
+                causal_conv=config.causal_conv_enc,
+                bi=config.bi_enc,
+                pad_first=True,
+                ar=config.ar_enc)
+            logging.info(model_encoder_excit)
+            model_decoder_excit = GRU_EXCIT_DECODER(
+                feat_dim=config.lat_dim,
+                cap_dim=config.cap_dim,
+                n_spk=n_spk,
+                hidden_layers=config.hidden_layers_dec,
+                hidden_units=config.hidden_units_dec,
+                kernel_size=config.kernel_size_dec,
+                dilation_size=config.dilation_size_dec,
+                causal_conv=config.causal_conv_dec,
+                bi=config.bi_dec,
+                spkidtr_dim=config.spkidtr_dim,
+                pad_first=True,
+                ar=config.ar_dec)
+            logging.info(model_decoder_excit)
+            checkpoint = torch.load(args.model, map_location="cpu")
+            if checkpoint.get("frozen", False):
+                # frozen model of freeze_model.py
+                for model in [model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit]:
+                    freeze_model(model)
+            model_encoder_mcep.load_state_dict(checkpoint["model_encoder_mcep"])
+            model_decoder_mcep.load_state_dict(checkpoint["model_decoder_mcep"])
+            model_encoder_excit.load_state_dict(checkpoint["model_encoder_excit"])
+            model_decoder_excit.load_state_dict(checkpoint["model_decoder_excit"])
+            model_encoder_mcep.to(device)
+            model_decoder_mcep.to(device)
+            model_encoder_excit.to(device)
+            model_decoder_excit.to(device)
+            model_encoder_mcep.eval()
+            model_decoder_mcep.eval()
+            model_encoder_excit.eval()
+            model_decoder_excit.eval()
+            for param in model_encoder_mcep.parameters():
+                param.requires_grad = False
+            for param in model_decoder_mcep.parameters():
+                param.requires_grad = False
+            for param in model_encoder_excit.parameters():
+                param.requires_grad = False
+            for param in model_decoder_excit.parameters():
+                param.requires_grad = False
+            model_decoder_mcep.precompute_spk_table()
+            model_decoder_excit.precompute_spk_table()
+            model_encoder_pair = GRU_VAE_ENCODER_PAIR(model_encoder_mcep, model_encoder_excit, \
+                                    fuse=args.fuse_enc if args.fuse_enc is not None else device.type == "cuda")
+            logging.info("fused mcep/excit encoders: %s" % (model_encoder_pair.fused))
+            model_encoder_pair.to(device)
+            model_encoder_pair.eval()
+        return model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_encoder_pair
+
+    def decode_RNN(feat_list, device, queue=None, models=None):
+        metric_stats = MetricStats()
+        metric_batch = MetricBatch(metric_stats)
+        with device_scope(device):
+            # models are loaded once per worker, or shared by the cpu workers
+            if models is None:
+                models = load_models(device)
+            model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_encoder_pair = models
             with torch.no_grad():
-                model_encoder_mcep = GRU_VAE_ENCODER(
-                    in_dim=config.mcep_dim+config.excit_dim,
-                    n_spk=n_spk,
-                    lat_dim=config.lat_dim,
-                    hidden_layers=config.hidden_layers_enc,
-                    hidden_units=config.hidden_units_enc,
-                    kernel_size=config.kernel_size_enc,
-                    dilation_size=config.dilation_size_enc,
-                    causal_conv=config.causal_conv_enc,
-                    bi=config.bi_enc,
-                    pad_first=True,
-                    ar=config.ar_enc)
-                logging.info(model_encoder_mcep)
-                model_decoder_mcep = GRU_SPEC_DECODER(
-                    feat_dim=config.lat_dim,
-                    out_dim=config.mcep_dim,
-                    n_spk=n_spk,
-                    hidden_layers=config.hidden_layers_dec,
-                    hidden_units=config.hidden_units_dec,
-                    kernel_size=config.kernel_size_dec,
-                    dilation_size=config.dilation_size_dec,
-                    causal_conv=config.causal_conv_dec,
-                    bi=config.bi_dec,
-                    spkidtr_dim=config.spkidtr_dim,
-                    pad_first=True,
-                    diff=config.diff,
-                    ar=config.ar_dec)
-                logging.info(model_decoder_mcep)
-                model_encoder_excit = GRU_VAE_ENCODER(
-                    in_dim=config.mcep_dim+config.excit_dim,
-                    n_spk=n_spk,
-                    lat_dim=config.lat_dim,
-                    hidden_layers=config.hidden_layers_enc,
-                    hidden_units=config.hidden_units_enc,
-                    kernel_size=config.kernel_size_enc,
-                    dilation_size=config.dilation_size_enc,
-                    causal_conv=config.causal_conv_enc,
-                    bi=config.bi_enc,
-                    pad_first=True,
-                    ar=config.ar_enc)
-                logging.info(model_encoder_excit)
-                model_decoder_excit = GRU_EXCIT_DECODER(
-                    feat_dim=config.lat_dim,
-                    cap_dim=config.cap_dim,
-                    n_spk=n_spk,
-                    hidden_layers=config.hidden_layers_dec,
-                    hidden_units=config.hidden_units_dec,
-                    kernel_size=config.kernel_size_dec,
-                    dilation_size=config.dilation_size_dec,
-                    causal_conv=config.causal_conv_dec,
-                    bi=config.bi_dec,
-                    spkidtr_dim=config.spkidtr_dim,
-                    pad_first=True,
-                    ar=config.ar_dec)
-                logging.info(model_decoder_excit)
-                model_encoder_mcep.load_state_dict(torch.load(args.model)["model_encoder_mcep"])
-                model_decoder_mcep.load_state_dict(torch.load(args.model)["model_decoder_mcep"])
-                model_encoder_excit.load_state_dict(torch.load(args.model)["model_encoder_excit"])
-                model_decoder_excit.load_state_dict(torch.load(args.model)["model_decoder_excit"])
-                model_encoder_mcep.cuda()
-                model_decoder_mcep.cuda()
-                model_encoder_excit.cuda()
-                model_decoder_excit.cuda()
-                model_encoder_mcep.eval()
-                model_decoder_mcep.eval()
-                model_encoder_excit.eval()
-                model_decoder_excit.eval()
-                for param in model_encoder_mcep.parameters():
-                    param.requires_grad = False
-                for param in model_decoder_mcep.parameters():
-                    param.requires_grad = False
-                for param in model_encoder_excit.parameters():
-                    param.requires_grad = False
-                for param in model_decoder_excit.parameters():
-                    param.requires_grad = False
                 if config.ar_enc:
-                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim*2)).cuda()
-                    yz_in_e = torch.zeros((1, 1, n_spk+config.lat_dim_e*2)).cuda()
+                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim*2)).to(device)
+                    yz_in_e = torch.zeros((1, 1, n_spk+config.lat_dim_e*2)).to(device)
                 if config.ar_dec or config.ar_f0:
                     mean_stats = torch.FloatTensor(read_hdf5(config.stats, "/mean_"+config.string_path.replace("/","")))
                     scale_stats = torch.FloatTensor(read_hdf5(config.stats, "/scale_"+config.string_path.replace("/","")))
                 if config.ar_dec:
-                    x_in = ((torch.zeros((1, 1, config.mcep_dim))-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]).cuda()
+                    x_in = ((torch.zeros((1, 1, config.mcep_dim))-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]).to(device)
                 if config.ar_f0:
                     e_in = torch.cat((torch.zeros(1,1,1), (torch.zeros(1,1,1)-mean_stats[1:2])/scale_stats[1:2], \
-                                    torch.zeros(1,1,1), (torch.zeros(1,1,config.cap_dim)-mean_stats[3:config.excit_dim])/scale_stats[3:config.excit_dim]), 2).cuda()
+                                    torch.zeros(1,1,1), (torch.zeros(1,1,config.cap_dim)-mean_stats[3:config.excit_dim])/scale_stats[3:config.excit_dim]), 2).to(device)
             fs = args.fs
             fft_size = args.fftl
             mcep_dim = model_decoder_mcep.out_dim-1
@@ -285,7 +307,7 @@ def main():
 
             # interpolated spk-code
             if args.n_interp > 0:
-                feat = torch.LongTensor(np.arange(n_spk)).cuda().unsqueeze(0)
+                feat = torch.LongTensor(np.arange(n_spk)).to(device).unsqueeze(0)
                 logging.info(feat)
                 z = model_decoder_mcep.spkidtr_conv(F.one_hot(feat, num_classes=n_spk).float().transpose(1,2)).transpose(1,2)
                 z_e = model_decoder_excit.spkidtr_conv(F.one_hot(feat, num_classes=n_spk).float().transpose(1,2)).transpose(1,2)
@@ -348,14 +370,13 @@ def main():
 
                 logging.info("generate")
                 with torch.no_grad():
-                    feat = F.pad(torch.FloatTensor(feat).cuda().unsqueeze(0).transpose(1,2), (pad_left,pad_right), "replicate").transpose(1,2)
+                    feat = F.pad(torch.FloatTensor(feat).to(device).unsqueeze(0).transpose(1,2), (pad_left,pad_right), "replicate").transpose(1,2)
 
                     if config.ar_enc:
                         spk_logits, _, lat_src, _, _ = model_encoder_mcep(feat, yz_in=yz_in, sampling=False)
                         spk_logits_e, _, lat_src_e, _, _ = model_encoder_excit(feat, yz_in=yz_in, sampling=False)
                     else:
-                        spk_logits, _, lat_src, _ = model_encoder_mcep(feat, sampling=False)
-                        spk_logits_e, _, lat_src_e, _ = model_encoder_excit(feat, sampling=False)
+                        (spk_logits, _, lat_src, _), (spk_logits_e, _, lat_src_e, _) = model_encoder_pair(feat, sampling=False)
                     logging.info('input spkpost')
                     if outpad_rights[0] > 0:
                         logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[0]:-outpad_rights[0]], dim=-1), 1))
@@ -369,14 +390,12 @@ def main():
 
                     if trg_exist:
                         if config.ar_enc:
-                            spk_trg_logits, _, lat_trg, _, _ = model_encoder_mcep(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), \
+                            spk_trg_logits, _, lat_trg, _, _ = model_encoder_mcep(F.pad(torch.FloatTensor(feat_trg).to(device).unsqueeze(0).transpose(1,2), \
                                                                             (model_encoder_mcep.pad_left,model_encoder_mcep.pad_right), "replicate").transpose(1,2), yz_in=yz_in, sampling=False)
-                            spk_trg_logits_e, _, lat_trg_e, _, _ = model_encoder_mcep(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), \
+                            spk_trg_logits_e, _, lat_trg_e, _, _ = model_encoder_excit(F.pad(torch.FloatTensor(feat_trg).to(device).unsqueeze(0).transpose(1,2), \
                                                                             (model_encoder_mcep.pad_left,model_encoder_mcep.pad_right), "replicate").transpose(1,2), yz_in=yz_in, sampling=False)
                         else:
-                            spk_trg_logits, _, lat_trg, _ = model_encoder_excit(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), \
-                                                                            (model_encoder_mcep.pad_left,model_encoder_mcep.pad_right), "replicate").transpose(1,2), sampling=False)
-                            spk_trg_logits_e, _, lat_trg_e, _ = model_encoder_excit(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), \
+                            (spk_trg_logits, _, lat_trg, _), (spk_trg_logits_e, _, lat_trg_e, _) = model_encoder_pair(F.pad(torch.FloatTensor(feat_trg).to(device).unsqueeze(0).transpose(1,2), \
                                                                             (model_encoder_mcep.pad_left,model_encoder_mcep.pad_right), "replicate").transpose(1,2), sampling=False)
                         logging.info('target spkpost')
                         logging.info(torch.mean(F.softmax(spk_trg_logits, dim=-1), 1))
@@ -384,12 +403,12 @@ def main():
                         logging.info(torch.mean(F.softmax(spk_trg_logits_e, dim=-1), 1))
 
                     if args.n_interp == 0: # if just reconstructed and conversion
-                        src_code = (torch.ones((1, lat_src.shape[1]))*src_idx).cuda().long()
+                        src_code = (torch.ones((1, lat_src.shape[1]))*src_idx).to(device).long()
                         if config.ar_dec:
                             cvmcep_src, _, _ = model_decoder_mcep(src_code, lat_src, x_in=x_in)
                         else:
                             cvmcep_src, _ = model_decoder_mcep(src_code, lat_src)
-                        src_code = (torch.ones((1, lat_src_e.shape[1]))*src_idx).cuda().long()
+                        src_code = (torch.ones((1, lat_src_e.shape[1]))*src_idx).to(device).long()
                         if config.ar_f0:
                             cvlf0_src, _, _ = model_decoder_excit(src_code, lat_src_e, e_in=e_in)
                         else:
@@ -400,8 +419,7 @@ def main():
                             spk_logits, _, lat_rec, _, _ = model_encoder_mcep(cv_feat, yz_in=yz_in, sampling=False)
                             spk_logits_e, _, lat_rec_e, _, _ = model_encoder_excit(cv_feat, yz_in=yz_in, sampling=False)
                         else:
-                            spk_logits, _, lat_rec, _ = model_encoder_mcep(cv_feat, sampling=False)
-                            spk_logits_e, _, lat_rec_e, _ = model_encoder_excit(cv_feat, sampling=False)
+                            (spk_logits, _, lat_rec, _), (spk_logits_e, _, lat_rec_e, _) = model_encoder_pair(cv_feat, sampling=False)
                         if outpad_rights[2] > 0:
                             logging.info('rec spkpost')
                             logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:-outpad_rights[2]], dim=-1), 1))
@@ -413,12 +431,12 @@ def main():
                             logging.info('rec spkpost_e')
                             logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[2]:], dim=-1), 1))
 
-                        trg_code = (torch.ones((1, lat_src.shape[1]))*trg_idx).cuda().long()
+                        trg_code = (torch.ones((1, lat_src.shape[1]))*trg_idx).to(device).long()
                         if config.ar_dec:
                             cvmcep, _, _ = model_decoder_mcep(trg_code, lat_src, x_in=x_in)
                         else:
                             cvmcep, _ = model_decoder_mcep(trg_code, lat_src)
-                        trg_code = (torch.ones((1, lat_src_e.shape[1]))*trg_idx).cuda().long()
+                        trg_code = (torch.ones((1, lat_src_e.shape[1]))*trg_idx).to(device).long()
                         if config.ar_f0:
                             cvlf0, _, _ = model_decoder_excit(trg_code, lat_src_e, e_in=e_in)
                         else:
@@ -429,8 +447,7 @@ def main():
                             spk_logits, _, lat_cv, _, _ = model_encoder_mcep(cv_feat, yz_in=yz_in, sampling=False)
                             spk_logits_e, _, lat_cv_e, _, _ = model_encoder_excit(cv_feat, yz_in=yz_in, sampling=False)
                         else:
-                            spk_logits, _, lat_cv, _ = model_encoder_mcep(cv_feat, sampling=False)
-                            spk_logits_e, _, lat_cv_e, _ = model_encoder_excit(cv_feat, sampling=False)
+                            (spk_logits, _, lat_cv, _), (spk_logits_e, _, lat_cv_e, _) = model_encoder_pair(cv_feat, sampling=False)
                         if outpad_rights[2] > 0:
                             logging.info('cv spkpost')
                             logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:-outpad_rights[2]], dim=-1), 1))
@@ -442,12 +459,12 @@ def main():
                             logging.info('cv spkpost_e')
                             logging.info(torch.mean(F.softmax(spk_logits_e[:,outpad_lefts[2]:], dim=-1), 1))
 
-                        src_code = (torch.ones((1, lat_cv.shape[1]))*src_idx).cuda().long()
+                        src_code = (torch.ones((1, lat_cv.shape[1]))*src_idx).to(device).long()
                         if config.ar_dec:
                             cvmcep_cyc, _, _ = model_decoder_mcep(src_code, lat_cv, x_in=x_in)
                         else:
                             cvmcep_cyc, _ = model_decoder_mcep(src_code, lat_cv)
-                        src_code = (torch.ones((1, lat_cv_e.shape[1]))*src_idx).cuda().long()
+                        src_code = (torch.ones((1, lat_cv_e.shape[1]))*src_idx).to(device).long()
                         if config.ar_f0:
                             cvlf0_cyc, _, _ = model_decoder_excit(src_code, lat_cv_e, e_in=e_in)
                         else:
@@ -639,37 +656,15 @@ def main():
                     logging.info(lat_src.shape)
                     logging.info(lat_trg.shape)
  
-                cvlist.append(np.var(cvmcep[:,1:], axis=0))
+                metric_batch.append("cv", os.path.basename(feat_file), spk_src, gv_est=cvmcep)
 
                 cvf0_src = np.array(np.rint(cvlf0_src[:,0])*np.exp(cvlf0_src[:,1]))
                 cvcodeap_src = np.array(np.rint(cvlf0_src[:,2:3])*(-np.exp(cvlf0_src[:,3:])))
-                f0_rmse = np.sqrt(np.mean((cvf0_src-f0)**2))
-                logging.info('F0_rmse: %lf Hz' % (f0_rmse))
-                f0rmse_cvlist_src.append(f0_rmse)
-                cvf0_src_mean = np.mean(cvf0_src)
-                f0_mean = np.mean(f0)
-                f0_corr = np.sum((cvf0_src-cvf0_src_mean)*(f0-f0_mean))/(np.sqrt(np.sum((cvf0_src-cvf0_src_mean)**2))*np.sqrt(np.sum((f0-f0_mean)**2)))
-                logging.info('F0_corr: %lf' % (f0_corr))
-                f0corr_cvlist_src.append(f0_corr)
-                codeap_rmse = np.sqrt(np.mean((cvcodeap_src-codeap)**2, axis=0))
-                for i in range(codeap_rmse.shape[-1]):
-                    logging.info('codeap-%d_rmse: %lf dB' % (i+1, codeap_rmse[i]))
-                caprmse_cvlist_src.append(codeap_rmse)
-
                 cvf0_cyc = np.array(np.rint(cvlf0_cyc[:,0])*np.exp(cvlf0_cyc[:,1]))
                 cvcodeap_cyc = np.array(np.rint(cvlf0_cyc[:,2:3])*(-np.exp(cvlf0_cyc[:,3:])))
-                f0_rmse = np.sqrt(np.mean((cvf0_cyc-f0)**2))
-                logging.info('F0_rmse_cyc: %lf Hz' % (f0_rmse))
-                f0rmse_cvlist_cyc.append(f0_rmse)
-                cvf0_cyc_mean = np.mean(cvf0_cyc)
-                f0_mean = np.mean(f0)
-                f0_corr = np.sum((cvf0_cyc-cvf0_cyc_mean)*(f0-f0_mean))/(np.sqrt(np.sum((cvf0_cyc-cvf0_cyc_mean)**2))*np.sqrt(np.sum((f0-f0_mean)**2)))
-                logging.info('F0_corr_cyc: %lf' % (f0_corr))
-                f0corr_cvlist_cyc.append(f0_corr)
-                codeap_rmse = np.sqrt(np.mean((cvcodeap_cyc-codeap)**2, axis=0))
-                for i in range(codeap_rmse.shape[-1]):
-                    logging.info('codeap-%d_rmse_cyc: %lf dB' % (i+1, codeap_rmse[i]))
-                caprmse_cvlist_cyc.append(codeap_rmse)
+                for group, cvf0_, cvcodeap_ in [("src_cv", cvf0_src, cvcodeap_src), ("cyc_cv", cvf0_cyc, cvcodeap_cyc)]:
+                    metric_batch.append(group, os.path.basename(feat_file), spk_src, f0_ref=f0, f0_est=cvf0_, codeap_ref=codeap, \
+                        codeap_est=cvcodeap_)
 
                 cvf0 = np.array(np.rint(cvlf0[:,0])*np.exp(cvlf0[:,1]))
                 cvcodeap = np.array(np.rint(cvlf0[:,2:3])*(-np.exp(cvlf0[:,3:])))
@@ -715,14 +710,7 @@ def main():
                 uv_range_lin = np.expand_dims(uv_range_lin, axis=-1)
                 cont_f0_lpf_range_lin = np.expand_dims(cont_f0_lpf_range_lin, axis=-1)
 
-                f0_rmse = np.sqrt(np.mean((cvf0-cvf0_lin)**2))
-                logging.info('F0_rmse_cv: %lf Hz' % (f0_rmse))
-                f0rmse_cvlist_cv.append(f0_rmse)
-                cvf0_mean = np.mean(cvf0)
-                f0_mean = np.mean(cvf0_lin)
-                f0_corr = np.sum((cvf0-cvf0_mean)*(cvf0_lin-f0_mean))/(np.sqrt(np.sum((cvf0-cvf0_mean)**2))*np.sqrt(np.sum((cvf0_lin-f0_mean)**2)))
-                logging.info('F0_corr_cv: %lf' % (f0_corr))
-                f0corr_cvlist_cv.append(f0_corr)
+                metric_batch.append("cv", os.path.basename(feat_file), spk_src, f0_ref=cvf0_lin, f0_est=cvf0)
 
                 #if trg_exist:
                 #    figname = os.path.join(args.outdir, os.path.basename(feat_file).replace(".h5","_f0.png"))
@@ -755,18 +743,7 @@ def main():
 
                 spcidx = np.array(read_hdf5(feat_file, "/spcidx_range")[0])
 
-                _, mcdpow_arr = dtw.calc_mcd(np.array(mcep[spcidx], dtype=np.float64), np.array(cvmcep_src[spcidx], dtype=np.float64))
-                _, mcd_arr = dtw.calc_mcd(np.array(mcep[spcidx,1:], dtype=np.float64), np.array(cvmcep_src[spcidx,1:], dtype=np.float64))
-                mcdpow_mean = np.mean(mcdpow_arr)
-                mcdpow_std = np.std(mcdpow_arr)
-                mcd_mean = np.mean(mcd_arr)
-                mcd_std = np.std(mcd_arr)
-                logging.info("mcdpow_src_cv: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                logging.info("mcd_src_cv: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                mcdpow_cvlist_src.append(mcdpow_mean)
-                mcdpowstd_cvlist_src.append(mcdpow_std)
-                mcd_cvlist_src.append(mcd_mean)
-                mcdstd_cvlist_src.append(mcd_std)
+                metric_batch.append("src_cv", os.path.basename(feat_file), spk_src, mcep_ref=mcep[spcidx], mcep_est=cvmcep_src[spcidx])
 
                 if trg_exist:
                     spcidx_trg = np.array(read_hdf5(file_trg, "/spcidx_range")[0])
@@ -774,19 +751,9 @@ def main():
                                                 dtype=np.float64), np.array(mcep_trg[spcidx_trg], dtype=np.float64))
                     _, _, _, mcd_arr = dtw.dtw_org_to_trg(np.array(cvmcep[spcidx,1:], \
                                                 dtype=np.float64), np.array(mcep_trg[spcidx_trg,1:], dtype=np.float64))
-                    mcdpow_mean = np.mean(mcdpow_arr)
-                    mcdpow_std = np.std(mcdpow_arr)
-                    mcd_mean = np.mean(mcd_arr)
-                    mcd_std = np.std(mcd_arr)
-                    logging.info("mcdpow_trg: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                    logging.info("mcd_trg: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                    mcdpow_cvlist.append(mcdpow_mean)
-                    mcdpowstd_cvlist.append(mcdpow_std)
-                    mcd_cvlist.append(mcd_mean)
-                    mcdstd_cvlist.append(mcd_std)
-
-                    spcidx_src = torch.LongTensor(spcidx).cuda()
-                    spcidx_trg = torch.LongTensor(spcidx_trg).cuda()
+
+                    spcidx_src = torch.LongTensor(spcidx).to(device)
+                    spcidx_trg = torch.LongTensor(spcidx_trg).to(device)
 
                     trj_lat_src = np.array(torch.index_select(lat_src[0],0,spcidx_src).cpu().data.numpy(), dtype=np.float64)
                     trj_lat_trg = np.array(torch.index_select(lat_trg[0],0,spcidx_trg).cpu().data.numpy(), dtype=np.float64)
@@ -799,22 +766,11 @@ def main():
                     logging.info("%lf %lf %lf %lf" % (lat_dist_srctrg, lat_cdist_srctrg, lat_dist_trgsrc, lat_cdist_trgsrc))
                     lat_dist_rmse = (lat_dist_srctrg+lat_dist_trgsrc)/2
                     lat_dist_cosim = (lat_cdist_srctrg+lat_cdist_trgsrc)/2
-                    lat_dist_rmse_list.append(lat_dist_rmse)
-                    lat_dist_cosim_list.append(lat_dist_cosim)
+                    metric_batch.append("cv", os.path.basename(feat_file), spk_src, metrics={"lat_dist_rmse": lat_dist_rmse, \
+                        "lat_dist_cosim": lat_dist_cosim}, mcdpow_frames=mcdpow_arr, mcd_frames=mcd_arr)
                     logging.info("lat_dist: %.6f %.6f" % (lat_dist_rmse, lat_dist_cosim))
 
-                _, mcdpow_arr = dtw.calc_mcd(np.array(mcep[spcidx], dtype=np.float64), np.array(cvmcep_cyc[spcidx], dtype=np.float64))
-                _, mcd_arr = dtw.calc_mcd(np.array(mcep[spcidx,1:], dtype=np.float64), np.array(cvmcep_cyc[spcidx,1:], dtype=np.float64))
-                mcdpow_mean = np.mean(mcdpow_arr)
-                mcdpow_std = np.std(mcdpow_arr)
-                mcd_mean = np.mean(mcd_arr)
-                mcd_std = np.std(mcd_arr)
-                logging.info("mcdpow_cyc_cv: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                logging.info("mcd_cyc_cv: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                mcdpow_cvlist_cyc.append(mcdpow_mean)
-                mcdpowstd_cvlist_cyc.append(mcdpow_std)
-                mcd_cvlist_cyc.append(mcd_mean)
-                mcdstd_cvlist_cyc.append(mcd_std)
+                metric_batch.append("cyc_cv", os.path.basename(feat_file), spk_src, mcep_ref=mcep[spcidx], mcep_est=cvmcep_cyc[spcidx])
 
                 logging.info('org f0')
                 logging.info(f0[10:15])
@@ -1032,89 +988,26 @@ def main():
                 count += 1
                 #if count >= 5:
                 #    break
+            metric_batch.flush()
+            queue.put(metric_stats)
+
+
+    logging.info("GRU-RNN decoding")
+    metric_stats = MetricStats()
+    for result in run_pool(decode_RNN, longest_first(feat_list, feat_lengths), devices, load_models=load_models):
+        metric_stats.merge(result)
+
+    # calculate statistics
+    logging.info("== summary rec. acc. ==")
+    metric_stats.log_summary("src_cv")
+    logging.info("=== summary cyc. acc. ===")
+    metric_stats.log_summary("cyc_cv")
+    logging.info("=== summary cv. acc. ===")
+    cvgv_mean = metric_stats.summary("cv")["gv"][0]
+    logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg)))), np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg))))))
+    metric_stats.log_summary("cv")
+    metric_stats.write_json(os.path.join(args.outdir, "metrics.json"))
 
 
-    with mp.Manager() as manager:
-        logging.info("GRU-RNN decoding")
-        processes = []
-        cvlist = manager.list()
-        mcd_cvlist_src = manager.list()
-        mcdstd_cvlist_src = manager.list()
-        mcdpow_cvlist_src = manager.list()
-        mcdpowstd_cvlist_src = manager.list()
-        f0rmse_cvlist_src = manager.list()
-        f0corr_cvlist_src = manager.list()
-        caprmse_cvlist_src = manager.list()
-        mcd_cvlist_cyc = manager.list()
-        mcdstd_cvlist_cyc = manager.list()
-        mcdpow_cvlist_cyc = manager.list()
-        mcdpowstd_cvlist_cyc = manager.list()
-        f0rmse_cvlist_cyc = manager.list()
-        f0corr_cvlist_cyc = manager.list()
-        caprmse_cvlist_cyc = manager.list()
-        f0rmse_cvlist_cv = manager.list()
-        f0corr_cvlist_cv = manager.list()
-        mcd_cvlist = manager.list()
-        mcdstd_cvlist = manager.list()
-        mcdpow_cvlist = manager.list()
-        mcdpowstd_cvlist = manager.list()
-        lat_dist_rmse_list = manager.list()
-        lat_dist_cosim_list = manager.list()
-        gpu = 0
-        for i, feat_list in enumerate(feat_lists):
-            logging.info(i)
-            p = mp.Process(target=decode_RNN, args=(feat_list, gpu, cvlist, \
-                mcd_cvlist_src, mcdstd_cvlist_src, mcdpow_cvlist_src, mcdpowstd_cvlist_src, \
-                    f0rmse_cvlist_src, f0corr_cvlist_src, caprmse_cvlist_src, \
-                mcd_cvlist_cyc, mcdstd_cvlist_cyc, mcdpow_cvlist_cyc, mcdpowstd_cvlist_cyc, \
-                    f0rmse_cvlist_cyc, f0corr_cvlist_cyc, caprmse_cvlist_cyc,\
-                f0rmse_cvlist_cv, f0corr_cvlist_cv,\
-                    mcd_cvlist, mcdstd_cvlist, mcdpow_cvlist, mcdpowstd_cvlist,\
-                lat_dist_rmse_list, lat_dist_cosim_list,))
-            p.start()
-            processes.append(p)
-            gpu += 1
-            if (i + 1) % args.n_gpus == 0:
-                gpu = 0
-
-        # wait for all process
-        for p in processes:
-            p.join()
-
-        # calculate statistics
-        logging.info("== summary rec. acc. ==")
-        logging.info("mcdpow_src_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_src)),\
-        np.std(np.array(mcdpow_cvlist_src)),np.mean(np.array(mcdpowstd_cvlist_src)),np.std(np.array(mcdpowstd_cvlist_src))))
-        logging.info("mcd_src_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_src)),\
-        np.std(np.array(mcd_cvlist_src)),np.mean(np.array(mcdstd_cvlist_src)),np.std(np.array(mcdstd_cvlist_src))))
-        logging.info("f0rmse_src_cv: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_src)),np.std(np.array(f0rmse_cvlist_src))))
-        logging.info("f0corr_src_cv: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_src)),np.std(np.array(f0corr_cvlist_src))))
-        caprmse_cvlist_src = np.array(caprmse_cvlist_src)
-        for i in range(caprmse_cvlist_src.shape[-1]):
-            logging.info("caprmse-%d_src_cv: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist_src[:,i]),np.std(caprmse_cvlist_src[:,i])))
-        logging.info("=== summary cyc. acc. ===")
-        logging.info("mcdpow_cyc_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_cyc)),\
-        np.std(np.array(mcdpow_cvlist_cyc)),np.mean(np.array(mcdpowstd_cvlist_cyc)),np.std(np.array(mcdpowstd_cvlist_cyc))))
-        logging.info("mcd_cyc_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_cyc)),\
-        np.std(np.array(mcd_cvlist_cyc)),np.mean(np.array(mcdstd_cvlist_cyc)),np.std(np.array(mcdstd_cvlist_cyc))))
-        logging.info("f0rmse_cyc_cv: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_cyc)),np.std(np.array(f0rmse_cvlist_cyc))))
-        logging.info("f0corr_cyc_cv: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_cyc)),np.std(np.array(f0corr_cvlist_cyc))))
-        caprmse_cvlist_cyc = np.array(caprmse_cvlist_cyc)
-        for i in range(caprmse_cvlist_cyc.shape[-1]):
-            logging.info("caprmse-%d_cyc_cv: %.6f dB (+- %.6f)" % (i+1, np.mean(caprmse_cvlist_cyc[:,i]),np.std(caprmse_cvlist_cyc[:,i])))
-        logging.info("=== summary cv. acc. ===")
-        logging.info("f0rmse_cv: %.6f Hz (+- %.6f)" % (np.mean(np.array(f0rmse_cvlist_cv)),np.std(np.array(f0rmse_cvlist_cv))))
-        logging.info("f0corr_cv: %.6f (+- %.6f)" % (np.mean(np.array(f0corr_cvlist_cv)),np.std(np.array(f0corr_cvlist_cv))))
-        cvgv_mean = np.mean(np.array(cvlist), axis=0)
-        logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg)))), np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg))))))
-        if len(mcdpow_cvlist) > 0:
-            logging.info("mcdpow_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist)),\
-            np.std(np.array(mcdpow_cvlist)),np.mean(np.array(mcdpowstd_cvlist)),np.std(np.array(mcdpowstd_cvlist))))
-            logging.info("mcd_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist)),\
-            np.std(np.array(mcd_cvlist)),np.mean(np.array(mcdstd_cvlist)),np.std(np.array(mcdstd_cvlist))))
-            logging.info("lat_dist_rmse: %.6f (+- %.6f)" % (np.mean(np.array(lat_dist_rmse_list)),np.std(np.array(lat_dist_rmse_list))))
-            logging.info("lat_dist_cosim: %.6f (+- %.6f)" % (np.mean(np.array(lat_dist_cosim_list)),np.std(np.array(lat_dist_cosim_list))))
-  
- 
 if __name__ == "__main__":
     main()
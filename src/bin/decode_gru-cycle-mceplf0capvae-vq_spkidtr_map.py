@@ -130,8 +130,9 @@ def main():
             pad_first=True,
             ar=config.ar_dec)
         logging.info(model_decoder_excit)
-        model_decoder_mcep.load_state_dict(torch.load(args.model, map_location=device)["model_decoder_mcep"])
-        model_decoder_excit.load_state_dict(torch.load(args.model, map_location=device)["model_decoder_excit"])
+        checkpoint = torch.load(args.model, map_location=device)
+        model_decoder_mcep.load_state_dict(checkpoint["model_decoder_mcep"])
+        model_decoder_excit.load_state_dict(checkpoint["model_decoder_excit"])
         #model_decoder_mcep.cuda()
         #model_decoder_excit.cuda()
         model_decoder_mcep.eval()
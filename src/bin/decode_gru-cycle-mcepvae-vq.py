@@ -29,10 +29,12 @@ from utils import write_hdf5
 
 import soundfile as sf
 
-from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, nn_search_batch
+from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, nn_search_batch, freeze_model
 from feature_extract import convert_f0, convert_continuos_f0, low_pass_filter, mod_pow
 #from feature_extract import convert_continuos_codeap
 from dtw_c import dtw_c as dtw
+from metrics import MetricBatch, MetricStats
+from decode_pool import worker_devices, device_scope, file_lengths, longest_first, run_pool
 
 import pysptk as ps
 import pyworld as pw
@@ -74,6 +76,10 @@ def main():
                         type=str, help="speaker target")
     parser.add_argument("--n_gpus", default=N_GPUS,
                         type=int, help="number of gpus")
+    parser.add_argument("--n_cpu_workers", default=0,
+        type=int, help="number of cpu decoding workers (pinned to disjoint core sets) in addition to gpu workers")
+    parser.add_argument("--cpus_per_job", default=None,
+        type=int, help="number of cpu cores (and compute threads) of each decoding worker (if None, the available cores are divided)")
     parser.add_argument("--string_path", required=True,
                         type=str, help="directory to save generated samples")
     # other setting
@@ -166,73 +172,83 @@ def main():
     cvgv_mean = read_hdf5(stats_list[trg_idx], "/recgv_mean_"+string_path)
     gv_mean_trg = read_hdf5(stats_list[trg_idx], "/gv_range_mean")[1:]
 
-    # prepare the file list for parallel decoding
-    feat_lists = np.array_split(feat_list, args.n_gpus)
-    feat_lists = [f_list.tolist() for f_list in feat_lists]
-    for i in range(args.n_gpus):
-        logging.info('gpu: %d'+str(i+1)+' : '+str(len(feat_lists[i])))
+    # decoding workers on gpus and/or cpu core sets, pulling utterances from a central queue longest-first
+    devices = worker_devices(args.n_gpus, args.n_cpu_workers, cpus_per_job=args.cpus_per_job)
+    feat_lengths = file_lengths(feat_list, config.string_path)
 
     ### GRU-RNN decoding ###
     logging.info(config)
-    def decode_RNN(feat_list, gpu, cvlist=None,
-            mcd_cvlist_src=None, mcdstd_cvlist_src=None, mcdpow_cvlist_src=None, mcdpowstd_cvlist_src=None,\
-            mcd_cvlist_cyc=None, mcdstd_cvlist_cyc=None, mcdpow_cvlist_cyc=None, mcdpowstd_cvlist_cyc=None,\
-            mcd_cvlist=None, mcdstd_cvlist=None, mcdpow_cvlist=None, mcdpowstd_cvlist=None, \
-            lat_dist_rmse_list=None, lat_dist_cosim_list=None):
-        with torch.cuda.device(gpu):
-            # define model and load parameters
+    # define models and load parameters on a device
+    def load_models(device):
+        with torch.no_grad():
+            model_encoder = GRU_VAE_ENCODER(
+                in_dim=config.mcep_dim+config.excit_dim,
+                n_spk=n_spk,
+                lat_dim=config.lat_dim,
+                hidden_layers=config.hidden_layers_enc,
+                hidden_units=config.hidden_units_enc,
+                kernel_size=config.kernel_size_enc,
+                dilation_size=config.dilation_size_enc,
+                causal_conv=config.causal_conv_enc,
+                bi=config.bi_enc,
+                cont=False,
+                pad_first=True,
+                right_size=config.right_size,
+                ar=config.ar_enc)
+            logging.info(model_encoder)
+            model_decoder = GRU_SPEC_DECODER(
+                feat_dim=config.lat_dim,
+                out_dim=config.mcep_dim,
+                n_spk=n_spk,
+                hidden_layers=config.hidden_layers_dec,
+                hidden_units=config.hidden_units_dec,
+                kernel_size=config.kernel_size_dec,
+                dilation_size=config.dilation_size_dec,
+                causal_conv=config.causal_conv_dec,
+                bi=config.bi_dec,
+                pad_first=True,
+                ar=config.ar_dec)
+            logging.info(model_decoder)
+            model_vq = torch.nn.Embedding(config.ctr_size, config.lat_dim)
+            logging.info(model_vq)
+            checkpoint = torch.load(args.model, map_location="cpu")
+            if checkpoint.get("frozen", False):
+                # frozen model of freeze_model.py
+                for model in [model_encoder, model_decoder]:
+                    freeze_model(model)
+            model_encoder.load_state_dict(checkpoint["model_encoder"])
+            model_decoder.load_state_dict(checkpoint["model_decoder"])
+            model_vq.load_state_dict(checkpoint["model_vq"])
+            model_encoder.to(device)
+            model_decoder.to(device)
+            model_vq.to(device)
+            model_encoder.eval()
+            model_decoder.eval()
+            model_vq.eval()
+            for param in model_encoder.parameters():
+                param.requires_grad = False
+            for param in model_decoder.parameters():
+                param.requires_grad = False
+            model_decoder.precompute_spk_table()
+            for param in model_vq.parameters():
+                param.requires_grad = False
+        return model_encoder, model_decoder, model_vq
+
+    def decode_RNN(feat_list, device, queue=None, models=None):
+        metric_stats = MetricStats()
+        metric_batch = MetricBatch(metric_stats)
+        with device_scope(device):
+            # models are loaded once per worker, or shared by the cpu workers
+            if models is None:
+                models = load_models(device)
+            model_encoder, model_decoder, model_vq = models
             with torch.no_grad():
-                model_encoder = GRU_VAE_ENCODER(
-                    in_dim=config.mcep_dim+config.excit_dim,
-                    n_spk=n_spk,
-                    lat_dim=config.lat_dim,
-                    hidden_layers=config.hidden_layers_enc,
-                    hidden_units=config.hidden_units_enc,
-                    kernel_size=config.kernel_size_enc,
-                    dilation_size=config.dilation_size_enc,
-                    causal_conv=config.causal_conv_enc,
-                    bi=config.bi_enc,
-                    cont=False,
-                    pad_first=True,
-                    right_size=config.right_size,
-                    ar=config.ar_enc)
-                logging.info(model_encoder)
-                model_decoder = GRU_SPEC_DECODER(
-                    feat_dim=config.lat_dim,
-                    out_dim=config.mcep_dim,
-                    n_spk=n_spk,
-                    hidden_layers=config.hidden_layers_dec,
-                    hidden_units=config.hidden_units_dec,
-                    kernel_size=config.kernel_size_dec,
-                    dilation_size=config.dilation_size_dec,
-                    causal_conv=config.causal_conv_dec,
-                    bi=config.bi_dec,
-                    pad_first=True,
-                    ar=config.ar_dec)
-                logging.info(model_decoder)
-                model_vq = torch.nn.Embedding(config.ctr_size, config.lat_dim)
-                logging.info(model_vq)
-                model_encoder.load_state_dict(torch.load(args.model)["model_encoder"])
-                model_decoder.load_state_dict(torch.load(args.model)["model_decoder"])
-                model_vq.load_state_dict(torch.load(args.model)["model_vq"])
-                model_encoder.cuda()
-                model_decoder.cuda()
-                model_vq.cuda()
-                model_encoder.eval()
-                model_decoder.eval()
-                model_vq.eval()
-                for param in model_encoder.parameters():
-                    param.requires_grad = False
-                for param in model_decoder.parameters():
-                    param.requires_grad = False
-                for param in model_vq.parameters():
-                    param.requires_grad = False
                 if config.ar_enc:
-                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim)).cuda()
+                    yz_in = torch.zeros((1, 1, n_spk+config.lat_dim)).to(device)
                 if config.ar_dec:
-                    mean_stats = torch.FloatTensor(read_hdf5(config.stats, "/mean_"+config.string_path.replace("/",""))).cuda()
-                    scale_stats = torch.FloatTensor(read_hdf5(config.stats, "/scale_"+config.string_path.replace("/",""))).cuda()
-                    x_in = (torch.zeros((1, 1, config.mcep_dim)).cuda()-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]
+                    mean_stats = torch.FloatTensor(read_hdf5(config.stats, "/mean_"+config.string_path.replace("/",""))).to(device)
+                    scale_stats = torch.FloatTensor(read_hdf5(config.stats, "/scale_"+config.string_path.replace("/",""))).to(device)
+                    x_in = (torch.zeros((1, 1, config.mcep_dim)).to(device)-mean_stats[config.excit_dim:])/scale_stats[config.excit_dim:]
             fs = args.fs
             fft_size = args.fftl
             mcep_dim = model_decoder.out_dim-1
@@ -274,7 +290,7 @@ def main():
 
                 logging.info("generate")
                 with torch.no_grad():
-                    feat = torch.FloatTensor(feat).cuda().unsqueeze(0)
+                    feat = torch.FloatTensor(feat).to(device).unsqueeze(0)
                     feat_excit = feat[:,:,:config.excit_dim]
 
                     if config.ar_enc:
@@ -298,10 +314,10 @@ def main():
 
                     if trg_exist:
                         if config.ar_enc:
-                            spk_trg_logits, lat_trg, _, _ = model_encoder(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), (model_encoder.pad_left,model_encoder.pad_right), "replicate").transpose(1,2), \
+                            spk_trg_logits, lat_trg, _, _ = model_encoder(F.pad(torch.FloatTensor(feat_trg).to(device).unsqueeze(0).transpose(1,2), (model_encoder.pad_left,model_encoder.pad_right), "replicate").transpose(1,2), \
                                                                 yz_in=yz_in)
                         else:
-                            spk_trg_logits, lat_trg, _ = model_encoder(F.pad(torch.FloatTensor(feat_trg).cuda().unsqueeze(0).transpose(1,2), (model_encoder.pad_left,model_encoder.pad_right), "replicate").transpose(1,2))
+                            spk_trg_logits, lat_trg, _ = model_encoder(F.pad(torch.FloatTensor(feat_trg).to(device).unsqueeze(0).transpose(1,2), (model_encoder.pad_left,model_encoder.pad_right), "replicate").transpose(1,2))
                         idx_vq = nn_search_batch(lat_trg, model_vq.weight)
                         lat_trg = model_vq(idx_vq)
                         unique, counts = np.unique(idx_vq.cpu().data.numpy(), return_counts=True)
@@ -310,7 +326,7 @@ def main():
                         logging.info('target spkpost')
                         logging.info(torch.mean(F.softmax(spk_trg_logits, dim=-1), 1))
 
-                    src_code = (torch.ones((1, lat_src.shape[1]))*src_idx).cuda().long()
+                    src_code = (torch.ones((1, lat_src.shape[1]))*src_idx).to(device).long()
                     if config.ar_dec:
                         cvmcep_src, _, _ = model_decoder(src_code, lat_src, x_in=x_in)
                     else:
@@ -338,17 +354,17 @@ def main():
                     else:
                         logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:], dim=-1), 1))
 
-                    trg_code = (torch.ones((1, lat_src.shape[1]))*trg_idx).cuda().long()
+                    trg_code = (torch.ones((1, lat_src.shape[1]))*trg_idx).to(device).long()
                     if config.ar_dec:
                         cvmcep, _, _ = model_decoder(trg_code, lat_src, x_in=x_in)
                     else:
                         cvmcep, _ = model_decoder(trg_code, lat_src)
 
                     if config.ar_enc:
-                        spk_logits, lat_cv, _, _ = model_encoder(torch.cat((F.pad(torch.FloatTensor(feat_cv).cuda().unsqueeze(0).transpose(1,2), \
+                        spk_logits, lat_cv, _, _ = model_encoder(torch.cat((F.pad(torch.FloatTensor(feat_cv).to(device).unsqueeze(0).transpose(1,2), \
                                             (outpad_lefts[1],outpad_rights[1]), "replicate").transpose(1,2), cvmcep_src), 2))
                     else:
-                        spk_logits, lat_cv, _ = model_encoder(torch.cat((F.pad(torch.FloatTensor(feat_cv).cuda().unsqueeze(0).transpose(1,2), \
+                        spk_logits, lat_cv, _ = model_encoder(torch.cat((F.pad(torch.FloatTensor(feat_cv).to(device).unsqueeze(0).transpose(1,2), \
                                             (outpad_lefts[1],outpad_rights[1]), "replicate").transpose(1,2), cvmcep_src), 2))
                     idx_vq = nn_search_batch(lat_cv, model_vq.weight)
                     lat_cv = model_vq(idx_vq)
@@ -364,7 +380,7 @@ def main():
                     else:
                         logging.info(torch.mean(F.softmax(spk_logits[:,outpad_lefts[2]:], dim=-1), 1))
 
-                    src_code = (torch.ones((1, lat_cv.shape[1]))*src_idx).cuda().long()
+                    src_code = (torch.ones((1, lat_cv.shape[1]))*src_idx).to(device).long()
                     if config.ar_dec:
                         cvmcep_cyc, _, _ = model_decoder(src_code, lat_cv, x_in=x_in)
                     else:
@@ -386,7 +402,7 @@ def main():
                     logging.info(lat_src.shape)
                     logging.info(lat_trg.shape)
  
-                cvlist.append(np.var(cvmcep[:,1:], axis=0))
+                metric_batch.append("cv", os.path.basename(feat_file), spk_src, gv_est=cvmcep)
 
                 logging.info("cvf0lin")
                 cvf0_range_lin = convert_f0(f0_range, src_f0_mean, src_f0_std, trg_f0_mean, trg_f0_std)
@@ -403,36 +419,15 @@ def main():
 
                 logging.info("mcd acc")
                 spcidx = np.array(read_hdf5(feat_file, "/spcidx_range")[0])
-                _, mcdpow_arr = dtw.calc_mcd(np.array(mcep[spcidx], dtype=np.float64), np.array(cvmcep_src[spcidx], dtype=np.float64))
-                _, mcd_arr = dtw.calc_mcd(np.array(mcep[spcidx,1:], dtype=np.float64), np.array(cvmcep_src[spcidx,1:], dtype=np.float64))
-                mcdpow_mean = np.mean(mcdpow_arr)
-                mcdpow_std = np.std(mcdpow_arr)
-                mcd_mean = np.mean(mcd_arr)
-                mcd_std = np.std(mcd_arr)
-                logging.info("mcdpow_src_cv: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                logging.info("mcd_src_cv: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                mcdpow_cvlist_src.append(mcdpow_mean)
-                mcdpowstd_cvlist_src.append(mcdpow_std)
-                mcd_cvlist_src.append(mcd_mean)
-                mcdstd_cvlist_src.append(mcd_std)
+                metric_batch.append("rec_cv", os.path.basename(feat_file), spk_src, mcep_ref=mcep[spcidx], mcep_est=cvmcep_src[spcidx])
                 if trg_exist:
                     spcidx_trg = np.array(read_hdf5(file_trg, "/spcidx_range")[0])
                     _, _, _, mcdpow_arr = dtw.dtw_org_to_trg(np.array(cvmcep[spcidx], \
                                                 dtype=np.float64), np.array(mcep_trg[spcidx_trg], dtype=np.float64))
                     _, _, _, mcd_arr = dtw.dtw_org_to_trg(np.array(cvmcep[spcidx,1:], \
                                                 dtype=np.float64), np.array(mcep_trg[spcidx_trg,1:], dtype=np.float64))
-                    mcdpow_mean = np.mean(mcdpow_arr)
-                    mcdpow_std = np.std(mcdpow_arr)
-                    mcd_mean = np.mean(mcd_arr)
-                    mcd_std = np.std(mcd_arr)
-                    logging.info("mcdpow_trg: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                    logging.info("mcd_trg: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                    mcdpow_cvlist.append(mcdpow_mean)
-                    mcdpowstd_cvlist.append(mcdpow_std)
-                    mcd_cvlist.append(mcd_mean)
-                    mcdstd_cvlist.append(mcd_std)
-                    spcidx_src = torch.LongTensor(spcidx).cuda()
-                    spcidx_trg = torch.LongTensor(spcidx_trg).cuda()
+                    spcidx_src = torch.LongTensor(spcidx).to(device)
+                    spcidx_trg = torch.LongTensor(spcidx_trg).to(device)
                     trj_lat_src = np.array(torch.index_select(lat_src[0],0,spcidx_src).cpu().data.numpy(), dtype=np.float64)
                     trj_lat_trg = np.array(torch.index_select(lat_trg[0],0,spcidx_trg).cpu().data.numpy(), dtype=np.float64)
                     aligned_lat_srctrg, _, _, _ = dtw.dtw_org_to_trg(trj_lat_src, trj_lat_trg)
@@ -444,21 +439,10 @@ def main():
                     logging.info("%lf %lf %lf %lf" % (lat_dist_srctrg, lat_cdist_srctrg, lat_dist_trgsrc, lat_cdist_trgsrc))
                     lat_dist_rmse = (lat_dist_srctrg+lat_dist_trgsrc)/2
                     lat_dist_cosim = (lat_cdist_srctrg+lat_cdist_trgsrc)/2
-                    lat_dist_rmse_list.append(lat_dist_rmse)
-                    lat_dist_cosim_list.append(lat_dist_cosim)
+                    metric_batch.append("cv", os.path.basename(feat_file), spk_src, metrics={"lat_dist_rmse": lat_dist_rmse, \
+                        "lat_dist_cosim": lat_dist_cosim}, mcdpow_frames=mcdpow_arr, mcd_frames=mcd_arr)
                     logging.info("lat_dist: %.6f %.6f" % (lat_dist_rmse, lat_dist_cosim))
-                _, mcdpow_arr = dtw.calc_mcd(np.array(mcep[spcidx], dtype=np.float64), np.array(cvmcep_cyc[spcidx], dtype=np.float64))
-                _, mcd_arr = dtw.calc_mcd(np.array(mcep[spcidx,1:], dtype=np.float64), np.array(cvmcep_cyc[spcidx,1:], dtype=np.float64))
-                mcdpow_mean = np.mean(mcdpow_arr)
-                mcdpow_std = np.std(mcdpow_arr)
-                mcd_mean = np.mean(mcd_arr)
-                mcd_std = np.std(mcd_arr)
-                logging.info("mcdpow_cyc_cv: %.6f dB +- %.6f" % (mcdpow_mean, mcdpow_std))
-                logging.info("mcd_cyc_cv: %.6f dB +- %.6f" % (mcd_mean, mcd_std))
-                mcdpow_cvlist_cyc.append(mcdpow_mean)
-                mcdpowstd_cvlist_cyc.append(mcdpow_std)
-                mcd_cvlist_cyc.append(mcd_mean)
-                mcdstd_cvlist_cyc.append(mcd_std)
+                metric_batch.append("cyc_cv", os.path.basename(feat_file), spk_src, mcep_ref=mcep[spcidx], mcep_est=cvmcep_cyc[spcidx])
 
                 logging.info("synth anasyn")
                 wav = np.clip(pw.synthesize(f0_range, sp, ap, fs, frame_period=args.shiftms), -1, 1)
@@ -598,66 +582,26 @@ def main():
                 count += 1
                 #if count >= 5:
                 #    break
+            metric_batch.flush()
+            queue.put(metric_stats)
+
+
+    logging.info("GRU-RNN decoding")
+    metric_stats = MetricStats()
+    for result in run_pool(decode_RNN, longest_first(feat_list, feat_lengths), devices, load_models=load_models):
+        metric_stats.merge(result)
+
+    # calculate statistics
+    logging.info("== summary rec. acc. ==")
+    metric_stats.log_summary("rec_cv")
+    logging.info("=== summary cyc. acc. ===")
+    metric_stats.log_summary("cyc_cv")
+    logging.info("=== summary cv. acc. ===")
+    cvgv_mean = metric_stats.summary("cv")["gv"][0]
+    logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg)))), np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg))))))
+    metric_stats.log_summary("cv")
+    metric_stats.write_json(os.path.join(args.outdir, "metrics.json"))
 
 
-    with mp.Manager() as manager:
-        logging.info("GRU-RNN decoding")
-        processes = []
-        cvlist = manager.list()
-        mcd_cvlist_src = manager.list()
-        mcdstd_cvlist_src = manager.list()
-        mcdpow_cvlist_src = manager.list()
-        mcdpowstd_cvlist_src = manager.list()
-        mcd_cvlist_cyc = manager.list()
-        mcdstd_cvlist_cyc = manager.list()
-        mcdpow_cvlist_cyc = manager.list()
-        mcdpowstd_cvlist_cyc = manager.list()
-        mcd_cvlist = manager.list()
-        mcdstd_cvlist = manager.list()
-        mcdpow_cvlist = manager.list()
-        mcdpowstd_cvlist = manager.list()
-        lat_dist_rmse_list = manager.list()
-        lat_dist_cosim_list = manager.list()
-        gpu = 0
-        for i, feat_list in enumerate(feat_lists):
-            logging.info(i)
-            p = mp.Process(target=decode_RNN, args=(feat_list, gpu, cvlist, \
-                mcd_cvlist_src, mcdstd_cvlist_src, mcdpow_cvlist_src, mcdpowstd_cvlist_src, \
-                mcd_cvlist_cyc, mcdstd_cvlist_cyc, mcdpow_cvlist_cyc, mcdpowstd_cvlist_cyc, \
-                    mcd_cvlist, mcdstd_cvlist, mcdpow_cvlist, mcdpowstd_cvlist,\
-                lat_dist_rmse_list, lat_dist_cosim_list,))
-            p.start()
-            processes.append(p)
-            gpu += 1
-            if (i + 1) % args.n_gpus == 0:
-                gpu = 0
-
-        # wait for all process
-        for p in processes:
-            p.join()
-
-        # calculate statistics
-        logging.info("== summary rec. acc. ==")
-        logging.info("mcdpow_rec_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_src)),\
-        np.std(np.array(mcdpow_cvlist_src)),np.mean(np.array(mcdpowstd_cvlist_src)),np.std(np.array(mcdpowstd_cvlist_src))))
-        logging.info("mcd_rec_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_src)),\
-        np.std(np.array(mcd_cvlist_src)),np.mean(np.array(mcdstd_cvlist_src)),np.std(np.array(mcdstd_cvlist_src))))
-        logging.info("=== summary cyc. acc. ===")
-        logging.info("mcdpow_cyc_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist_cyc)),\
-        np.std(np.array(mcdpow_cvlist_cyc)),np.mean(np.array(mcdpowstd_cvlist_cyc)),np.std(np.array(mcdpowstd_cvlist_cyc))))
-        logging.info("mcd_cyc_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist_cyc)),\
-        np.std(np.array(mcd_cvlist_cyc)),np.mean(np.array(mcdstd_cvlist_cyc)),np.std(np.array(mcdstd_cvlist_cyc))))
-        logging.info("=== summary cv. acc. ===")
-        cvgv_mean = np.mean(np.array(cvlist), axis=0)
-        logging.info("%lf +- %lf" % (np.mean(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg)))), np.std(np.sqrt(np.square(np.log(cvgv_mean)-np.log(gv_mean_trg))))))
-        if len(mcdpow_cvlist) > 0:
-            logging.info("mcdpow_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcdpow_cvlist)),\
-            np.std(np.array(mcdpow_cvlist)),np.mean(np.array(mcdpowstd_cvlist)),np.std(np.array(mcdpowstd_cvlist))))
-            logging.info("mcd_cv: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (np.mean(np.array(mcd_cvlist)),\
-            np.std(np.array(mcd_cvlist)),np.mean(np.array(mcdstd_cvlist)),np.std(np.array(mcdstd_cvlist))))
-            logging.info("lat_dist_rmse: %.6f (+- %.6f)" % (np.mean(np.array(lat_dist_rmse_list)),np.std(np.array(lat_dist_rmse_list))))
-            logging.info("lat_dist_cosim: %.6f (+- %.6f)" % (np.mean(np.array(lat_dist_cosim_list)),np.std(np.array(lat_dist_cosim_list))))
-  
- 
 if __name__ == "__main__":
     main()
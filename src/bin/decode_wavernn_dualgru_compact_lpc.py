@@ -24,8 +24,9 @@ import matplotlib.pyplot as plt
 import librosa
 
 from utils import find_files
-from utils import read_txt, read_hdf5, shape_hdf5
-from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT
+from utils import read_txt, read_hdf5, shape_hdf5, read_spc_mask
+from decode_pool import worker_devices, device_scope, file_lengths, longest_first, run_pool
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, freeze_model
 
 #import warnings
 #warnings.filterwarnings('ignore')
@@ -59,13 +60,16 @@ def pad_list(batch_list, pad_value=0.0):
 
 
 #def decode_generator(wav_list, feat_list, upsampling_factor=120, string_path='/feat_mceplf0cap', batch_size=1):
-def decode_generator(feat_list, upsampling_factor=120, string_path='/feat_mceplf0cap', batch_size=1):
+def decode_generator(feat_list, upsampling_factor=120, string_path='/feat_mceplf0cap', batch_size=1, skip_silence=False, \
+        device=None):
     """DECODE BATCH GENERATOR
 
     Args:
         wav_list (str): list including wav files
         batch_size (int): batch size in decoding
         upsampling_factor (int): upsampling factor
+        skip_silence (bool): also read speech frame mask of each feature file
+        device (torch.device): device of the feature batches (if None, cuda if available)
 
     Return:
         (object): generator instance
@@ -90,6 +94,7 @@ def decode_generator(feat_list, upsampling_factor=120, string_path='/feat_mceplf
         for batch_feat_list in batch_feat_lists:
             #batch_x = []
             batch_feat = []
+            batch_spc = []
             n_samples_list = []
             feat_ids = []
             #for wav_file, featfile in zip(batch_wav_list, batch_feat_list):
@@ -104,21 +109,26 @@ def decode_generator(feat_list, upsampling_factor=120, string_path='/feat_mceplf
                 # append to list
                 #batch_x += [x]
                 batch_feat += [feat]
+                if skip_silence:
+                    batch_spc += [read_spc_mask(featfile, feat.shape[0])]
                 n_samples_list += [feat.shape[0]*upsampling_factor]
                 feat_ids += [os.path.basename(featfile).replace(".h5", "")]
 
             # convert list to ndarray
             #batch_x = pad_list(batch_x)
             batch_feat = pad_list(batch_feat)
+            batch_spc = pad_list(batch_spc) if skip_silence else None
 
             # convert to torch variable
             #batch_x = torch.FloatTensor(batch_x)
             batch_feat = torch.FloatTensor(batch_feat)
-            if torch.cuda.is_available():
+            if device is not None:
+                batch_feat = batch_feat.to(device)
+            elif torch.cuda.is_available():
                 batch_feat = batch_feat.cuda()
 
             #yield feat_ids, (batch_x, batch_feat, n_samples_list)
-            yield feat_ids, (batch_feat, n_samples_list)
+            yield feat_ids, (batch_feat, n_samples_list, batch_spc)
 
 
 def main():
@@ -140,6 +150,20 @@ def main():
                         type=int, help="number of batch size in decoding")
     parser.add_argument("--n_gpus", default=1,
                         type=int, help="number of gpus")
+    parser.add_argument("--n_cpu_workers", default=0,
+                        type=int, help="number of cpu decoding workers (pinned to disjoint core sets) in addition to gpu workers")
+    parser.add_argument("--cpus_per_job", default=None,
+                        type=int, help="number of cpu cores (and compute threads) of each decoding worker (if None, the available cores are divided)")
+    parser.add_argument("--gate_tables", default=True,
+                        type=strtobool, help="use precomputed embedding-to-gate tables of previous sample in generation")
+    parser.add_argument("--fold_len", default=None,
+                        type=int, help="number of frames of each folded segment for parallel generation (if None, sequential generation)")
+    parser.add_argument("--fold_overlap", default=4,
+                        type=int, help="number of frames of hidden state warm-up and crossfade between folded segments")
+    parser.add_argument("--skip_silence", default=False,
+                        type=strtobool, help="bypass generation of silent frames based on spcidx_range/npow of feature files")
+    parser.add_argument("--skip_warmup", default=240,
+                        type=int, help="number of samples of hidden state re-warm-up before each speech region in skipping silence")
     # other setting
     parser.add_argument("--string_path", default=None,
                         type=str, help="log interval")
@@ -212,51 +236,64 @@ def main():
         logging.error("--feats should be directory or list.")
         sys.exit(1)
 
-    # prepare the file list for parallel decoding
-    #wav_lists = np.array_split(wav_list, args.n_gpus)
-    #wav_lists = [f_list.tolist() for f_list in wav_lists]
-    feat_lists = np.array_split(feat_list, args.n_gpus)
-    feat_lists = [f_list.tolist() for f_list in feat_lists]
-
-    # define gpu decode function
-    #def gpu_decode(wav_list, feat_list, gpu):
-    def gpu_decode(feat_list, gpu):
-        with torch.cuda.device(gpu):
+    # string path of the features
+    if args.string_path is None:
+        string_path = config.string_path
+    else:
+        string_path = args.string_path
+    logging.info(string_path)
+
+    # decoding workers on gpus and/or cpu core sets, pulling batches of similar lengths from a central queue longest-first
+    devices = worker_devices(args.n_gpus, args.n_cpu_workers, cpus_per_job=args.cpus_per_job)
+    feat_batches = longest_first(feat_list, file_lengths(feat_list, string_path), args.batch_size)
+
+    # define model and load parameters on a device
+    def load_models(device):
+        with torch.no_grad():
+            model_waveform = GRU_WAVE_DECODER_DUALGRU_COMPACT(
+                feat_dim=config.mcep_dim+config.excit_dim,
+                upsampling_factor=config.upsampling_factor,
+                hidden_units=config.hidden_units_wave,
+                hidden_units_2=config.hidden_units_wave_2,
+                kernel_size=config.kernel_size_wave,
+                dilation_size=config.dilation_size_wave,
+                n_quantize=config.n_quantize,
+                causal_conv=config.causal_conv_wave,
+                lpc=config.lpc)
+            logging.info(model_waveform)
+            model_waveform.to(device)
+            #check = torch.load(args.checkpoint, map_location=torch.device('cpu'))
+            #if 'model_encoder' in check or 'model_encoder_mcep' in check:
+            #    torch.nn.utils.weight_norm(model_waveform.scale_in)
+            checkpoint = torch.load(args.checkpoint, map_location="cpu")
+            if checkpoint.get("frozen", False):
+                # frozen model of freeze_model.py
+                freeze_model(model_waveform)
+            model_waveform.load_state_dict(checkpoint["model_waveform"])
+            model_waveform.remove_weight_norm()
+            model_waveform.eval()
+            for param in model_waveform.parameters():
+                param.requires_grad = False
+        return [model_waveform]
+
+    # define decode function of a worker
+    def worker_decode(feat_list, device, queue=None, models=None):
+        with device_scope(device):
+            # model is loaded once per worker, or shared by the cpu workers
+            if models is None:
+                models = load_models(device)
+            model_waveform = models[0]
             with torch.no_grad():
-                model_waveform = GRU_WAVE_DECODER_DUALGRU_COMPACT(
-                    feat_dim=config.mcep_dim+config.excit_dim,
-                    upsampling_factor=config.upsampling_factor,
-                    hidden_units=config.hidden_units_wave,
-                    hidden_units_2=config.hidden_units_wave_2,
-                    kernel_size=config.kernel_size_wave,
-                    dilation_size=config.dilation_size_wave,
-                    n_quantize=config.n_quantize,
-                    causal_conv=config.causal_conv_wave,
-                    lpc=config.lpc)
-                logging.info(model_waveform)
-                model_waveform.cuda()
-                #check = torch.load(args.checkpoint, map_location=torch.device('cpu'))
-                #if 'model_encoder' in check or 'model_encoder_mcep' in check:
-                #    torch.nn.utils.weight_norm(model_waveform.scale_in)
-                model_waveform.load_state_dict(torch.load(args.checkpoint)["model_waveform"])
-                model_waveform.remove_weight_norm()
-                model_waveform.eval()
-                for param in model_waveform.parameters():
-                    param.requires_grad = False
                 torch.backends.cudnn.benchmark = True
 
-                # define generator
-                if args.string_path is None:
-                    string_path = config.string_path
-                else:
-                    string_path = args.string_path
-                logging.info(string_path)
-                generator = decode_generator(
-                    feat_list,
-                    batch_size=args.batch_size,
+                # define generator of the batches pulled from the central queue
+                generator = (batch for batch_feat_list in feat_list for batch in decode_generator(
+                    batch_feat_list,
+                    batch_size=len(batch_feat_list),
                     upsampling_factor=config.upsampling_factor,
-                    string_path=string_path)
-                    #wav_list,
+                    string_path=string_path,
+                    skip_silence=args.skip_silence,
+                    device=device))
 
                 # decode
                 time_sample = []
@@ -264,7 +301,7 @@ def main():
                 n_samples_t = []
                 count = 0
                 #for feat_ids, (batch_x, batch_feat, n_samples_list) in generator:
-                for feat_ids, (batch_feat, n_samples_list) in generator:
+                for feat_ids, (batch_feat, n_samples_list, batch_spc) in generator:
                     logging.info("decoding start")
                     start = time.time()
                     #logging.info(batch_x.shape)
@@ -273,7 +310,8 @@ def main():
                     #batch_x_prev = torch.zeros((batch_feat.shape[0], 1)).cuda().fill_(config.n_quantize//2).long()
                     #logging.info(batch_x_prev)
 
-                    samples = model_waveform.generate(batch_feat)
+                    samples = model_waveform.generate(batch_feat, tables=args.gate_tables, fold_len=args.fold_len, \
+                                    fold_overlap=args.fold_overlap, spc_mask=batch_spc, warmup=args.skip_warmup)
                     logging.info(samples.shape)
 
                     #samples_src_list = batch_x.data.numpy()
@@ -313,27 +351,14 @@ def main():
                     #if count >= 1:
                     #    break
 
-                logging.info("average time / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % (\
-                    sum(time_sample)/sum(n_samples), sum(n_samples), sum(n_samples)/(1000*sum(time_sample))))
-                logging.info("average throughput / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % (\
-                sum(time_sample)/sum(n_samples_t), sum(n_samples_t), sum(n_samples_t)/(1000*sum(time_sample))))
+                if len(time_sample) > 0:
+                    logging.info("average time / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % (\
+                        sum(time_sample)/sum(n_samples), sum(n_samples), sum(n_samples)/(1000*sum(time_sample))))
+                    logging.info("average throughput / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % (\
+                    sum(time_sample)/sum(n_samples_t), sum(n_samples_t), sum(n_samples_t)/(1000*sum(time_sample))))
 
     # parallel decode
-    processes = []
-    gpu = 0
-    #for i, (wav_list, feat_list) in enumerate(zip(wav_lists, feat_lists)):
-    for i, feat_list in enumerate(feat_lists):
-        #p = mp.Process(target=gpu_decode, args=(wav_list, feat_list, gpu,))
-        p = mp.Process(target=gpu_decode, args=(feat_list, gpu,))
-        p.start()
-        processes.append(p)
-        gpu += 1
-        if (i + 1) % args.n_gpus == 0:
-            gpu = 0
-
-    # wait for all process
-    for p in processes:
-        p.join()
+    run_pool(worker_decode, feat_batches, devices, load_models=load_models)
 
 
 if __name__ == "__main__":
@@ -12,6 +12,8 @@ import argparse
 import multiprocessing as mp
 import os
 import sys
+import time
+from collections import OrderedDict
 from distutils.util import strtobool
 
 import logging
@@ -19,13 +21,14 @@ import numpy as np
 from numpy.matlib import repmat
 from scipy.interpolate import interp1d
 import soundfile as sf
-from scipy.signal import firwin
-from scipy.signal import lfilter
 import librosa
 
 from utils import find_files
 from utils import read_txt
 from utils import write_hdf5, read_hdf5
+from utils import HDF5Writer
+from dsp import fir_design, fir_filter, mel_basis, mel_basis_pinv
+from cpu_governor import govern_worker, partition_cores
 
 from multiprocessing import Array
 
@@ -48,6 +51,7 @@ LOWPASS_CUTOFF = 20
 HIGHPASS_CUTOFF = 65
 OVERWRITE = True
 MAX_CODEAP = -8.6856974912498e-12
+HDF5_DTYPE = "float32"
 
 
 def melsp(x, n_mels=MEL_DIM, n_fft=FFTL, shiftms=SHIFTMS, winms=WINMS, fs=FS):
@@ -55,29 +59,27 @@ def melsp(x, n_mels=MEL_DIM, n_fft=FFTL, shiftms=SHIFTMS, winms=WINMS, fs=FS):
     win_length = int((fs/1000)*winms)
     stft = librosa.core.stft(x, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window='hann')
     magspec = np.abs(stft)
-    melfb = librosa.filters.mel(fs, n_fft, n_mels=n_mels)
+    melfb = mel_basis(fs, n_fft, n_mels)
 
     return np.dot(melfb, magspec).T
 
 
-def low_cut_filter(x, fs, cutoff=HIGHPASS_CUTOFF):
+def low_cut_filter(x, fs, cutoff=HIGHPASS_CUTOFF, zero_phase=False):
     """FUNCTION TO APPLY LOW CUT FILTER
 
     Args:
         x (ndarray): Waveform sequence
         fs (int): Sampling frequency
         cutoff (float): Cutoff frequency of low cut filter
+        zero_phase (bool): Compensate the delay of the linear-phase filter (if False, causal as lfilter)
 
     Return:
         (ndarray): Low cut filtered waveform sequence
     """
 
-    nyquist = fs // 2
-    norm_cutoff = cutoff / nyquist
-
     # low cut filter
-    fil = firwin(1023, norm_cutoff, pass_zero=False)
-    lcf_x = lfilter(fil, 1, x)
+    fil = fir_design(fs, cutoff, 1023, pass_zero=False)
+    lcf_x = fir_filter(x, fil, zero_phase=zero_phase)
 
     return lcf_x
 
@@ -174,15 +176,11 @@ def low_pass_filter(x, fs, cutoff=LOWPASS_CUTOFF, padding=True):
         (ndarray): Low pass filtered waveform sequence
     """
 
-    nyquist = fs // 2
-    norm_cutoff = cutoff / nyquist
-
-    # low cut filter
+    # low pass filter, zero-phase on the edge-padded sequence
     numtaps = 255
-    fil = firwin(numtaps, norm_cutoff)
+    fil = fir_design(fs, cutoff, numtaps)
     x_pad = np.pad(x, (numtaps, numtaps), 'edge')
-    lpf_x = lfilter(fil, 1, x_pad)
-    lpf_x = lpf_x[numtaps + numtaps // 2: -numtaps // 2]
+    lpf_x = fir_filter(x_pad, fil, zero_phase=True)[numtaps:-numtaps]
 
     return lpf_x
 
@@ -307,9 +305,21 @@ def main():
     parser.add_argument(
         "--highpass_cutoff", default=HIGHPASS_CUTOFF,
         type=int, help="Cut off frequency in lowpass filter")
+    parser.add_argument(
+        "--hdf5_dtype", default=HDF5_DTYPE,
+        type=str, help="storage dtype of floating-point features (float32 or float64)")
+    parser.add_argument(
+        "--chunk_frames", default=None,
+        type=int, help="number of frames per hdf5 chunk (if None, contiguous or auto-chunked with compression)")
+    parser.add_argument(
+        "--compression", default=None,
+        type=str, help="hdf5 compression filter (lzf or gzip)")
     parser.add_argument(
         "--n_jobs", default=10,
         type=int, help="number of parallel jobs")
+    parser.add_argument(
+        "--cpus_per_job", default=None,
+        type=int, help="number of cpu cores (and compute threads) of each job (if None, the available cores are divided)")
     parser.add_argument(
         "--verbose", default=1,
         type=int, help="log message level")
@@ -354,13 +364,15 @@ def main():
         os.makedirs(args.hdf5dir)
 
     def feature_extract(cpu, wav_list, arr, max_frame_list, max_spc_frame_list):
+        govern_worker(core_sets[cpu])
         n_wav = len(wav_list)
         n_sample = 0
         n_frame = 0
         max_frame = 0
         max_spc_frame = 0
+        write_time = 0
         count = 1
-        melfb_t = np.linalg.pinv(librosa.filters.mel(args.fs, args.fftl, n_mels=args.mel_dim))
+        melfb_t = mel_basis_pinv(args.fs, args.fftl, args.mel_dim)
         for wav_name in wav_list:
             # load wavfile and apply low cut filter
             fs, x = read_wav(wav_name, cutoff=args.highpass_cutoff)
@@ -374,6 +386,7 @@ def main():
                 sys.exit(1)
 
             hdf5name = args.hdf5dir + "/" + os.path.basename(wav_name).replace(".wav", ".h5")
+            hdf5_feats = OrderedDict()
 
             if not args.init:
                 if args.minf0 != 40 and args.maxf0 != 700:
@@ -382,13 +395,13 @@ def main():
                 else:
                     logging.info('open spk')
                     time_axis_range, f0_range, spc_range, ap_range = analyze(x, fs=fs, fperiod=args.shiftms, fftl=args.fftl)
-                write_hdf5(hdf5name, "/f0_range", f0_range)
-                write_hdf5(hdf5name, "/time_axis", time_axis_range)
+                hdf5_feats["/f0_range"] = f0_range
+                hdf5_feats["/time_axis"] = time_axis_range
 
                 melmagsp = melsp(x, n_mels=args.mel_dim, n_fft=args.fftl, shiftms=args.shiftms, winms=args.winms, fs=fs)
                 logging.info(melmagsp.shape)
 
-                write_hdf5(hdf5name, "/log_1pmelmagsp", np.log(1+10000*melmagsp))
+                hdf5_feats["/log_1pmelmagsp"] = np.log(1+10000*melmagsp)
 
                 uv_range, cont_f0_range = convert_continuos_f0(np.array(f0_range))
                 unique, counts = np.unique(uv_range, return_counts=True)
@@ -409,9 +422,9 @@ def main():
 
                 feat_orglf0 = np.c_[uv_range,np.log(cont_f0_lpf_range),codeap_range,mcep_range]
                 logging.info(feat_orglf0.shape)
-                write_hdf5(hdf5name, "/feat_org_lf0", feat_orglf0)
+                hdf5_feats["/feat_org_lf0"] = feat_orglf0
 
-                write_hdf5(hdf5name, "/spcidx_range", spcidx_range)
+                hdf5_feats["/spcidx_range"] = spcidx_range
 
                 logging.info(hdf5name)
                 n_codeap = codeap_range.shape[-1]
@@ -433,7 +446,7 @@ def main():
                     logging.info(cont_codeap.shape)
                 feat_mceplf0cap = np.c_[uv_range, np.log(cont_f0_lpf_range), uv_codeap, cont_codeap, mcep_range]
                 logging.info(feat_mceplf0cap.shape)
-                write_hdf5(hdf5name, "/feat_mceplf0cap", feat_mceplf0cap)
+                hdf5_feats["/feat_mceplf0cap"] = feat_mceplf0cap
 
                 n_frame += feat_orglf0.shape[0]
                 if max_frame < feat_orglf0.shape[0]:
@@ -459,13 +472,21 @@ def main():
                 sf.write(wavpath, wav, fs, 'PCM_16')
             else:
                 time_axis, f0, spc, ap = analyze(x, fs=fs, fperiod=args.shiftms, fftl=args.fftl)
-                write_hdf5(hdf5name, "/f0", f0)
+                hdf5_feats["/f0"] = f0
                 npow = spc2npow(spc)
-                write_hdf5(hdf5name, "/npow", npow)
+                hdf5_feats["/npow"] = npow
                 n_frame += f0.shape[0]
                 if max_frame < f0.shape[0]:
                     max_frame = f0.shape[0]
 
+            # write all datasets of the utterance in one open
+            start = time.time()
+            with HDF5Writer(hdf5name, dtype=np.dtype(args.hdf5_dtype), chunk_frames=args.chunk_frames, \
+                    compression=args.compression) as f:
+                for hdf5_path, hdf5_data in hdf5_feats.items():
+                    f.write(hdf5_path, hdf5_data)
+            write_time += time.time() - start
+
             count += 1
         arr[0] += n_wav
         arr[1] += n_sample
@@ -475,6 +496,7 @@ def main():
         if (n_wav > 0):
             logging.info(str(arr[0])+" "+str(n_wav)+" "+str(arr[1])+" "+str(n_sample/n_wav)+" "+\
                     str(arr[2])+" "+str(n_frame/n_wav)+" max_frame = "+str(max_frame)+" max_spc_frame = "+str(max_spc_frame))
+            logging.info("cpu-%d hdf5 write time = %.3f sec (%.6f sec / utt)" % (cpu+1, write_time, write_time/n_wav))
 
     # divie list
     file_lists = np.array_split(file_list, args.n_jobs)
@@ -483,6 +505,9 @@ def main():
         logging.info('cpu-%d %d' % (i+1, len(file_lists[i])))
         logging.info(file_lists[i])
 
+    # partition cpu cores across jobs to avoid oversubscription of compute threads
+    core_sets = partition_cores(len(file_lists), cpus_per_job=args.cpus_per_job)
+
     # multi processing
     with mp.Manager() as manager:
         processes = []
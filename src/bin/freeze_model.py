@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import logging
+import torch
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_VAE_ENCODER_PAIR, GRU_SPEC_DECODER, GRU_EXCIT_DECODER
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+from vcneuvoco import copy_model, freeze_model
+
+
+def define_models(config, checkpoint):
+    """FUNCTION TO DEFINE THE MODELS OF A CHECKPOINT AS IN DECODING
+
+    Args:
+        config (Namespace): model configuration
+        checkpoint (dict): checkpoint of model state dicts
+
+    Return:
+        (dict): models with the keys of the checkpoint
+    """
+    models = {}
+    if "model_waveform" in checkpoint:
+        if hasattr(config, "seg"):
+            models["model_waveform"] = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(
+                feat_dim=config.mcep_dim+config.excit_dim,
+                upsampling_factor=config.upsampling_factor,
+                hidden_units=config.hidden_units_wave,
+                hidden_units_2=config.hidden_units_wave_2,
+                kernel_size=config.kernel_size_wave,
+                dilation_size=config.dilation_size_wave,
+                seg=config.seg,
+                lpc=config.lpc,
+                causal_conv=config.causal_conv_wave,
+                right_size=config.right_size)
+        else:
+            models["model_waveform"] = GRU_WAVE_DECODER_DUALGRU_COMPACT(
+                feat_dim=config.mcep_dim+config.excit_dim,
+                upsampling_factor=config.upsampling_factor,
+                hidden_units=config.hidden_units_wave,
+                hidden_units_2=config.hidden_units_wave_2,
+                kernel_size=config.kernel_size_wave,
+                dilation_size=config.dilation_size_wave,
+                n_quantize=config.n_quantize,
+                causal_conv=config.causal_conv_wave,
+                lpc=config.lpc)
+        return models
+
+    n_spk = len(config.spk_list.split('@'))
+    vq = "model_vq" in checkpoint
+    if vq:
+        enc_kwargs = dict(cont=False, right_size=config.right_size)
+        dec_kwargs = {}
+    else:
+        enc_kwargs = {}
+        dec_kwargs = dict(diff=config.diff)
+    if "model_encoder_mcep" in checkpoint:
+        names_enc = ["model_encoder_mcep", "model_encoder_excit"]
+    else:
+        names_enc = ["model_encoder"]
+    for name in names_enc:
+        models[name] = GRU_VAE_ENCODER(
+            in_dim=config.mcep_dim+config.excit_dim,
+            n_spk=n_spk,
+            lat_dim=config.lat_dim,
+            hidden_layers=config.hidden_layers_enc,
+            hidden_units=config.hidden_units_enc,
+            kernel_size=config.kernel_size_enc,
+            dilation_size=config.dilation_size_enc,
+            causal_conv=config.causal_conv_enc,
+            bi=config.bi_enc,
+            pad_first=True,
+            ar=config.ar_enc,
+            **enc_kwargs)
+    if "model_decoder_mcep" in checkpoint:
+        models["model_decoder_mcep"] = GRU_SPEC_DECODER(
+            feat_dim=config.lat_dim,
+            out_dim=config.mcep_dim,
+            n_spk=n_spk,
+            hidden_layers=config.hidden_layers_dec,
+            hidden_units=config.hidden_units_dec,
+            kernel_size=config.kernel_size_dec,
+            dilation_size=config.dilation_size_dec,
+            causal_conv=config.causal_conv_dec,
+            bi=config.bi_dec,
+            spkidtr_dim=config.spkidtr_dim,
+            pad_first=True,
+            ar=config.ar_dec,
+            **dec_kwargs)
+        models["model_decoder_excit"] = GRU_EXCIT_DECODER(
+            feat_dim=config.lat_dim,
+            cap_dim=config.cap_dim,
+            n_spk=n_spk,
+            hidden_layers=config.hidden_layers_dec,
+            hidden_units=config.hidden_units_dec,
+            kernel_size=config.kernel_size_dec,
+            dilation_size=config.dilation_size_dec,
+            causal_conv=config.causal_conv_dec,
+            bi=config.bi_dec,
+            spkidtr_dim=config.spkidtr_dim,
+            pad_first=True,
+            ar=config.ar_dec)
+    else:
+        models["model_decoder"] = GRU_SPEC_DECODER(
+            feat_dim=config.lat_dim,
+            out_dim=config.mcep_dim,
+            n_spk=n_spk,
+            hidden_layers=config.hidden_layers_dec,
+            hidden_units=config.hidden_units_dec,
+            kernel_size=config.kernel_size_dec,
+            dilation_size=config.dilation_size_dec,
+            causal_conv=config.causal_conv_dec,
+            bi=config.bi_dec,
+            pad_first=True,
+            ar=config.ar_dec,
+            **dec_kwargs)
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="freezing models of a checkpoint for inference, checking their parity and latency.")
+
+    parser.add_argument("--config", required=True,
+        type=str, help="configure file of the models")
+    parser.add_argument("--model", required=True,
+        type=str, help="model file (VC models or waveform model)")
+    parser.add_argument("--outmodel", required=True,
+        type=str, help="frozen model file to be saved")
+    parser.add_argument("--expdir", required=True,
+        type=str, help="directory to save the log")
+    parser.add_argument("--n_frames", default=500,
+        type=int, help="number of frames of the input")
+    parser.add_argument("--batch_size", default=1,
+        type=int, help="number of utterances of the input")
+    parser.add_argument("--n_iter", default=20,
+        type=int, help="number of timed iterations")
+    parser.add_argument("--tolerance", default=1e-4,
+        type=float, help="maximum absolute difference of outputs")
+    parser.add_argument("--verbose", default=1,
+        type=int, help="log message level")
+
+    args = parser.parse_args()
+
+    # check directory existence
+    if not os.path.exists(args.expdir):
+        os.makedirs(args.expdir)
+
+    # set log level
+    if args.verbose > 0:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S',
+                            filename=args.expdir + "/freeze_model.log")
+        logging.getLogger().addHandler(logging.StreamHandler())
+    else:
+        logging.basicConfig(level=logging.WARN,
+                            format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
+                            datefmt='%m/%d/%Y %I:%M:%S',
+                            filename=args.expdir + "/freeze_model.log")
+        logging.getLogger().addHandler(logging.StreamHandler())
+        logging.warn("logging is disabled.")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    config = torch.load(args.config)
+    checkpoint = torch.load(args.model, map_location="cpu")
+    if checkpoint.get("frozen", False):
+        logging.error("%s is already frozen." % (args.model))
+        sys.exit(1)
+    models = define_models(config, checkpoint)
+
+    def timing(func):
+        for i in range(3):
+            func()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.time()
+        for i in range(args.n_iter):
+            func()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return (time.time() - start) / args.n_iter
+
+    def tensors(outputs):
+        if isinstance(outputs, torch.Tensor):
+            return [outputs]
+        tensor_list = []
+        for output in outputs:
+            if isinstance(output, (torch.Tensor, tuple, list)):
+                tensor_list += tensors(output)
+        return tensor_list
+
+    max_diff = 0
+    # training states (optimizer, random states, etc.) are not kept
+    frozen_checkpoint = {key: value for key, value in checkpoint.items() if key.startswith("model_")}
+    models_frozen = {}
+    for name, model in models.items():
+        model.load_state_dict(checkpoint[name])
+        model.to(device)
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad = False
+        model_frozen = freeze_model(copy_model(model))
+        models_frozen[name] = model_frozen
+        frozen_checkpoint[name] = {key: value.cpu() for key, value in model_frozen.state_dict().items()}
+
+        # inputs of the non-autoregressive forward (frame-rate conditioning network of the waveform models)
+        if isinstance(model, (GRU_WAVE_DECODER_DUALGRU_COMPACT, GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG)):
+            c = torch.randn((args.batch_size, args.n_frames, model.in_dim), device=device)
+            run = lambda m: m.conv_s_c(m.conv(m.scale_in(c.transpose(1,2))))
+        elif model.ar:
+            logging.info("%s (%s) is autoregressive, frozen without parity check" % (name, type(model).__name__))
+            continue
+        else:
+            n_frames = args.n_frames+model.pad_left+model.pad_right
+            if isinstance(model, GRU_VAE_ENCODER):
+                x = torch.randn((args.batch_size, n_frames, model.in_dim), device=device)
+                run = lambda m: m(x, sampling=False)
+            else:
+                y = torch.randint(model.n_spk, (args.batch_size, 1), device=device).repeat(1, n_frames)
+                z = torch.randn((args.batch_size, n_frames, model.feat_dim), device=device)
+                if isinstance(model, GRU_SPEC_DECODER) and model.excit_dim is not None:
+                    e = torch.randn((args.batch_size, n_frames, model.excit_dim), device=device)
+                    run = lambda m: m(y, z, e=e)
+                else:
+                    run = lambda m: m(y, z)
+
+        with torch.no_grad():
+            diff = 0
+            for output, output_frozen in zip(tensors(run(model)), tensors(run(model_frozen))):
+                diff = max(diff, torch.max(torch.abs(output.float() - output_frozen.float())).item())
+            max_diff = max(max_diff, diff)
+            time_model = timing(lambda: run(model))
+            time_frozen = timing(lambda: run(model_frozen))
+        logging.info("%s (%s): %.3f ms, frozen = %.3f ms (%.2fx), max abs diff = %.3e" % (name, \
+                        type(model).__name__, time_model*1000, time_frozen*1000, \
+                            time_model/max(time_frozen, 1e-9), diff))
+
+    # frozen mcep/excit. encoders are fused at decoding, check the fused pair against the separate encoders
+    if "model_encoder_mcep" in models:
+        encoders = [models["model_encoder_mcep"], models["model_encoder_excit"]]
+        model_encoder_pair = GRU_VAE_ENCODER_PAIR(models_frozen["model_encoder_mcep"], \
+                                models_frozen["model_encoder_excit"])
+        if model_encoder_pair.fused:
+            model_encoder_pair.to(device)
+            model_encoder_pair.eval()
+            x = torch.randn((args.batch_size, args.n_frames+model_encoder_pair.pad_left+model_encoder_pair.pad_right, \
+                                encoders[0].in_dim), device=device)
+            with torch.no_grad():
+                diff = 0
+                for outputs, outputs_fused in zip([encoder(x, sampling=False) for encoder in encoders], \
+                                                    model_encoder_pair(x, sampling=False)):
+                    for output, output_fused in zip(tensors(outputs), tensors(outputs_fused)):
+                        diff = max(diff, torch.max(torch.abs(output.float() - output_fused.float())).item())
+                max_diff = max(max_diff, diff)
+                time_separate = timing(lambda: [encoder(x, sampling=False) for encoder in encoders])
+                time_fused = timing(lambda: model_encoder_pair(x, sampling=False))
+            logging.info("fused frozen encoders (%s): %.3f ms, separate = %.3f ms (%.2fx), max abs diff = %.3e" % ( \
+                            type(model_encoder_pair).__name__, time_fused*1000, time_separate*1000, \
+                                time_separate/max(time_fused, 1e-9), diff))
+        else:
+            logging.info("encoders cannot be fused, frozen without parity check of the fused pair")
+    logging.info("device = %s, batch = %d, frames = %d" % (device, args.batch_size, args.n_frames))
+
+    if max_diff > args.tolerance:
+        logging.error("frozen models differ from the original ones: %.3e > %.3e" % (max_diff, args.tolerance))
+        sys.exit(1)
+    logging.info("parity ok: %.3e <= %.3e" % (max_diff, args.tolerance))
+
+    frozen_checkpoint["frozen"] = True
+    torch.save(frozen_checkpoint, args.outmodel)
+    logging.info("frozen model saved to %s" % (args.outmodel))
+
+
+if __name__ == "__main__":
+    main()
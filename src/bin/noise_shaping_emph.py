@@ -15,10 +15,11 @@ import sys
 
 import numpy as np
 import soundfile as sf
-from scipy.signal import lfilter
 
 from utils import find_files
 from utils import read_txt
+from cpu_governor import govern_worker, partition_cores
+from dsp import preemphasis, deemphasis
 
 ##FS = 16000
 #FS = 22050
@@ -27,17 +28,6 @@ FS = 24000
 ##FS = 48000
 ALPHA = 0.85
 
-def preemphasis(x, alpha=ALPHA):
-    b = np.array([1., -alpha], x.dtype)
-    a = np.array([1.], x.dtype)
-    return lfilter(b, a, x)
-
-
-def deemphasis(x, alpha=ALPHA):
-    b = np.array([1.], x.dtype)
-    a = np.array([1., -alpha], x.dtype)
-    return lfilter(b, a, x)
-
 
 def main():
     parser = argparse.ArgumentParser(
@@ -61,6 +51,9 @@ def main():
     parser.add_argument(
         '--n_jobs', default=1,
         type=int, help="number of parallel jobs")
+    parser.add_argument(
+        '--cpus_per_job', default=None,
+        type=int, help="number of cpu cores (and compute threads) of each job (if None, the available cores are divided)")
     parser.add_argument(
         '--inv', default=False, type=strtobool,
         help="if True, inverse filtering will be performed")
@@ -76,7 +69,8 @@ def main():
     if not os.path.exists(args.writedir):
         os.makedirs(args.writedir)
 
-    def noise_shaping(wav_list):
+    def noise_shaping(wav_list, core_set):
+        govern_worker(core_set)
         for wav_name in wav_list:
             # load wavfile and apply low cut filter
             x, fs = sf.read(wav_name)
@@ -98,10 +92,11 @@ def main():
     file_lists = np.array_split(file_list, args.n_jobs)
     file_lists = [f_list.tolist() for f_list in file_lists]
 
-    # multi processing
+    # multi processing, with cpu cores partitioned across jobs
+    core_sets = partition_cores(len(file_lists), cpus_per_job=args.cpus_per_job)
     processes = []
-    for f in file_lists:
-        p = mp.Process(target=noise_shaping, args=(f,))
+    for f, core_set in zip(file_lists, core_sets):
+        p = mp.Process(target=noise_shaping, args=(f, core_set,))
         p.start()
         processes.append(p)
 
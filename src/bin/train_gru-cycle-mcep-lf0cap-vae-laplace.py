@@ -32,6 +32,10 @@ from utils import read_txt
 from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER
 from vcneuvoco import GRU_EXCIT_DECODER
 from vcneuvoco import kl_laplace
+from vcneuvoco import DataParallel, MixedPrecision, length_mask, masked_mean
+from vcneuvoco import checkpoint_forward, peak_memory
+from vcneuvoco import BlockSparsity, gru_recurrent_weights
+from vcneuvoco import decode_rec_cv
 from radam import RAdam
 
 from dataset import FeatureDatasetCycMceplf0WavVAE, FeatureDatasetEvalCycMceplf0WavVAE, padding
@@ -228,7 +232,7 @@ def eval_generator(dataloader, device, batch_size, limit_count=None, spcidx=True
 
 
 def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, \
-        optimizer, numpy_random_state, torch_random_state, iterations):
+        optimizer, numpy_random_state, torch_random_state, iterations, sparsity=None):
     """FUNCTION TO SAVE CHECKPOINT
 
     Args:
@@ -236,7 +240,9 @@ def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, mode
         model (torch.nn.Module): pytorch model instance
         optimizer (Optimizer): pytorch optimizer instance
         iterations (int): number of current iterations
+        sparsity (BlockSparsity): block-sparsification masks of recurrent weights
     """
+    device = next(model_encoder_mcep.parameters()).device
     model_encoder_mcep.cpu()
     model_decoder_mcep.cpu()
     model_encoder_excit.cpu()
@@ -250,18 +256,22 @@ def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, mode
         "numpy_random_state": numpy_random_state,
         "torch_random_state": torch_random_state,
         "iterations": iterations}
+    if sparsity is not None:
+        checkpoint["sparsity"] = sparsity.state_dict()
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     torch.save(checkpoint, checkpoint_dir + "/checkpoint-%d.pkl" % iterations)
-    model_encoder_mcep.cuda()
-    model_decoder_mcep.cuda()
-    model_encoder_excit.cuda()
-    model_decoder_excit.cuda()
+    model_encoder_mcep.to(device)
+    model_decoder_mcep.to(device)
+    model_encoder_excit.to(device)
+    model_decoder_excit.to(device)
     logging.info("%d-iter checkpoint created." % iterations)
 
 
 def write_to_tensorboard(writer, steps, loss):
     """Write to tensorboard."""
+    if writer is None:
+        return
     for key, value in loss.items():
         writer.add_scalar(key, value, steps)
 
@@ -374,6 +384,22 @@ def main():
                         type=str, help="pretrained model path")
     parser.add_argument("--string_path", required=True,
                         type=str, help="h5 path of features")
+    parser.add_argument("--dist_backend", default=None,
+                        type=str, help="backend of data-parallel training: gloo (cpu) or nccl (gpu), None for single process")
+    parser.add_argument("--dist_init", default="env://",
+                        type=str, help="init method of data-parallel process group")
+    parser.add_argument("--sparse_densities", default=None,
+                        type=str, help="final density of reset, update, new gate blocks of encoder/decoder gru recurrent weights (if None, not sparsified)")
+    parser.add_argument("--sparse_t_start", default=20000,
+                        type=int, help="iter idx to start sparsify")
+    parser.add_argument("--sparse_t_end", default=200000,
+                        type=int, help="iter idx to finish density sparsify")
+    parser.add_argument("--sparse_interval", default=100,
+                        type=int, help="interval in finishing density sparsify")
+    parser.add_argument("--grad_checkpoint", default=False,
+                        type=strtobool, help="recompute activations of each encoder/decoder call in backward to save memory")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -384,28 +410,35 @@ def main():
         os.environ["CUDA_DEVICE_ORDER"]     = "PCI_BUS_ID"
         os.environ["CUDA_VISIBLE_DEVICES"]  = str(args.GPU_device)
 
+    # data-parallel training, one process per rank (e.g., torchrun --nproc_per_node)
+    dp = DataParallel(args.dist_backend, args.dist_init)
+    if dp.rank == 0:
+        log_file = args.expdir + "/train.log"
+    else:
+        log_file = args.expdir + "/train-%d.log" % (dp.rank)
+
     # make experimental directory
     if not os.path.exists(args.expdir):
-        os.makedirs(args.expdir)
+        os.makedirs(args.expdir, exist_ok=True)
 
     # set log level
     if args.verbose == 1:
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     elif args.verbose > 1:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     else:
         logging.basicConfig(level=logging.WARN,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
         logging.warn("logging is disabled.")
 
@@ -414,9 +447,11 @@ def main():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if str(device) == "cpu":
+    device = dp.device
+    if str(device) == "cpu" and args.dist_backend is None:
         raise ValueError('ERROR: Training by CPU is not acceptable.')
+    if args.dist_backend is not None:
+        logging.info("data-parallel rank %d of %d on %s" % (dp.rank, dp.world_size, device))
 
     torch.backends.cudnn.benchmark = True #faster
 
@@ -451,7 +486,8 @@ def main():
             args.causal_conv_lf0 = True
         else:
             args.causal_conv_dec = True
-    torch.save(args, args.expdir + "/model.conf")
+    if dp.rank == 0:
+        torch.save(args, args.expdir + "/model.conf")
 
     # define network
     model_encoder_mcep = GRU_VAE_ENCODER(
@@ -529,27 +565,23 @@ def main():
         e_in_zeros_ = torch.cat((torch.zeros(1,1,1), (torch.zeros(1,1,1)-mean_stats[1:2])/scale_stats[1:2], \
                         torch.zeros(1,1,1), (torch.zeros(1,1,args.cap_dim)-mean_stats[3:args.excit_dim])/scale_stats[3:args.excit_dim]), 2)
 
-    # send to gpu
-    if torch.cuda.is_available():
-        model_encoder_mcep.cuda()
-        model_decoder_mcep.cuda()
-        model_encoder_excit.cuda()
-        model_decoder_excit.cuda()
-        criterion_ce.cuda()
-        criterion_l1.cuda()
-        criterion_l2.cuda()
-        mean_stats = mean_stats.cuda()
-        scale_stats = scale_stats.cuda()
-        if args.ar_enc:
-            yz_in_zeros_ = yz_in_zeros_.cuda()
-            yz_in_e_zeros_ = yz_in_e_zeros_.cuda()
-        if args.ar_dec:
-            x_in_zeros_ = x_in_zeros_.cuda()
-        if args.ar_f0:
-            e_in_zeros_ = e_in_zeros_.cuda()
-    else:
-        logging.error("gpu is not available. please check the setting.")
-        sys.exit(1)
+    # send to device
+    model_encoder_mcep.to(device)
+    model_decoder_mcep.to(device)
+    model_encoder_excit.to(device)
+    model_decoder_excit.to(device)
+    criterion_ce.to(device)
+    criterion_l1.to(device)
+    criterion_l2.to(device)
+    mean_stats = mean_stats.to(device)
+    scale_stats = scale_stats.to(device)
+    if args.ar_enc:
+        yz_in_zeros_ = yz_in_zeros_.to(device)
+        yz_in_e_zeros_ = yz_in_e_zeros_.to(device)
+    if args.ar_dec:
+        x_in_zeros_ = x_in_zeros_.to(device)
+    if args.ar_f0:
+        e_in_zeros_ = e_in_zeros_.to(device)
 
     model_encoder_mcep.train()
     model_decoder_mcep.train()
@@ -642,6 +674,17 @@ def main():
     optimizer = RAdam(module_list, lr=args.lr)
     #optimizer = torch.optim.Adam(module_list, lr=args.lr)
 
+    # block-sparsification masks of encoder/decoder gru recurrent weights, kept and reapplied after every update
+    if args.sparse_densities is not None:
+        sparsity = BlockSparsity(gru_recurrent_weights({"encoder_mcep": model_encoder_mcep, "decoder_mcep": model_decoder_mcep, \
+                        "encoder_excit": model_encoder_excit, "decoder_excit": model_decoder_excit}))
+        sparse_densities = dict()
+        for name in sparsity.weights.keys():
+            sparse_densities[name] = [float(density) for density in args.sparse_densities.split('-')]
+        logging.info(sparse_densities)
+    else:
+        sparsity = None
+
     # resume
     if args.pretrained is not None:
         checkpoint = torch.load(args.pretrained)
@@ -659,6 +702,8 @@ def main():
         model_encoder_excit.load_state_dict(checkpoint["model_encoder_excit"])
         model_decoder_excit.load_state_dict(checkpoint["model_decoder_excit"])
         optimizer.load_state_dict(checkpoint["optimizer"])
+        if sparsity is not None and "sparsity" in checkpoint:
+            sparsity.load_state_dict(checkpoint["sparsity"])
         epoch_idx = checkpoint["iterations"]
         logging.info("restored from %d-iter checkpoint." % epoch_idx)
     else:
@@ -681,6 +726,9 @@ def main():
         logging.error("--feats should be directory or list.")
         sys.exit(1)
     logging.info("number of training data = %d." % len(feat_list))
+    if dp.world_size > 1:
+        feat_list = dp.shard(feat_list)
+        logging.info("number of training data in rank %d = %d." % (dp.rank, len(feat_list)))
     dataset = FeatureDatasetCycMceplf0WavVAE(feat_list, pad_feat_transform, spk_list, stats_list, \
                     args.n_half_cyc, args.string_path, excit_dim=args.excit_dim)
     dataloader = DataLoader(dataset, batch_size=args.batch_size_utt, shuffle=True, num_workers=args.n_workers)
@@ -701,11 +749,36 @@ def main():
                     stats_list, args.string_path, excit_dim=args.excit_dim)
     n_eval_data = len(dataset_eval.file_list_src)
     logging.info("number of evaluation data = %d." % n_eval_data)
+    if dp.world_size > 1:
+        dataset_eval.shard(dp.rank, dp.world_size)
+        logging.info("number of evaluation data in rank %d = %d." % (dp.rank, len(dataset_eval)))
     dataloader_eval = DataLoader(dataset_eval, batch_size=args.batch_size_utt_eval, shuffle=False, num_workers=args.n_workers)
     #generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=1)
     generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=None)
 
-    writer = SummaryWriter(args.expdir)
+    # same initial parameters in all ranks
+    dp.broadcast([model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit])
+
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_encoder_mcep)
+    amp.apply(model_decoder_mcep)
+    amp.apply(model_encoder_excit)
+    amp.apply(model_decoder_excit)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
+    # activation checkpointing per half-cycle of each module
+    if args.grad_checkpoint:
+        checkpoint_forward(model_encoder_mcep)
+        checkpoint_forward(model_decoder_mcep)
+        checkpoint_forward(model_encoder_excit)
+        checkpoint_forward(model_decoder_excit)
+    logging.info("gradient checkpointing: %s" % (args.grad_checkpoint))
+
+    if dp.rank == 0:
+        writer = SummaryWriter(args.expdir)
+    else:
+        writer = None
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
 
@@ -1000,7 +1073,7 @@ def main():
         start = time.time()
         batch_feat, batch_sc, batch_sc_cv_data, batch_feat_cv_data, c_idx, utt_idx, featfile, \
             f_bs, f_ss, flens, n_batch_utt, del_index_utt, max_flen, spk_cv, idx_select, idx_select_full, flens_acc = next(generator)
-        if c_idx < 0: # summarize epoch
+        if dp.any(c_idx < 0): # summarize epoch, ended in all ranks by the first exhausted shard (generators restarted)
             # save current epoch model
             numpy_random_state = np.random.get_state()
             torch_random_state = torch.get_rng_state()
@@ -1088,6 +1161,14 @@ def main():
                             np.mean(loss_powmcep[i]), np.std(loss_powmcep[i]), np.mean(loss_mcep[i]), np.std(loss_mcep[i]), \
                             np.mean(loss_uv[i]), np.std(loss_uv[i]), np.mean(loss_f0[i]), np.std(loss_f0[i]))
             logging.info("%s (%.3f min., %.3f sec / batch)" % (text_log, total / 60.0, total / iter_count))
+            if dp.world_size > 1:
+                logging.info("gradient all-reduce of %d ranks %.3f min. (%.3f sec / batch)" % (dp.world_size, \
+                    dp.comm_time / 60.0, dp.comm_time / iter_count))
+                dp.comm_time = 0
+            logging.info("peak memory %.1f MB" % (peak_memory(device)))
+            if sparsity is not None:
+                logging.info("sparsification overhead = %.6f sec / batch" % (sparsity.time / iter_count))
+                sparsity.time = 0
             logging.info("estimated time until max. epoch = {0.days:02}:{0.hours:02}:{0.minutes:02}:"\
             "{0.seconds:02}".format(relativedelta(seconds=int((args.epoch_count - (epoch_idx + 1)) * total))))
             # compute loss in evaluation data
@@ -1468,7 +1549,7 @@ def main():
                                     _, twf_mcep, batch_mcd_src_trg, _ = dtw.dtw_org_to_trg(\
                                         np.array(trj_src_trg_[:,1:].cpu().data.numpy(), dtype=np.float64), \
                                         np.array(trj_trg_[:,1:].cpu().data.numpy(), dtype=np.float64))
-                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).cuda()
+                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).to(device)
                                     # excit dtw
                                     trj_src_trg_uv = torch.index_select(trj_src_trg_uv,0,twf_mcep)
                                     trj_src_trg_f0 = torch.index_select(trj_src_trg_f0,0,twf_mcep)
@@ -1895,6 +1976,18 @@ def main():
                     logging.info("%s (%.3f sec)" % (text_log, time.time() - start))
                     iter_count += 1
                     total += time.time() - start
+            # aggregate evaluation results of all ranks
+            if dp.world_size > 1:
+                pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_uv_src_trg, loss_f0_src_trg, \
+                    loss_uvcap_src_trg, loss_cap_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, gv_src_src, gv_src_trg, \
+                    loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_qy_py_e, loss_qy_py_err_e, loss_qz_pz_e, \
+                    loss_uv, loss_f0, loss_uvcap, loss_cap, loss_powmcep, loss_mcep, loss_mcep_cv, loss_mcep_rec, loss_uv_cv, \
+                    loss_f0_cv, loss_uvcap_cv, loss_cap_cv = \
+                    dp.all_gather_results([pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_uv_src_trg, loss_f0_src_trg, \
+                            loss_uvcap_src_trg, loss_cap_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, gv_src_src, gv_src_trg, \
+                            loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_qy_py_e, loss_qy_py_err_e, loss_qz_pz_e, \
+                            loss_uv, loss_f0, loss_uvcap, loss_cap, loss_powmcep, loss_mcep, loss_mcep_cv, loss_mcep_rec, loss_uv_cv, \
+                            loss_f0_cv, loss_uvcap_cv, loss_cap_cv])
             tmp_gv_1 = []
             tmp_gv_2 = []
             for j in range(n_spk):
@@ -2478,10 +2571,10 @@ def main():
                                 min_eval_loss_uv[i], min_eval_loss_uv_std[i], min_eval_loss_f0[i], min_eval_loss_f0_std[i])
                 logging.info("%s min_idx=%d" % (text_log, min_idx+1))
             #if ((epoch_idx + 1) % args.save_interval_epoch == 0) or (epoch_min_flag):
-            if True:
+            if dp.rank == 0:
                 logging.info('save epoch:%d' % (epoch_idx+1))
                 save_checkpoint(args.expdir, model_encoder_mcep, model_decoder_mcep, model_encoder_excit, \
-                    model_decoder_excit, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
+                    model_decoder_excit, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1, sparsity=sparsity)
             total = 0
             iter_count = 0
             for i in range(args.n_half_cyc):
@@ -2538,7 +2631,10 @@ def main():
             if args.cap_dim is not None:
                 for param in model_decoder_excit.scale_out_cap.parameters():
                     param.requires_grad = False
-            # start next epoch
+            # start next epoch, the epoch ended in all ranks by the first exhausted shard,
+            # so generators of all ranks are restarted to begin the next epoch from a new pass over their shards
+            if dp.world_size > 1:
+                generator = train_generator(dataloader, device, args.batch_size, n_cv, limit_count=None)
             if epoch_idx < args.epoch_count:
                 start = time.time()
                 logging.info("==%d EPOCH==" % (epoch_idx+1))
@@ -2733,20 +2829,24 @@ def main():
                     z[i] = qz_alpha[i][:,:,:args.lat_dim] - torch.exp(qz_alpha[i][:,:,args.lat_dim:]) * eps.sign() * torch.log1p(-eps.abs()) # sampling laplace
                     idx_in += 1
                     if args.ar_dec:
-                        batch_mcep_rec[i], h_mcep[i], x_in[i] = model_decoder_mcep(batch_sc_in[idx_in], z[i], x_in[i], h=h_mcep[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z[i], x_in_cv[i_cv], h=h_mcep_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i], x_in[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z[i], x_in[i], x_in_cv[i_cv], h=h_mcep[i], h_cv=h_mcep_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_mcep_rec[i], h_mcep[i] = model_decoder_mcep(batch_sc_in[idx_in], z[i], h=h_mcep[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z[i], h=h_mcep_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z[i], h=h_mcep[i], h_cv=h_mcep_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     eps_e = torch.empty_like(qz_alpha_e[i][:,:,:args.lat_dim_e])
                     eps_e.uniform_(eps_1,1)
                     z_e[i] = qz_alpha_e[i][:,:,:args.lat_dim_e] - torch.exp(qz_alpha_e[i][:,:,args.lat_dim_e:]) * eps_e.sign() * torch.log1p(-eps_e.abs()) # sampling laplace
                     if args.ar_f0:
-                        batch_lf0_rec[i], h_lf0[i], e_in[i] = model_decoder_excit(batch_sc_in[idx_in], z_e[i], e_in[i], h=h_lf0[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_e[i], e_in_cv[i_cv], h=h_lf0_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i], e_in[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_e[i], e_in[i], e_in_cv[i_cv], h=h_lf0[i], h_cv=h_lf0_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_lf0_rec[i], h_lf0[i] = model_decoder_excit(batch_sc_in[idx_in], z_e[i], h=h_lf0[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_e[i], h=h_lf0_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_e[i], h=h_lf0[i], h_cv=h_lf0_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     feat_len = qy_logits[i].shape[1]
                     idx_in_1 = idx_in-1
                     qy_logits[i] = qy_logits[i][:,outpad_lefts[idx_in_1]:feat_len-outpad_rights[idx_in_1]]
@@ -2870,20 +2970,24 @@ def main():
                     z[i] = qz_alpha[i][:,:,:args.lat_dim] - torch.exp(qz_alpha[i][:,:,args.lat_dim:]) * eps.sign() * torch.log1p(-eps.abs()) # sampling laplace
                     idx_in += 1
                     if args.ar_dec:
-                        batch_mcep_rec[i], h_mcep[i], x_in[i] = model_decoder_mcep(batch_sc_in[idx_in], z[i], x_in_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z[i], x_in_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i], x_in[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z[i], x_in_, x_in_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_mcep_rec[i], h_mcep[i] = model_decoder_mcep(batch_sc_in[idx_in], z[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z[i], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z[i], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     eps_e = torch.empty_like(qz_alpha_e[i][:,:,:args.lat_dim_e])
                     eps_e.uniform_(eps_1,1)
                     z_e[i] = qz_alpha_e[i][:,:,:args.lat_dim_e] - torch.exp(qz_alpha_e[i][:,:,args.lat_dim_e:]) * eps_e.sign() * torch.log1p(-eps_e.abs()) # sampling laplace
                     if args.ar_f0:
-                        batch_lf0_rec[i], h_lf0[i], e_in[i] = model_decoder_excit(batch_sc_in[idx_in], z_e[i], e_in_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_e[i], e_in_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i], e_in[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_e[i], e_in_, e_in_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_lf0_rec[i], h_lf0[i] = model_decoder_excit(batch_sc_in[idx_in], z_e[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_e[i], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_e[i], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     feat_len = qy_logits[i].shape[1]
                     idx_in_1 = idx_in-1
                     qy_logits[i] = qy_logits[i][:,outpad_lefts[idx_in_1]:feat_len-outpad_rights[idx_in_1]]
@@ -2992,117 +3096,15 @@ def main():
             # Losses computation
             batch_loss = 0
 
-            # handle short ending
+            # handle short ending by frame mask of utterance lengths within the batch losses,
+            # short endings only enter the optimized loss, the logged batch losses are of full-length utterances
+            mask = length_mask(torch.LongTensor(flens_acc).to(device), batch_mcep_rec[0].shape[1])
+            idx_log = slice(None)
             if len(idx_select) > 0:
                 logging.info('len_idx_select: '+str(len(idx_select)))
-                batch_loss_px_select = 0
-                batch_loss_qz_pz_kl_select = 0
-                batch_loss_qy_py_ce_select = 0
-                batch_loss_qy_py_err_select = 0
-                for j in range(len(idx_select)):
-                    k = idx_select[j]
-                    flens_utt = flens_acc[k]
-                    logging.info('%s %d' % (featfile[k], flens_utt))
-                    batch_feat_select = batch_feat[k,:flens_utt]
-                    powmcep = batch_feat_select[:,args.excit_dim:]
-                    uv = batch_feat_select[:,0]
-                    f0 = torch.exp(batch_feat_select[:,1])
-                    if args.cap_dim is not None:
-                        uvcap_select = batch_feat_select[:,2]
-                        cap = -torch.exp(batch_feat_select[:,3:args.excit_dim])
-
-                    batch_sc_ = batch_sc[k,:flens_utt]
-                    batch_sc_onehot_ = F.one_hot(batch_sc_, num_classes=n_spk).float()
-                    for i in range(args.n_half_cyc):
-                        qy_logits_select_ = qy_logits[i][k,:flens_utt]
-                        qy_logits_e_select_ = qy_logits_e[i][k,:flens_utt]
-
-                        ## reconst. [i % 2 == 0] / cyclic reconst. [i % 2 == 1]
-                        batch_lf0_rec_select = batch_lf0_rec[i][k,:flens_utt]
-                        uv_est = batch_lf0_rec_select[:,0]
-                        f0_est = torch.exp(batch_lf0_rec_select[:,1])
-                        if args.cap_dim is not None:
-                            uvcap_est = batch_lf0_rec_select[:,2]
-                            cap_est = -torch.exp(batch_lf0_rec_select[:,3:])
-
-                        ## U/V, lf0, codeap, mcep acc.
-                        if flens_utt > 1:
-                            batch_loss_px_select += torch.mean(mcd_constant*torch.sum(criterion_l1(batch_mcep_rec[i][k,:flens_utt], powmcep), -1)) \
-                                                        + torch.mean(100*criterion_l1(uv_est, uv)) \
-                                                            + torch.sqrt(torch.mean(criterion_l2(f0_est, f0)))
-                        else:
-                            batch_loss_px_select += torch.mean(mcd_constant*torch.sum(criterion_l1(batch_mcep_rec[i][k,:flens_utt], powmcep), -1)) \
-                                                        + torch.mean(100*criterion_l1(uv_est, uv)) \
-                                                            + torch.mean(criterion_l1(f0_est, f0))
-                        if args.cap_dim is not None:
-                            batch_loss_px_select += torch.mean(100*criterion_l1(uvcap_est, uvcap_select)) \
-                                                        + torch.mean(torch.sum(criterion_l1(cap_est, cap), -1))
-                        if i % 2 == 0:
-                            ## conversion
-                            if flens_utt > 1:
-                                batch_loss_px_select += torch.sqrt(torch.mean(criterion_l2(torch.exp(batch_lf0_cv[i//2][k,:flens_utt,1]), \
-                                                                torch.exp(batch_feat_cv[i//2][k,:flens_utt,1]))))
-                            else:
-                                batch_loss_px_select += torch.mean(criterion_l1(torch.exp(batch_lf0_cv[i//2][k,:flens_utt,1]), \
-                                                                torch.exp(batch_feat_cv[i//2][k,:flens_utt,1])))
-
-                            batch_loss_qy_py_ce_select += torch.mean(criterion_ce(qy_logits_select_, batch_sc_)) \
-                                                                + torch.mean(criterion_ce(qy_logits_e_select_, batch_sc_))
-                            batch_loss_qy_py_err_select += torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), batch_sc_onehot_), -1)) \
-                                                                + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e_select_, dim=-1), batch_sc_onehot_), -1))
-                        else:
-                            sc_cv_select_ = batch_sc_cv[i//2][k,:flens_utt]
-                            sc_cv_select_onehot_ = F.one_hot(sc_cv_select_, num_classes=n_spk).float()
-                            batch_loss_qy_py_ce_select += torch.mean(criterion_ce(qy_logits_select_, sc_cv_select_)) \
-                                                                + torch.mean(criterion_ce(qy_logits_e_select_, sc_cv_select_))
-                            batch_loss_qy_py_err_select += torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), sc_cv_select_onehot_), -1)) \
-                                                                + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e_select_, dim=-1), sc_cv_select_onehot_), -1))
-                        batch_loss_qz_pz_kl_select += torch.mean(torch.sum(kl_laplace(qz_alpha[i][k,:flens_utt]), -1)) \
-                                                        + torch.mean(torch.sum(kl_laplace(qz_alpha_e[i][k,:flens_utt]), -1))
-                batch_loss += batch_loss_px_select + batch_loss_qz_pz_kl_select + batch_loss_qy_py_ce_select + batch_loss_qy_py_err_select
                 if len(idx_select_full) > 0:
                     logging.info('len_idx_select_full: '+str(len(idx_select_full)))
-                    batch_feat = torch.index_select(batch_feat,0,idx_select_full)
-                    batch_sc = torch.index_select(batch_sc,0,idx_select_full)
-                    for i in range(args.n_half_cyc):
-                        batch_mcep_rec[i] = torch.index_select(batch_mcep_rec[i],0,idx_select_full)
-                        batch_lf0_rec[i] = torch.index_select(batch_lf0_rec[i],0,idx_select_full)
-                        qz_alpha[i] = torch.index_select(qz_alpha[i],0,idx_select_full)
-                        qy_logits[i] = torch.index_select(qy_logits[i],0,idx_select_full)
-                        qz_alpha_e[i] = torch.index_select(qz_alpha_e[i],0,idx_select_full)
-                        qy_logits_e[i] = torch.index_select(qy_logits_e[i],0,idx_select_full)
-                        if i % 2 == 0:
-                            batch_mcep_cv[i//2] = torch.index_select(batch_mcep_cv[i//2],0,idx_select_full)
-                            batch_feat_cv[i//2] = torch.index_select(batch_feat_cv[i//2],0,idx_select_full)
-                            batch_lf0_cv[i//2] = torch.index_select(batch_lf0_cv[i//2],0,idx_select_full)
-                            batch_sc_cv[i//2] = torch.index_select(batch_sc_cv[i//2],0,idx_select_full)
-                            if args.n_half_cyc == 1:
-                                qz_alpha[i+1] = torch.index_select(qz_alpha[i+1],0,idx_select_full)
-                                qy_logits[i+1] = torch.index_select(qy_logits[i+1],0,idx_select_full)
-                                qz_alpha_e[i+1] = torch.index_select(qz_alpha_e[i+1],0,idx_select_full)
-                                qy_logits_e[i+1] = torch.index_select(qy_logits_e[i+1],0,idx_select_full)
-                else:
-                    optimizer.zero_grad()
-                    batch_loss.backward()
-                    optimizer.step()
-
-                    text_log = "batch loss_select %lf " % (batch_loss.item())
-                    logging.info("%s (%.3f sec)" % (text_log, time.time() - start))
-                    iter_idx += 1
-                    #if iter_idx % args.save_interval_iter == 0:
-                    #    logging.info('save iter:%d' % (iter_idx))
-                    #    save_checkpoint(args.expdir, model_encoder, model_decoder, model_lf0, \
-                    #        optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
-                    iter_count += 1
-                    if iter_idx % args.log_interval_steps == 0:
-                        logging.info('smt')
-                        for key in total_train_loss.keys():
-                            total_train_loss[key] = np.mean(total_train_loss[key])
-                            logging.info(f"(Steps: {iter_idx}) {key} = {total_train_loss[key]:.4f}.")
-                        write_to_tensorboard(writer, iter_idx, total_train_loss)
-                        total_train_loss = defaultdict(list)
-                    total += time.time() - start
-                    continue
+                    idx_log = idx_select_full
 
             # loss_compute
             uv = batch_feat[:,:,0]
@@ -3134,82 +3136,83 @@ def main():
                     sc_cv_onehot = F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()
 
                 ## U/V, lf0, codeap, mcep acc.
-                batch_loss_uv_ = torch.mean(100*criterion_l1(uv_est, uv), -1)
-                batch_loss_uv[i] = batch_loss_uv_.mean()
-                batch_loss_f0_ = torch.sqrt(torch.mean(criterion_l2(f0_est, f0), -1))
-                batch_loss_f0[i] = batch_loss_f0_.mean()
+                batch_loss_uv_ = masked_mean(100*criterion_l1(uv_est, uv), mask)
+                batch_loss_uv[i] = batch_loss_uv_[idx_log].mean()
+                batch_loss_f0_ = torch.sqrt(masked_mean(criterion_l2(f0_est, f0), mask))
+                batch_loss_f0[i] = batch_loss_f0_[idx_log].mean()
                 batch_loss_px[i] = batch_loss_uv[i] + batch_loss_f0[i]
-                batch_loss_px_sum = batch_loss_uv_.sum() + batch_loss_f0_.sum()
+                batch_loss_px_ = batch_loss_uv_ + batch_loss_f0_
                 if args.cap_dim is not None:
-                    batch_loss_uvcap_ = torch.mean(100*criterion_l1(uvcap_est, uvcap), -1)
-                    batch_loss_uvcap[i] = batch_loss_uvcap_.mean()
-                    batch_loss_cap_ = torch.mean(torch.sum(criterion_l1(cap_est, cap), -1), -1)
-                    batch_loss_cap[i] = batch_loss_cap_.mean()
+                    batch_loss_uvcap_ = masked_mean(100*criterion_l1(uvcap_est, uvcap), mask)
+                    batch_loss_uvcap[i] = batch_loss_uvcap_[idx_log].mean()
+                    batch_loss_cap_ = masked_mean(torch.sum(criterion_l1(cap_est, cap), -1), mask)
+                    batch_loss_cap[i] = batch_loss_cap_[idx_log].mean()
                     batch_loss_px[i] += batch_loss_uvcap[i] + batch_loss_cap[i]
-                    batch_loss_px_sum += batch_loss_uvcap_.sum() + batch_loss_cap_.sum()
-                batch_loss_powmcep_ = torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), -1)
-                batch_loss_powmcep[i] = batch_loss_powmcep_.mean()
-                batch_loss_mcep[i] = torch.mean(torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), -1))
-                batch_loss_px_mcep_ = torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), -1)
-                batch_loss_mcep_rec[i] = batch_loss_px_mcep_.mean()
+                    batch_loss_px_ += batch_loss_uvcap_ + batch_loss_cap_
+                batch_loss_powmcep_ = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), mask)
+                batch_loss_powmcep[i] = batch_loss_powmcep_[idx_log].mean()
+                batch_loss_mcep[i] = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), mask)[idx_log].mean()
+                batch_loss_px_mcep_ = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), mask)
+                batch_loss_mcep_rec[i] = batch_loss_px_mcep_[idx_log].mean()
                 batch_loss_px[i] += batch_loss_mcep_rec[i]
-                batch_loss_px_sum += batch_loss_px_mcep_.sum()
+                batch_loss_px_ += batch_loss_px_mcep_
 
                 ## conversion
                 if i % 2 == 0:
-                    batch_loss_uv_cv[i//2] = torch.mean(torch.mean(100*criterion_l1(uv_cv, uv), -1))
-                    batch_loss_f0_cv_ = torch.sqrt(torch.mean(criterion_l2(f0_cv, f0cv), -1))
-                    batch_loss_f0_cv[i//2] = batch_loss_f0_cv_.mean()
+                    batch_loss_uv_cv[i//2] = masked_mean(100*criterion_l1(uv_cv, uv), mask)[idx_log].mean()
+                    batch_loss_f0_cv_ = torch.sqrt(masked_mean(criterion_l2(f0_cv, f0cv), mask))
+                    batch_loss_f0_cv[i//2] = batch_loss_f0_cv_[idx_log].mean()
                     batch_loss_px[i] += batch_loss_f0_cv[i//2]
-                    batch_loss_px_sum += batch_loss_f0_cv_.sum()
+                    batch_loss_px_ += batch_loss_f0_cv_
                     if args.cap_dim is not None:
-                        batch_loss_uvcap_cv[i//2] = torch.mean(torch.mean(100*criterion_l1(uvcap_cv, uvcap), -1))
-                        batch_loss_cap_cv[i//2] = torch.mean(torch.mean(torch.sum(criterion_l1(cap_cv, cap), -1), -1))
-                    batch_loss_mcep_cv[i//2] = torch.mean(torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), -1))
+                        batch_loss_uvcap_cv[i//2] = masked_mean(100*criterion_l1(uvcap_cv, uvcap), mask)[idx_log].mean()
+                        batch_loss_cap_cv[i//2] = masked_mean(torch.sum(criterion_l1(cap_cv, cap), -1), mask)[idx_log].mean()
+                    batch_loss_mcep_cv[i//2] = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), mask)[idx_log].mean()
 
                 # KL-div latent-posterior, CE and error-percentage speaker-posterior
                 if i % 2 == 0:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
                     if args.n_half_cyc == 1:
-                        batch_loss_qy_py[i+1] = torch.mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1).mean()
-                        batch_loss_qy_py_err[i+1] = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1).mean()
-                        batch_loss_qz_pz[i+1] = torch.mean(torch.sum(kl_laplace(qz_alpha[i+1]), -1), -1).mean()
+                        batch_loss_qy_py[i+1] = masked_mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)[idx_log].mean()
+                        batch_loss_qy_py_err[i+1] = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)[idx_log].mean()
+                        batch_loss_qz_pz[i+1] = masked_mean(torch.sum(kl_laplace(qz_alpha[i+1]), -1), mask)[idx_log].mean()
                 else:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_cv_onehot), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
-                batch_loss_qz_pz_ = torch.mean(torch.sum(kl_laplace(qz_alpha[i]), -1), -1)
-                batch_loss_qz_pz[i] = batch_loss_qz_pz_.mean()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_cv_onehot), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
+                batch_loss_qz_pz_ = masked_mean(torch.sum(kl_laplace(qz_alpha[i]), -1), mask)
+                batch_loss_qz_pz[i] = batch_loss_qz_pz_[idx_log].mean()
                 if i % 2 == 0:
-                    batch_loss_qy_py_e_ = torch.mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), -1)
-                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_.mean()
-                    batch_loss_qy_py_err_e_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_onehot), -1), -1)
-                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_.mean()
+                    batch_loss_qy_py_e_ = masked_mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), mask)
+                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_[idx_log].mean()
+                    batch_loss_qy_py_err_e_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_onehot), -1), mask)
+                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_[idx_log].mean()
                     if args.n_half_cyc == 1:
-                        batch_loss_qy_py_e[i+1] = torch.mean(criterion_ce(qy_logits_e[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1).mean()
-                        batch_loss_qy_py_err_e[i+1] = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1).mean()
-                        batch_loss_qz_pz_e[i+1] = torch.mean(torch.sum(kl_laplace(qz_alpha_e[i+1]), -1), -1).mean()
+                        batch_loss_qy_py_e[i+1] = masked_mean(criterion_ce(qy_logits_e[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)[idx_log].mean()
+                        batch_loss_qy_py_err_e[i+1] = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)[idx_log].mean()
+                        batch_loss_qz_pz_e[i+1] = masked_mean(torch.sum(kl_laplace(qz_alpha_e[i+1]), -1), mask)[idx_log].mean()
                 else:
-                    batch_loss_qy_py_e_ = torch.mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1)
-                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_.mean()
-                    batch_loss_qy_py_err_e_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_cv_onehot), -1), -1)
-                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_.mean()
-                batch_loss_qz_pz_e_ = torch.mean(torch.sum(kl_laplace(qz_alpha_e[i]), -1), -1)
-                batch_loss_qz_pz_e[i] = batch_loss_qz_pz_e_.mean()
+                    batch_loss_qy_py_e_ = masked_mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)
+                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_[idx_log].mean()
+                    batch_loss_qy_py_err_e_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_cv_onehot), -1), mask)
+                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_[idx_log].mean()
+                batch_loss_qz_pz_e_ = masked_mean(torch.sum(kl_laplace(qz_alpha_e[i]), -1), mask)
+                batch_loss_qz_pz_e[i] = batch_loss_qz_pz_e_[idx_log].mean()
 
-                batch_loss_qy_py_ce = batch_loss_qy_py_.sum() + batch_loss_qy_py_e_.sum()
-                batch_loss_qy_py_prc = batch_loss_qy_py_err_.sum() + batch_loss_qy_py_err_e_.sum()
-                batch_loss_qz_pz_kl = batch_loss_qz_pz_.sum() + batch_loss_qz_pz_e_.sum()
+                batch_loss_qy_py_ce_ = batch_loss_qy_py_ + batch_loss_qy_py_e_
+                batch_loss_qy_py_prc_ = batch_loss_qy_py_err_ + batch_loss_qy_py_err_e_
+                batch_loss_qz_pz_kl_ = batch_loss_qz_pz_ + batch_loss_qz_pz_e_
 
                 # elbo
-                batch_loss_elbo[i] = batch_loss_px_sum + batch_loss_qy_py_ce + batch_loss_qy_py_prc + batch_loss_qz_pz_kl
-                batch_loss += batch_loss_elbo[i]
+                batch_loss_elbo_ = batch_loss_px_ + batch_loss_qy_py_ce_ + batch_loss_qy_py_prc_ + batch_loss_qz_pz_kl_
+                batch_loss_elbo[i] = batch_loss_elbo_[idx_log].sum()
+                batch_loss += batch_loss_elbo_.sum()
 
                 total_train_loss["train/loss_elbo-%d"%(i+1)].append(batch_loss_elbo[i].item())
                 total_train_loss["train/loss_px-%d"%(i+1)].append(batch_loss_px[i].item())
@@ -3272,8 +3275,13 @@ def main():
                     loss_qz_pz_e[i+1].append(batch_loss_qz_pz_e[i+1].item())
 
             optimizer.zero_grad()
-            batch_loss.backward()
-            optimizer.step()
+            amp.backward(batch_loss)
+            dp.all_reduce_grads([model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit])
+            amp.step(optimizer)
+
+            if sparsity is not None:
+                with torch.no_grad():
+                    sparsity.step(iter_idx + 1, args.sparse_t_start, args.sparse_t_end, args.sparse_interval, sparse_densities)
 
             text_log = "batch loss [%d] %d %d " % (c_idx+1, f_ss, f_bs)
             for i in range(args.n_half_cyc):
@@ -3360,15 +3368,16 @@ def main():
 
 
     # save final model
-    model_encoder_mcep.cpu()
-    model_decoder_mcep.cpu()
-    model_encoder_excit.cpu()
-    model_decoder_excit.cpu()
-    torch.save({"model_encoder_mcep": model_encoder_mcep.state_dict(),
-                "model_decoder_mcep": model_decoder_mcep.state_dict(),
-                "model_encoder_excit": model_encoder_excit.state_dict(),
-                "model_decoder_excit": model_decoder_excit.state_dict()}, args.expdir + "/checkpoint-final.pkl")
-    logging.info("final checkpoint created.")
+    if dp.rank == 0:
+        model_encoder_mcep.cpu()
+        model_decoder_mcep.cpu()
+        model_encoder_excit.cpu()
+        model_decoder_excit.cpu()
+        torch.save({"model_encoder_mcep": model_encoder_mcep.state_dict(),
+                    "model_decoder_mcep": model_decoder_mcep.state_dict(),
+                    "model_encoder_excit": model_encoder_excit.state_dict(),
+                    "model_decoder_excit": model_decoder_excit.state_dict()}, args.expdir + "/checkpoint-final.pkl")
+        logging.info("final checkpoint created.")
 
 
 if __name__ == "__main__":
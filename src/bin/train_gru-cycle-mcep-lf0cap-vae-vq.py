@@ -31,6 +31,10 @@ from utils import read_hdf5, write_hdf5, check_hdf5
 from utils import read_txt
 from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER
 from vcneuvoco import GRU_EXCIT_DECODER, nn_search_batch
+from vcneuvoco import DataParallel, MixedPrecision, length_mask, masked_mean
+from vcneuvoco import checkpoint_forward, peak_memory
+from vcneuvoco import BlockSparsity, gru_recurrent_weights
+from vcneuvoco import decode_rec_cv
 from radam import RAdam
 
 from dataset import FeatureDatasetCycMceplf0WavVAE, FeatureDatasetEvalCycMceplf0WavVAE, padding
@@ -229,7 +233,7 @@ def eval_generator(dataloader, device, batch_size, limit_count=None, spcidx=True
 
 
 def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, model_encoder_excit, \
-        model_decoder_excit, model_vq, optimizer, numpy_random_state, torch_random_state, iterations):
+        model_decoder_excit, model_vq, optimizer, numpy_random_state, torch_random_state, iterations, sparsity=None):
     """FUNCTION TO SAVE CHECKPOINT
 
     Args:
@@ -237,7 +241,9 @@ def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, mode
         model (torch.nn.Module): pytorch model instance
         optimizer (Optimizer): pytorch optimizer instance
         iterations (int): number of current iterations
+        sparsity (BlockSparsity): block-sparsification masks of recurrent weights
     """
+    device = next(model_encoder_mcep.parameters()).device
     model_encoder_mcep.cpu()
     model_decoder_mcep.cpu()
     model_encoder_excit.cpu()
@@ -253,19 +259,23 @@ def save_checkpoint(checkpoint_dir, model_encoder_mcep, model_decoder_mcep, mode
         "numpy_random_state": numpy_random_state,
         "torch_random_state": torch_random_state,
         "iterations": iterations}
+    if sparsity is not None:
+        checkpoint["sparsity"] = sparsity.state_dict()
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     torch.save(checkpoint, checkpoint_dir + "/checkpoint-%d.pkl" % iterations)
-    model_encoder_mcep.cuda()
-    model_decoder_mcep.cuda()
-    model_encoder_excit.cuda()
-    model_decoder_excit.cuda()
-    model_vq.cuda()
+    model_encoder_mcep.to(device)
+    model_decoder_mcep.to(device)
+    model_encoder_excit.to(device)
+    model_decoder_excit.to(device)
+    model_vq.to(device)
     logging.info("%d-iter checkpoint created." % iterations)
 
 
 def write_to_tensorboard(writer, steps, loss):
     """Write to tensorboard."""
+    if writer is None:
+        return
     for key, value in loss.items():
         writer.add_scalar(key, value, steps)
 
@@ -380,6 +390,22 @@ def main():
                         type=str, help="pretrained model path")
     parser.add_argument("--string_path", required=True,
                         type=str, help="h5 path of features")
+    parser.add_argument("--dist_backend", default=None,
+                        type=str, help="backend of data-parallel training: gloo (cpu) or nccl (gpu), None for single process")
+    parser.add_argument("--dist_init", default="env://",
+                        type=str, help="init method of data-parallel process group")
+    parser.add_argument("--sparse_densities", default=None,
+                        type=str, help="final density of reset, update, new gate blocks of encoder/decoder gru recurrent weights (if None, not sparsified)")
+    parser.add_argument("--sparse_t_start", default=20000,
+                        type=int, help="iter idx to start sparsify")
+    parser.add_argument("--sparse_t_end", default=200000,
+                        type=int, help="iter idx to finish density sparsify")
+    parser.add_argument("--sparse_interval", default=100,
+                        type=int, help="interval in finishing density sparsify")
+    parser.add_argument("--grad_checkpoint", default=False,
+                        type=strtobool, help="recompute activations of each encoder/decoder call in backward to save memory")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -390,28 +416,35 @@ def main():
         os.environ["CUDA_DEVICE_ORDER"]     = "PCI_BUS_ID"
         os.environ["CUDA_VISIBLE_DEVICES"]  = str(args.GPU_device)
 
+    # data-parallel training, one process per rank (e.g., torchrun --nproc_per_node)
+    dp = DataParallel(args.dist_backend, args.dist_init)
+    if dp.rank == 0:
+        log_file = args.expdir + "/train.log"
+    else:
+        log_file = args.expdir + "/train-%d.log" % (dp.rank)
+
     # make experimental directory
     if not os.path.exists(args.expdir):
-        os.makedirs(args.expdir)
+        os.makedirs(args.expdir, exist_ok=True)
 
     # set log level
     if args.verbose == 1:
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     elif args.verbose > 1:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     else:
         logging.basicConfig(level=logging.WARN,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
         logging.warn("logging is disabled.")
 
@@ -420,9 +453,11 @@ def main():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if str(device) == "cpu":
+    device = dp.device
+    if str(device) == "cpu" and args.dist_backend is None:
         raise ValueError('ERROR: Training by CPU is not acceptable.')
+    if args.dist_backend is not None:
+        logging.info("data-parallel rank %d of %d on %s" % (dp.rank, dp.world_size, device))
 
     torch.backends.cudnn.benchmark = True #faster
 
@@ -460,7 +495,8 @@ def main():
             args.causal_conv_lf0 = True
         else:
             args.causal_conv_dec = True
-    torch.save(args, args.expdir + "/model.conf")
+    if dp.rank == 0:
+        torch.save(args, args.expdir + "/model.conf")
 
     # define network
     model_encoder_mcep = GRU_VAE_ENCODER(
@@ -539,30 +575,26 @@ def main():
     if args.ar_f0:
         e_in_zeros_ = torch.cat((torch.zeros(1,1,1), (torch.zeros(1,1,1)-mean_stats[1:2])/scale_stats[1:2], torch.zeros(1,1,1), (torch.zeros(1,1,args.cap_dim)-mean_cap)/scale_cap), 2)
 
-    # send to gpu
-    if torch.cuda.is_available():
-        model_encoder_mcep.cuda()
-        model_decoder_mcep.cuda()
-        model_encoder_excit.cuda()
-        model_decoder_excit.cuda()
-        model_vq.cuda()
-        criterion_ce.cuda()
-        criterion_l1.cuda()
-        criterion_l2.cuda()
-        mean_stats = mean_stats.cuda()
-        scale_stats = scale_stats.cuda()
-        mean_cap = mean_cap.cuda()
-        scale_cap = scale_cap.cuda()
-        if args.ar_enc:
-            yz_in_zeros_ = yz_in_zeros_.cuda()
-            yz_in_e_zeros_ = yz_in_e_zeros_.cuda()
-        if args.ar_dec:
-            x_in_zeros_ = x_in_zeros_.cuda()
-        if args.ar_f0:
-            e_in_zeros_ = e_in_zeros_.cuda()
-    else:
-        logging.error("gpu is not available. please check the setting.")
-        sys.exit(1)
+    # send to device
+    model_encoder_mcep.to(device)
+    model_decoder_mcep.to(device)
+    model_encoder_excit.to(device)
+    model_decoder_excit.to(device)
+    model_vq.to(device)
+    criterion_ce.to(device)
+    criterion_l1.to(device)
+    criterion_l2.to(device)
+    mean_stats = mean_stats.to(device)
+    scale_stats = scale_stats.to(device)
+    mean_cap = mean_cap.to(device)
+    scale_cap = scale_cap.to(device)
+    if args.ar_enc:
+        yz_in_zeros_ = yz_in_zeros_.to(device)
+        yz_in_e_zeros_ = yz_in_e_zeros_.to(device)
+    if args.ar_dec:
+        x_in_zeros_ = x_in_zeros_.to(device)
+    if args.ar_f0:
+        e_in_zeros_ = e_in_zeros_.to(device)
 
     model_encoder_mcep.train()
     model_decoder_mcep.train()
@@ -659,6 +691,17 @@ def main():
         optimizer = RAdam(module_list, lr=args.lr)
         #optimizer = torch.optim.Adam(module_list, lr=args.lr)
 
+    # block-sparsification masks of encoder/decoder gru recurrent weights, kept and reapplied after every update
+    if args.sparse_densities is not None:
+        sparsity = BlockSparsity(gru_recurrent_weights({"encoder_mcep": model_encoder_mcep, "decoder_mcep": model_decoder_mcep, \
+                        "encoder_excit": model_encoder_excit, "decoder_excit": model_decoder_excit}))
+        sparse_densities = dict()
+        for name in sparsity.weights.keys():
+            sparse_densities[name] = [float(density) for density in args.sparse_densities.split('-')]
+        logging.info(sparse_densities)
+    else:
+        sparsity = None
+
     # resume
     if args.pretrained is not None:
         checkpoint = torch.load(args.pretrained)
@@ -678,6 +721,8 @@ def main():
         model_decoder_excit.load_state_dict(checkpoint["model_decoder_excit"])
         model_vq.load_state_dict(checkpoint["model_vq"])
         optimizer.load_state_dict(checkpoint["optimizer"])
+        if sparsity is not None and "sparsity" in checkpoint:
+            sparsity.load_state_dict(checkpoint["sparsity"])
         epoch_idx = checkpoint["iterations"]
         logging.info("restored from %d-iter checkpoint." % epoch_idx)
     else:
@@ -700,6 +745,9 @@ def main():
         logging.error("--feats should be directory or list.")
         sys.exit(1)
     logging.info("number of training data = %d." % len(feat_list))
+    if dp.world_size > 1:
+        feat_list = dp.shard(feat_list)
+        logging.info("number of training data in rank %d = %d." % (dp.rank, len(feat_list)))
     dataset = FeatureDatasetCycMceplf0WavVAE(feat_list, pad_feat_transform, spk_list, stats_list, \
                     args.n_half_cyc, args.string_path, excit_dim=args.full_excit_dim)
     dataloader = DataLoader(dataset, batch_size=args.batch_size_utt, shuffle=True, num_workers=args.n_workers)
@@ -720,6 +768,9 @@ def main():
                     stats_list, args.string_path, excit_dim=args.full_excit_dim)
     n_eval_data = len(dataset_eval.file_list_src)
     logging.info("number of evaluation data = %d." % n_eval_data)
+    if dp.world_size > 1:
+        dataset_eval.shard(dp.rank, dp.world_size)
+        logging.info("number of evaluation data in rank %d = %d." % (dp.rank, len(dataset_eval)))
     dataloader_eval = DataLoader(dataset_eval, batch_size=args.batch_size_utt_eval, shuffle=False, num_workers=args.n_workers)
     #generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=1)
     generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=None)
@@ -736,8 +787,10 @@ def main():
         z_list = None
         init = True
         init = False
-        if not check_hdf5(args.stats, "/vq-mcep-excit_"+str(args.lat_dim)+"-"+str(args.ctr_size)):
+        if dp.rank == 0 and not check_hdf5(args.stats, "/vq-mcep-excit_"+str(args.lat_dim)+"-"+str(args.ctr_size)):
             init =True
+        # latents of the K-means init are sampled from the shards of all ranks, as from the whole list in one process
+        init = dp.any(init)
         if init:
             with torch.no_grad():
                 while True:
@@ -779,8 +832,8 @@ def main():
                             _, z_e, h_z_e = model_encoder_excit(batch_feat, h=h_z_e)
                     else:
                         if args.ar_enc:
-                            yz_in_ = torch.zeros((batch_feat.shape[0], 1, n_spk+args.lat_dim)).cuda()
-                            yz_in_e_ = torch.zeros((batch_feat.shape[0], 1, n_spk+args.lat_dim_e)).cuda()
+                            yz_in_ = torch.zeros((batch_feat.shape[0], 1, n_spk+args.lat_dim)).to(device)
+                            yz_in_e_ = torch.zeros((batch_feat.shape[0], 1, n_spk+args.lat_dim_e)).to(device)
                             _, z, h_z, yz_in = model_encoder_mcep(batch_feat, yz_in=yz_in_)
                             _, z_e, h_z_e, yz_in_e = model_encoder_excit(batch_feat, yz_in=yz_in_e_)
                         else:
@@ -797,26 +850,32 @@ def main():
                     logging.info("[%d] %d %d %d" % (c_idx+1, f_ss, f_es, max_flen))
                     total.append(time.time() - start)
 
-                    if z_list.shape[0] >= 1000000:
+                    if z_list.shape[0]*dp.world_size >= 1000000:
                         break
                 torch.cuda.empty_cache()
                 logging.info("decode lat in %.3f min (%.3f sec / batch)" % (sum(total)/60, np.mean(total)))
-                start = time.time()
-                X = z_list
-                logging.info(X.shape)
-                kmeans = KMeans(n_clusters=args.ctr_size, random_state=0, n_jobs=50).fit(X)
-                labels = np.array(kmeans.labels_)
-                centroids = kmeans.cluster_centers_
-                write_hdf5(args.stats, "/vq-mcep-excit_"+str(args.lat_dim)+"-"+str(args.ctr_size), centroids)
-                logging.info(kmeans.inertia_)
-                unique, counts = np.unique(labels, return_counts=True)
-                cluster_stats = dict(zip(unique, counts))
-                logging.info(cluster_stats)
-                logging.info("K-means clustering [mcep-excit] in %.3f sec" % (time.time() - start))
-        else:
+                z_list = dp.gather_rows(z_list)
+                if dp.rank == 0:
+                    start = time.time()
+                    X = z_list
+                    logging.info(X.shape)
+                    kmeans = KMeans(n_clusters=args.ctr_size, random_state=0, n_jobs=50).fit(X)
+                    labels = np.array(kmeans.labels_)
+                    centroids = kmeans.cluster_centers_
+                    write_hdf5(args.stats, "/vq-mcep-excit_"+str(args.lat_dim)+"-"+str(args.ctr_size), centroids)
+                    logging.info(kmeans.inertia_)
+                    unique, counts = np.unique(labels, return_counts=True)
+                    cluster_stats = dict(zip(unique, counts))
+                    logging.info(cluster_stats)
+                    logging.info("K-means clustering [mcep-excit] in %.3f sec" % (time.time() - start))
+                else: # broadcast from rank 0
+                    centroids = np.zeros((args.ctr_size, args.lat_dim))
+        elif dp.rank == 0:
             centroids = read_hdf5(args.stats, "/vq-mcep-excit_"+str(args.lat_dim)+"-"+str(args.ctr_size))
             logging.info(centroids.shape)
-        centroids = torch.FloatTensor(centroids).cuda()
+        else: # broadcast from rank 0
+            centroids = np.zeros((args.ctr_size, args.lat_dim))
+        centroids = torch.FloatTensor(centroids).to(device)
         model_vq.weight = torch.nn.Parameter(centroids.data)
         model_encoder_mcep.train()
         model_encoder_excit.train()
@@ -824,7 +883,29 @@ def main():
         optimizer = RAdam(module_list, lr=args.lr)
         #optimizer = torch.optim.Adam(module_list, lr=args.lr)
 
-    writer = SummaryWriter(args.expdir)
+    # same initial parameters in all ranks
+    dp.broadcast([model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_vq])
+
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_encoder_mcep)
+    amp.apply(model_decoder_mcep)
+    amp.apply(model_encoder_excit)
+    amp.apply(model_decoder_excit)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
+    # activation checkpointing per half-cycle of each module
+    if args.grad_checkpoint:
+        checkpoint_forward(model_encoder_mcep)
+        checkpoint_forward(model_decoder_mcep)
+        checkpoint_forward(model_encoder_excit)
+        checkpoint_forward(model_decoder_excit)
+    logging.info("gradient checkpointing: %s" % (args.grad_checkpoint))
+
+    if dp.rank == 0:
+        writer = SummaryWriter(args.expdir)
+    else:
+        writer = None
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
 
@@ -1128,7 +1209,7 @@ def main():
         start = time.time()
         batch_feat, batch_sc, batch_sc_cv_data, batch_feat_cv_data, c_idx, utt_idx, featfile, \
             f_bs, f_ss, flens, n_batch_utt, del_index_utt, max_flen, spk_cv, idx_select, idx_select_full, flens_acc = next(generator)
-        if c_idx < 0: # summarize epoch
+        if dp.any(c_idx < 0): # summarize epoch, ended in all ranks by the first exhausted shard (generators restarted)
             # save current epoch model
             numpy_random_state = np.random.get_state()
             torch_random_state = torch.get_rng_state()
@@ -1179,6 +1260,14 @@ def main():
                         np.mean(loss_uv[i]), np.std(loss_uv[i]), np.mean(loss_f0[i]), np.std(loss_f0[i]), \
                         np.mean(loss_uvcap[i]), np.std(loss_uvcap[i]), np.mean(loss_cap[i]), np.std(loss_cap[i]))
             logging.info("%s (%.3f min., %.3f sec / batch)" % (text_log, total / 60.0, total / iter_count))
+            if dp.world_size > 1:
+                logging.info("gradient all-reduce of %d ranks %.3f min. (%.3f sec / batch)" % (dp.world_size, \
+                    dp.comm_time / 60.0, dp.comm_time / iter_count))
+                dp.comm_time = 0
+            logging.info("peak memory %.1f MB" % (peak_memory(device)))
+            if sparsity is not None:
+                logging.info("sparsification overhead = %.6f sec / batch" % (sparsity.time / iter_count))
+                sparsity.time = 0
             logging.info("estimated time until max. epoch = {0.days:02}:{0.hours:02}:{0.minutes:02}:"\
             "{0.seconds:02}".format(relativedelta(seconds=int((args.epoch_count - (epoch_idx + 1)) * total))))
             # compute loss in evaluation data
@@ -1585,7 +1674,7 @@ def main():
                                     _, twf_mcep, batch_mcd_src_trg, _ = dtw.dtw_org_to_trg(\
                                         np.array(trj_src_trg_[:,1:].cpu().data.numpy(), dtype=np.float64), \
                                         np.array(trj_trg_[:,1:].cpu().data.numpy(), dtype=np.float64))
-                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).cuda()
+                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).to(device)
                                     # excit dtw
                                     trj_src_trg_uv = torch.index_select(trj_src_trg_uv,0,twf_mcep)
                                     trj_src_trg_f0 = torch.index_select(trj_src_trg_f0,0,twf_mcep)
@@ -1978,6 +2067,18 @@ def main():
                     logging.info("%s (%.3f sec)" % (text_log, time.time() - start))
                     iter_count += 1
                     total += time.time() - start
+            # aggregate evaluation results of all ranks
+            if dp.world_size > 1:
+                pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_uv_src_trg, loss_f0_src_trg, \
+                    loss_uvcap_src_trg, loss_cap_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, gv_src_src, gv_src_trg, \
+                    loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_qy_py_e, loss_qy_py_err_e, loss_qz_pz_e, \
+                    loss_uv, loss_f0, loss_uvcap, loss_cap, loss_powmcep, loss_mcep, loss_mcep_cv, loss_mcep_rec, loss_uv_cv, \
+                    loss_f0_cv, loss_uvcap_cv, loss_cap_cv = \
+                    dp.all_gather_results([pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_uv_src_trg, loss_f0_src_trg, \
+                            loss_uvcap_src_trg, loss_cap_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, gv_src_src, gv_src_trg, \
+                            loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_qy_py_e, loss_qy_py_err_e, loss_qz_pz_e, \
+                            loss_uv, loss_f0, loss_uvcap, loss_cap, loss_powmcep, loss_mcep, loss_mcep_cv, loss_mcep_rec, loss_uv_cv, \
+                            loss_f0_cv, loss_uvcap_cv, loss_cap_cv])
             tmp_gv_1 = []
             tmp_gv_2 = []
             for j in range(n_spk):
@@ -2371,10 +2472,10 @@ def main():
                             min_eval_loss_uvcap[i], min_eval_loss_uvcap_std[i], min_eval_loss_cap[i], min_eval_loss_cap_std[i])
                 logging.info("%s min_idx=%d" % (text_log, min_idx+1))
             #if ((epoch_idx + 1) % args.save_interval_epoch == 0) or (epoch_min_flag):
-            if True:
+            if dp.rank == 0:
                 logging.info('save epoch:%d' % (epoch_idx+1))
                 save_checkpoint(args.expdir, model_encoder_mcep, model_decoder_mcep, model_encoder_excit, \
-                    model_decoder_excit, model_vq, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
+                    model_decoder_excit, model_vq, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1, sparsity=sparsity)
             total = 0
             iter_count = 0
             for i in range(args.n_half_cyc):
@@ -2430,7 +2531,10 @@ def main():
                 param.requires_grad = False
             for param in model_decoder_excit.scale_out_cap.parameters():
                 param.requires_grad = False
-            # start next epoch
+            # start next epoch, the epoch ended in all ranks by the first exhausted shard,
+            # so generators of all ranks are restarted to begin the next epoch from a new pass over their shards
+            if dp.world_size > 1:
+                generator = train_generator(dataloader, device, args.batch_size, n_cv, limit_count=None)
             if epoch_idx < args.epoch_count:
                 start = time.time()
                 logging.info("==%d EPOCH==" % (epoch_idx+1))
@@ -2630,11 +2734,13 @@ def main():
                         z_ = (z[i] - qz_alpha[i]).detach() + qz_alpha[i]
                     idx_in += 1
                     if not args.ar_dec:
-                        batch_mcep_rec[i], h_mcep[i] = model_decoder_mcep(batch_sc_in[idx_in], z_, h=h_mcep[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z_, h=h_mcep_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, h=h_mcep[i], h_cv=h_mcep_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_mcep_rec[i], h_mcep[i], x_in[i] = model_decoder_mcep(batch_sc_in[idx_in], z_, x_in[i], h=h_mcep[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z_, x_in_cv[i_cv], h=h_mcep_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i], x_in[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, x_in[i], x_in_cv[i_cv], h=h_mcep[i], h_cv=h_mcep_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     idx_vq_z_e[i] = nn_search_batch(qz_alpha_e[i], model_vq.weight)
                     z_e[i] = model_vq(idx_vq_z_e[i])
                     if i == 0: # keep path to decoder for VQ-codebook only on the very 1st half cycle
@@ -2642,11 +2748,13 @@ def main():
                     else:
                         z_ = (z_e[i] - qz_alpha_e[i]).detach() + qz_alpha_e[i]
                     if not args.ar_f0:
-                        batch_lf0_rec[i], h_lf0[i] = model_decoder_excit(batch_sc_in[idx_in], z_, h=h_lf0[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_, h=h_lf0_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, h=h_lf0[i], h_cv=h_lf0_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_lf0_rec[i], h_lf0[i], e_in[i] = model_decoder_excit(batch_sc_in[idx_in], z_, e_in[i], h=h_lf0[i], outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_, e_in_cv[i_cv], h=h_lf0_cv[i_cv], outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i], e_in[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, e_in[i], e_in_cv[i_cv], h=h_lf0[i], h_cv=h_lf0_cv[i_cv], \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     feat_len = qy_logits[i].shape[1]
                     idx_in_1 = idx_in-1
                     qy_logits[i] = qy_logits[i][:,outpad_lefts[idx_in_1]:feat_len-outpad_rights[idx_in_1]]
@@ -2787,11 +2895,13 @@ def main():
                         z_ = (z[i] - qz_alpha[i]).detach() + qz_alpha[i]
                     idx_in += 1
                     if not args.ar_dec:
-                        batch_mcep_rec[i], h_mcep[i] = model_decoder_mcep(batch_sc_in[idx_in], z_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_mcep_rec[i], h_mcep[i], x_in[i] = model_decoder_mcep(batch_sc_in[idx_in], z_, x_in_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv] = model_decoder_mcep(batch_sc_cv_in[i_cv], z_, x_in_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_mcep_rec[i], h_mcep[i], x_in[i]), (batch_mcep_cv[i_cv], h_mcep_cv[i_cv], x_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_mcep, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, x_in_, x_in_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     idx_vq_z_e[i] = nn_search_batch(qz_alpha_e[i], model_vq.weight)
                     z_e[i] = model_vq(idx_vq_z_e[i])
                     if i == 0: # keep path to decoder for VQ-codebook only on the very 1st half cycle
@@ -2799,11 +2909,13 @@ def main():
                     else:
                         z_ = (z_e[i] - qz_alpha_e[i]).detach() + qz_alpha_e[i]
                     if not args.ar_f0:
-                        batch_lf0_rec[i], h_lf0[i] = model_decoder_excit(batch_sc_in[idx_in], z_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     else:
-                        batch_lf0_rec[i], h_lf0[i], e_in[i] = model_decoder_excit(batch_sc_in[idx_in], z_, e_in_, outpad_right=outpad_rights[idx_in], do=True)
-                        batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv] = model_decoder_excit(batch_sc_cv_in[i_cv], z_, e_in_, outpad_right=outpad_rights[idx_in], do=True)
+                        (batch_lf0_rec[i], h_lf0[i], e_in[i]), (batch_lf0_cv[i_cv], h_lf0_cv[i_cv], e_in_cv[i_cv]) \
+                            = decode_rec_cv(model_decoder_excit, batch_sc_in[idx_in], batch_sc_cv_in[i_cv], z_, e_in_, e_in_, \
+                                outpad_right=outpad_rights[idx_in], do=True)
                     feat_len = qy_logits[i].shape[1]
                     idx_in_1 = idx_in-1
                     qy_logits[i] = qy_logits[i][:,outpad_lefts[idx_in_1]:feat_len-outpad_rights[idx_in_1]]
@@ -2925,116 +3037,15 @@ def main():
             # Losses computation
             batch_loss = 0
 
-            # handle short ending
+            # handle short ending by frame mask of utterance lengths within the batch losses,
+            # short endings only enter the optimized loss, the logged batch losses are of full-length utterances
+            mask = length_mask(torch.LongTensor(flens_acc).to(device), batch_mcep_rec[0].shape[1])
+            idx_log = slice(None)
             if len(idx_select) > 0:
                 logging.info('len_idx_select: '+str(len(idx_select)))
-                for j in range(len(idx_select)):
-                    k = idx_select[j]
-                    flens_utt = flens_acc[k]
-                    logging.info('%s %d' % (featfile[k], flens_utt))
-                    powmcep = batch_mcep[k,:flens_utt]
-                    batch_feat_select = batch_excit[k,:flens_utt]
-                    uv = batch_feat_select[:,0]
-                    f0 = torch.exp(batch_feat_select[:,1])
-                    uvcap_select = batch_feat_select[:,2]
-                    cap = -torch.exp(batch_feat_select[:,3:])
-
-                    batch_sc_ = batch_sc[k,:flens_utt]
-                    batch_sc_onehot_ = F.one_hot(batch_sc_, num_classes=n_spk).float()
-                    for i in range(args.n_half_cyc):
-                        qy_logits_select_ = qy_logits[i][k,:flens_utt]
-                        qy_logits_e_select_ = qy_logits_e[i][k,:flens_utt]
-
-                        ## reconst. [i % 2 == 0] / cyclic reconst. [i % 2 == 1]
-                        batch_lf0_rec_select = batch_lf0_rec[i][k,:flens_utt]
-                        uv_est = batch_lf0_rec_select[:,0]
-                        f0_est = torch.exp(batch_lf0_rec_select[:,1])
-                        uvcap_est = batch_lf0_rec_select[:,2]
-                        cap_est = -torch.exp(batch_lf0_rec_select[:,3:])
-
-                        ## U/V, lf0, codeap, mcep acc.
-                        if flens_utt > 1: #use rmse for f0 if len > 1
-                            batch_loss += torch.mean(mcd_constant*torch.sum(criterion_l1(batch_mcep_rec[i][k,:flens_utt], powmcep), -1)) \
-                                            + torch.mean(100*criterion_l1(uv_est, uv)) \
-                                                       + torch.sqrt(torch.mean(criterion_l2(f0_est, f0))) \
-                                                        + torch.mean(100*criterion_l1(uvcap_est, uvcap_select)) \
-                                                        + torch.mean(torch.sum(criterion_l1(cap_est, cap), -1))
-                        else:
-                            batch_loss += torch.mean(mcd_constant*torch.sum(criterion_l1(batch_mcep_rec[i][k,:flens_utt], powmcep), -1)) \
-                                            + torch.mean(100*criterion_l1(uv_est, uv)) \
-                                                       + torch.mean(criterion_l1(f0_est, f0)) \
-                                                        + torch.mean(100*criterion_l1(uvcap_est, uvcap_select)) \
-                                                        + torch.mean(torch.sum(criterion_l1(cap_est, cap), -1))
-                        if i % 2 == 0:
-                            ## conversion
-                            if flens_utt > 1: #use rmse for f0 if len > 1
-                                batch_loss += torch.mean(criterion_l1(torch.exp(batch_lf0_cv[i//2][k,:flens_utt,1]), torch.exp(batch_feat_cv[i//2][k,:flens_utt,1]))) \
-                                                    + torch.mean(criterion_ce(qy_logits_select_, batch_sc_)) \
-                                                                        + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), batch_sc_onehot_), -1)) \
-                                                    + torch.mean(criterion_ce(qy_logits_e_select_, batch_sc_)) \
-                                                                        + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e_select_, dim=-1), batch_sc_onehot_), -1))
-                            else:
-                                batch_loss += torch.sqrt(torch.mean(criterion_l2(torch.exp(batch_lf0_cv[i//2][k,:flens_utt,1]), torch.exp(batch_feat_cv[i//2][k,:flens_utt,1])))) \
-                                                    + torch.mean(criterion_ce(qy_logits_select_, batch_sc_)) \
-                                                                        + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), batch_sc_onehot_), -1)) \
-                                                    + torch.mean(criterion_ce(qy_logits_e_select_, batch_sc_)) \
-                                                                        + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e_select_, dim=-1), batch_sc_onehot_), -1))
-                        else:
-                            sc_cv_select_ = batch_sc_cv[i//2][k,:flens_utt]
-                            sc_cv_select_onehot_ = F.one_hot(sc_cv_select_, num_classes=n_spk).float()
-                            batch_loss += torch.mean(criterion_ce(qy_logits_select_, sc_cv_select_)) \
-                                                                    + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), sc_cv_select_onehot_), -1)) \
-                                                + torch.mean(criterion_ce(qy_logits_e_select_, sc_cv_select_)) \
-                                                                    + torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e_select_, dim=-1), sc_cv_select_onehot_), -1))
-                        batch_loss += torch.mean(torch.sum(criterion_l1(qz_alpha[i][k,:flens_utt], z[i][k,:flens_utt]), -1)) \
-                                        + torch.mean(torch.sum(criterion_l1(qz_alpha_e[i][k,:flens_utt], z_e[i][k,:flens_utt]), -1))
                 if len(idx_select_full) > 0:
                     logging.info('len_idx_select_full: '+str(len(idx_select_full)))
-                    batch_mcep = torch.index_select(batch_mcep,0,idx_select_full)
-                    batch_excit = torch.index_select(batch_excit,0,idx_select_full)
-                    batch_sc = torch.index_select(batch_sc,0,idx_select_full)
-                    for i in range(args.n_half_cyc):
-                        batch_mcep_rec[i] = torch.index_select(batch_mcep_rec[i],0,idx_select_full)
-                        batch_lf0_rec[i] = torch.index_select(batch_lf0_rec[i],0,idx_select_full)
-                        qz_alpha[i] = torch.index_select(qz_alpha[i],0,idx_select_full)
-                        z[i] = torch.index_select(z[i],0,idx_select_full)
-                        qy_logits[i] = torch.index_select(qy_logits[i],0,idx_select_full)
-                        qz_alpha_e[i] = torch.index_select(qz_alpha_e[i],0,idx_select_full)
-                        z_e[i] = torch.index_select(z_e[i],0,idx_select_full)
-                        qy_logits_e[i] = torch.index_select(qy_logits_e[i],0,idx_select_full)
-                        if i % 2 == 0:
-                            batch_mcep_cv[i//2] = torch.index_select(batch_mcep_cv[i//2],0,idx_select_full)
-                            batch_feat_cv[i//2] = torch.index_select(batch_feat_cv[i//2],0,idx_select_full)
-                            batch_lf0_cv[i//2] = torch.index_select(batch_lf0_cv[i//2],0,idx_select_full)
-                            batch_sc_cv[i//2] = torch.index_select(batch_sc_cv[i//2],0,idx_select_full)
-                            if args.n_half_cyc == 1:
-                                qz_alpha[i+1] = torch.index_select(qz_alpha[i+1],0,idx_select_full)
-                                z[i+1] = torch.index_select(z[i+1],0,idx_select_full)
-                                qy_logits[i+1] = torch.index_select(qy_logits[i+1],0,idx_select_full)
-                                qz_alpha_e[i+1] = torch.index_select(qz_alpha_e[i+1],0,idx_select_full)
-                                z_e[i+1] = torch.index_select(z_e[i+1],0,idx_select_full)
-                                qy_logits_e[i+1] = torch.index_select(qy_logits_e[i+1],0,idx_select_full)
-                else:
-                    optimizer.zero_grad()
-                    batch_loss.backward()
-                    optimizer.step()
-
-                    logging.info("batch_loss_select (%.3f sec)" % (time.time() - start))
-                    iter_idx += 1
-                    #if iter_idx % args.save_interval_iter == 0:
-                    #    logging.info('save iter:%d' % (iter_idx))
-                    #    save_checkpoint(args.expdir, model_encoder, model_decoder, model_lf0, \
-                    #        optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
-                    iter_count += 1
-                    if iter_idx % args.log_interval_steps == 0:
-                        logging.info('smt')
-                        for key in total_train_loss.keys():
-                            total_train_loss[key] = np.mean(total_train_loss[key])
-                            logging.info(f"(Steps: {iter_idx}) {key} = {total_train_loss[key]:.4f}.")
-                        write_to_tensorboard(writer, iter_idx, total_train_loss)
-                        total_train_loss = defaultdict(list)
-                    total += time.time() - start
-                    continue
+                    idx_log = idx_select_full
 
             # loss_compute
             uv = batch_excit[:,:,0]
@@ -3063,84 +3074,82 @@ def main():
                     sc_cv_onehot = F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()
 
                 ## U/V, lf0, codeap, mcep acc.
-                batch_loss_uv_ = torch.mean(100*criterion_l1(uv_est, uv), -1)
-                batch_loss_uv[i] = batch_loss_uv_.mean()
-                batch_loss_f0_ = torch.sqrt(torch.mean(criterion_l2(f0_est, f0), -1))
-                batch_loss_f0[i] = batch_loss_f0_.mean()
+                batch_loss_uv_ = masked_mean(100*criterion_l1(uv_est, uv), mask)
+                batch_loss_uv[i] = batch_loss_uv_[idx_log].mean()
+                batch_loss_f0_ = torch.sqrt(masked_mean(criterion_l2(f0_est, f0), mask))
+                batch_loss_f0[i] = batch_loss_f0_[idx_log].mean()
                 batch_loss_px[i] = batch_loss_uv[i] + batch_loss_f0[i]
-                batch_loss_uvcap_ = torch.mean(100*criterion_l1(uvcap_est, uvcap), -1)
-                batch_loss_uvcap[i] = batch_loss_uvcap_.mean()
-                batch_loss_cap_ = torch.mean(torch.sum(criterion_l1(cap_est, cap), -1), -1)
-                batch_loss_cap[i] = batch_loss_cap_.mean()
+                batch_loss_uvcap_ = masked_mean(100*criterion_l1(uvcap_est, uvcap), mask)
+                batch_loss_uvcap[i] = batch_loss_uvcap_[idx_log].mean()
+                batch_loss_cap_ = masked_mean(torch.sum(criterion_l1(cap_est, cap), -1), mask)
+                batch_loss_cap[i] = batch_loss_cap_[idx_log].mean()
                 batch_loss_px[i] += batch_loss_uvcap[i] + batch_loss_cap[i]
-                batch_loss_px_f0 = batch_loss_uv_.sum() + batch_loss_f0_.sum() \
-                                    + batch_loss_uvcap_.sum() + batch_loss_cap_.sum()
-                batch_loss_powmcep_ = torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), -1)
-                batch_loss_powmcep[i] = batch_loss_powmcep_.mean()
-                batch_loss_mcep[i] = torch.mean(torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), -1))
-                batch_loss_px_mcep_ = torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), -1)
-                batch_loss_mcep_rec[i] = batch_loss_px_mcep_.mean()
+                batch_loss_px_f0_ = batch_loss_uv_ + batch_loss_f0_ \
+                                    + batch_loss_uvcap_ + batch_loss_cap_
+                batch_loss_powmcep_ = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), mask)
+                batch_loss_powmcep[i] = batch_loss_powmcep_[idx_log].mean()
+                batch_loss_mcep[i] = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), mask)[idx_log].mean()
+                batch_loss_px_mcep_ = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), mask)
+                batch_loss_mcep_rec[i] = batch_loss_px_mcep_[idx_log].mean()
                 batch_loss_px[i] += batch_loss_mcep_rec[i]
-                batch_loss_px_mcep = batch_loss_px_mcep_.sum()
 
                 ## conversion
                 if i % 2 == 0:
-                    batch_loss_uv_cv[i//2] = torch.mean(torch.mean(100*criterion_l1(uv_cv, uv), -1))
-                    batch_loss_f0_cv_ = torch.sqrt(torch.mean(criterion_l2(f0_cv, f0cv), -1))
-                    batch_loss_f0_cv[i//2] = batch_loss_f0_cv_.mean()
+                    batch_loss_uv_cv[i//2] = masked_mean(100*criterion_l1(uv_cv, uv), mask)[idx_log].mean()
+                    batch_loss_f0_cv_ = torch.sqrt(masked_mean(criterion_l2(f0_cv, f0cv), mask))
+                    if len(idx_select) > 0:
+                        # l1 for f0 of short endings, as in their former loop
+                        batch_loss_f0_cv_ = batch_loss_f0_cv_.index_copy(0, idx_select, \
+                                                masked_mean(criterion_l1(f0_cv, f0cv), mask)[idx_select])
+                    batch_loss_f0_cv[i//2] = batch_loss_f0_cv_[idx_log].mean()
                     batch_loss_px[i] += batch_loss_f0_cv[i//2]
-                    batch_loss_px_f0 += batch_loss_f0_cv_.sum()
-                    batch_loss_uvcap_cv[i//2] = torch.mean(torch.mean(100*criterion_l1(uvcap_cv, uvcap), -1))
-                    batch_loss_cap_cv[i//2] = torch.mean(torch.mean(torch.sum(criterion_l1(cap_cv, cap), -1), -1))
-                    batch_loss_mcep_cv[i//2] = torch.mean(torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), -1))
+                    batch_loss_px_f0_ += batch_loss_f0_cv_
+                    batch_loss_uvcap_cv[i//2] = masked_mean(100*criterion_l1(uvcap_cv, uvcap), mask)[idx_log].mean()
+                    batch_loss_cap_cv[i//2] = masked_mean(torch.sum(criterion_l1(cap_cv, cap), -1), mask)[idx_log].mean()
+                    batch_loss_mcep_cv[i//2] = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), mask)[idx_log].mean()
 
                 # KL-div latent-posterior, CE and error-percentage speaker-posterior
                 if i % 2 == 0:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
                     if args.n_half_cyc == 1:
-                        batch_loss_qy_py[i+1] = torch.mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1).mean()
-                        batch_loss_qy_py_err[i+1] = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1).mean()
-                        batch_loss_qz_pz[i+1] = torch.mean(torch.sum(criterion_l1(qz_alpha[i+1], z[i+1]), -1))
+                        batch_loss_qy_py[i+1] = masked_mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)[idx_log].mean()
+                        batch_loss_qy_py_err[i+1] = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)[idx_log].mean()
+                        batch_loss_qz_pz[i+1] = masked_mean(torch.sum(criterion_l1(qz_alpha[i+1], z[i+1]), -1), mask)[idx_log].mean()
                 else:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_cv_onehot), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
-                batch_loss_qz_pz_ = torch.mean(torch.sum(criterion_l1(qz_alpha[i], z[i]), -1), -1)
-                batch_loss_qz_pz[i] = batch_loss_qz_pz_.mean()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_cv_onehot), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
+                batch_loss_qz_pz_ = masked_mean(torch.sum(criterion_l1(qz_alpha[i], z[i]), -1), mask)
+                batch_loss_qz_pz[i] = batch_loss_qz_pz_[idx_log].mean()
                 if i % 2 == 0:
-                    batch_loss_qy_py_e_ = torch.mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), -1)
-                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_.mean()
-                    batch_loss_qy_py_err_e_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_onehot), -1), -1)
-                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_.mean()
+                    batch_loss_qy_py_e_ = masked_mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), mask)
+                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_[idx_log].mean()
+                    batch_loss_qy_py_err_e_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_onehot), -1), mask)
+                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_[idx_log].mean()
                     if args.n_half_cyc == 1:
-                        batch_loss_qy_py_e[i+1] = torch.mean(criterion_ce(qy_logits_e[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1).mean()
-                        batch_loss_qy_py_err_e[i+1] = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1).mean()
-                        batch_loss_qz_pz_e[i+1] = torch.mean(torch.sum(criterion_l1(qz_alpha_e[i+1], z_e[i+1]), -1))
+                        batch_loss_qy_py_e[i+1] = masked_mean(criterion_ce(qy_logits_e[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)[idx_log].mean()
+                        batch_loss_qy_py_err_e[i+1] = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)[idx_log].mean()
+                        batch_loss_qz_pz_e[i+1] = masked_mean(torch.sum(criterion_l1(qz_alpha_e[i+1], z_e[i+1]), -1), mask)[idx_log].mean()
                 else:
-                    batch_loss_qy_py_e_ = torch.mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1)
-                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_.mean()
-                    batch_loss_qy_py_err_e_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_cv_onehot), -1), -1)
-                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_.mean()
-                batch_loss_qz_pz_e_ = torch.mean(torch.sum(criterion_l1(qz_alpha_e[i], z_e[i]), -1), -1)
-                batch_loss_qz_pz_e[i] = batch_loss_qz_pz_e_.mean()
-
-                batch_loss_qy_py_ce = batch_loss_qy_py_.sum()
-                batch_loss_qy_py_prc = batch_loss_qy_py_err_.sum()
-                batch_loss_qz_pz_kl = batch_loss_qz_pz_.sum()
-                batch_loss_qy_py_ce_e = batch_loss_qy_py_e_.sum()
-                batch_loss_qy_py_prc_e = batch_loss_qy_py_err_e_.sum()
-                batch_loss_qz_pz_kl_e = batch_loss_qz_pz_e_.sum()
+                    batch_loss_qy_py_e_ = masked_mean(criterion_ce(qy_logits_e[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)
+                    batch_loss_qy_py_e[i] = batch_loss_qy_py_e_[idx_log].mean()
+                    batch_loss_qy_py_err_e_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_e[i], dim=-1), sc_cv_onehot), -1), mask)
+                    batch_loss_qy_py_err_e[i] = batch_loss_qy_py_err_e_[idx_log].mean()
+                batch_loss_qz_pz_e_ = masked_mean(torch.sum(criterion_l1(qz_alpha_e[i], z_e[i]), -1), mask)
+                batch_loss_qz_pz_e[i] = batch_loss_qz_pz_e_[idx_log].mean()
+
 
                 # elbo
-                batch_loss_elbo[i] = batch_loss_px_mcep + batch_loss_qy_py_ce + batch_loss_qy_py_prc + batch_loss_qz_pz_kl \
-                                        + batch_loss_px_f0 + batch_loss_qy_py_ce_e + batch_loss_qy_py_prc_e + batch_loss_qz_pz_kl_e
-                batch_loss += batch_loss_elbo[i]
+                batch_loss_elbo_ = batch_loss_px_mcep_ + batch_loss_qy_py_ + batch_loss_qy_py_err_ + batch_loss_qz_pz_ \
+                                        + batch_loss_px_f0_ + batch_loss_qy_py_e_ + batch_loss_qy_py_err_e_ + batch_loss_qz_pz_e_
+                batch_loss_elbo[i] = batch_loss_elbo_[idx_log].sum()
+                batch_loss += batch_loss_elbo_.sum()
 
                 total_train_loss["train/loss_elbo-%d"%(i+1)].append(batch_loss_elbo[i].item())
                 total_train_loss["train/loss_px-%d"%(i+1)].append(batch_loss_px[i].item())
@@ -3200,8 +3209,13 @@ def main():
                     loss_qz_pz_e[i+1].append(batch_loss_qz_pz_e[i+1].item())
 
             optimizer.zero_grad()
-            batch_loss.backward()
-            optimizer.step()
+            amp.backward(batch_loss)
+            dp.all_reduce_grads([model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, model_vq])
+            amp.step(optimizer)
+
+            if sparsity is not None:
+                with torch.no_grad():
+                    sparsity.step(iter_idx + 1, args.sparse_t_start, args.sparse_t_end, args.sparse_interval, sparse_densities)
 
             text_log = "batch loss [%d] %d %d " % (c_idx+1, f_ss, f_bs)
             for i in range(args.n_half_cyc):
@@ -3258,17 +3272,18 @@ def main():
 
 
     # save final model
-    model_encoder_mcep.cpu()
-    model_decoder_mcep.cpu()
-    model_encoder_excit.cpu()
-    model_decoder_excit.cpu()
-    model_vq.cpu()
-    torch.save({"model_encoder_mcep": model_encoder_mcep.state_dict(),
-                "model_decoder_mcep": model_decoder_mcep.state_dict(),
-                "model_encoder_excit": model_encoder_excit.state_dict(),
-                "model_decoder_excit": model_decoder_excit.state_dict(),
-                "model_vq": model_vq.state_dict()}, args.expdir + "/checkpoint-final.pkl")
-    logging.info("final checkpoint created.")
+    if dp.rank == 0:
+        model_encoder_mcep.cpu()
+        model_decoder_mcep.cpu()
+        model_encoder_excit.cpu()
+        model_decoder_excit.cpu()
+        model_vq.cpu()
+        torch.save({"model_encoder_mcep": model_encoder_mcep.state_dict(),
+                    "model_decoder_mcep": model_decoder_mcep.state_dict(),
+                    "model_encoder_excit": model_encoder_excit.state_dict(),
+                    "model_decoder_excit": model_decoder_excit.state_dict(),
+                    "model_vq": model_vq.state_dict()}, args.expdir + "/checkpoint-final.pkl")
+        logging.info("final checkpoint created.")
 
 
 if __name__ == "__main__":
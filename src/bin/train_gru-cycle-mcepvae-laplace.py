@@ -31,6 +31,9 @@ from utils import read_hdf5
 from utils import read_txt
 from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER
 from vcneuvoco import kl_laplace
+from vcneuvoco import DataParallel, MixedPrecision, length_mask, masked_mean
+from vcneuvoco import checkpoint_forward, peak_memory
+from vcneuvoco import BlockSparsity, gru_recurrent_weights
 from radam import RAdam
 
 from dataset import FeatureDatasetCycMceplf0WavVAE, FeatureDatasetEvalCycMceplf0WavVAE, padding
@@ -229,7 +232,7 @@ def eval_generator(dataloader, device, batch_size, limit_count=None, spcidx=True
 
 
 def save_checkpoint(checkpoint_dir, model_encoder, model_decoder,
-        optimizer, numpy_random_state, torch_random_state, iterations):
+        optimizer, numpy_random_state, torch_random_state, iterations, sparsity=None):
     """FUNCTION TO SAVE CHECKPOINT
 
     Args:
@@ -237,7 +240,9 @@ def save_checkpoint(checkpoint_dir, model_encoder, model_decoder,
         model (torch.nn.Module): pytorch model instance
         optimizer (Optimizer): pytorch optimizer instance
         iterations (int): number of current iterations
+        sparsity (BlockSparsity): block-sparsification masks of recurrent weights
     """
+    device = next(model_encoder.parameters()).device
     model_encoder.cpu()
     model_decoder.cpu()
     checkpoint = {
@@ -247,16 +252,20 @@ def save_checkpoint(checkpoint_dir, model_encoder, model_decoder,
         "numpy_random_state": numpy_random_state,
         "torch_random_state": torch_random_state,
         "iterations": iterations}
+    if sparsity is not None:
+        checkpoint["sparsity"] = sparsity.state_dict()
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     torch.save(checkpoint, checkpoint_dir + "/checkpoint-%d.pkl" % iterations)
-    model_encoder.cuda()
-    model_decoder.cuda()
+    model_encoder.to(device)
+    model_decoder.to(device)
     logging.info("%d-iter checkpoint created." % iterations)
 
 
 def write_to_tensorboard(writer, steps, loss):
     """Write to tensorboard."""
+    if writer is None:
+        return
     for key, value in loss.items():
         writer.add_scalar(key, value, steps)
 
@@ -351,6 +360,22 @@ def main():
                         type=str, help="pretrained model path")
     parser.add_argument("--string_path", required=True,
                         type=str, help="h5 path of features")
+    parser.add_argument("--dist_backend", default=None,
+                        type=str, help="backend of data-parallel training: gloo (cpu) or nccl (gpu), None for single process")
+    parser.add_argument("--dist_init", default="env://",
+                        type=str, help="init method of data-parallel process group")
+    parser.add_argument("--sparse_densities", default=None,
+                        type=str, help="final density of reset, update, new gate blocks of encoder/decoder gru recurrent weights (if None, not sparsified)")
+    parser.add_argument("--sparse_t_start", default=20000,
+                        type=int, help="iter idx to start sparsify")
+    parser.add_argument("--sparse_t_end", default=200000,
+                        type=int, help="iter idx to finish density sparsify")
+    parser.add_argument("--sparse_interval", default=100,
+                        type=int, help="interval in finishing density sparsify")
+    parser.add_argument("--grad_checkpoint", default=False,
+                        type=strtobool, help="recompute activations of each encoder/decoder call in backward to save memory")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -361,28 +386,35 @@ def main():
         os.environ["CUDA_DEVICE_ORDER"]     = "PCI_BUS_ID"
         os.environ["CUDA_VISIBLE_DEVICES"]  = str(args.GPU_device)
 
+    # data-parallel training, one process per rank (e.g., torchrun --nproc_per_node)
+    dp = DataParallel(args.dist_backend, args.dist_init)
+    if dp.rank == 0:
+        log_file = args.expdir + "/train.log"
+    else:
+        log_file = args.expdir + "/train-%d.log" % (dp.rank)
+
     # make experimental directory
     if not os.path.exists(args.expdir):
-        os.makedirs(args.expdir)
+        os.makedirs(args.expdir, exist_ok=True)
 
     # set log level
     if args.verbose == 1:
         logging.basicConfig(level=logging.INFO,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     elif args.verbose > 1:
         logging.basicConfig(level=logging.DEBUG,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
     else:
         logging.basicConfig(level=logging.WARN,
                             format='%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s',
                             datefmt='%m/%d/%Y %I:%M:%S',
-                            filename=args.expdir + "/train.log")
+                            filename=log_file)
         logging.getLogger().addHandler(logging.StreamHandler())
         logging.warn("logging is disabled.")
 
@@ -391,9 +423,11 @@ def main():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if str(device) == "cpu":
+    device = dp.device
+    if str(device) == "cpu" and args.dist_backend is None:
         raise ValueError('ERROR: Training by CPU is not acceptable.')
+    if args.dist_backend is not None:
+        logging.info("data-parallel rank %d of %d on %s" % (dp.rank, dp.world_size, device))
 
     torch.backends.cudnn.benchmark = True #faster
 
@@ -417,7 +451,8 @@ def main():
         args.excit_dim = 2
 
     # save args as conf
-    torch.save(args, args.expdir + "/model.conf")
+    if dp.rank == 0:
+        torch.save(args, args.expdir + "/model.conf")
 
     # define network
     if not args.f0in:
@@ -475,22 +510,18 @@ def main():
     if args.ar_dec:
         x_in_zeros_ = (torch.zeros(1, 1, args.mcep_dim)-mean_stats[args.excit_dim:])/scale_stats[args.excit_dim:]
 
-    # send to gpu
-    if torch.cuda.is_available():
-        model_encoder.cuda()
-        model_decoder.cuda()
-        criterion_ce.cuda()
-        criterion_l1.cuda()
-        criterion_l2.cuda()
-        mean_stats = mean_stats.cuda()
-        scale_stats = scale_stats.cuda()
-        if args.ar_enc:
-            yz_in_zeros_ = yz_in_zeros_.cuda()
-        if args.ar_dec:
-            x_in_zeros_ = x_in_zeros_.cuda()
-    else:
-        logging.error("gpu is not available. please check the setting.")
-        sys.exit(1)
+    # send to device
+    model_encoder.to(device)
+    model_decoder.to(device)
+    criterion_ce.to(device)
+    criterion_l1.to(device)
+    criterion_l2.to(device)
+    mean_stats = mean_stats.to(device)
+    scale_stats = scale_stats.to(device)
+    if args.ar_enc:
+        yz_in_zeros_ = yz_in_zeros_.to(device)
+    if args.ar_dec:
+        x_in_zeros_ = x_in_zeros_.to(device)
 
     model_encoder.train()
     model_decoder.train()
@@ -539,6 +570,16 @@ def main():
     optimizer = RAdam(module_list, lr=args.lr)
     #optimizer = torch.optim.Adam(module_list, lr=args.lr)
 
+    # block-sparsification masks of encoder/decoder gru recurrent weights, kept and reapplied after every update
+    if args.sparse_densities is not None:
+        sparsity = BlockSparsity(gru_recurrent_weights({"encoder": model_encoder, "decoder": model_decoder}))
+        sparse_densities = dict()
+        for name in sparsity.weights.keys():
+            sparse_densities[name] = [float(density) for density in args.sparse_densities.split('-')]
+        logging.info(sparse_densities)
+    else:
+        sparsity = None
+
     # resume
     if args.pretrained is not None:
         checkpoint = torch.load(args.pretrained)
@@ -552,6 +593,8 @@ def main():
         model_encoder.load_state_dict(checkpoint["model_encoder"])
         model_decoder.load_state_dict(checkpoint["model_decoder"])
         optimizer.load_state_dict(checkpoint["optimizer"])
+        if sparsity is not None and "sparsity" in checkpoint:
+            sparsity.load_state_dict(checkpoint["sparsity"])
         epoch_idx = checkpoint["iterations"]
         logging.info("restored from %d-iter checkpoint." % epoch_idx)
     else:
@@ -574,6 +617,9 @@ def main():
         logging.error("--feats should be directory or list.")
         sys.exit(1)
     logging.info("number of training data = %d." % len(feat_list))
+    if dp.world_size > 1:
+        feat_list = dp.shard(feat_list)
+        logging.info("number of training data in rank %d = %d." % (dp.rank, len(feat_list)))
     dataset = FeatureDatasetCycMceplf0WavVAE(feat_list, pad_feat_transform, spk_list, stats_list, \
                     args.n_half_cyc, args.string_path, excit_dim=args.excit_dim, uvcap_flag=False)
     dataloader = DataLoader(dataset, batch_size=args.batch_size_utt, shuffle=True, num_workers=args.n_workers)
@@ -594,11 +640,32 @@ def main():
                     stats_list, args.string_path, excit_dim=args.excit_dim, uvcap_flag=False)
     n_eval_data = len(dataset_eval.file_list_src)
     logging.info("number of evaluation data = %d." % n_eval_data)
+    if dp.world_size > 1:
+        dataset_eval.shard(dp.rank, dp.world_size)
+        logging.info("number of evaluation data in rank %d = %d." % (dp.rank, len(dataset_eval)))
     dataloader_eval = DataLoader(dataset_eval, batch_size=args.batch_size_utt_eval, shuffle=False, num_workers=args.n_workers)
     #generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=1)
     generator_eval = eval_generator(dataloader_eval, device, args.batch_size, limit_count=None)
 
-    writer = SummaryWriter(args.expdir)
+    # same initial parameters in all ranks
+    dp.broadcast([model_encoder, model_decoder])
+
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_encoder)
+    amp.apply(model_decoder)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
+    # activation checkpointing per half-cycle of each module
+    if args.grad_checkpoint:
+        checkpoint_forward(model_encoder)
+        checkpoint_forward(model_decoder)
+    logging.info("gradient checkpointing: %s" % (args.grad_checkpoint))
+
+    if dp.rank == 0:
+        writer = SummaryWriter(args.expdir)
+    else:
+        writer = None
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
 
@@ -798,7 +865,7 @@ def main():
         start = time.time()
         batch_feat, batch_sc, batch_sc_cv_data, batch_feat_cv_data, c_idx, utt_idx, featfile, \
             f_bs, f_ss, flens, n_batch_utt, del_index_utt, max_flen, spk_cv, idx_select, idx_select_full, flens_acc = next(generator)
-        if c_idx < 0: # summarize epoch
+        if dp.any(c_idx < 0): # summarize epoch, ended in all ranks by the first exhausted shard (generators restarted)
             # save current epoch model
             numpy_random_state = np.random.get_state()
             torch_random_state = torch.get_rng_state()
@@ -829,6 +896,14 @@ def main():
                         np.mean(loss_qz_pz[i]), np.std(loss_qz_pz[i]), np.mean(loss_mcep_rec[i]), np.std(loss_mcep_rec[i]), \
                         np.mean(loss_powmcep[i]), np.std(loss_powmcep[i]), np.mean(loss_mcep[i]), np.std(loss_mcep[i]))
             logging.info("%s (%.3f min., %.3f sec / batch)" % (text_log, total / 60.0, total / iter_count))
+            if dp.world_size > 1:
+                logging.info("gradient all-reduce of %d ranks %.3f min. (%.3f sec / batch)" % (dp.world_size, \
+                    dp.comm_time / 60.0, dp.comm_time / iter_count))
+                dp.comm_time = 0
+            logging.info("peak memory %.1f MB" % (peak_memory(device)))
+            if sparsity is not None:
+                logging.info("sparsification overhead = %.6f sec / batch" % (sparsity.time / iter_count))
+                sparsity.time = 0
             logging.info("estimated time until max. epoch = {0.days:02}:{0.hours:02}:{0.minutes:02}:"\
             "{0.seconds:02}".format(relativedelta(seconds=int((args.epoch_count - (epoch_idx + 1)) * total))))
             # compute loss in evaluation data
@@ -1128,7 +1203,7 @@ def main():
                                     _, twf_mcep, batch_mcd_src_trg, _ = dtw.dtw_org_to_trg(\
                                         np.array(trj_src_trg_[:,1:].cpu().data.numpy(), dtype=np.float64), \
                                         np.array(trj_trg_[:,1:].cpu().data.numpy(), dtype=np.float64))
-                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).cuda()
+                                    twf_mcep = torch.LongTensor(twf_mcep[:,0]).to(device)
                                     # time-warping of latent source-to-target for RMSE
                                     aligned_lat_srctrg1, _, _, _ = dtw.dtw_org_to_trg(trj_lat_src_, trj_lat_trg_)
                                     batch_lat_dist_srctrg1 = np.mean(np.sqrt(np.mean((\
@@ -1350,6 +1425,14 @@ def main():
                     logging.info("%s (%.3f sec)" % (text_log, time.time() - start))
                     iter_count += 1
                     total += time.time() - start
+            # aggregate evaluation results of all ranks
+            if dp.world_size > 1:
+                pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, \
+                    gv_src_src, gv_src_trg, loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_powmcep, loss_mcep, \
+                    loss_mcep_cv, loss_mcep_rec = \
+                    dp.all_gather_results([pair_exist, total_eval_loss, loss_mcdpow_src_trg, loss_mcd_src_trg, loss_lat_dist_rmse, loss_lat_dist_cossim, \
+                            gv_src_src, gv_src_trg, loss_elbo, loss_px, loss_qy_py, loss_qy_py_err, loss_qz_pz, loss_powmcep, loss_mcep, \
+                            loss_mcep_cv, loss_mcep_rec])
             tmp_gv_1 = []
             tmp_gv_2 = []
             for j in range(n_spk):
@@ -1577,10 +1660,10 @@ def main():
                             min_eval_loss_powmcep[i], min_eval_loss_powmcep_std[i], min_eval_loss_mcep[i], min_eval_loss_mcep_std[i])
                 logging.info("%s min_idx=%d" % (text_log, min_idx+1))
             #if ((epoch_idx + 1) % args.save_interval_epoch == 0) or (epoch_min_flag):
-            if True:
+            if dp.rank == 0:
                 logging.info('save epoch:%d' % (epoch_idx+1))
                 save_checkpoint(args.expdir, model_encoder, model_decoder, \
-                    optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
+                    optimizer, numpy_random_state, torch_random_state, epoch_idx + 1, sparsity=sparsity)
             total = 0
             iter_count = 0
             for i in range(args.n_half_cyc):
@@ -1610,7 +1693,10 @@ def main():
                 param.requires_grad = True
             for param in model_decoder.scale_out.parameters():
                 param.requires_grad = False
-            # start next epoch
+            # start next epoch, the epoch ended in all ranks by the first exhausted shard,
+            # so generators of all ranks are restarted to begin the next epoch from a new pass over their shards
+            if dp.world_size > 1:
+                generator = train_generator(dataloader, device, args.batch_size, n_cv, limit_count=None)
             if epoch_idx < args.epoch_count:
                 start = time.time()
                 logging.info("==%d EPOCH==" % (epoch_idx+1))
@@ -1989,66 +2075,15 @@ def main():
             # loss
             batch_loss = 0
 
+            # handle short ending by frame mask of utterance lengths within the batch losses,
+            # short endings only enter the optimized loss, the logged batch losses are of full-length utterances
+            mask = length_mask(torch.LongTensor(flens_acc).to(device), batch_mcep_rec[0].shape[1])
+            idx_log = slice(None)
             if len(idx_select) > 0:
                 logging.info('len_idx_select: '+str(len(idx_select)))
-                batch_loss_px_select = 0
-                batch_loss_qz_pz_kl_select = 0
-                batch_loss_qy_py_ce_select = 0
-                batch_loss_qy_py_err_select = 0
-                for j in range(len(idx_select)):
-                    k = idx_select[j]
-                    flens_utt = flens_acc[k]
-                    logging.info('%s %d' % (featfile[k], flens_utt))
-                    powmcep = batch_feat[k,:flens_utt,args.excit_dim:]
-                    batch_sc_ = batch_sc[k,:flens_utt]
-                    for i in range(args.n_half_cyc):
-                        batch_loss_px_select += torch.mean(mcd_constant*torch.sum(criterion_l1(batch_mcep_rec[i][k,:flens_utt], powmcep), -1))
-                        qy_logits_select_ = qy_logits[i][k,:flens_utt]
-                        if i % 2 == 0:
-                            batch_loss_qy_py_ce_select += torch.mean(criterion_ce(qy_logits_select_, batch_sc_))
-                            batch_loss_qy_py_err_select += torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), F.one_hot(batch_sc_, num_classes=n_spk).float()), -1))
-                        else:
-                            sc_cv_select_ = batch_sc_cv[i//2][k,:flens_utt]
-                            batch_loss_qy_py_ce_select += torch.mean(criterion_ce(qy_logits_select_, sc_cv_select_))
-                            batch_loss_qy_py_err_select += torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits_select_, dim=-1), F.one_hot(sc_cv_select_, num_classes=n_spk).float()), -1))
-                        batch_loss_qz_pz_kl_select += torch.mean(torch.sum(kl_laplace(qz_alpha[i][k,:flens_utt]), -1))
-                batch_loss += batch_loss_px_select + batch_loss_qz_pz_kl_select + batch_loss_qy_py_ce_select + batch_loss_qy_py_err_select
                 if len(idx_select_full) > 0:
                     logging.info('len_idx_select_full: '+str(len(idx_select_full)))
-                    batch_feat = torch.index_select(batch_feat,0,idx_select_full)
-                    batch_sc = torch.index_select(batch_sc,0,idx_select_full)
-                    for i in range(args.n_half_cyc):
-                        batch_mcep_rec[i] = torch.index_select(batch_mcep_rec[i],0,idx_select_full)
-                        qz_alpha[i] = torch.index_select(qz_alpha[i],0,idx_select_full)
-                        qy_logits[i] = torch.index_select(qy_logits[i],0,idx_select_full)
-                        if i % 2 == 0:
-                            batch_mcep_cv[i//2] = torch.index_select(batch_mcep_cv[i//2],0,idx_select_full)
-                            batch_sc_cv[i//2] = torch.index_select(batch_sc_cv[i//2],0,idx_select_full)
-                            if args.n_half_cyc == 1:
-                                qz_alpha[i+1] = torch.index_select(qz_alpha[i+1],0,idx_select_full)
-                                qy_logits[i+1] = torch.index_select(qy_logits[i+1],0,idx_select_full)
-                else:
-                    optimizer.zero_grad()
-                    batch_loss.backward()
-                    optimizer.step()
-
-                    text_log = "batch loss_select %lf " % (batch_loss.item())
-                    logging.info("%s (%.3f sec)" % (text_log, time.time() - start))
-                    iter_idx += 1
-                    #if iter_idx % args.save_interval_iter == 0:
-                    #    logging.info('save iter:%d' % (iter_idx))
-                    #    save_checkpoint(args.expdir, model_encoder, model_decoder, model_lf0, \
-                    #        optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
-                    iter_count += 1
-                    if iter_idx % args.log_interval_steps == 0:
-                        logging.info('smt')
-                        for key in total_train_loss.keys():
-                            total_train_loss[key] = np.mean(total_train_loss[key])
-                            logging.info(f"(Steps: {iter_idx}) {key} = {total_train_loss[key]:.4f}.")
-                        write_to_tensorboard(writer, iter_idx, total_train_loss)
-                        total_train_loss = defaultdict(list)
-                    total += time.time() - start
-                    continue
+                    idx_log = idx_select_full
 
             # loss_compute
             powmcep = batch_feat[:,:,args.excit_dim:]
@@ -2060,43 +2095,41 @@ def main():
                     mcep_cv = batch_mcep_cv[i//2]
 
                 ## mcep acc.
-                batch_loss_powmcep_ = torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), -1)
-                batch_loss_powmcep[i] = batch_loss_powmcep_.mean()
-                batch_loss_mcep[i] = torch.mean(torch.mean(mcd_constant*torch.sqrt(\
-                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), -1))
-                batch_loss_px_mcep_ = torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), -1)
-                batch_loss_mcep_rec[i] = batch_loss_px_mcep_.mean()
+                batch_loss_powmcep_ = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est, powmcep), -1)), mask)
+                batch_loss_powmcep[i] = batch_loss_powmcep_[idx_log].mean()
+                batch_loss_mcep[i] = masked_mean(mcd_constant*torch.sqrt(\
+                                                    torch.sum(criterion_l2(mcep_est[:,:,1:], mcep), -1)), mask)[idx_log].mean()
+                batch_loss_px_mcep_ = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_est, powmcep), -1), mask)
+                batch_loss_mcep_rec[i] = batch_loss_px_mcep_[idx_log].mean()
                 if i % 2 == 0:
-                    batch_loss_mcep_cv[i//2] = torch.mean(torch.mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), -1))
+                    batch_loss_mcep_cv[i//2] = masked_mean(mcd_constant*torch.sum(criterion_l1(mcep_cv, powmcep),-1), mask)[idx_log].mean()
 
                 batch_loss_px[i] = batch_loss_mcep_rec[i]
 
                 # KL div
                 if i % 2 == 0:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc.reshape(-1)).reshape(batch_sc.shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), sc_onehot), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
                     if args.n_half_cyc == 1:
-                        batch_loss_qy_py[i+1] = torch.mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1).mean()
-                        batch_loss_qy_py_err[i+1] = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1).mean()
-                        batch_loss_qz_pz[i+1] = torch.mean(torch.sum(kl_laplace(qz_alpha[i+1]), -1), -1).mean()
+                        batch_loss_qy_py[i+1] = masked_mean(criterion_ce(qy_logits[i+1].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)[idx_log].mean()
+                        batch_loss_qy_py_err[i+1] = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i+1], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)[idx_log].mean()
+                        batch_loss_qz_pz[i+1] = masked_mean(torch.sum(kl_laplace(qz_alpha[i+1]), -1), mask)[idx_log].mean()
                 else:
-                    batch_loss_qy_py_ = torch.mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), -1)
-                    batch_loss_qy_py[i] = batch_loss_qy_py_.mean()
-                    batch_loss_qy_py_err_ = torch.mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), -1)
-                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_.mean()
-                batch_loss_qz_pz_ = torch.mean(torch.sum(kl_laplace(qz_alpha[i]), -1), -1)
-                batch_loss_qz_pz[i] = batch_loss_qz_pz_.mean()
-                batch_loss_qy_py_ce = batch_loss_qy_py_.sum()
-                batch_loss_qy_py_prc = batch_loss_qy_py_err_.sum()
-                batch_loss_qz_pz_kl = batch_loss_qz_pz_.sum()
+                    batch_loss_qy_py_ = masked_mean(criterion_ce(qy_logits[i].reshape(-1, n_spk), batch_sc_cv[i//2].reshape(-1)).reshape(batch_sc_cv[i//2].shape[0], -1), mask)
+                    batch_loss_qy_py[i] = batch_loss_qy_py_[idx_log].mean()
+                    batch_loss_qy_py_err_ = masked_mean(100*torch.sum(criterion_l1(F.softmax(qy_logits[i], dim=-1), F.one_hot(batch_sc_cv[i//2], num_classes=n_spk).float()), -1), mask)
+                    batch_loss_qy_py_err[i] = batch_loss_qy_py_err_[idx_log].mean()
+                batch_loss_qz_pz_ = masked_mean(torch.sum(kl_laplace(qz_alpha[i]), -1), mask)
+                batch_loss_qz_pz[i] = batch_loss_qz_pz_[idx_log].mean()
 
                 # elbo
-                batch_loss_elbo[i] = batch_loss_px_mcep_.sum() + batch_loss_qy_py_ce + batch_loss_qy_py_prc + batch_loss_qz_pz_kl
+                batch_loss_elbo_ = batch_loss_px_mcep_ + batch_loss_qy_py_ + batch_loss_qy_py_err_ + batch_loss_qz_pz_
+                batch_loss_elbo[i] = batch_loss_elbo_[idx_log].sum()
 
-                batch_loss += batch_loss_elbo[i]
+                batch_loss += batch_loss_elbo_.sum()
 
                 total_train_loss["train/loss_elbo-%d"%(i+1)].append(batch_loss_elbo[i].item())
                 total_train_loss["train/loss_px-%d"%(i+1)].append(batch_loss_px[i].item())
@@ -2126,8 +2159,13 @@ def main():
                     loss_qz_pz[i+1].append(batch_loss_qz_pz[i+1].item())
 
             optimizer.zero_grad()
-            batch_loss.backward()
-            optimizer.step()
+            amp.backward(batch_loss)
+            dp.all_reduce_grads([model_encoder, model_decoder])
+            amp.step(optimizer)
+
+            if sparsity is not None:
+                with torch.no_grad():
+                    sparsity.step(iter_idx + 1, args.sparse_t_start, args.sparse_t_end, args.sparse_interval, sparse_densities)
 
             text_log = "batch loss [%d] %d %d " % (c_idx+1, f_ss, f_bs)
             for i in range(args.n_half_cyc):
@@ -2166,11 +2204,12 @@ def main():
 
 
     # save final model
-    model_encoder.cpu()
-    model_decoder.cpu()
-    torch.save({"model_encoder": model_encoder.state_dict(),
-                "model_decoder": model_decoder.state_dict()}, args.expdir + "/checkpoint-final.pkl")
-    logging.info("final checkpoint created.")
+    if dp.rank == 0:
+        model_encoder.cpu()
+        model_decoder.cpu()
+        torch.save({"model_encoder": model_encoder.state_dict(),
+                    "model_decoder": model_decoder.state_dict()}, args.expdir + "/checkpoint-final.pkl")
+        logging.info("final checkpoint created.")
 
 
 if __name__ == "__main__":
@@ -30,6 +30,8 @@ from utils import find_files
 from utils import read_hdf5
 from utils import read_txt
 from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, encode_mu_law
+from vcneuvoco import MixedPrecision
+from vcneuvoco import BlockSparsity, peak_memory
 from radam import RAdam
 
 from dataset import FeatureDatasetNeuVoco, padding
@@ -126,7 +128,7 @@ def data_generator(dataloader, device, batch_size, upsampling_factor, limit_coun
 
 
 def save_checkpoint(checkpoint_dir, model_waveform,
-        optimizer, numpy_random_state, torch_random_state, iterations):
+        optimizer, numpy_random_state, torch_random_state, iterations, sparsity=None):
     """FUNCTION TO SAVE CHECKPOINT
 
     Args:
@@ -134,6 +136,7 @@ def save_checkpoint(checkpoint_dir, model_waveform,
         model (torch.nn.Module): pytorch model instance
         optimizer (Optimizer): pytorch optimizer instance
         iterations (int): number of current iterations
+        sparsity (BlockSparsity): block-sparsification masks of recurrent weights
     """
     model_waveform.cpu()
     checkpoint = {
@@ -142,6 +145,8 @@ def save_checkpoint(checkpoint_dir, model_waveform,
         "numpy_random_state": numpy_random_state,
         "torch_random_state": torch_random_state,
         "iterations": iterations}
+    if sparsity is not None:
+        checkpoint["sparsity"] = sparsity.state_dict()
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     torch.save(checkpoint, checkpoint_dir + "/checkpoint-%d.pkl" % iterations)
@@ -155,46 +160,6 @@ def write_to_tensorboard(writer, steps, loss):
         writer.add_scalar(key, value, steps)
 
 
-def sparsify(model_waveform, iter_idx, t_start, t_end, interval, densities, densities_p=None):
-    if iter_idx < t_start or ((iter_idx-t_start) % interval != 0 and iter_idx < t_end):
-        pass
-    else:
-        logging.info('sparsify: %ld %ld %ld %ld' % (iter_idx, t_start, t_end, interval))
-        p = model_waveform.gru.weight_hh_l0
-        nb = p.shape[0]//p.shape[1]
-        N = p.shape[1]
-        N_16 = N // 16
-        ones = torch.diag(torch.ones(N, device=p.device))
-        if densities_p is not None:
-            for k in range(nb):
-                density = densities[k]
-                if iter_idx < t_end:
-                    r = 1 - (iter_idx-t_start)/(t_end - t_start)
-                    density = densities_p[k] - (densities_p[k]-densities[k])*(1 - r)**5
-                logging.info('%ld: %lf %lf %lf' % (k+1, densities_p[k], densities[k], density))
-                A = p[k*N:(k+1)*N, :]
-                L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(N, N_16, 16)
-                S = torch.sum(L*L, -1)
-                SS, _ = torch.sort(S.reshape(-1))
-                thresh = SS[round(N*N_16*(1-density))]
-                mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones, max=1).transpose(1,0)
-                p[k*N:(k+1)*N, :] = p[k*N:(k+1)*N, :]*mask
-        else:
-            for k in range(nb):
-                density = densities[k]
-                if iter_idx < t_end:
-                    r = 1 - (iter_idx-t_start)/(t_end - t_start)
-                    density = 1 - (1-densities[k])*(1 - r)**5
-                logging.info('%ld: 1 %lf %lf' % (k+1, densities[k], density))
-                A = p[k*N:(k+1)*N, :]
-                L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(N, N_16, 16)
-                S = torch.sum(L*L, -1)
-                SS, _ = torch.sort(S.reshape(-1))
-                thresh = SS[round(N*N_16*(1-density))]
-                mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones, max=1).transpose(1,0)
-                p[k*N:(k+1)*N, :] = p[k*N:(k+1)*N, :]*mask
-
-
 def main():
     parser = argparse.ArgumentParser()
     # path setting
@@ -223,6 +188,8 @@ def main():
                         type=int, help="kernel size of dilated causal convolution")
     parser.add_argument("--lpc", default=12,
                         type=int, help="kernel size of dilated causal convolution")
+    parser.add_argument("--lpc_chunk", default=None,
+                        type=int, help="number of samples in a chunk to compute data-driven lpc logits (if None, all samples)")
     parser.add_argument("--mcep_dim", default=50,
                         type=int, help="kernel size of dilated causal convolution")
     parser.add_argument("--right_size", default=0,
@@ -256,6 +223,8 @@ def main():
                         type=int, help="interval in finishing densitiy sparsify")
     parser.add_argument("--densities", default="0.05-0.05-0.2",
                         type=str, help="final densitiy of reset, update, new hidden gate matrices")
+    parser.add_argument("--densities_2", default=None,
+                        type=str, help="final densitiy of reset, update, new hidden gate matrices of 2nd gru (if None, not sparsified)")
     # other setting
     parser.add_argument("--pad_len", default=3000,
                         type=int, help="seed number")
@@ -273,6 +242,8 @@ def main():
                         type=str, help="model path to restart training")
     parser.add_argument("--string_path", default=None,
                         type=str, help="model path to restart training")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -383,7 +354,8 @@ def main():
         causal_conv=args.causal_conv_wave,
         lpc=args.lpc,
         right_size=args.right_size,
-        do_prob=args.do_prob)
+        do_prob=args.do_prob,
+        lpc_chunk=args.lpc_chunk)
     logging.info(model_waveform)
     criterion_ce = torch.nn.CrossEntropyLoss(reduction='none')
     criterion_l1 = torch.nn.L1Loss(reduction='none')
@@ -402,6 +374,9 @@ def main():
 
     model_waveform.train()
 
+    # block-sparsification masks of recurrent weights, kept and reapplied after every update
+    sparsity = BlockSparsity({"gru": model_waveform.gru.weight_hh_l0, "gru_2": model_waveform.gru_2.weight_hh_l0})
+
     if args.pretrained is None:
         model_waveform.scale_in.weight = torch.nn.Parameter(torch.unsqueeze(torch.diag(1.0/scale_stats.data),2))
         model_waveform.scale_in.bias = torch.nn.Parameter(-(mean_stats.data/scale_stats.data))
@@ -443,6 +418,8 @@ def main():
         checkpoint = torch.load(args.resume)
         model_waveform.load_state_dict(checkpoint["model_waveform"])
         optimizer.load_state_dict(checkpoint["optimizer"])
+        if "sparsity" in checkpoint:
+            sparsity.load_state_dict(checkpoint["sparsity"])
         epoch_idx = checkpoint["iterations"]
         logging.info("restored from %d-iter checkpoint." % epoch_idx)
     else:
@@ -510,6 +487,11 @@ def main():
     #generator_eval = data_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=1)
     generator_eval = data_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=None)
 
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_waveform)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
     writer = SummaryWriter(args.expdir)
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
@@ -565,6 +547,21 @@ def main():
     logging.info(t_ends)
     logging.info(args.interval)
     logging.info(densities)
+    # per-stage densities of sparsified recurrent weights, 2nd gru only if set
+    if args.densities_2 is not None:
+        density_deltas_2_ = args.densities_2.split('-')
+        densities_2 = [None]*args.n_stage
+        for i in range(args.n_stage):
+            densities_2[i] = [None]*len(density_deltas_2_)
+            for j in range(len(density_deltas_2_)):
+                if i < args.n_stage-1:
+                    densities_2[i][j] = 1-(i+1)*(1-float(density_deltas_2_[j]))/args.n_stage
+                else:
+                    densities_2[i][j] = float(density_deltas_2_[j])
+        logging.info(densities_2)
+        stage_densities = [{"gru": densities[i], "gru_2": densities_2[i]} for i in range(args.n_stage)]
+    else:
+        stage_densities = [{"gru": densities[i]} for i in range(args.n_stage)]
     idx_stage = 0
 
     # train
@@ -603,6 +600,9 @@ def main():
             logging.info("(EPOCH:%d) average optimization loss = %.6f (+- %.6f) %.6f (+- %.6f) %% ;; "\
                 "(%.3f min., %.3f sec / batch)" % (epoch_idx + 1, np.mean(loss_ce), np.std(loss_ce), \
                     np.mean(loss_err), np.std(loss_err), total / 60.0, total / iter_count))
+            logging.info("peak memory %.1f MB" % (peak_memory(device)))
+            logging.info("sparsification overhead = %.6f sec / batch" % (sparsity.time / iter_count))
+            sparsity.time = 0
             logging.info("estimated time until max. epoch = {0.days:02}:{0.hours:02}:{0.minutes:02}:"\
             "{0.seconds:02}".format(relativedelta(seconds=int((args.epoch_count - (epoch_idx + 1)) * total))))
             # compute loss in evaluation data
@@ -747,7 +747,7 @@ def main():
             #    logging.info('save epoch:%d' % (epoch_idx+1))
             #    save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
             logging.info('save epoch:%d' % (epoch_idx+1))
-            save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
+            save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1, sparsity=sparsity)
             total = 0
             iter_count = 0
             loss_ce = []
@@ -854,7 +854,8 @@ def main():
                 #elif len(idx_select) > 1:
                 else:
                     optimizer.zero_grad()
-                    batch_loss.backward()
+                    amp.backward(batch_loss)
+                    amp.unscale(optimizer)
                     #for name, param in model_waveform.named_parameters():
                     #    if param.requires_grad:
                     #        logging.info(f"{name} {param.grad.norm()}")
@@ -868,13 +869,14 @@ def main():
                                 flag = True
                     if flag:
                         logging.info("explode grad")
+                        amp.skip()
                         optimizer.zero_grad()
                         continue
                     torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
                     #for name, param in model_waveform.named_parameters():
                     #    if param.requires_grad:
                     #        logging.info(f"{name} {param.grad.norm()}")
-                    optimizer.step()
+                    amp.step(optimizer)
 
                     with torch.no_grad():
                         #test = model_waveform.gru.weight_hh_l0.data.clone()
@@ -883,9 +885,9 @@ def main():
                         if idx_stage < args.n_stage-1 and iter_idx + 1 == t_starts[idx_stage+1]:
                             idx_stage += 1
                         if idx_stage > 0:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1])
+                            sparsity.step(iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1])
                         else:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage])
+                            sparsity.step(iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage])
                         #logging.info((test==model_waveform.gru.weight_hh_l0).all())
 
                     logging.info("batch loss select %.3f %.3f (%.3f sec)" % (batch_loss_ce_select.item(), \
@@ -893,7 +895,7 @@ def main():
                     iter_idx += 1
                     if iter_idx % args.save_interval_iter == 0:
                         logging.info('save iter:%d' % (iter_idx))
-                        save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
+                        save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx, sparsity=sparsity)
                     iter_count += 1
                     if iter_idx % args.log_interval_steps == 0:
                         logging.info('smt')
@@ -921,7 +923,8 @@ def main():
             batch_loss += batch_loss_ce_.sum()
 
             optimizer.zero_grad()
-            batch_loss.backward()
+            amp.backward(batch_loss)
+            amp.unscale(optimizer)
             #for name, param in model_waveform.named_parameters():
             #    if param.requires_grad:
             #        logging.info(f"{name} {param.grad.norm()}")
@@ -935,13 +938,14 @@ def main():
                         flag = True
             if flag:
                 logging.info("explode grad")
+                amp.skip()
                 optimizer.zero_grad()
                 continue
             torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
             #for name, param in model_waveform.named_parameters():
             #    if param.requires_grad:
             #        logging.info(f"{name} {param.grad.norm()}")
-            optimizer.step()
+            amp.step(optimizer)
 
             with torch.no_grad():
                 #test = model_waveform.gru.weight_hh_l0.data.clone()
@@ -950,9 +954,9 @@ def main():
                 if idx_stage < args.n_stage-1 and iter_idx + 1 == t_starts[idx_stage+1]:
                     idx_stage += 1
                 if idx_stage > 0:
-                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1])
+                    sparsity.step(iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1])
                 else:
-                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage])
+                    sparsity.step(iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage])
                 #logging.info((test==model_waveform.gru.weight_hh_l0).all())
 
             logging.info("batch loss [%d] %d %d %d %d %d : %.3f %.3f %% (%.3f sec)" % (c_idx+1, max_slen, x_ss, x_bs, \
@@ -960,7 +964,7 @@ def main():
             iter_idx += 1
             if iter_idx % args.save_interval_iter == 0:
                 logging.info('save iter:%d' % (iter_idx))
-                save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
+                save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx, sparsity=sparsity)
             iter_count += 1
             if iter_idx % args.log_interval_steps == 0:
                 logging.info('smt')
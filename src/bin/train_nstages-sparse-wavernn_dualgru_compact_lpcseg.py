@@ -31,6 +31,8 @@ from utils import read_hdf5
 from utils import read_txt
 from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
 from vcneuvoco import encode_mu_law
+from vcneuvoco import MixedPrecision
+from vcneuvoco import BlockSparsity, peak_memory
 from radam import RAdam
 
 from dataset import FeatureDatasetNeuVoco, padding
@@ -204,7 +206,7 @@ def eval_generator(dataloader, device, batch_size, upsampling_factor, limit_coun
 
 
 def save_checkpoint(checkpoint_dir, model_waveform,
-        optimizer, numpy_random_state, torch_random_state, iterations):
+        optimizer, numpy_random_state, torch_random_state, iterations, sparsity=None):
     """FUNCTION TO SAVE CHECKPOINT
 
     Args:
@@ -212,6 +214,7 @@ def save_checkpoint(checkpoint_dir, model_waveform,
         model (torch.nn.Module): pytorch model instance
         optimizer (Optimizer): pytorch optimizer instance
         iterations (int): number of current iterations
+        sparsity (BlockSparsity): block-sparsification masks of recurrent weights
     """
     model_waveform.cpu()
     checkpoint = {
@@ -220,6 +223,8 @@ def save_checkpoint(checkpoint_dir, model_waveform,
         "numpy_random_state": numpy_random_state,
         "torch_random_state": torch_random_state,
         "iterations": iterations}
+    if sparsity is not None:
+        checkpoint["sparsity"] = sparsity.state_dict()
     if not os.path.exists(checkpoint_dir):
         os.makedirs(checkpoint_dir)
     torch.save(checkpoint, checkpoint_dir + "/checkpoint-%d.pkl" % iterations)
@@ -233,84 +238,13 @@ def write_to_tensorboard(writer, steps, loss):
         writer.add_scalar(key, value, steps)
 
 
-def sparsify(model_waveform, iter_idx, t_start, t_end, interval, densities, densities_p=None, density_conv_s_c=None, density_conv_s_c_p=None,
+def sparsify(model_waveform, sparsity, iter_idx, t_start, t_end, interval, densities, densities_p=None, density_conv_s_c=None, density_conv_s_c_p=None,
         density_out=None, density_out_p=None):
+    #recurrent weights with persistent block-sparsity masks
+    sparsity.step(iter_idx, t_start, t_end, interval, densities, densities_p=densities_p)
     if iter_idx < t_start or ((iter_idx-t_start) % interval != 0 and iter_idx < t_end):
         pass
     else:
-        logging.info('sparsify: %ld %ld %ld %ld' % (iter_idx, t_start, t_end, interval))
-        p = model_waveform.gru.weight_hh_l0 #recurrent
-        nb = p.shape[0] // p.shape[1]
-        N = p.shape[0] // nb
-        N_16 = N // 16
-        ones = torch.diag(torch.ones(N, device=p.device))
-        #q = model_waveform.gru.weight_ih_l0 #input
-        #M = q.shape[0] // nb
-        #M_16 = M // 16
-        #M_row = q.shape[1]
-        #if M == M_row:
-        #    if M == N:
-        #        ones_ = ones
-        #    else:
-        #        ones_ = torch.diag(torch.ones(M, device=q.device))
-        if densities_p is not None:
-            for k in range(nb):
-                density = densities[k]
-                if iter_idx < t_end:
-                    r = 1 - (iter_idx-t_start)/(t_end - t_start)
-                    density = densities_p[k] - (densities_p[k]-densities[k])*(1 - r)**5
-                logging.info('%ld: %lf %lf %lf' % (k+1, densities_p[k], densities[k], density))
-                #recurrent weight
-                A = p[k*N:(k+1)*N, :]
-                L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(N, N_16, 16) #horizontal block structure (16) in input part, in real-time simultaneously computed for each 16 output using 2 registers (256x2 bits)
-                S = torch.sum(L*L, -1)
-                SS, _ = torch.sort(S.reshape(-1))
-                thresh = SS[round(N*N_16*(1-density))]
-                mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones, max=1).transpose(1,0)
-                p[k*N:(k+1)*N, :] = p[k*N:(k+1)*N, :]*mask
-        #        #input weight
-        #        A = q[k*M:(k+1)*M, :]
-        #        if M == M_row:
-        #            L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(M, M_16, 16) #horizontal block structure (16) in input part, in real-time simultaneously computed for each 16 output using 2 registers (256x2 bits)
-        #        else:
-        #            L = A.transpose(1, 0).reshape(M_row, M_16, 16) #horizontal block structure (16) in input part, in real-time simultaneously computed for each 16 output using 2 registers (256x2 bits)
-        #        S = torch.sum(L*L, -1)
-        #        SS, _ = torch.sort(S.reshape(-1))
-        #        thresh = SS[round(M_row*M_16*(1-density))]
-        #        if M == M_row:
-        #            mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones_, max=1).transpose(1,0)
-        #        else:
-        #            mask = torch.repeat_interleave((S>=thresh).float(), 16, dim=1).transpose(1,0)
-        #        q[k*M:(k+1)*M, :] = q[k*M:(k+1)*M, :]*mask
-        else:
-            for k in range(nb):
-                density = densities[k]
-                if iter_idx < t_end:
-                    r = 1 - (iter_idx-t_start)/(t_end - t_start)
-                    density = 1 - (1-densities[k])*(1 - r)**5
-                logging.info('%ld: 1 %lf %lf' % (k+1, densities[k], density))
-                #recurrent weight
-                A = p[k*N:(k+1)*N, :]
-                L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(N, N_16, 16)
-                S = torch.sum(L*L, -1)
-                SS, _ = torch.sort(S.reshape(-1))
-                thresh = SS[round(N*N_16*(1-density))]
-                mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones, max=1).transpose(1,0)
-                p[k*N:(k+1)*N, :] = p[k*N:(k+1)*N, :]*mask
-        #        #input weight
-        #        A = q[k*M:(k+1)*M, :]
-        #        if M == M_row:
-        #            L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(M, M_16, 16)
-        #        else:
-        #            L = A.transpose(1, 0).reshape(M_row, M_16, 16)
-        #        S = torch.sum(L*L, -1)
-        #        SS, _ = torch.sort(S.reshape(-1))
-        #        thresh = SS[round(M_row*M_16*(1-density))]
-        #        if M == M_row:
-        #            mask = torch.clamp(torch.repeat_interleave((S>=thresh).float(), 16, dim=1) + ones_, max=1).transpose(1,0)
-        #        else:
-        #            mask = torch.repeat_interleave((S>=thresh).float(), 16, dim=1).transpose(1,0)
-        #        q[k*M:(k+1)*M, :] = q[k*M:(k+1)*M, :]*mask
         #out.out
         if density_out is not None:
             s = model_waveform.out.out.weight #conv after upsampling before multiplication with waveform for GRU input
@@ -367,8 +301,12 @@ def main():
                         type=int, help="kernel size of dilated causal convolution")
     parser.add_argument("--seg", default=2,
                         type=int, help="kernel size of dilated causal convolution")
+    parser.add_argument("--rand_shift", default=False,
+                        type=strtobool, help="train one random 1 shift segment grouping per batch of utterances instead of all seg of them")
     parser.add_argument("--lpc", default=4,
                         type=int, help="kernel size of dilated causal convolution")
+    parser.add_argument("--lpc_chunk", default=None,
+                        type=int, help="number of samples in a chunk to compute data-driven lpc logits (if None, all samples)")
     parser.add_argument("--right_size", default=0,
                         type=int, help="kernel size of dilated causal convolution")
     # network training setting
@@ -400,6 +338,8 @@ def main():
                         type=int, help="interval in finishing densitiy sparsify")
     parser.add_argument("--densities", default="0.27-0.27-0.39",
                         type=str, help="final densitiy of reset, update, new hidden gate matrices")
+    parser.add_argument("--densities_2", default=None,
+                        type=str, help="final densitiy of reset, update, new hidden gate matrices of 2nd gru (if None, not sparsified)")
     # other setting
     parser.add_argument("--pad_len", default=3000,
                         type=int, help="seed number")
@@ -417,6 +357,8 @@ def main():
                         type=str, help="model path to restart training")
     parser.add_argument("--string_path", default=None,
                         type=str, help="model path to restart training")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -516,7 +458,8 @@ def main():
         lpc=args.lpc,
         causal_conv=args.causal_conv_wave,
         right_size=args.right_size,
-        do_prob=args.do_prob)
+        do_prob=args.do_prob,
+        lpc_chunk=args.lpc_chunk)
     logging.info(model_waveform)
     criterion_ce = torch.nn.CrossEntropyLoss(reduction='none')
     criterion_l1 = torch.nn.L1Loss(reduction='none')
@@ -534,6 +477,9 @@ def main():
 
     model_waveform.train()
 
+    # block-sparsification masks of recurrent weights, kept and reapplied after every update
+    sparsity = BlockSparsity({"gru": model_waveform.gru.weight_hh_l0, "gru_2": model_waveform.gru_2.weight_hh_l0})
+
     model_waveform.scale_in.weight = torch.nn.Parameter(torch.unsqueeze(torch.diag(1.0/scale_stats.data),2))
     model_waveform.scale_in.bias = torch.nn.Parameter(-(mean_stats.data/scale_stats.data))
 
@@ -566,6 +512,8 @@ def main():
         checkpoint = torch.load(args.resume)
         model_waveform.load_state_dict(checkpoint["model_waveform"])
         optimizer.load_state_dict(checkpoint["optimizer"])
+        if "sparsity" in checkpoint:
+            sparsity.load_state_dict(checkpoint["sparsity"])
         epoch_idx = checkpoint["iterations"]
         logging.info("restored from %d-iter checkpoint." % epoch_idx)
     else:
@@ -636,6 +584,11 @@ def main():
     #generator_eval = data_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=1)
     generator_eval = data_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=None)
 
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_waveform)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
     writer = SummaryWriter(args.expdir)
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
@@ -725,6 +678,21 @@ def main():
     logging.info(t_ends)
     logging.info(args.interval)
     logging.info(densities)
+    # per-stage densities of sparsified recurrent weights, 2nd gru only if set
+    if args.densities_2 is not None:
+        density_deltas_2_ = args.densities_2.split('-')
+        densities_2 = [None]*args.n_stage
+        for i in range(args.n_stage):
+            densities_2[i] = [None]*len(density_deltas_2_)
+            for j in range(len(density_deltas_2_)):
+                if i < args.n_stage-1:
+                    densities_2[i][j] = 1-(i+1)*(1-float(density_deltas_2_[j]))/args.n_stage
+                else:
+                    densities_2[i][j] = float(density_deltas_2_[j])
+        logging.info(densities_2)
+        stage_densities = [{"gru": densities[i], "gru_2": densities_2[i]} for i in range(args.n_stage)]
+    else:
+        stage_densities = [{"gru": densities[i]} for i in range(args.n_stage)]
     idx_stage = 0
 
     # train
@@ -780,6 +748,9 @@ def main():
                 text_log += " [%d] %.6f (+- %.6f) %.6f (+- %.6f) %% ;" % (i+1, \
                     np.mean(loss_ce[i]), np.std(loss_ce[i]), np.mean(loss_prc[i]), np.std(loss_prc[i]))
             logging.info("%s; (%.3f min., %.3f sec / batch)" % (text_log, total / 60.0, total / iter_count))
+            logging.info("peak memory %.1f MB" % (peak_memory(device)))
+            logging.info("sparsification overhead = %.6f sec / batch" % (sparsity.time / iter_count))
+            sparsity.time = 0
             logging.info("estimated time until max. epoch = {0.days:02}:{0.hours:02}:{0.minutes:02}:"\
             "{0.seconds:02}".format(relativedelta(seconds=int((args.epoch_count - (epoch_idx + 1)) * total))))
             # compute loss in evaluation data
@@ -931,7 +902,7 @@ def main():
             #    logging.info('save epoch:%d' % (epoch_idx+1))
             #    save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
             logging.info('save epoch:%d' % (epoch_idx+1))
-            save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1)
+            save_checkpoint(args.expdir, model_waveform, optimizer, numpy_random_state, torch_random_state, epoch_idx + 1, sparsity=sparsity)
             prev_n_batch_utt = args.batch_size_utt
             total = 0
             iter_count = 0
@@ -994,15 +965,19 @@ def main():
                 if f_ss > 0:
                     batch_feat = batch_feat[:,f_ss-1:]
 
+            # 1 shift segment groupings of this batch of utterances, a random one is kept over all of its chunks
+            # for the continuity of hidden states
+            if f_ss == 0:
+                if args.rand_shift:
+                    shifts = [np.random.randint(model_waveform.seg)]
+                else:
+                    shifts = list(range(model_waveform.seg))
+
             # prev ground-truth wave. for prediction calc. for each 1 shift segment
             if model_waveform.lpc > 0:
                 # B x T --> B x T x K --> B x T_seg x K x seg --> B x T_seg x seg x K
-                x_lpc = batch_x_lpc[:,:-model_waveform.seg_1].unfold(1, model_waveform.lpc, 1).unfold(1, model_waveform.seg, model_waveform.seg).permute(0,1,3,2)
-                for i in range(1,model_waveform.seg):
-                    if i < model_waveform.seg_1:
-                        x_lpc = torch.cat((x_lpc, batch_x_lpc[:,i:-model_waveform.seg_1+i].unfold(1, model_waveform.lpc, 1).unfold(1, model_waveform.seg, model_waveform.seg).permute(0,1,3,2)), 0)
-                    else:
-                        x_lpc = torch.cat((x_lpc, batch_x_lpc[:,i:].unfold(1, model_waveform.lpc, 1).unfold(1, model_waveform.seg, model_waveform.seg).permute(0,1,3,2)), 0)
+                x_lpc = torch.cat([batch_x_lpc[:,i:batch_x_lpc.shape[1]-model_waveform.seg_1+i].unfold(1, model_waveform.lpc, 1).unfold(1, model_waveform.seg, model_waveform.seg).permute(0,1,3,2) \
+                            for i in shifts], 0)
 
             # feedforward
             if f_ss > 0:
@@ -1010,7 +985,7 @@ def main():
                     idx_batch_seg_s = 0
                     idx_batch_seg_e = prev_n_batch_utt
                     # handle hidden state per group of batch (because of 1 shift even though segment output)
-                    for i in range(model_waveform.seg):
+                    for i in range(len(shifts)):
                         if i > 0:
                             h_x_ = torch.cat((h_x_, torch.FloatTensor(np.delete(h_x[:,idx_batch_seg_s:idx_batch_seg_e].cpu().data.numpy(), del_index_utt, axis=1)).to(device)), 1)
                             h_x_2_ = torch.cat((h_x_2_, torch.FloatTensor(np.delete(h_x_2[:,idx_batch_seg_s:idx_batch_seg_e].cpu().data.numpy(), del_index_utt, axis=1)).to(device)), 1)
@@ -1022,14 +997,14 @@ def main():
                     h_x = h_x_
                     h_x_2 = h_x_2_
                 if model_waveform.lpc > 0:
-                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, h=h_x, h_2=h_x_2, x_lpc=x_lpc, do=True)
+                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, h=h_x, h_2=h_x_2, x_lpc=x_lpc, do=True, shifts=shifts)
                 else:
-                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, h=h_x, h_2=h_x_2, do=True)
+                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, h=h_x, h_2=h_x_2, do=True, shifts=shifts)
             else:
                 if model_waveform.lpc > 0:
-                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, x_lpc=x_lpc, do=True, first=True)
+                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, x_lpc=x_lpc, do=True, first=True, shifts=shifts)
                 else:
-                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, do=True, first=True)
+                    batch_x_output, h_x, h_x_2 = model_waveform(batch_feat, batch_x_prev, do=True, first=True, shifts=shifts)
             prev_n_batch_utt = n_batch_utt
 
             batch_loss = 0 
@@ -1044,7 +1019,7 @@ def main():
                     k = idx_select[j]
                     slens_utt = slens_acc[k]
                     logging.info('%s %d' % (featfile[k], slens_utt))
-                    for i in range(model_waveform.seg): #from t-(seg-1) to t for 1 shift segment grouping
+                    for i in shifts: #from t-(seg-1) to t for 1 shift segment grouping
                         batch_x_i_ = batch_x[k,:slens_utt-model_waveform.seg_1+i] # ground truth not include seg_offset at first
                         # discard the leading index for t-(seg-1) due to shift 1 segment output
                         batch_x_output_i_ = batch_x_output[k,model_waveform.seg_1-i:slens_utt]
@@ -1054,7 +1029,7 @@ def main():
                         batch_loss_ce_sum_select_[i] += batch_loss_ce_sum_select__
                         batch_loss_prc_sum_select_[i] += torch.mean(torch.sum(100*criterion_l1(F.softmax(batch_x_output_i_, dim=-1), F.one_hot(batch_x_i_, num_classes=args.n_quantize).float()), -1))
                 batch_loss += batch_loss_ce_sum_select
-                for i in range(model_waveform.seg):
+                for i in shifts:
                     batch_loss_ce_sum_select_[i] /= len(idx_select)
                     total_train_loss["train/loss_ce-%d"%(i+1)].append(batch_loss_ce_sum_select_[i].item())
                     loss_ce[i].append(batch_loss_ce_sum_select_[i].item())
@@ -1066,7 +1041,7 @@ def main():
                     batch_x = torch.index_select(batch_x, 0, idx_select_full)
                     idx_batch_seg_s = 0
                     idx_batch_seg_e = n_batch_utt
-                    for i in range(model_waveform.seg):
+                    for i in range(len(shifts)):
                         if i > 0:
                             batch_x_output_ = torch.cat((batch_x_output_, torch.index_select(batch_x_output[idx_batch_seg_s:idx_batch_seg_e], 0, idx_select_full)), 0)
                         else:
@@ -1076,7 +1051,8 @@ def main():
                     batch_x_output = batch_x_output_
                 else:
                     optimizer.zero_grad()
-                    batch_loss.backward()
+                    amp.backward(batch_loss)
+                    amp.unscale(optimizer)
                     flag = False
                     for name, param in model_waveform.named_parameters():
                         if param.requires_grad:
@@ -1085,10 +1061,11 @@ def main():
                                 flag = True
                     if flag:
                         logging.info("explode grad")
+                        amp.skip()
                         optimizer.zero_grad()
                         continue
                     torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
-                    optimizer.step()
+                    amp.step(optimizer)
 
                     with torch.no_grad():
                         if idx_stage < args.n_stage-1 and iter_idx + 1 == t_starts[idx_stage+1]:
@@ -1096,31 +1073,31 @@ def main():
                         if not flag_conv_s_c:
                             if not flag_out:
                                 if idx_stage > 0:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1])
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1])
                                 else:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage])
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage])
                             else:
                                 if idx_stage > 0:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                         density_out=densities_out[idx_stage], density_out_p=densities_out[idx_stage-1])
                                 else:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                         density_out=densities_out[idx_stage])
                         else:
                             if not flag_out:
                                 if idx_stage > 0:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                                 density_conv_s_c=densities_conv_s_c[idx_stage], density_conv_s_c_p=densities_conv_s_c[idx_stage-1])
                                 else:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                                 density_conv_s_c=densities_conv_s_c[idx_stage])
                             else:
                                 if idx_stage > 0:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                                 density_conv_s_c=densities_conv_s_c[idx_stage], density_conv_s_c_p=densities_conv_s_c[idx_stage-1], \
                                                     density_out=densities_out[idx_stage], density_out_p=densities_out[idx_stage-1])
                                 else:
-                                    sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                                    sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                                 density_conv_s_c=densities_conv_s_c[idx_stage], density_out=densities_out[idx_stage])
 
                     text_log = "batch loss_select %lf " % (batch_loss.item())
@@ -1129,7 +1106,7 @@ def main():
                     if iter_idx % args.save_interval_iter == 0:
                         logging.info('save iter:%d' % (iter_idx))
                         save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), \
-                            torch.get_rng_state(), iter_idx)
+                            torch.get_rng_state(), iter_idx, sparsity=sparsity)
                     iter_count += 1
                     if iter_idx % args.log_interval_steps == 0:
                         logging.info('smt')
@@ -1146,7 +1123,7 @@ def main():
                 n_batch_utt = len(idx_select_full)
             idx_batch_seg_s = 0
             idx_batch_seg_e = n_batch_utt
-            for i in range(model_waveform.seg): #from t-(seg-1) to t for 1 shift segment grouping
+            for i in shifts: #from t-(seg-1) to t for 1 shift segment grouping
                 if i < model_waveform.seg_1:
                     batch_x_i[i] = batch_x[:,:-model_waveform.seg_1+i] # ground truth not include seg_offset at first
                 else:
@@ -1158,7 +1135,7 @@ def main():
 
             # loss
             batch_loss_ce_sum = 0
-            for i in range(model_waveform.seg_1,-1,-1):
+            for i in shifts[::-1]:
                 batch_loss_ce_ = torch.mean(criterion_ce(batch_x_output_i[i].reshape(-1, args.n_quantize), batch_x_i[i].reshape(-1)).reshape(batch_x_output_i[i].shape[0], -1), -1)
                 batch_loss_ce[i] = batch_loss_ce_.mean().item()
                 total_train_loss["train/loss_ce-%d"%(i+1)].append(batch_loss_ce[i])
@@ -1167,13 +1144,14 @@ def main():
                 batch_loss_prc[i] = torch.mean(torch.sum(100*criterion_l1(F.softmax(batch_x_output_i[i], dim=-1), F.one_hot(batch_x_i[i], num_classes=args.n_quantize).float()), -1)).item()
                 total_train_loss["train/loss_prc-%d"%(i+1)].append(batch_loss_prc[i])
                 loss_prc[i].append(batch_loss_prc[i])
-                if i == model_waveform.seg_1:
+                if i == shifts[-1]:
                     i = np.random.randint(0, batch_x_output_i[i].shape[0])
                     logging.info("%s" % (os.path.join(os.path.basename(os.path.dirname(featfile[i])),os.path.basename(featfile[i]))))
             batch_loss += batch_loss_ce_sum
 
             optimizer.zero_grad()
-            batch_loss.backward()
+            amp.backward(batch_loss)
+            amp.unscale(optimizer)
             flag = False
             for name, param in model_waveform.named_parameters():
                 if param.requires_grad:
@@ -1182,10 +1160,11 @@ def main():
                         flag = True
             if flag:
                 logging.info("explode grad")
+                amp.skip()
                 optimizer.zero_grad()
                 continue
             torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
-            optimizer.step()
+            amp.step(optimizer)
 
             with torch.no_grad():
                 if idx_stage < args.n_stage-1 and iter_idx + 1 == t_starts[idx_stage+1]:
@@ -1193,41 +1172,41 @@ def main():
                 if not flag_conv_s_c:
                     if not flag_out:
                         if idx_stage > 0:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1])
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1])
                         else:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage])
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage])
                     else:
                         if idx_stage > 0:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                 density_out=densities_out[idx_stage], density_out_p=densities_out[idx_stage-1])
                         else:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                 density_out=densities_out[idx_stage])
                 else:
                     if not flag_out:
                         if idx_stage > 0:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                         density_conv_s_c=densities_conv_s_c[idx_stage], density_conv_s_c_p=densities_conv_s_c[idx_stage-1])
                         else:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                         density_conv_s_c=densities_conv_s_c[idx_stage])
                     else:
                         if idx_stage > 0:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], densities_p=densities[idx_stage-1], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], densities_p=stage_densities[idx_stage-1], \
                                         density_conv_s_c=densities_conv_s_c[idx_stage], density_conv_s_c_p=densities_conv_s_c[idx_stage-1], \
                                             density_out=densities_out[idx_stage], density_out_p=densities_out[idx_stage-1])
                         else:
-                            sparsify(model_waveform, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, densities[idx_stage], \
+                            sparsify(model_waveform, sparsity, iter_idx + 1, t_starts[idx_stage], t_ends[idx_stage], args.interval, stage_densities[idx_stage], \
                                         density_conv_s_c=densities_conv_s_c[idx_stage], density_out=densities_out[idx_stage])
 
             text_log = "batch loss [%d] %d %d %d %d %d :" % (c_idx+1, max_slen, x_ss, x_bs, f_ss, f_bs)
-            for i in range(model_waveform.seg_1,-1,-1):
+            for i in shifts[::-1]:
                 text_log += " [%d] %.3f %.3f %% ;" % (i+1, batch_loss_ce[i], batch_loss_prc[i])
             logging.info("%s; (%.3f sec)" % (text_log, time.time() - start))
             iter_idx += 1
             if iter_idx % args.save_interval_iter == 0:
                 logging.info('save iter:%d' % (iter_idx))
-                save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx)
+                save_checkpoint(args.expdir, model_waveform, optimizer, np.random.get_state(), torch.get_rng_state(), iter_idx, sparsity=sparsity)
             iter_count += 1
             if iter_idx % args.log_interval_steps == 0:
                 logging.info('smt')
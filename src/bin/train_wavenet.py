@@ -30,6 +30,7 @@ from utils import find_files
 from utils import read_hdf5
 from utils import read_txt
 from vcneuvoco import DSWNV, encode_mu_law
+from vcneuvoco import MixedPrecision
 from radam import RAdam
 
 from dataset import FeatureDatasetNeuVoco, padding
@@ -227,6 +228,8 @@ def main():
                         type=str, help="model path to restart training")
     parser.add_argument("--string_path", default=None,
                         type=str, help="model path to restart training")
+    parser.add_argument("--mixed_precision", default="fp32",
+                        type=str, help="training precision: fp32, fp16 (autocast with loss scaling), or bf16 (autocast)")
     parser.add_argument("--GPU_device", default=None,
                         type=int, help="selection of GPU device")
     parser.add_argument("--verbose", default=1,
@@ -444,6 +447,11 @@ def main():
     #generator_eval = train_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=1)
     generator_eval = train_generator(dataloader_eval, device, args.batch_size, args.upsampling_factor, limit_count=None)
 
+    # mixed precision, losses are kept in fp32
+    amp = MixedPrecision(args.mixed_precision, device)
+    amp.apply(model_waveform)
+    logging.info("training precision: %s" % (args.mixed_precision))
+
     writer = SummaryWriter(args.expdir)
     total_train_loss = defaultdict(list)
     total_eval_loss = defaultdict(list)
@@ -698,9 +706,10 @@ def main():
                     batch_x_output = torch.index_select(batch_x_output,0,idx_select_full)
                 else:
                     optimizer.zero_grad()
-                    batch_loss.backward()
+                    amp.backward(batch_loss)
+                    amp.unscale(optimizer)
                     torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
-                    optimizer.step()
+                    amp.step(optimizer)
 
                     logging.info("batch loss select %.3f %.3f (%.3f sec)" % (batch_loss_ce.item(), batch_loss_err.item(), time.time() - start))
                     iter_idx += 1
@@ -732,9 +741,10 @@ def main():
             batch_loss += batch_loss_ce_.sum()
 
             optimizer.zero_grad()
-            batch_loss.backward()
+            amp.backward(batch_loss)
+            amp.unscale(optimizer)
             torch.nn.utils.clip_grad_norm_(model_waveform.parameters(), 10)
-            optimizer.step()
+            amp.step(optimizer)
 
             logging.info("batch loss [%d] %d %d %d %d %d : %.3f %.3f %% (%.3f sec)" % (c_idx+1, max_slen, x_ss, x_bs, \
                 f_ss, f_bs, batch_loss_ce.item(), batch_loss_err.item(), time.time() - start))
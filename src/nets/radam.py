@@ -14,16 +14,116 @@ from torch.optim.optimizer import Optimizer
 class RAdam(Optimizer):
     """Rectified Adam optimizer."""
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0):
-        """Initilize RAdam optimizer."""
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0, foreach=None):
+        """Initilize RAdam optimizer.
+
+        With foreach, the float32 dense parameters of a group sharing the same step are updated
+        with multi-tensor (torch._foreach_*) ops, giving the same update as the per-parameter loop.
+        If foreach is None, only cuda parameters are, as on cpu the per-parameter loop is faster.
+        """
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
         self.buffer = [[None, None, None] for ind in range(10)]
+        self.foreach = foreach if hasattr(torch, "_foreach_addcdiv_") else False
         super(RAdam, self).__init__(params, defaults)
 
     def __setstate__(self, state):
         """Set state."""
         super(RAdam, self).__setstate__(state)
 
+    def _rectification(self, step, beta1, beta2):
+        """Rectification term (N_sma) and step size of a step, buffered over parameters and groups."""
+        buffered = self.buffer[int(step % 10)]
+        if step == buffered[0]:
+            N_sma, step_size = buffered[1], buffered[2]
+        else:
+            buffered[0] = step
+            beta2_t = beta2 ** step
+            N_sma_max = 2 / (1 - beta2) - 1
+            N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+            buffered[1] = N_sma
+
+            # more conservative since it's an approximated value
+            if N_sma >= 5:
+                step_size = math.sqrt(
+                    (1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)  # NOQA
+            else:
+                step_size = 1.0 / (1 - beta1 ** step)
+            buffered[2] = step_size
+
+        return N_sma, step_size
+
+    def _init_state(self, p, p_data_fp32):
+        """Initialize or cast state of a parameter."""
+        state = self.state[p]
+
+        if len(state) == 0:
+            state['step'] = 0
+            state['exp_avg'] = torch.zeros_like(p_data_fp32)
+            state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
+        else:
+            state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
+            state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
+
+        return state
+
+    def _single_tensor_step(self, group, p):
+        """Update a parameter."""
+        grad = p.grad.data.float()
+
+        p_data_fp32 = p.data.float()
+
+        state = self._init_state(p, p_data_fp32)
+
+        exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+        beta1, beta2 = group['betas']
+
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+
+        state['step'] += 1
+        N_sma, step_size = self._rectification(state['step'], beta1, beta2)
+
+        if group['weight_decay'] != 0:
+            p_data_fp32.add_(p_data_fp32, alpha=-group['weight_decay'] * group['lr'])
+
+        # more conservative since it's an approximated value
+        if N_sma >= 5:
+            denom = exp_avg_sq.sqrt().add_(group['eps'])
+            p_data_fp32.addcdiv_(exp_avg, denom, value=-step_size * group['lr'])
+        else:
+            p_data_fp32.add_(exp_avg, alpha=-step_size * group['lr'])
+
+        p.data.copy_(p_data_fp32)
+
+    def _multi_tensor_step(self, group, params):
+        """Update float32 parameters of a group sharing the same step with multi-tensor ops."""
+        params_data = [p.data for p in params]
+        grads = [p.grad.data for p in params]
+        states = [self._init_state(p, p.data) for p in params]
+        exp_avgs = [state['exp_avg'] for state in states]
+        exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+        beta1, beta2 = group['betas']
+
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+        for state in states:
+            state['step'] += 1
+        N_sma, step_size = self._rectification(states[0]['step'], beta1, beta2)
+
+        if group['weight_decay'] != 0:
+            torch._foreach_add_(params_data, params_data, alpha=-group['weight_decay'] * group['lr'])
+
+        # more conservative since it's an approximated value
+        if N_sma >= 5:
+            denom = torch._foreach_sqrt(exp_avg_sqs)
+            torch._foreach_add_(denom, group['eps'])
+            torch._foreach_addcdiv_(params_data, exp_avgs, denom, value=-step_size * group['lr'])
+        else:
+            torch._foreach_add_(params_data, exp_avgs, alpha=-step_size * group['lr'])
+
     def step(self, closure=None):
         """Run one step."""
         loss = None
@@ -32,60 +132,21 @@ class RAdam(Optimizer):
 
         for group in self.param_groups:
 
+            # float32 parameters are bucketed by step (all of them, unless some had no grad in earlier steps)
+            buckets = {}
             for p in group['params']:
                 if p.grad is None:
                     continue
-                grad = p.grad.data.float()
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError('RAdam does not support sparse gradients')
 
-                p_data_fp32 = p.data.float()
-
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p_data_fp32)
-                    state['exp_avg_sq'] = torch.zeros_like(p_data_fp32)
-                else:
-                    state['exp_avg'] = state['exp_avg'].type_as(p_data_fp32)
-                    state['exp_avg_sq'] = state['exp_avg_sq'].type_as(p_data_fp32)
-
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
-
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-
-                state['step'] += 1
-                buffered = self.buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
-                else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-
-                    # more conservative since it's an approximated value
-                    if N_sma >= 5:
-                        step_size = math.sqrt(
-                            (1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])  # NOQA
-                    else:
-                        step_size = 1.0 / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
-
-                if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
-
-                # more conservative since it's an approximated value
-                if N_sma >= 5:
-                    denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size * group['lr'], exp_avg, denom)
+                foreach = self.foreach if self.foreach is not None else p.is_cuda
+                if foreach and p.dtype == torch.float32 and p.grad.dtype == torch.float32:
+                    buckets.setdefault(self.state[p].get('step', 0), []).append(p)
                 else:
-                    p_data_fp32.add_(-step_size * group['lr'], exp_avg)
+                    self._single_tensor_step(group, p)
 
-                p.data.copy_(p_data_fp32)
+            for params in buckets.values():
+                self._multi_tensor_step(group, params)
 
         return loss
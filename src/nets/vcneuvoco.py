@@ -5,14 +5,23 @@
 
 from __future__ import division
 
+import copy
 import logging
+import os
+import pickle
+import resource
 import sys
 import time
 import math
 
+from collections import defaultdict
+
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.weight_norm import WeightNorm
+from torch.utils.checkpoint import checkpoint
 
 from torch.distributions.one_hot_categorical import OneHotCategorical
 
@@ -103,6 +112,431 @@ def decode_mu_law_torch(y, mu=256):
     return x
 
 
+def cast_float(x):
+    """FUNCTION TO CAST FLOATING-POINT TENSORS (ALSO IN TUPLE/LIST) TO FLOAT32
+
+    Arg:
+        x (object): tensor, or tuple/list of tensors and other objects
+
+    Return:
+        (object): input with floating-point tensors in float32
+    """
+    if isinstance(x, torch.Tensor):
+        if x.is_floating_point():
+            return x.float()
+        return x
+    elif isinstance(x, (tuple, list)):
+        return type(x)(cast_float(y) for y in x)
+    return x
+
+
+class MixedPrecision(object):
+    """MIXED PRECISION TRAINING WITH AUTOCAST
+
+    Forward of the applied modules is run in autocast, while their outputs are cast back to float32,
+    so that the losses (e.g., kl_laplace, LaplaceLoss, cross-entropy) are computed outside autocast in float32.
+    fp16 uses dynamic loss scaling, bf16 does not need it.
+
+    Args:
+        mode (str): "fp32", "fp16", or "bf16"
+        device (torch.device): device of training
+    """
+
+    def __init__(self, mode, device):
+        self.mode = mode
+        self.device_type = device.type
+        self.dtype = None
+        self.scaler = None
+        if self.mode != "fp32":
+            if not hasattr(torch, "autocast"):
+                logging.error("mixed precision training requires pytorch >= 1.10.")
+                sys.exit(1)
+            if self.mode == "fp16":
+                if self.device_type != "cuda":
+                    logging.error("fp16 autocast is only available on gpu, please use bf16 on cpu.")
+                    sys.exit(1)
+                self.dtype = torch.float16
+                self.scaler = torch.cuda.amp.GradScaler()
+            elif self.mode == "bf16":
+                self.dtype = torch.bfloat16
+            else:
+                logging.error("%s is not supported, please use fp32, fp16, or bf16." % (self.mode))
+                sys.exit(1)
+
+    def apply(self, model):
+        """Run forward of model in autocast with float32 outputs."""
+        if self.dtype is None:
+            return model
+        forward = model.forward
+        device_type = self.device_type
+        dtype = self.dtype
+        def forward_autocast(*args, **kwargs):
+            with torch.autocast(device_type=device_type, dtype=dtype):
+                return cast_float(forward(*args, **kwargs))
+        model.forward = forward_autocast
+        return model
+
+    def backward(self, loss):
+        """Backward of (scaled) loss."""
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def unscale(self, optimizer):
+        """Unscale gradients before clipping or checking them."""
+        if self.scaler is not None:
+            self.scaler.unscale_(optimizer)
+
+    def step(self, optimizer):
+        """Update parameters, skipped by the scaler if gradients are not finite."""
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+    def skip(self):
+        """Update loss scale when the step is skipped after unscale."""
+        if self.scaler is not None:
+            self.scaler.update()
+
+
+def checkpoint_forward(model):
+    """FUNCTION TO APPLY ACTIVATION CHECKPOINTING TO FORWARD OF A MODULE
+
+    Activations within each call of the module (i.e., each of its half-cycles) are not kept for backprop,
+    but recomputed in backward, with the same dropout masks. Calls without gradient (evaluation) are not affected.
+
+    Args:
+        model (torch.nn.Module): module instance
+
+    Return:
+        (torch.nn.Module): module with checkpointed forward
+    """
+    if tuple(int(x) for x in torch.__version__.split(".")[:2]) < (1, 11):
+        logging.error("gradient checkpointing requires pytorch >= 1.11.")
+        sys.exit(1)
+    forward = model.forward
+    def forward_checkpoint(*args, **kwargs):
+        if not torch.is_grad_enabled():
+            return forward(*args, **kwargs)
+        return checkpoint(lambda *inputs: forward(*inputs, **kwargs), *args, use_reentrant=False)
+    model.forward = forward_checkpoint
+    return model
+
+
+def peak_memory(device):
+    """FUNCTION TO GET PEAK MEMORY [MB]
+
+    On gpu, peak of allocated tensors since the last call; on cpu, peak resident size of the process.
+
+    Args:
+        device (torch.device): device of training
+
+    Return:
+        (float): peak memory in MB
+    """
+    if device.type == "cuda":
+        mem = torch.cuda.max_memory_allocated(device)/1e6
+        torch.cuda.reset_peak_memory_stats(device)
+        return mem
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+
+
+class WeightNormedWeight(object):
+    """EFFECTIVE WEIGHT g*v/||v|| OF A WEIGHT-NORMED PARAMETER FOR BLOCK-SPARSIFICATION
+
+    The masks are computed from the effective weight, and a masked weight is written back
+    as v = w and g = ||w||, so that the effective weight is exactly the masked one.
+
+    Args:
+        module (torch.nn.Module): module with weight norm applied to the parameter
+        name (str): name of the parameter (e.g., weight_hh_l0)
+    """
+
+    def __init__(self, module, name):
+        self.g = getattr(module, name + "_g")
+        self.v = getattr(module, name + "_v")
+        self.dim = [hook.dim for hook in module._forward_pre_hooks.values() \
+                        if isinstance(hook, WeightNorm) and hook.name == name][0]
+        self.shape = self.v.shape
+        self.device = self.v.device
+
+    @property
+    def data(self):
+        return torch._weight_norm(self.v.data, self.g.data, self.dim)
+
+    def mask_(self, mask):
+        weight = self.data * mask
+        self.v.data.copy_(weight)
+        self.g.data.copy_(torch.norm_except_dim(weight, 2, self.dim))
+
+
+def gru_recurrent_weights(models):
+    """FUNCTION TO COLLECT RECURRENT WEIGHTS OF GRU LAYERS FOR BLOCK-SPARSIFICATION
+
+    Weight-normed recurrent weights are collected as their effective weights (WeightNormedWeight).
+
+    Args:
+        models (dict): name and model instance having a gru module
+
+    Return:
+        (dict): name and recurrent weight (parameter or WeightNormedWeight) of each gru layer
+    """
+    weights = dict()
+    for key, model in models.items():
+        for name, param in model.gru.named_parameters():
+            if name.startswith("weight_hh") and name.endswith("_v"):
+                weights["%s.gru.%s" % (key, name[:-2])] = WeightNormedWeight(model.gru, name[:-2])
+            elif name.startswith("weight_hh") and not name.endswith("_g"):
+                weights["%s.gru.%s" % (key, name)] = param
+    return weights
+
+
+class BlockSparsity(object):
+    """BLOCK-SPARSIFICATION OF GRU RECURRENT WEIGHTS WITH PERSISTENT MASKS
+
+    Each gate block (N x N) of a recurrent weight is pruned by the norms of its 16-block rows of the transposed weight
+    (horizontal block structure), while its diagonal is always kept. Masks are recomputed on the sparsification schedule,
+    with threshold selected by kthvalue, and kept to be reapplied after every optimizer step,
+    so that pruned weights do not drift back between the recomputations. Masks are saved in the checkpoint.
+
+    Args:
+        weights (dict): name and recurrent weight parameter (nb*N x N, e.g., gru.weight_hh_l0) or WeightNormedWeight
+        block_size (int): size of pruned block
+    """
+
+    def __init__(self, weights, block_size=16):
+        self.block_size = block_size
+        self.weights = dict()
+        for name, weight in weights.items():
+            if weight.shape[1] % self.block_size != 0 or weight.shape[0] % weight.shape[1] != 0:
+                logging.warn("%s %s is not sparsified with %d-block." % (name, str(tuple(weight.shape)), self.block_size))
+            else:
+                self.weights[name] = weight
+        self.masks = dict()
+        self.t_final = None
+        self.time = 0
+
+    def density(self, iter_idx, t_start, t_end, density, density_p=None):
+        """Density of the schedule, cubic decay from the previous stage density (or 1) to the stage density."""
+        if iter_idx < t_end:
+            r = 1 - (iter_idx-t_start)/(t_end - t_start)
+            if density_p is not None:
+                return density_p - (density_p-density)*(1 - r)**5
+            return 1 - (1-density)*(1 - r)**5
+        return density
+
+    def update(self, iter_idx, t_start, t_end, densities, densities_p=None):
+        """Recompute masks of the weights with the scheduled density of each gate block, and apply them.
+
+        Args:
+            densities (dict): name and list of stage densities of each gate block
+            densities_p (dict): name and list of previous stage densities of each gate block
+        """
+        for name in densities.keys():
+            if name not in self.weights:
+                continue
+            p = self.weights[name]
+            N = p.shape[1]
+            nb = p.shape[0] // N
+            W = p.data
+            if name not in self.masks:
+                self.masks[name] = torch.ones_like(W)
+            for k in range(nb):
+                if densities_p is not None:
+                    density = self.density(iter_idx, t_start, t_end, densities[name][k], densities_p[name][k])
+                    logging.info('%s %ld: %lf %lf %lf' % (name, k+1, densities_p[name][k], densities[name][k], density))
+                else:
+                    density = self.density(iter_idx, t_start, t_end, densities[name][k])
+                    logging.info('%s %ld: 1 %lf %lf' % (name, k+1, densities[name][k], density))
+                A = W[k*N:(k+1)*N, :]
+                L = (A - torch.diag(torch.diag(A))).transpose(1, 0).reshape(N, N // self.block_size, self.block_size)
+                S = torch.sum(L*L, -1).reshape(-1)
+                n_prune = min(max(round(S.shape[0]*(1-density)), 0), S.shape[0]-1)
+                thresh = torch.kthvalue(S, n_prune+1)[0]
+                mask = torch.repeat_interleave((S >= thresh).float().reshape(N, -1), self.block_size, dim=1).transpose(1, 0)
+                mask.fill_diagonal_(1)
+                self.masks[name][k*N:(k+1)*N, :] = mask
+        self.apply()
+
+    def apply(self):
+        """Zero the pruned weights."""
+        for name, mask in self.masks.items():
+            if isinstance(self.weights[name], WeightNormedWeight):
+                self.weights[name].mask_(mask)
+            else:
+                self.weights[name].data.mul_(mask)
+
+    def step(self, iter_idx, t_start, t_end, interval, densities, densities_p=None):
+        """Update masks on the schedule (every interval iterations between t_start and t_end), otherwise reapply them.
+
+        The masks of the final densities of a schedule are computed once at its first step from t_end
+        (also after resuming), and only reapplied afterwards.
+        """
+        start = time.time()
+        if iter_idx >= t_end:
+            if self.t_final != t_end:
+                logging.info('sparsify: %ld %ld %ld %ld (final)' % (iter_idx, t_start, t_end, interval))
+                self.update(iter_idx, t_start, t_end, densities, densities_p=densities_p)
+                self.t_final = t_end
+            else:
+                self.apply()
+        elif iter_idx < t_start or (iter_idx-t_start) % interval != 0:
+            self.apply()
+        else:
+            logging.info('sparsify: %ld %ld %ld %ld' % (iter_idx, t_start, t_end, interval))
+            self.update(iter_idx, t_start, t_end, densities, densities_p=densities_p)
+        self.time += time.time() - start
+
+    def state_dict(self):
+        return {name: mask.cpu() for name, mask in self.masks.items()}
+
+    def load_state_dict(self, state_dict):
+        for name, mask in state_dict.items():
+            if name in self.weights:
+                self.masks[name] = mask.to(self.weights[name].device)
+
+
+class DataParallel(object):
+    """DATA-PARALLEL TRAINING WITH TORCH.DISTRIBUTED
+
+    Each rank is a process (e.g., launched by torchrun) training on its shard of the utterance list,
+    parameters are broadcast from rank 0, and gradients are averaged with all-reduce before the update.
+    gloo trains on cpu, nccl on the gpu of LOCAL_RANK, and None is the single-process training.
+
+    Args:
+        backend (str): None, "gloo", or "nccl"
+        init_method (str): url of process group initialization
+    """
+
+    def __init__(self, backend=None, init_method="env://"):
+        self.backend = backend
+        self.rank = 0
+        self.world_size = 1
+        self.comm_time = 0
+        if self.backend is None:
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        else:
+            if not dist.is_available():
+                logging.error("torch.distributed is not available in this pytorch build.")
+                sys.exit(1)
+            if self.backend == "gloo":
+                self.device = torch.device("cpu")
+            elif self.backend == "nccl":
+                self.device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+                torch.cuda.set_device(self.device)
+            else:
+                logging.error("%s is not supported, please use gloo or nccl." % (self.backend))
+                sys.exit(1)
+            dist.init_process_group(self.backend, init_method=init_method)
+            self.rank = dist.get_rank()
+            self.world_size = dist.get_world_size()
+
+    def shard(self, file_list):
+        """Utterance list of this rank, padded with the first utterances to the same number in all ranks."""
+        n_pad = -len(file_list) % self.world_size
+        file_list = list(file_list) + list(file_list[:n_pad])
+        return file_list[self.rank::self.world_size]
+
+    def broadcast(self, models):
+        """Copy parameters and buffers of rank 0 to all ranks."""
+        if self.world_size == 1:
+            return
+        for model in models:
+            for tensor in list(model.parameters()) + list(model.buffers()):
+                dist.broadcast(tensor.data, 0)
+
+    def all_reduce_grads(self, models):
+        """Average gradients over ranks in a single flattened bucket.
+
+        Parameters without gradient in all ranks are kept without gradient,
+        otherwise missing gradients are reduced as zeros.
+        """
+        if self.world_size == 1:
+            return
+        start = time.time()
+        params = [param for model in models for param in model.parameters() if param.requires_grad]
+        flags = torch.FloatTensor([param.grad is not None for param in params]).to(self.device)
+        dist.all_reduce(flags, op=dist.ReduceOp.MAX)
+        params = [param for param, flag in zip(params, flags.tolist()) if flag > 0]
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        grads = [param.grad.data for param in params]
+        bucket = torch.cat([grad.reshape(-1) for grad in grads])
+        dist.all_reduce(bucket)
+        bucket /= self.world_size
+        offset = 0
+        for grad in grads:
+            grad.copy_(bucket[offset:offset+grad.numel()].view_as(grad))
+            offset += grad.numel()
+        self.comm_time += time.time() - start
+
+    def any(self, flag):
+        """Flag is set in any rank."""
+        if self.world_size == 1:
+            return flag
+        flag = torch.FloatTensor([flag]).to(self.device)
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+        return flag.item() > 0
+
+    def gather(self, obj):
+        """List of picklable object of all ranks."""
+        if self.world_size == 1:
+            return [obj]
+        data = torch.from_numpy(np.frombuffer(pickle.dumps(obj), dtype=np.uint8).copy()).to(self.device)
+        sizes = [torch.zeros(1, dtype=torch.long, device=self.device) for _ in range(self.world_size)]
+        dist.all_gather(sizes, torch.LongTensor([data.shape[0]]).to(self.device))
+        sizes = [size.item() for size in sizes]
+        buffer = torch.zeros(max(sizes), dtype=torch.uint8, device=self.device)
+        buffer[:data.shape[0]] = data
+        buffers = [torch.zeros_like(buffer) for _ in range(self.world_size)]
+        dist.all_gather(buffers, buffer)
+        return [pickle.loads(buffer[:size].cpu().numpy().tobytes()) for buffer, size in zip(buffers, sizes)]
+
+    def gather_rows(self, array):
+        """Concatenate rows of ndarray (N x D, with N of each rank) of all ranks in rank order."""
+        if self.world_size == 1:
+            return array
+        data = torch.from_numpy(np.ascontiguousarray(array)).to(self.device)
+        sizes = [torch.zeros(1, dtype=torch.long, device=self.device) for _ in range(self.world_size)]
+        dist.all_gather(sizes, torch.LongTensor([data.shape[0]]).to(self.device))
+        sizes = [size.item() for size in sizes]
+        buffer = data.new_zeros((max(sizes),)+data.shape[1:])
+        buffer[:data.shape[0]] = data
+        buffers = [torch.zeros_like(buffer) for _ in range(self.world_size)]
+        dist.all_gather(buffers, buffer)
+        return np.concatenate([buffer[:size].cpu().numpy() for buffer, size in zip(buffers, sizes)], 0)
+
+    def all_gather_results(self, results):
+        """Concatenate evaluation results of all ranks.
+
+        Each result is a flag (any of ranks), a dict of lists (e.g., total_eval_loss),
+        a list of values, or a list of such lists (e.g., per half-cycle or per speaker).
+        """
+        if self.world_size == 1:
+            return results
+        def merge(values):
+            value = values[0]
+            if value is None:
+                return None
+            if isinstance(value, bool):
+                return any(values)
+            if isinstance(value, dict):
+                merged = defaultdict(list)
+                for value_rank in values:
+                    for key, value_key in value_rank.items():
+                        merged[key].extend(value_key)
+                return merged
+            if len(value) > 0 and all(x is None or isinstance(x, list) for x in value):
+                return [merge([value_rank[i] for value_rank in values]) for i in range(len(value))]
+            return [x for value_rank in values for x in value_rank]
+        results_ranks = self.gather(results)
+        return [merge([result_rank[i] for result_rank in results_ranks]) for i in range(len(results))]
+
+
 class ConvTranspose2d(nn.ConvTranspose2d):
     """Conv1d module with customized initialization."""
 
@@ -353,6 +787,72 @@ class EmbeddingHalf(nn.Embedding):
         torch.nn.init.constant_(self.weight, 0.5)
 
 
+def gru_cell(x_gates, h, weight_hh, bias_hh):
+    """FUNCTION OF GRU CELL STEP WITH PRECOMPUTED INPUT GATES
+
+    Args:
+        x_gates (Tensor): B x 3*H input projection of gates (reset, update, new), including input bias
+        h (Tensor): B x H previous hidden state
+        weight_hh (Tensor): 3*H x H recurrent weight
+        bias_hh (Tensor): 3*H recurrent bias
+
+    Return:
+        (Tensor): B x H next hidden state
+    """
+    h_gates = F.linear(h, weight_hh, bias_hh)
+    x_r, x_z, x_n = x_gates.chunk(3, 1)
+    h_r, h_z, h_n = h_gates.chunk(3, 1)
+    r = torch.sigmoid(x_r + h_r)
+    z = torch.sigmoid(x_z + h_z)
+    n = torch.tanh(x_n + r*h_n)
+
+    return n + z*(h - n)
+
+
+def active_sample_mask(spc_mask, upsampling_factor, warmup=0, per_utt=False):
+    """FUNCTION TO GET SAMPLE-LEVEL MASK OF AUTOREGRESSIVE STEPS FROM FRAME-LEVEL SPEECH MASK
+
+    A sample is active if its frame is speech (in any utterance of the batch, or in its own utterance with per_utt),
+    or if a speech sample follows it within warmup samples, so that the hidden state is re-warmed before each speech
+    region after a skipped silence.
+
+    Args:
+        spc_mask (ndarray): B x T_frm speech frame mask (nonzero for frames above the power threshold)
+        upsampling_factor (int): number of samples per frame
+        warmup (int): number of samples to run before each speech region
+        per_utt (bool): mask of each utterance instead of that of the whole batch
+
+    Return:
+        (ndarray): T (or B x T with per_utt) boolean mask of samples to be generated autoregressively
+    """
+    active = np.asarray(spc_mask) > 0
+    if not per_utt:
+        active = np.any(active, axis=0, keepdims=True)
+    active = np.repeat(active, upsampling_factor, axis=1)
+    if warmup > 0:
+        T = active.shape[1]
+        cumsum = np.concatenate((np.zeros((active.shape[0], 1), dtype=np.int64), np.cumsum(active, axis=1)), 1)
+        active = (cumsum[:,np.minimum(np.arange(T)+warmup+1, T)] - cumsum[:,:T]) > 0
+
+    return active if per_utt else active[0]
+
+
+def freeze_rows(h, h_prev, active):
+    """FUNCTION TO KEEP PREVIOUS HIDDEN STATES OF INACTIVE UTTERANCES
+
+    Args:
+        h (Tensor): updated hidden states (B x H, or n_layers x B x H of torch.nn.GRU)
+        h_prev (Tensor): previous hidden states (None for zero initial states)
+        active (Tensor): B boolean mask of active utterances
+
+    Return:
+        (Tensor): hidden states with those of inactive utterances unchanged
+    """
+    if h_prev is None:
+        h_prev = torch.zeros_like(h)
+    return torch.where(active.reshape((1,)*(h.dim()-2)+(-1, 1)), h, h_prev)
+
+
 class DualFC(nn.Module):
     """Compact Dual Fully Connected layers based on LPCNet"""
 
@@ -447,6 +947,60 @@ class DualFCMult(nn.Module):
                     *self.fact.weight[0]).reshape(x.shape[0],x.shape[2]*self.seg,2,-1), 2)
 
 
+class LPCLogits(torch.autograd.Function):
+    """DATA-DRIVEN LPC LOGITS IN TIME CHUNKS
+
+    Computes sum_k lpc[:,t,k] * weight[x_lpc[:,t,k]] (B x T x K and B x T x K --> B x T x V) for chunk of time
+    steps at a time, so that the B x T x K x V embedding expansion is never kept, neither for the output nor for
+    backward, where only lpc, x_lpc, and weight are saved, and the gradients are computed in the same chunks.
+    """
+
+    @staticmethod
+    def forward(ctx, lpc, x_lpc, weight, chunk):
+        ctx.save_for_backward(lpc, x_lpc, weight)
+        ctx.chunk = chunk
+        out = lpc.new_empty(lpc.shape[:-1]+(weight.shape[1],))
+        for t in range(0, lpc.shape[1], chunk):
+            out[:,t:t+chunk] = torch.sum(lpc[:,t:t+chunk].unsqueeze(-1)*weight[x_lpc[:,t:t+chunk]], -2)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        lpc, x_lpc, weight = ctx.saved_tensors
+        chunk = ctx.chunk
+        grad_lpc = None
+        grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_lpc = torch.empty_like(lpc)
+        if ctx.needs_input_grad[2]:
+            grad_weight = torch.zeros_like(weight)
+        for t in range(0, lpc.shape[1], chunk):
+            x_lpc_t = x_lpc[:,t:t+chunk]
+            grad_out_t = grad_out[:,t:t+chunk].unsqueeze(-2)
+            if grad_lpc is not None:
+                grad_lpc[:,t:t+chunk] = torch.sum(grad_out_t*weight[x_lpc_t], -1)
+            if grad_weight is not None:
+                grad_weight.index_add_(0, x_lpc_t.reshape(-1), (lpc[:,t:t+chunk].unsqueeze(-1)*grad_out_t).reshape(-1,weight.shape[1]))
+        return grad_lpc, None, grad_weight, None
+
+
+def lpc_logits(lpc, x_lpc, weight, chunk=None):
+    """FUNCTION TO COMPUTE DATA-DRIVEN LPC LOGITS IN TIME CHUNKS
+
+    Args:
+        lpc (Tensor): B x T x K lpc coefficients, k-th one for x_lpc[:,:,k]
+        x_lpc (Tensor): B x T x K indices of previous samples
+        weight (Tensor): V x V logits embedding
+        chunk (int): number of time steps in a chunk, if None, all of them
+
+    Return:
+        (Tensor): B x T x V lpc logits
+    """
+    if chunk is None:
+        chunk = max(lpc.shape[1], 1)
+    return LPCLogits.apply(lpc, x_lpc, weight, chunk)
+
+
 def nn_search(encoding, centroids):
     T = encoding.shape[0]
     K = centroids.shape[0]
@@ -479,6 +1033,66 @@ def sampling_normal(mu, var):
     return mu + torch.sqrt(var) * eps # var
 
 
+def length_mask(lens, max_len):
+    """FUNCTION TO MAKE FRAME MASK OF UTTERANCES FROM THEIR LENGTHS
+
+    Args:
+        lens (Tensor): B lengths of utterances, can be larger than max_len
+        max_len (int): number of frames T
+
+    Return:
+        (Tensor): B x T mask, 1 for valid frames and 0 for padded ones
+    """
+    return (torch.arange(max_len, device=lens.device).unsqueeze(0) < lens.unsqueeze(1)).float()
+
+
+def masked_mean(x, mask):
+    """FUNCTION TO AVERAGE FRAME VALUES OF EACH UTTERANCE WITHIN ITS LENGTH
+
+    Args:
+        x (Tensor): B x T values
+        mask (Tensor): B x T frame mask
+
+    Return:
+        (Tensor): B averages
+    """
+    return torch.sum(x*mask, -1)/torch.sum(mask, -1)
+
+
+def decode_rec_cv(model_decoder, y, y_cv, z, x_in=None, x_in_cv=None, h=None, h_cv=None, outpad_right=0, do=False):
+    """FUNCTION TO DECODE RECONSTRUCTION AND CONVERSION OF A LATENT IN ONE BATCHED FORWARD
+
+    Source and target speaker-codes are stacked on the batch axis (2B), so that both
+    outputs are computed by a single decoder call and split afterwards.
+
+    Args:
+        model_decoder (torch.nn.Module): GRU_SPEC_DECODER or GRU_EXCIT_DECODER instance
+        y (Tensor): B x T source speaker-code
+        y_cv (Tensor): B x T target speaker-code
+        z (Tensor): B x T x C latent
+        x_in (Tensor): B x 1 x C previous output of reconstruction for autoregressive decoder
+        x_in_cv (Tensor): B x 1 x C previous output of conversion for autoregressive decoder
+        h (Tensor): hidden state of reconstruction
+        h_cv (Tensor): hidden state of conversion
+
+    Return:
+        (tuple): outputs of reconstruction as returned by the decoder
+        (tuple): outputs of conversion as returned by the decoder
+    """
+    B = z.shape[0]
+    if h is not None:
+        h = torch.cat((h, h_cv), 1)
+    if x_in is not None:
+        outputs = model_decoder(torch.cat((y, y_cv), 0), torch.cat((z, z), 0), torch.cat((x_in, x_in_cv), 0), \
+                    h=h, outpad_right=outpad_right, do=do)
+    else:
+        outputs = model_decoder(torch.cat((y, y_cv), 0), torch.cat((z, z), 0), h=h, outpad_right=outpad_right, do=do)
+    # output and previous output on batch axis 0, hidden state on axis 1
+    outputs_rec = [outputs[0][:B], outputs[1][:,:B]] + [x[:B] for x in outputs[2:]]
+    outputs_cv = [outputs[0][B:], outputs[1][:,B:]] + [x[B:] for x in outputs[2:]]
+    return tuple(outputs_rec), tuple(outputs_cv)
+
+
 def kl_normal(mu_q, var_q):
     """ 1/2 [µ_i^2 + σ^2_i − 1 - ln(σ^2_i) ] """
 
@@ -662,7 +1276,7 @@ class GRU_VAE_ENCODER(nn.Module):
 
             if self.cont:
                 qy_logits = F.selu(s[:,:,:self.n_spk])
-                qz_alpha = torch.cat((s[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(s[:,:,self.n_spk+self.lat_dim:])), 2)
+                qz_alpha = torch.cat((s[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(s[:,:,self.n_spk+self.lat_dim:].float())), 2)
 
                 if sampling:
                     return qy_logits, qz_alpha, h.detach()
@@ -698,7 +1312,7 @@ class GRU_VAE_ENCODER(nn.Module):
                 out = self.out(out.transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
             qy_logit = F.selu(out[:,:,:self.n_spk])
             if self.cont:
-                qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:])), 2)
+                qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:].float())), 2)
             else:
                 qz_alpha = out[:,:,self.n_spk:]
             yz_in = torch.cat((qy_logit, qz_alpha), 2)
@@ -710,7 +1324,7 @@ class GRU_VAE_ENCODER(nn.Module):
                         out, h = self.gru(torch.cat((x_conv[:,t:t+1], yz_in), 2), h) # B x T x C
                         out = self.out(self.gru_drop(out).transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
                         qy_logit = F.selu(out[:,:,:self.n_spk])
-                        qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:])), 2)
+                        qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:].float())), 2)
                         yz_in = torch.cat((qy_logit, qz_alpha), 2)
                         qy_logits = torch.cat((qy_logits, qy_logit), 1)
                         qz_alphas = torch.cat((qz_alphas, qz_alpha), 1)
@@ -721,7 +1335,7 @@ class GRU_VAE_ENCODER(nn.Module):
                             out, h_ = self.gru(torch.cat((x_conv[:,t:t+1], yz_in_), 2), h_) # B x T x C
                             out = self.out(self.gru_drop(out).transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
                             qy_logit = F.selu(out[:,:,:self.n_spk])
-                            qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:])), 2)
+                            qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:].float())), 2)
                             yz_in_ = torch.cat((qy_logit, qz_alpha), 2)
                             qy_logits = torch.cat((qy_logits, qy_logit), 1)
                             qz_alphas = torch.cat((qz_alphas, qz_alpha), 1)
@@ -730,7 +1344,7 @@ class GRU_VAE_ENCODER(nn.Module):
                         out, h = self.gru(torch.cat((x_conv[:,t:t+1], yz_in), 2), h) # B x T x C
                         out = self.out(out.transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
                         qy_logit = F.selu(out[:,:,:self.n_spk])
-                        qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:])), 2)
+                        qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:].float())), 2)
                         yz_in = torch.cat((qy_logit, qz_alpha), 2)
                         qy_logits = torch.cat((qy_logits, qy_logit), 1)
                         qz_alphas = torch.cat((qz_alphas, qz_alpha), 1)
@@ -741,7 +1355,7 @@ class GRU_VAE_ENCODER(nn.Module):
                             out, h_ = self.gru(torch.cat((x_conv[:,t:t+1], yz_in_), 2), h_) # B x T x C
                             out = self.out(out.transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
                             qy_logit = F.selu(out[:,:,:self.n_spk])
-                            qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim], F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:])), 2)
+                            qz_alpha = torch.cat((out[:,:,self.n_spk:self.n_spk+self.lat_dim].float(), F.logsigmoid(out[:,:,self.n_spk+self.lat_dim:].float())), 2)
                             yz_in_ = torch.cat((qy_logit, qz_alpha), 2)
                             qy_logits = torch.cat((qy_logits, qy_logit), 1)
                             qz_alphas = torch.cat((qz_alphas, qz_alpha), 1)
@@ -853,6 +1467,260 @@ class GRU_VAE_ENCODER(nn.Module):
         self.apply(_remove_weight_norm)
 
 
+def stack_conv1d(convs, groups=1):
+    """FUNCTION TO STACK CONV1D LAYERS INTO ONE CONV1D
+
+    Args:
+        convs (list): Conv1d layers of the same kernel, dilation, and padding
+        groups (int): 1 if the layers share the same input,
+            len(convs) if each layer takes its own group of the stacked input channels
+
+    Return:
+        (Conv1d): layer with the output channels of each conv (zero-padded to the largest one) stacked in order
+    """
+    out_chn = max([conv.out_channels for conv in convs])
+    conv = nn.Conv1d(convs[0].in_channels*groups, out_chn*len(convs), convs[0].kernel_size, \
+                        padding=convs[0].padding, dilation=convs[0].dilation, groups=groups, \
+                        bias=convs[0].bias is not None)
+    with torch.no_grad():
+        conv.weight.zero_()
+        if conv.bias is not None:
+            conv.bias.zero_()
+        for i, conv_ in enumerate(convs):
+            conv.weight[i*out_chn:i*out_chn+conv_.out_channels] = conv_.weight
+            if conv.bias is not None:
+                conv.bias[i*out_chn:i*out_chn+conv_.out_channels] = conv_.bias
+
+    return conv
+
+
+def stack_conv_modules(modules):
+    """FUNCTION TO STACK IDENTICALLY-STRUCTURED CONV. STACKS (Conv1d, PReLU, or Sequential of them) AS GROUPED CONV.
+
+    Args:
+        modules (list): conv. stacks, each taking its own group of the stacked input channels
+
+    Return:
+        (Module): grouped conv. stack
+    """
+    if isinstance(modules[0], nn.Sequential):
+        return nn.Sequential(*[stack_conv_modules(list(layers)) for layers in zip(*modules)])
+    elif isinstance(modules[0], nn.Conv1d):
+        return stack_conv1d(modules, groups=len(modules))
+    elif isinstance(modules[0], nn.PReLU):
+        prelu = nn.PReLU(sum([module.num_parameters for module in modules]))
+        with torch.no_grad():
+            prelu.weight.copy_(torch.cat([module.weight for module in modules], 0))
+        return prelu
+    else:
+        raise NotImplementedError("cannot stack %s" % (type(modules[0])))
+
+
+class GRU_VAE_ENCODER_PAIR(nn.Module):
+    """INFERENCE-TIME FUSION OF TWO GRU_VAE_ENCODERS OF THE SAME INPUT (e.g., MCEP AND EXCIT. ENCODERS)
+
+    The input normalization layers are stacked, and the conv. stacks and the output layers are run as grouped convs.,
+    so that both encoders are computed in one pass, except for their GRUs, which are run one after the other on their
+    channels of the conv. output (one GRU with block-diagonal weights would do twice the recurrent flops of both).
+    If the encoders are autoregressive, bidirectional, or of different structures, they are run one after the other.
+    """
+
+    def __init__(self, encoder_1, encoder_2, fuse=True):
+        super(GRU_VAE_ENCODER_PAIR, self).__init__()
+        self.pad_left = encoder_1.pad_left
+        self.pad_right = encoder_1.pad_right
+        self.fused = fuse and self.fusable(encoder_1, encoder_2)
+        if not self.fused:
+            self.encoder_1 = encoder_1
+            self.encoder_2 = encoder_2
+        else:
+            encoders = []
+            for encoder in [encoder_1, encoder_2]:
+                encoder = copy_model(encoder)
+                encoder.remove_weight_norm()
+                encoders.append(encoder)
+            self.heads = [(encoder.n_spk, encoder.lat_dim, encoder.out_dim, encoder.cont, encoder.onehot_lat) \
+                            for encoder in encoders]
+            self.out_chn = max([encoder.out_dim for encoder in encoders])
+            if isinstance(encoders[0].scale_in, nn.Identity):
+                # frozen encoders, with scale_in folded into their conv. stacks
+                self.scale_in = nn.Identity()
+            else:
+                self.scale_in = stack_conv1d([encoder.scale_in for encoder in encoders])
+            self.conv = copy_model(encoders[0].conv)
+            self.conv.conv = stack_conv_modules([encoder.conv.conv for encoder in encoders])
+            if isinstance(self.scale_in, nn.Identity):
+                # without stacked scale_in, the 1st layers share the same input instead of one group each
+                conv_1 = stack_conv1d([conv_stack_layers(encoder.conv)[0] for encoder in encoders])
+                if isinstance(self.conv.conv, nn.Sequential):
+                    self.conv.conv[0] = conv_1
+                else:
+                    self.conv.conv = conv_1
+            self.gru = nn.ModuleList([encoder.gru for encoder in encoders])
+            self.gru_in_dims = [encoder.gru.input_size for encoder in encoders]
+            self.out = stack_conv1d([encoder.out for encoder in encoders], groups=2)
+            for param in self.parameters():
+                param.requires_grad = False
+
+    @staticmethod
+    def fusable(encoder_1, encoder_2):
+        """Check whether two encoders can be fused"""
+        if encoder_1.ar or encoder_2.ar or encoder_1.bi or encoder_2.bi:
+            return False
+        for name in ["in_dim", "hidden_units", "hidden_layers", "kernel_size", "dilation_size", "right_size", \
+                        "causal_conv", "nonlinear_conv", "pad_first"]:
+            if getattr(encoder_1, name) != getattr(encoder_2, name):
+                return False
+        if isinstance(encoder_1.scale_in, nn.Identity) != isinstance(encoder_2.scale_in, nn.Identity):
+            return False
+        # padded frames of frozen padded stacks are not stacked
+        if any([isinstance(conv_stack_layers(encoder.conv)[0], EdgePaddedConv1d) for encoder in [encoder_1, encoder_2]]):
+            return False
+        return True
+
+    def forward(self, x, h=None, sampling=True, outpad_right=0):
+        """Forward calculation
+
+        Args:
+            x (Tensor): B x T x C input features
+            h (tuple): hidden states of both encoders
+            sampling (bool): return values of the encoders as with sampling=True/False
+            outpad_right (int): number of right-padded frames, not passed to the returned hidden state
+
+        Return:
+            (tuple): outputs of the 1st encoder as in GRU_VAE_ENCODER.forward with do=False
+            (tuple): outputs of the 2nd encoder
+        """
+        if not self.fused:
+            if h is None:
+                h = (None, None)
+            return self.encoder_1(x, h=h[0], sampling=sampling, outpad_right=outpad_right), \
+                    self.encoder_2(x, h=h[1], sampling=sampling, outpad_right=outpad_right)
+
+        s = self.conv(self.scale_in(x.transpose(1,2))).transpose(1,2) # B x C x T --> B x T x C
+        if h is None:
+            h = (None, None)
+        s_list = []
+        h_list = []
+        for gru, s_, h_ in zip(self.gru, torch.split(s, self.gru_in_dims, 2), h):
+            if outpad_right > 0:
+                if h_ is None:
+                    out, h_ = gru(s_[:,:-outpad_right]) # B x T x C
+                else:
+                    out, h_ = gru(s_[:,:-outpad_right], h_) # B x T x C
+                out_, _ = gru(s_[:,-outpad_right:], h_) # B x T x C
+                s_ = torch.cat((out, out_), 1)
+            else:
+                if h_ is None:
+                    s_, h_ = gru(s_) # B x T x C
+                else:
+                    s_, h_ = gru(s_, h_) # B x T x C
+            s_list.append(s_)
+            h_list.append(h_)
+        s = torch.cat(s_list, 2)
+        s = self.out(s.transpose(1,2)).transpose(1,2) # B x T x C -> B x C x T -> B x T x C
+
+        outputs = []
+        for i, (n_spk, lat_dim, out_dim, cont, onehot_lat) in enumerate(self.heads):
+            s_ = s[:,:,i*self.out_chn:i*self.out_chn+out_dim]
+            h_ = h_list[i].detach()
+            if cont:
+                qy_logits = F.selu(s_[:,:,:n_spk])
+                qz_alpha = torch.cat((s_[:,:,n_spk:n_spk+lat_dim].float(), F.logsigmoid(s_[:,:,n_spk+lat_dim:].float())), 2)
+                if sampling:
+                    outputs.append((qy_logits, qz_alpha, h_))
+                else:
+                    outputs.append((qy_logits, qz_alpha, qz_alpha[:,:,:lat_dim], h_))
+            elif onehot_lat:
+                outputs.append((F.selu(s_[:,:,:n_spk]), F.softmax(s_[:,:,n_spk:], dim=-1), s_[:,:,n_spk:], h_))
+            else:
+                outputs.append((F.selu(s_[:,:,:n_spk]), s_[:,:,n_spk:], h_))
+
+        return tuple(outputs)
+
+
+def conv_weight(conv):
+    """FUNCTION TO GET EFFECTIVE WEIGHT OF CONV. LAYER, WITH OR WITHOUT WEIGHT NORM
+
+    Arg:
+        conv (torch.nn.Conv1d): conv. layer
+
+    Return:
+        (Tensor): C_out x C_in x K weight, recomputed from weight_g and weight_v if weight-normalized
+    """
+    if hasattr(conv, "weight_g"):
+        return torch._weight_norm(conv.weight_v, conv.weight_g, 0)
+    return conv.weight
+
+
+def spk_conv_table(conv, n_spk, spkidtr_conv=None, spkidtr_deconv=None, spk_ids=None):
+    """FUNCTION TO COMPUTE PER-SPEAKER CONTRIBUTION TO EACH KERNEL TAP OF THE 1ST CONV. LAYER
+
+    The speaker code occupies the first n_spk input channels of the 1st layer of the dilated conv. stack,
+    and it only depends on the speaker index (one-hot, or its spkidtr transform), so that its contribution
+    to the linear 1st layer is a lookup table instead of a convolution over n_spk one-hot channels.
+
+    Args:
+        conv (TwoSidedDilConv1d/CausalDilConv1d): conv. stack
+        n_spk (int): number of speakers
+        spkidtr_conv (torch.nn.Module): speaker-space projection of one-hot code (if spkidtr is used)
+        spkidtr_deconv (torch.nn.Module): speaker-space back-projection (if spkidtr is used)
+        spk_ids (LongTensor): N speaker indices of the table (if None, all speakers)
+
+    Return:
+        (Tensor): N x K x C_out contributions of the speakers to the K kernel taps
+    """
+    weight = conv_weight(conv.conv[0])[:, :n_spk] # C_out x n_spk x K
+    if spkidtr_conv is not None:
+        if spk_ids is None:
+            spk_ids = torch.arange(n_spk, device=weight.device)
+        spk_code = spkidtr_deconv(spkidtr_conv(F.one_hot(spk_ids, num_classes=n_spk).float().unsqueeze(-1)))
+        return torch.einsum("ns,csk->nkc", spk_code.squeeze(-1), weight) # N x K x C_out
+    weight = weight.permute(1, 2, 0) # n_spk x K x C_out
+    if spk_ids is not None:
+        weight = weight[spk_ids]
+    return weight.contiguous()
+
+
+def spk_cond_conv(conv, spk_table, y, x):
+    """FUNCTION TO COMPUTE DILATED CONV. STACK OF [SPEAKER CODE; x] WITH THE SPEAKER PART FROM A TABLE
+
+    Equivalent to conv(torch.cat((speaker_code(y), x), 1)), where the 1st layer convolves only the
+    non-speaker channels and the speaker part is gathered per kernel tap from spk_table, so the cost
+    does not grow with the number of speakers.
+
+    Args:
+        conv (TwoSidedDilConv1d/CausalDilConv1d): conv. stack
+        spk_table (Tensor): N x K x C_out table of spk_conv_table
+        y (LongTensor): B x T speaker indices of the rows of spk_table
+        x (Tensor): B x C x T non-speaker input
+
+    Return:
+        (Tensor): B x C_out' x T' output of the conv. stack
+    """
+    conv_1 = conv.conv[0]
+    weight = conv_weight(conv_1)
+    if isinstance(conv_1, EdgePaddedConv1d):
+        out = F.conv1d(conv_1.edge_pad(x, slice(conv_1.in_channels-x.shape[1], None)), \
+                        weight[:, weight.shape[1]-x.shape[1]:], conv_1.bias, dilation=conv_1.dilation)
+    else:
+        out = F.conv1d(x, weight[:, weight.shape[1]-x.shape[1]:], conv_1.bias, padding=conv_1.padding, \
+                        dilation=conv_1.dilation)
+    padding = conv_1.padding[0]
+    if padding > 0:
+        # padded frames have zero speaker code
+        y = F.pad(y, (padding, padding), value=spk_table.shape[0])
+        spk_table = torch.cat((spk_table, spk_table.new_zeros((1,)+spk_table.shape[1:])), 0)
+    T = out.shape[2]
+    dilation = conv_1.dilation[0]
+    for k in range(spk_table.shape[1]):
+        out = out + F.embedding(y[:,k*dilation:k*dilation+T], spk_table[:,k]).transpose(1,2)
+    out = conv.conv[1:](out)
+    if isinstance(conv, CausalDilConv1d) and not conv.pad_first:
+        return out[:,:,:-conv.padding]
+    return out
+
+
 class GRU_SPEC_DECODER(nn.Module):
     def __init__(self, feat_dim=50, out_dim=50, hidden_layers=1, hidden_units=1024, causal_conv=False,
             kernel_size=7, dilation_size=1, do_prob=0, n_spk=14, bi=False, nonlinear_conv=False, ctr_size=None,
@@ -944,6 +1812,8 @@ class GRU_SPEC_DECODER(nn.Module):
             self.scale_out_cap = nn.Conv1d(self.cap_dim, self.cap_dim, 1)
         self.scale_out = nn.Conv1d(self.out_dim-self.uvcap_dim, self.out_dim-self.uvcap_dim, 1)
 
+        self.spk_table = None
+
         # apply weight norm
         if self.use_weight_norm:
             self.apply_weight_norm()
@@ -956,28 +1826,23 @@ class GRU_SPEC_DECODER(nn.Module):
             z = self.onehot_conv(z.transpose(1,2)).transpose(1,2)
         if self.ctr_size is not None:
             z = self.ctr_conv(z.transpose(1,2)).transpose(1,2)
+        if e is not None:
+            z = torch.cat((self.scale_in(e.transpose(1,2)).transpose(1,2), z), 2) # B x T_frm x C
         if len(y.shape) == 2:
-            if self.spkidtr_dim > 0:
-                if e is not None:
-                    z = torch.cat((self.spkidtr_deconv(self.spkidtr_conv(F.one_hot(y, num_classes=self.n_spk).float().transpose(1,2))).transpose(1,2), self.scale_in(e.transpose(1,2)).transpose(1,2), z), 2)
-                else:
-                    z = torch.cat((self.spkidtr_deconv(self.spkidtr_conv(F.one_hot(y, num_classes=self.n_spk).float().transpose(1,2))).transpose(1,2), z), 2) # B x T_frm x C
-            else:
-                if e is not None:
-                    z = torch.cat((F.one_hot(y, num_classes=self.n_spk).float(), self.scale_in(e.transpose(1,2)).transpose(1,2), z), 2) # B x T_frm x C
-                else:
-                    z = torch.cat((F.one_hot(y, num_classes=self.n_spk).float(), z), 2) # B x T_frm x C
+            spk_table, y = self.spk_cond(y)
+            z = spk_cond_conv(self.conv, spk_table, y, z.transpose(1,2)) # B x C x T
         else:
             if self.spkidtr_dim > 0:
                 z = torch.cat((self.spkidtr_deconv(y.transpose(1,2)).transpose(1,2), z), 2) # B x T_frm x C
             else:
                 z = torch.cat((y, z), 2) # B x T_frm x C
+            z = self.conv(z.transpose(1,2)) # B x C x T
         if not self.ar:
             # Input e layers
             if self.do_prob > 0 and do:
-                e = self.conv_drop(self.conv(z.transpose(1,2)).transpose(1,2)) # B x C x T --> B x T x C
+                e = self.conv_drop(z.transpose(1,2)) # B x C x T --> B x T x C
             else:
-                e = self.conv(z.transpose(1,2)).transpose(1,2) # B x C x T --> B x T x C
+                e = z.transpose(1,2) # B x C x T --> B x T x C
             if outpad_right > 0:
                 # GRU e layers
                 if h is None:
@@ -1015,9 +1880,9 @@ class GRU_SPEC_DECODER(nn.Module):
         else:
             # Input layers
             if self.do_prob > 0 and do:
-                z_conv = self.conv_drop(self.conv(z.transpose(1,2)).transpose(1,2)) # B x C x T --> B x T x C
+                z_conv = self.conv_drop(z.transpose(1,2)) # B x C x T --> B x T x C
             else:
-                z_conv = self.conv(z.transpose(1,2)).transpose(1,2) # B x C x T --> B x T x C
+                z_conv = z.transpose(1,2) # B x C x T --> B x T x C
     
             T = z_conv.shape[1]
             T_last = T-outpad_right
@@ -1095,6 +1960,24 @@ class GRU_SPEC_DECODER(nn.Module):
             else:
                 return self.scale_out(spec.transpose(1,2)).transpose(1,2), h.detach(), x_in.detach()
 
+    def spk_cond(self, y):
+        """Speaker table of the 1st conv. layer and the indices of its rows for B x T speaker indices y"""
+        if self.spk_table is not None and not self.training:
+            return self.spk_table, y
+        if self.spkidtr_dim > 0:
+            # only the speakers of the batch are projected
+            spk_ids, y = torch.unique(y, return_inverse=True)
+            return spk_conv_table(self.conv, self.n_spk, self.spkidtr_conv, self.spkidtr_deconv, spk_ids), y
+        return spk_conv_table(self.conv, self.n_spk), y
+
+    def precompute_spk_table(self):
+        """Precompute speaker table of the 1st conv. layer for inference, after loading and moving the weights"""
+        with torch.no_grad():
+            if self.spkidtr_dim > 0:
+                self.spk_table = spk_conv_table(self.conv, self.n_spk, self.spkidtr_conv, self.spkidtr_deconv)
+            else:
+                self.spk_table = spk_conv_table(self.conv, self.n_spk)
+
     def apply_weight_norm(self):
         """Apply weight normalization module from all of the layers."""
         def _apply_weight_norm(m):
@@ -1236,6 +2119,8 @@ class GRU_EXCIT_DECODER(nn.Module):
         if self.cap_dim is not None:
             self.scale_out_cap = nn.Conv1d(self.cap_dim, self.cap_dim, 1)
 
+        self.spk_table = None
+
         # apply weight norm
         if self.use_weight_norm:
             self.apply_weight_norm()
@@ -1252,21 +2137,20 @@ class GRU_EXCIT_DECODER(nn.Module):
         if self.ctr_size is not None:
             z = self.ctr_conv(z.transpose(1,2)).transpose(1,2)
         if len(y.shape) == 2:
-            if self.spkidtr_dim > 0:
-                z = torch.cat((self.spkidtr_deconv(self.spkidtr_conv(F.one_hot(y, num_classes=self.n_spk).float().transpose(1,2))).transpose(1,2), z), 2) # B x T_frm x C
-            else:
-                z = torch.cat((F.one_hot(y, num_classes=self.n_spk).float(), z), 2) # B x T_frm x C
+            spk_table, y = self.spk_cond(y)
+            z = spk_cond_conv(self.conv, spk_table, y, z.transpose(1,2)) # B x C x T
         else:
             if self.spkidtr_dim > 0:
                 z = torch.cat((self.spkidtr_deconv(y.transpose(1,2)).transpose(1,2), z), 2) # B x T_frm x C
             else:
                 z = torch.cat((y, z), 2) # B x T_frm x C
+            z = self.conv(z.transpose(1,2)) # B x C x T
         if not self.ar:
             # Input e layers
             if self.do_prob > 0 and do:
-                e = self.conv_drop(self.conv(z.transpose(1,2)).transpose(1,2)) # B x C x T --> B x T x C
+                e = self.conv_drop(z.transpose(1,2)) # B x C x T --> B x T x C
             else:
-                e = self.conv(z.transpose(1,2)).transpose(1,2) # B x C x T --> B x T x C
+                e = z.transpose(1,2) # B x C x T --> B x T x C
             if outpad_right > 0:
                 # GRU e layers
                 if h is None:
@@ -1302,9 +2186,9 @@ class GRU_EXCIT_DECODER(nn.Module):
         else:
             # Input layers
             if self.do_prob > 0 and do:
-                z_conv = self.conv_drop(self.conv(z.transpose(1,2)).transpose(1,2)) # B x C x T --> B x T x C
+                z_conv = self.conv_drop(z.transpose(1,2)) # B x C x T --> B x T x C
             else:
-                z_conv = self.conv(z.transpose(1,2)).transpose(1,2) # B x C x T --> B x T x C
+                z_conv = z.transpose(1,2) # B x C x T --> B x T x C
     
             T = z_conv.shape[1]
             T_last = T-outpad_right
@@ -1388,6 +2272,24 @@ class GRU_EXCIT_DECODER(nn.Module):
             else:
                 return torch.cat((torch.sigmoid(excit[:,:,:1]), torch.clamp(self.scale_out(excit[:,:,1:].transpose(1,2)).transpose(1,2), max=8)), 2), h.detach(), e_in.detach()
 
+    def spk_cond(self, y):
+        """Speaker table of the 1st conv. layer and the indices of its rows for B x T speaker indices y"""
+        if self.spk_table is not None and not self.training:
+            return self.spk_table, y
+        if self.spkidtr_dim > 0:
+            # only the speakers of the batch are projected
+            spk_ids, y = torch.unique(y, return_inverse=True)
+            return spk_conv_table(self.conv, self.n_spk, self.spkidtr_conv, self.spkidtr_deconv, spk_ids), y
+        return spk_conv_table(self.conv, self.n_spk), y
+
+    def precompute_spk_table(self):
+        """Precompute speaker table of the 1st conv. layer for inference, after loading and moving the weights"""
+        with torch.no_grad():
+            if self.spkidtr_dim > 0:
+                self.spk_table = spk_conv_table(self.conv, self.n_spk, self.spkidtr_conv, self.spkidtr_deconv)
+            else:
+                self.spk_table = spk_conv_table(self.conv, self.n_spk)
+
     def apply_weight_norm(self):
         """Apply weight normalization module from all of the layers."""
         def _apply_weight_norm(m):
@@ -1447,7 +2349,7 @@ class GRU_EXCIT_DECODER(nn.Module):
 class GRU_WAVE_DECODER_DUALGRU_COMPACT(nn.Module):
     def __init__(self, feat_dim=52, upsampling_factor=120, hidden_units=384, hidden_units_2=16, n_quantize=256, lpc=12,
             kernel_size=7, dilation_size=1, do_prob=0, causal_conv=False, use_weight_norm=True, nonlinear_conv=False,
-                right_size=0):
+                right_size=0, lpc_chunk=None):
         super(GRU_WAVE_DECODER_DUALGRU_COMPACT, self).__init__()
         self.feat_dim = feat_dim
         self.in_dim = self.feat_dim
@@ -1464,6 +2366,7 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT(nn.Module):
         self.s_dim = 256
         self.use_weight_norm = use_weight_norm
         self.lpc = lpc
+        self.lpc_chunk = lpc_chunk
         self.right_size = right_size
 
         self.scale_in = nn.Conv1d(self.in_dim, self.in_dim, 1)
@@ -1508,118 +2411,237 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT(nn.Module):
         else:
             self.apply(initialize)
 
+    def _cat_upsampled(self, c, x):
+        """Concatenate frame-rate conditioning to sample-rate input (B x T_frm x C and B x T x C_x --> B x T x C+C_x)
+
+        Frames are broadcast to their samples within the concatenation, without an upsampled conditioning tensor.
+        """
+        B = c.shape[0]
+        T_frm = c.shape[1]
+        return torch.cat((c.unsqueeze(2).expand(-1,-1,self.upsampling_factor,-1),
+                    x.reshape(B,T_frm,self.upsampling_factor,-1)), 3).reshape(B,T_frm*self.upsampling_factor,-1)
+
     def forward(self, c, x_prev, h=None, h_2=None, do=False, x_lpc=None):
         # Input
         if self.do_prob > 0 and do:
+            # dropout of upsampled conditioning
             conv = self.conv_drop(torch.repeat_interleave(self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2),self.upsampling_factor,dim=1))
+            cat_conv = lambda x: torch.cat((conv,x),2)
         else:
-            conv = torch.repeat_interleave(self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2),self.upsampling_factor,dim=1)
+            # conditioning kept at frame rate
+            conv = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2)
+            cat_conv = lambda x: self._cat_upsampled(conv,x)
 
         # GRU1
         if h is not None:
-            out, h = self.gru(torch.cat((conv,self.embed_wav(x_prev)),2), h)
+            out, h = self.gru(cat_conv(self.embed_wav(x_prev)), h)
         else:
-            out, h = self.gru(torch.cat((conv,self.embed_wav(x_prev)),2))
+            out, h = self.gru(cat_conv(self.embed_wav(x_prev)))
 
         # GRU2
         if self.do_prob > 0 and do:
             if h_2 is not None:
-                out, h_2 = self.gru_2(torch.cat((conv,self.gru_drop(out)),2), h_2) # B x T x C -> B x C x T -> B x T x C
+                out, h_2 = self.gru_2(cat_conv(self.gru_drop(out)), h_2) # B x T x C -> B x C x T -> B x T x C
             else:
-                out, h_2 = self.gru_2(torch.cat((conv,self.gru_drop(out)),2)) # B x T x C -> B x C x T -> B x T x C
+                out, h_2 = self.gru_2(cat_conv(self.gru_drop(out))) # B x T x C -> B x C x T -> B x T x C
         else:
             if h_2 is not None:
-                out, h_2 = self.gru_2(torch.cat((conv,out),2), h_2) # B x T x C -> B x C x T -> B x T x C
+                out, h_2 = self.gru_2(cat_conv(out), h_2) # B x T x C -> B x C x T -> B x T x C
             else:
-                out, h_2 = self.gru_2(torch.cat((conv,out),2)) # B x T x C -> B x C x T -> B x T x C
+                out, h_2 = self.gru_2(cat_conv(out)) # B x T x C -> B x C x T -> B x T x C
 
         # output
         if self.lpc > 0:
             lpc, logits = self.out(out.transpose(1,2)) # B x T x K and B x T x 256
             # x_lpc B x T_lpc --> B x T x K --> B x T x K x 256
-            return logits + torch.sum(lpc.flip(-1).unsqueeze(-1)*self.logits(x_lpc.unfold(1, self.lpc, 1)), 2), h.detach(), h_2.detach()
+            # data-driven LPC with logits embedding in fp32
+            return logits.float() + lpc_logits(lpc.float().flip(-1), x_lpc.unfold(1, self.lpc, 1), self.logits.weight.float(), self.lpc_chunk), \
+                h.detach(), h_2.detach()
         else:
             return self.out(out.transpose(1,2)), h.detach(), h_2.detach()
 
-    def generate(self, c, intervals=4000):
-        start = time.time()
-        time_sample = []
+    def gate_tables(self):
+        """Precompute tables of previous sample contributions for generation
 
-        c = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2)
-        if self.lpc > 0:
-            x_lpc = torch.empty(c.shape[0],1,self.lpc).cuda().fill_(self.n_quantize // 2).long()
-        T = c.shape[1]*self.upsampling_factor
+        As in LPCNet, the gru input of previous sample can only take n_quantize values, so its gate projection
+        W_ih[:,s_dim:] * embed_wav is computed once for all of them. The logits embedding of data-driven LPC is kept
+        in fp32 to be directly gathered.
 
-        c_f = c[:,:1]
-        out, h = self.gru(torch.cat((c_f,self.embed_wav(torch.zeros(c.shape[0],1).cuda().fill_(self.n_quantize//2).long())),2))
-        out, h_2 = self.gru_2(torch.cat((c_f,out),2))
+        Return:
+            (dict): n_quantize x 3*hidden_units "embed_gru" table and n_quantize x n_quantize "logits" table
+        """
+        tables = {"embed_gru": F.linear(self.embed_wav.weight, self.gru.weight_ih_l0[:,self.s_dim:])}
         if self.lpc > 0:
-            out = self.out(out.transpose(1,2), clip=False) # B x T x C -> B x C x T -> B x T x C
-            dist = OneHotCategorical(F.softmax(out[:,:,self.lpc:] + torch.sum(out[:,:,:self.lpc].unsqueeze(-1)*self.logits(x_lpc), 2), dim=-1))
-            x_wav = dist.sample().argmax(dim=-1)
-            x_out = x_wav
-            x_lpc[:,:,1:] = x_lpc[:,:,:-1]
-            x_lpc[:,:,0] = x_wav
-        else:
-            dist = OneHotCategorical(F.softmax(self.out(out.transpose(1,2), clip=False), dim=-1))
-            x_wav = dist.sample().argmax(dim=-1)
-            x_out = x_wav
+            tables["logits"] = self.logits.weight.float()
+        return tables
 
-        time_sample.append(time.time()-start)
-        if self.lpc > 0:
-            for t in range(1,T):
-                start_sample = time.time()
+    def generate(self, c, intervals=4000, tables=True, fold_len=None, fold_overlap=4, spc_mask=None, warmup=0):
+        """Generate waveform sample by sample
 
-                if t % self.upsampling_factor  == 0:
-                    idx_t_f = t//self.upsampling_factor
-                    c_f = c[:,idx_t_f:idx_t_f+1]
-                out, h = self.gru(torch.cat((c_f, self.embed_wav(x_wav)),2), h)
-                out, h_2 = self.gru_2(torch.cat((c_f,out),2), h_2)
+        With fold_len, the conditioning of each utterance is folded into segments of fold_len frames, each with
+        fold_overlap frames of left context for hidden state warm-up and fold_overlap frames of right extension,
+        which are generated in parallel as one batch. The right extension of a segment is crossfaded with the frames
+        following the warm-up of the next segment when unfolding. The conditioning is computed on the whole utterance
+        before folding, so that the conv receptive field is unaffected.
 
-                out = self.out(out.transpose(1,2), clip=False) # B x T x C -> B x C x T -> B x T x C
-                dist = OneHotCategorical(F.softmax(out[:,:,self.lpc:] + torch.sum(out[:,:,:self.lpc].unsqueeze(-1)*self.logits(x_lpc), 2), dim=-1))
-                x_wav = dist.sample().argmax(dim=-1)
-                x_out = torch.cat((x_out, x_wav), 1)
-                x_lpc[:,:,1:] = x_lpc[:,:,:-1]
-                x_lpc[:,:,0] = x_wav
+        With spc_mask, samples of silent frames are set to zero without running the network, except for warmup
+        samples before each speech region. A sample step is bypassed if it is silent in all utterances (or folded
+        segments) of the batch, otherwise the hidden states of the silent ones are frozen at the step, so that
+        folded segments are skipped per segment.
 
-                time_sample.append(time.time()-start_sample)
-                if (t + 1) % intervals == 0:
-                    logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
-                        (t + 1), T,
-                        ((T - t - 1) / intervals) * (time.time() - start),
-                        (time.time() - start) / intervals))
-                    start = time.time()
+        Arg:
+            c (Variable): float tensor variable with the shape  (B x T_frm x C_in)
+            intervals (int): number of samples to log the estimated time
+            tables (bool): gather the previous sample gates from precomputed tables and project conditioning at frame
+                rate, instead of per-sample gru input matmul
+            fold_len (int): number of frames in each folded segment, if None, whole utterance is generated sequentially
+            fold_overlap (int): number of frames of warm-up and crossfade between folded segments
+            spc_mask (ndarray): B x T_frm speech frame mask, if None, all samples are generated
+            warmup (int): number of samples of hidden state re-warm-up before each speech region
+
+        Return:
+            (ndarray): generated waveform with the shape (B x T)
+        """
+        B = c.shape[0]
+        T_frm = c.shape[1]
+        c = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2) # B x T_frm x C
+        if fold_len is None:
+            active = active_sample_mask(spc_mask, self.upsampling_factor, warmup, per_utt=True) \
+                        if spc_mask is not None else None
+            return decode_mu_law(self._generate_samples(c, intervals, tables, active).cpu().data.numpy())
+
+        # fold: B x T_frm x C --> B*N x fold_overlap+fold_len+fold_overlap x C
+        N = (T_frm + fold_len - 1) // fold_len
+        c = F.pad(c.transpose(1,2), (fold_overlap, N*fold_len+fold_overlap-T_frm), "replicate").transpose(1,2)
+        c = c.unfold(1, fold_len+2*fold_overlap, fold_len).permute(0,1,3,2).reshape(B*N, fold_len+2*fold_overlap, -1)
+        logging.info("fold %d frames into %d segments of %d+2*%d frames" % (T_frm, N, fold_len, fold_overlap))
+        if spc_mask is not None:
+            spc_mask = np.pad(np.asarray(spc_mask), ((0, 0), (fold_overlap, N*fold_len+fold_overlap-T_frm)), "edge")
+            spc_mask = np.stack([spc_mask[:,n*fold_len:n*fold_len+fold_len+2*fold_overlap] for n in range(N)], 1)
+            active = active_sample_mask(spc_mask.reshape(B*N, -1), self.upsampling_factor, warmup, per_utt=True)
         else:
-            for t in range(1,T):
-                start_sample = time.time()
+            active = None
+        x = decode_mu_law(self._generate_samples(c, intervals, tables, active).cpu().data.numpy()).reshape(B, N, -1)
+
+        # unfold with crossfade of overlaps, discarding warm-up samples
+        L = fold_len*self.upsampling_factor
+        O = fold_overlap*self.upsampling_factor
+        fade_in = np.linspace(0, 1, O, endpoint=False) if O > 0 else np.zeros(0)
+        fade_out = 1 - fade_in
+        out = np.zeros((B, N*L+O))
+        for n in range(N):
+            x_n = x[:,n,O:].copy() # L+O samples after warm-up
+            if n > 0:
+                x_n[:,:O] *= fade_in
+            if n < N-1:
+                x_n[:,L:] *= fade_out
+            out[:,n*L:n*L+L+O] += x_n
+        return out[:,:T_frm*self.upsampling_factor]
+
+    def _generate_samples(self, c, intervals=4000, tables=True, active=None):
+        """Autoregressive generation loop from conditioning (B x T_frm x C) to quantized samples (B x T)
+
+        Samples outside of the active mask (T, or B x T per utterance) are kept at the zero level of the quantized
+        buffer. Steps inactive in all utterances are skipped, otherwise the hidden states of inactive utterances
+        are kept unchanged.
+        """
+        start = time.time()
+        time_sample = []
 
-                if t % self.upsampling_factor  == 0:
-                    idx_t_f = t//self.upsampling_factor
+        B = c.shape[0]
+        T = c.shape[1]*self.upsampling_factor
+
+        # generated samples after left padding of previous samples
+        pad = max(self.lpc, 1)
+        x_buf = torch.empty(B, pad+T, dtype=torch.long, device=c.device).fill_(self.n_quantize // 2)
+        if tables:
+            gate_tables = self.gate_tables()
+            # conditioning projections of gru and gru_2 at frame rate, B x T_frm x 3*H
+            c_gru = F.linear(c, self.gru.weight_ih_l0[:,:self.s_dim], self.gru.bias_ih_l0)
+            c_gru_2 = F.linear(c, self.gru_2.weight_ih_l0[:,:self.s_dim], self.gru_2.bias_ih_l0)
+            h = torch.zeros(B, self.hidden_units, dtype=c.dtype, device=c.device)
+            h_2 = torch.zeros(B, self.hidden_units_2, dtype=c.dtype, device=c.device)
+        else:
+            h = None
+            h_2 = None
+        logging.info("gate tables: %s" % (tables))
+
+        # per-utterance mask: steps with any active utterance, and B x T mask of the steps with inactive ones
+        if active is not None and active.ndim == 2:
+            active_utt = torch.from_numpy(active).to(c.device)
+            partial = ~np.all(active, axis=0)
+            active = np.any(active, axis=0)
+            zero_level = torch.empty(B, dtype=torch.long, device=c.device).fill_(self.n_quantize // 2)
+        else:
+            partial = None
+
+        start_loop = time.time()
+        idx_t_f = -1
+        for t in range(T):
+            if active is not None and not active[t]:
+                continue
+            start_sample = time.time()
+            if partial is not None and partial[t]:
+                h_prev = h
+                h_2_prev = h_2
+
+            if t // self.upsampling_factor != idx_t_f:
+                idx_t_f = t // self.upsampling_factor
+                if tables:
+                    c_gru_f = c_gru[:,idx_t_f]
+                    c_gru_2_f = c_gru_2[:,idx_t_f]
+                else:
                     c_f = c[:,idx_t_f:idx_t_f+1]
-                out, h = self.gru(torch.cat((c_f, self.embed_wav(x_wav)),2), h)
+            if tables:
+                h = gru_cell(c_gru_f + gate_tables["embed_gru"][x_buf[:,pad+t-1]], h, self.gru.weight_hh_l0, self.gru.bias_hh_l0)
+                h_2 = gru_cell(c_gru_2_f + F.linear(h, self.gru_2.weight_ih_l0[:,self.s_dim:]), h_2, \
+                            self.gru_2.weight_hh_l0, self.gru_2.bias_hh_l0)
+                out = h_2.unsqueeze(-1) # B x C x 1
+            else:
+                out, h = self.gru(torch.cat((c_f, self.embed_wav(x_buf[:,pad+t-1:pad+t])),2), h)
                 out, h_2 = self.gru_2(torch.cat((c_f,out),2), h_2)
+                out = out.transpose(1,2) # B x C x 1
 
-                dist = OneHotCategorical(F.softmax(self.out(out.transpose(1,2), clip=False), dim=-1))
-                x_wav = dist.sample().argmax(dim=-1)
-                x_out = torch.cat((x_out, x_wav), 1)
+            if self.lpc > 0:
+                lpc, logits = self.out(out) # B x 1 x K and B x 1 x 256
+                # data-driven LPC with samples [t-K, t-1]
+                if tables:
+                    x_lpc = gate_tables["logits"][x_buf[:,pad+t-self.lpc:pad+t]]
+                else:
+                    x_lpc = self.logits(x_buf[:,pad+t-self.lpc:pad+t]).float()
+                dist = OneHotCategorical(F.softmax(logits[:,0].float() + torch.sum(lpc[:,0].float().flip(-1).unsqueeze(-1)*x_lpc, 1), dim=-1))
+            else:
+                dist = OneHotCategorical(F.softmax(self.out(out)[:,0].float(), dim=-1))
+            if partial is not None and partial[t]:
+                # inactive utterances keep their hidden states and the zero level
+                active_t = active_utt[:,t]
+                h = freeze_rows(h, h_prev, active_t)
+                h_2 = freeze_rows(h_2, h_2_prev, active_t)
+                x_buf[:,pad+t] = torch.where(active_t, dist.sample().argmax(dim=-1), zero_level)
+            else:
+                x_buf[:,pad+t] = dist.sample().argmax(dim=-1)
 
-                time_sample.append(time.time()-start_sample)
-                if (t + 1) % intervals == 0:
-                    logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
-                        (t + 1), T,
-                        ((T - t - 1) / intervals) * (time.time() - start),
-                        (time.time() - start) / intervals))
-                    start = time.time()
+            time_sample.append(time.time()-start_sample)
+            if (t + 1) % intervals == 0:
+                logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
+                    (t + 1), T,
+                    ((T - t - 1) / intervals) * (time.time() - start),
+                    (time.time() - start) / intervals))
+                start = time.time()
 
+        time_loop = time.time() - start_loop
         time_sample = np.array(time_sample)
         logging.info("average time / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % \
                         (np.mean(time_sample), len(time_sample), 1.0/(1000*np.mean(time_sample))))
         logging.info("average throughput / sample = %.6f sec (%ld samples * %ld) [%.3f kHz/s]" % \
-                        (np.sum(time_sample)/(len(time_sample)*c.shape[0]), len(time_sample), c.shape[0], \
-                            len(time_sample)*c.shape[0]/(1000*np.sum(time_sample))))
+                        (np.sum(time_sample)/(len(time_sample)*B), len(time_sample), B, \
+                            len(time_sample)*B/(1000*np.sum(time_sample))))
+        if active is not None:
+            n_skip = T - len(time_sample)
+            logging.info("skipped silence samples = %ld/%ld (%.2f %%), estimated speed-up = %.3fx" % (n_skip, T, \
+                            100*n_skip/T, (time_loop + n_skip*np.mean(time_sample))/time_loop))
 
-        return decode_mu_law(x_out.cpu().data.numpy())
+        return x_buf[:,pad:]
 
     def apply_weight_norm(self):
         """Apply weight normalization module from all of the layers."""
@@ -1648,7 +2670,7 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT(nn.Module):
 class GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(nn.Module):
     def __init__(self, feat_dim=52, upsampling_factor=120, hidden_units=384, hidden_units_2=32, n_quantize=256, lpc=4,
             kernel_size=7, dilation_size=1, do_prob=0, causal_conv=False, use_weight_norm=True, nonlinear_conv=False,
-                right_size=1, seg=2):
+                right_size=1, seg=2, lpc_chunk=None):
         super(GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG, self).__init__()
         self.feat_dim = feat_dim
         self.in_dim = self.feat_dim
@@ -1670,6 +2692,7 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(nn.Module):
         self.seg_1 = self.seg-1
         self.seg_offset = self.seg+self.seg_1 # include seg-1 of t-seg samples for 1 shift segment grouping generation in training
         self.lpc = lpc
+        self.lpc_chunk = lpc_chunk
         self.lpc_offset = self.lpc+self.seg_1 # t-(n_lpc + seg-1) until T_batch-1 is the index range of current t LPC
         self.wav_dim = self.s_dim // self.seg
         self.wav_dim_seg = self.wav_dim * self.seg
@@ -1720,33 +2743,38 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(nn.Module):
         else:
             self.apply(initialize)
 
-    def forward(self, c, x_prev, h=None, h_2=None, do=False, x_lpc=None, first=False, shift1=True):
+    def _cond_seg(self, c, offset, T_seg):
+        """Gather segment conditioning from frame-rate conditioning (B x T_frm x C --> B x T_seg x C_seg)
+
+        Sample j of segment s takes the frame of upsampled index offset+s*seg+j (clamped to the first frame as
+        replicate padding), without an upsampled conditioning tensor.
+        """
+        idx = torch.clamp((offset + torch.arange(T_seg*self.seg, device=c.device)) // self.upsampling_factor, min=0)
+        return c[:,idx].reshape(c.shape[0],T_seg,self.cond_dim_seg)
+
+    def forward(self, c, x_prev, h=None, h_2=None, do=False, x_lpc=None, first=False, shift1=True, shifts=None):
         # input
         B = c.shape[0]
+        c = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2) # B x T_frm x C
+        T = c.shape[1]*self.upsampling_factor
         if shift1:
             if not first:
-                # upsample, seg-1 from prev. frame,conv_vec, B x T x C
-                c = torch.repeat_interleave(self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))),self.upsampling_factor,dim=-1)[:,:,self.upsampling_factor-self.seg_1:].transpose(1,2)
+                # upsample, seg-1 from prev. frame
+                offset = self.upsampling_factor-self.seg_1
+                T_seg = (T-offset-self.seg_1) // self.seg
             else:
-                # upsample, pad left seg-1,conv_vec, B x T x C
-                c = F.pad(torch.repeat_interleave(self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))),self.upsampling_factor,dim=-1), (self.seg_1, 0), "replicate").transpose(1,2)
+                # upsample, pad left seg-1
+                offset = -self.seg_1
+                T_seg = T // self.seg
             x_prev = self.embed_wav(x_prev) # B x T --> B x T x C
 
-            cs = c[:,:-self.seg_1].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.cond_dim_seg) # concat cond_vec at each seg.
-            x_prevs = x_prev[:,:-self.seg_1].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.wav_dim_seg) # concat wav_vec at each seg.
-            if self.seg == 2:
-                cs = torch.cat((cs, c[:,1:].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.cond_dim_seg)), 0)
-                x_prevs = torch.cat((x_prevs, x_prev[:,1:].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.wav_dim_seg)), 0) # concat wav_vec at each seg.
-            else:
-                for i in range(1,self.seg):
-                    if i < self.seg_1:
-                        cs = torch.cat((cs, c[:,i:-self.seg_1+i].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.cond_dim_seg)), 0)
-                        x_prevs = torch.cat((x_prevs, x_prev[:,i:-self.seg_1+i].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.wav_dim_seg)), 0) # concat wav_vec at each seg.
-                    else:
-                        cs = torch.cat((cs, c[:,i:].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.cond_dim_seg)), 0)
-                        x_prevs = torch.cat((x_prevs, x_prev[:,i:].unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.wav_dim_seg)), 0) # concat wav_vec at each seg.
+            # 1 shift segment groupings stacked in batch, all of them or the given ones
+            if shifts is None:
+                shifts = range(self.seg)
+            cs = torch.cat([self._cond_seg(c, offset+i, T_seg) for i in shifts], 0) # concat cond_vec at each seg.
+            x_prevs = torch.cat([x_prev[:,i:i+T_seg*self.seg].reshape(B,T_seg,self.wav_dim_seg) for i in shifts], 0) # concat wav_vec at each seg.
         else:
-            cs = torch.repeat_interleave(self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2),self.upsampling_factor,dim=1).unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.cond_dim_seg)
+            cs = self._cond_seg(c, 0, T // self.seg)
             x_prevs = self.embed_wav(x_prev).unfold(1, self.seg, self.seg).permute(0,1,3,2).reshape(B,-1,self.wav_dim_seg)
         if self.do_prob > 0 and do:
             cs = self.conv_drop(cs)
@@ -1773,90 +2801,97 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(nn.Module):
         # output
         if self.lpc > 0:
             lpc, logits = self.out(out.transpose(1,2)) # B_seg x T_seg x K and B_seg x T x 256
-            # B_seg x T_seg x K --> B_seg x T_seg x 1 x K x 1 * (B_seg x T_seg x seg x K --> B_seg x T_seg x seg x K x 256) --> B_seg x T x 256
-            return logits + torch.sum(lpc.flip(-1).unsqueeze(-1).unsqueeze(2)*self.logits(x_lpc), 3).reshape(logits.shape[0],-1,self.n_quantize), h.detach(), h_2.detach()
+            # B_seg x T_seg x K --> B_seg x T_seg x seg x K --> B_seg x T x K, with B_seg x T_seg x seg x K --> B_seg x T x K --> B_seg x T x 256
+            # data-driven LPC with logits embedding in fp32
+            B_seg = logits.shape[0]
+            return logits.float() + lpc_logits(lpc.float().flip(-1).unsqueeze(2).expand(-1,-1,self.seg,-1).reshape(B_seg,-1,self.lpc), \
+                        x_lpc.reshape(B_seg,-1,self.lpc), self.logits.weight.float(), self.lpc_chunk), h.detach(), h_2.detach()
         else:
             return self.out(out.transpose(1,2)), h.detach(), h_2.detach()
 
     def generate(self, c, intervals=4000):
-        start = time.time()
-        time_sample = []
+        """Generate waveform with one GRU step per segment of seg samples
 
-        c = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2)
-        if self.lpc > 0:
-            x_lpc = torch.empty(c.shape[0],1,self.lpc).cuda().fill_(self.n_quantize // 2).long()
-        T = c.shape[1]*self.upsampling_factor
-
-        c_f = c[:,:1]
-        out, h = self.gru(torch.cat((c_f,self.embed_wav(torch.zeros(c.shape[0],1).cuda().fill_(self.n_quantize//2).long())),2))
-        out, h_2 = self.gru_2(torch.cat((c_f,out),2))
-        if self.lpc > 0:
-            out = self.out(out.transpose(1,2), clip=False) # B x T x C -> B x C x T -> B x T x C
-            dist = OneHotCategorical(F.softmax(out[:,:,self.lpc:] + torch.sum(out[:,:,:self.lpc].unsqueeze(-1)*self.logits(x_lpc), 2), dim=-1))
-            x_wav = dist.sample().argmax(dim=-1)
-            x_out = x_wav
-            x_lpc[:,:,1:] = x_lpc[:,:,:-1]
-            x_lpc[:,:,0] = x_wav
-        else:
-            dist = OneHotCategorical(F.softmax(self.out(out.transpose(1,2), clip=False), dim=-1))
-            x_wav = dist.sample().argmax(dim=-1)
-            x_out = x_wav
-
-        time_sample.append(time.time()-start)
-        if self.lpc > 0:
-            for t in range(1,T):
-                start_sample = time.time()
+        Inputs of a step are the concatenated conditioning vectors at the seg output times and the seg previously
+        generated samples [t-seg, t-1], as in training. The seg outputs are sampled in order within the segment, so
+        that the data-driven LPC of each sample includes the samples just generated in the same segment.
 
-                if t % self.upsampling_factor  == 0:
-                    idx_t_f = t//self.upsampling_factor
-                    c_f = c[:,idx_t_f:idx_t_f+1]
-                out, h = self.gru(torch.cat((c_f, self.embed_wav(x_wav)),2), h)
-                out, h_2 = self.gru_2(torch.cat((c_f,out),2), h_2)
+        Arg:
+            c (Variable): float tensor variable with the shape  (B x T_frm x C_in)
+            intervals (int): number of samples to log the estimated time
 
-                out = self.out(out.transpose(1,2), clip=False) # B x T x C -> B x C x T -> B x T x C
-                dist = OneHotCategorical(F.softmax(out[:,:,self.lpc:] + torch.sum(out[:,:,:self.lpc].unsqueeze(-1)*self.logits(x_lpc), 2), dim=-1))
-                x_wav = dist.sample().argmax(dim=-1)
-                x_out = torch.cat((x_out, x_wav), 1)
-                x_lpc[:,:,1:] = x_lpc[:,:,:-1]
-                x_lpc[:,:,0] = x_wav
+        Return:
+            (ndarray): generated waveform with the shape (B x T)
+        """
+        start = time.time()
+        time_sample = []
 
-                time_sample.append(time.time()-start_sample)
-                if (t + 1) % intervals == 0:
-                    logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
-                        (t + 1), T,
-                        ((T - t - 1) / intervals) * (time.time() - start),
-                        (time.time() - start) / intervals))
-                    start = time.time()
+        B = c.shape[0]
+        T_frm = c.shape[1]
+        T = T_frm*self.upsampling_factor
+        T_seg = (T + self.seg_1) // self.seg
+        c = self.conv_s_c(self.conv(self.scale_in(c.transpose(1,2)))).transpose(1,2) # B x T_frm x C
+
+        # preallocated buffers: generated samples after left padding of previous samples,
+        # and inputs of gru [cond_seg, wav_seg] and gru_2 [cond_seg, out]
+        pad = max(self.lpc, self.seg)
+        x_buf = torch.empty(B, pad+T_seg*self.seg, dtype=torch.long, device=c.device).fill_(self.n_quantize // 2)
+        in_buf = torch.empty(B, 1, self.cond_dim_seg+self.wav_dim_seg, dtype=c.dtype, device=c.device)
+        in_buf_2 = torch.empty(B, 1, self.cond_dim_seg+self.hidden_units, dtype=c.dtype, device=c.device)
+        if self.upsampling_factor % self.seg == 0:
+            # all samples of a segment are within one frame
+            seg_per_frm = self.upsampling_factor // self.seg
+            c_seg = c.repeat(1,1,self.seg) # B x T_frm x C_seg
         else:
-            for t in range(1,T):
-                start_sample = time.time()
-
-                if t % self.upsampling_factor  == 0:
-                    idx_t_f = t//self.upsampling_factor
-                    c_f = c[:,idx_t_f:idx_t_f+1]
-                out, h = self.gru(torch.cat((c_f, self.embed_wav(x_wav)),2), h)
-                out, h_2 = self.gru_2(torch.cat((c_f,out),2), h_2)
+            idx_c = torch.clamp(torch.arange(T_seg*self.seg, device=c.device) // self.upsampling_factor, max=T_frm-1).reshape(T_seg, self.seg)
+        h = None
+        h_2 = None
+
+        for s in range(T_seg):
+            start_sample = time.time()
+
+            t = pad+s*self.seg
+            if self.upsampling_factor % self.seg == 0:
+                if s % seg_per_frm == 0:
+                    idx_t_f = s // seg_per_frm
+                    in_buf[:,:,:self.cond_dim_seg] = c_seg[:,idx_t_f:idx_t_f+1]
+                    in_buf_2[:,:,:self.cond_dim_seg] = c_seg[:,idx_t_f:idx_t_f+1]
+            else:
+                in_buf[:,:,:self.cond_dim_seg] = c[:,idx_c[s]].reshape(B,1,-1)
+                in_buf_2[:,:,:self.cond_dim_seg] = in_buf[:,:,:self.cond_dim_seg]
+            in_buf[:,:,self.cond_dim_seg:] = self.embed_wav(x_buf[:,t-self.seg:t]).reshape(B,1,-1)
+            out, h = self.gru(in_buf, h)
+            in_buf_2[:,:,self.cond_dim_seg:] = out
+            out, h_2 = self.gru_2(in_buf_2, h_2)
+
+            if self.lpc > 0:
+                lpc, logits = self.out(out.transpose(1,2)) # B x 1 x K and B x seg x 256
+                lpc = lpc[:,0].float().flip(-1).unsqueeze(-1) # B x K x 1
+                logits = logits.float()
+                for j in range(self.seg):
+                    # data-driven LPC with samples [t+j-K, t+j-1], including the ones generated in this segment
+                    dist = OneHotCategorical(F.softmax(logits[:,j] + torch.sum(lpc*self.logits(x_buf[:,t+j-self.lpc:t+j]).float(), 1), dim=-1))
+                    x_buf[:,t+j] = dist.sample().argmax(dim=-1)
+            else:
+                dist = OneHotCategorical(F.softmax(self.out(out.transpose(1,2)).float(), dim=-1))
+                x_buf[:,t:t+self.seg] = dist.sample().argmax(dim=-1)
 
-                dist = OneHotCategorical(F.softmax(self.out(out.transpose(1,2), clip=False), dim=-1))
-                x_wav = dist.sample().argmax(dim=-1)
-                x_out = torch.cat((x_out, x_wav), 1)
-
-                time_sample.append(time.time()-start_sample)
-                if (t + 1) % intervals == 0:
-                    logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
-                        (t + 1), T,
-                        ((T - t - 1) / intervals) * (time.time() - start),
-                        (time.time() - start) / intervals))
-                    start = time.time()
+            time_sample.append(time.time()-start_sample)
+            if (s + 1) % max(intervals // self.seg, 1) == 0:
+                logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
+                    (s + 1)*self.seg, T,
+                    ((T_seg - s - 1) / max(intervals // self.seg, 1)) * (time.time() - start),
+                    (time.time() - start) / (max(intervals // self.seg, 1)*self.seg)))
+                start = time.time()
 
         time_sample = np.array(time_sample)
-        logging.info("average time / sample = %.6f sec (%ld samples) [%.3f kHz/s]" % \
-                        (np.mean(time_sample), len(time_sample), 1.0/(1000*np.mean(time_sample))))
+        logging.info("average time / step = %.6f sec (%ld steps of %ld samples) [%.3f kHz/s]" % \
+                        (np.mean(time_sample), len(time_sample), self.seg, self.seg/(1000*np.mean(time_sample))))
         logging.info("average throughput / sample = %.6f sec (%ld samples * %ld) [%.3f kHz/s]" % \
-                        (np.sum(time_sample)/(len(time_sample)*c.shape[0]), len(time_sample), c.shape[0], \
-                            len(time_sample)*c.shape[0]/(1000*np.sum(time_sample))))
+                        (np.sum(time_sample)/(len(time_sample)*self.seg*B), len(time_sample)*self.seg, B, \
+                            len(time_sample)*self.seg*B/(1000*np.sum(time_sample))))
 
-        return decode_mu_law(x_out.cpu().data.numpy())
+        return decode_mu_law(x_buf[:,pad:pad+T].cpu().data.numpy())
 
     def apply_weight_norm(self):
         """Apply weight normalization module from all of the layers."""
@@ -1882,6 +2917,219 @@ class GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(nn.Module):
         self.apply(_remove_weight_norm)
 
 
+def copy_model(model):
+    """FUNCTION TO DEEP-COPY A MODEL, ALSO WITH WEIGHT NORM
+
+    The weights recomputed by weight norm are not graph leaves, which newer pytorch cannot deep-copy,
+    so that they are detached first (they are recomputed in every forward anyway).
+
+    Arg:
+        model (torch.nn.Module): model
+
+    Return:
+        (torch.nn.Module): copy of the model
+    """
+    for m in model.modules():
+        for hook in m._forward_pre_hooks.values():
+            if isinstance(hook, WeightNorm):
+                setattr(m, hook.name, getattr(m, hook.name).detach())
+    return copy.deepcopy(model)
+
+
+def remove_weight_norms(model):
+    """FUNCTION TO PERMANENTLY REMOVE WEIGHT NORM OF ALL LAYERS (CONV., GRU, ETC.) OF A MODEL
+
+    Arg:
+        model (torch.nn.Module): model
+    """
+    for m in model.modules():
+        for hook in list(m._forward_pre_hooks.values()):
+            if isinstance(hook, WeightNorm):
+                torch.nn.utils.remove_weight_norm(m, name=hook.name)
+
+
+def conv_stack_layers(conv):
+    """FUNCTION TO GET LAYERS OF DILATED/SKEWED CONV. STACK
+
+    Arg:
+        conv (TwoSidedDilConv1d/CausalDilConv1d/SkewedConv1d): conv. stack
+
+    Return:
+        (list): list of modules of the stack
+    """
+    if isinstance(conv.conv, nn.Sequential):
+        return list(conv.conv)
+    return [conv.conv]
+
+
+class EdgePaddedConv1d(nn.Conv1d):
+    """CONV1D WITH ITS PADDED FRAMES FILLED WITH A CONSTANT INPUT VECTOR (pad_value) INSTEAD OF ZEROS
+
+    Used for the 1st layer of a padded conv. stack with the input normalization folded into it,
+    where the padded frames are the input vector mapped to zero by the normalization.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(EdgePaddedConv1d, self).__init__(*args, **kwargs)
+        self.register_buffer("pad_value", torch.zeros(self.in_channels))
+
+    def edge_pad(self, x, channels=slice(None)):
+        """Pad B x C x T input (with the given C channels of pad_value) on both sides."""
+        pad = self.pad_value[channels].to(x.dtype).reshape(1, -1, 1).expand(x.shape[0], -1, self.padding[0])
+        return torch.cat((pad, x, pad), 2)
+
+    def forward(self, x):
+        return F.conv1d(self.edge_pad(x), self.weight, self.bias, self.stride, 0, self.dilation, self.groups)
+
+
+def fold_conv1d_pre_padded(pre, conv, idx):
+    """FUNCTION TO FOLD 1x1 CONV. APPLIED TO INPUT CHANNELS idx OF A PADDED CONV. INTO AN EdgePaddedConv1d
+
+    The padded frames of channels idx are set to -pinv(W_pre) b_pre, which pre maps to zero as the padded frames
+    of its output in the original conv., so that the folded conv. is also exact at the edges.
+
+    Args:
+        pre (torch.nn.Conv1d): 1x1 conv. of C_pre channels
+        conv (torch.nn.Conv1d): padded conv. of which input channels idx are the output of pre
+        idx (slice): C_pre input channels of conv
+
+    Return:
+        (EdgePaddedConv1d): folded conv.
+    """
+    folded = EdgePaddedConv1d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, \
+                padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None)
+    folded.to(conv.weight)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight)
+        if conv.bias is not None:
+            folded.bias.copy_(conv.bias)
+        folded.pad_value[idx] = -torch.mv(torch.pinverse(pre.weight[:,:,0].double()), \
+                                        pre.bias.double()).to(folded.pad_value)
+    fold_conv1d_pre(pre, folded, idx)
+    return folded
+
+
+def fold_conv1d_pre(pre, conv, idx):
+    """FUNCTION TO FOLD 1x1 CONV. APPLIED TO INPUT CHANNELS idx OF A CONV. INTO ITS WEIGHT AND BIAS
+
+    Only exact if conv has no padding (otherwise padded frames are not transformed by pre),
+    see fold_conv1d_pre_padded for padded convs.
+
+    Args:
+        pre (torch.nn.Conv1d): 1x1 conv. of C_pre channels
+        conv (torch.nn.Conv1d): conv. of which input channels idx are the output of pre
+        idx (slice): C_pre input channels of conv
+    """
+    with torch.no_grad():
+        weight = conv.weight[:, idx] # C_out x C_pre x K
+        conv.bias.add_(torch.einsum("ock,c->o", weight, pre.bias))
+        conv.weight[:, idx] = torch.einsum("ock,ci->oik", weight, pre.weight[:,:,0])
+
+
+def fold_conv1d_post(conv, post, idx=None):
+    """FUNCTION TO FOLD 1x1 CONV. APPLIED TO OUTPUT CHANNELS OF A CONV. INTO ONE CONV.
+
+    Args:
+        conv (torch.nn.Conv1d): conv.
+        post (torch.nn.Conv1d): 1x1 conv. of output of conv
+        idx (slice): output channels of conv transformed by post (if None, all of them, with a new conv. returned)
+
+    Return:
+        (torch.nn.Conv1d): conv. of post(conv(x)), or with channels idx of conv(x) replaced by post(conv(x)[idx])
+    """
+    with torch.no_grad():
+        if idx is None:
+            folded = nn.Conv1d(conv.in_channels, post.out_channels, conv.kernel_size, stride=conv.stride, \
+                        padding=conv.padding, dilation=conv.dilation).to(conv.weight)
+            folded.weight.copy_(torch.einsum("oc,cik->oik", post.weight[:,:,0], conv.weight))
+            folded.bias.copy_(torch.mv(post.weight[:,:,0], conv.bias) + post.bias)
+            return folded
+        weight = conv.weight[idx]
+        bias = conv.bias[idx]
+        conv.weight[idx] = torch.einsum("oc,cik->oik", post.weight[:,:,0], weight)
+        conv.bias[idx] = torch.mv(post.weight[:,:,0], bias) + post.bias
+        return conv
+
+
+def freeze_model(model):
+    """FUNCTION TO FREEZE A MODEL FOR INFERENCE BY FOLDING ITS ADJACENT LINEAR LAYERS
+
+    Weight norm is removed permanently, then
+        - conv_s_c of the vocoders is folded into the last layer of a linear conv. stack,
+        - the input normalization scale_in into the 1st layer of the conv. stack, which becomes an EdgePaddedConv1d
+          if it is padded (its padded frames are the input mapped to zero by scale_in),
+        - the de-normalization scale_out/scale_out_cap of non-autoregressive, non-diff. decoders into their out layer,
+        - the stacked 1x1 convs of OutputConv1d into one conv.,
+    with the folded layers replaced by identities. As the structure only depends on the model configuration,
+    a frozen checkpoint is loaded by freezing the newly defined model before load_state_dict.
+
+    Arg:
+        model (torch.nn.Module): model (GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER,
+            GRU_WAVE_DECODER_DUALGRU_COMPACT, or GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG)
+
+    Return:
+        (torch.nn.Module): the same model, frozen
+    """
+    remove_weight_norms(model)
+
+    if hasattr(model, "conv_s_c"):
+        layers = conv_stack_layers(model.conv)
+        if isinstance(model.conv_s_c, nn.Sequential):
+            conv_s_c = model.conv_s_c[0]
+        else:
+            conv_s_c = model.conv_s_c
+        if isinstance(layers[-1], nn.Conv1d) and isinstance(conv_s_c, nn.Conv1d):
+            folded = fold_conv1d_post(layers[-1], conv_s_c)
+            if isinstance(model.conv.conv, nn.Sequential):
+                model.conv.conv[len(layers)-1] = folded
+            else:
+                model.conv.conv = folded
+            if isinstance(model.conv_s_c, nn.Sequential):
+                model.conv_s_c[0] = nn.Identity()
+            else:
+                model.conv_s_c = nn.Identity()
+
+    # after conv_s_c, which may be folded into the same (single) layer
+    if isinstance(getattr(model, "scale_in", None), nn.Conv1d) and hasattr(model, "conv"):
+        conv_1 = conv_stack_layers(model.conv)[0]
+        if isinstance(model, GRU_SPEC_DECODER):
+            # excit. channels follow speaker channels
+            idx = slice(model.n_spk, model.n_spk+model.excit_dim)
+        else:
+            idx = slice(0, model.scale_in.out_channels)
+        if conv_1.padding[0] == 0:
+            fold_conv1d_pre(model.scale_in, conv_1, idx)
+        else:
+            # padded stack (e.g., vocoders), padded frames are filled with the input mapped to zero by scale_in
+            logging.info("%s: scale_in is folded into the padded 1st conv. layer with edge padding" % (type(model).__name__))
+            conv_1 = fold_conv1d_pre_padded(model.scale_in, conv_1, idx)
+            if isinstance(model.conv.conv, nn.Sequential):
+                model.conv.conv[0] = conv_1
+            else:
+                model.conv.conv = conv_1
+        model.scale_in = nn.Identity()
+
+    if isinstance(model, (GRU_SPEC_DECODER, GRU_EXCIT_DECODER)) and not model.ar and not model.diff:
+        if isinstance(model, GRU_SPEC_DECODER):
+            if model.cap_dim is not None:
+                fold_conv1d_post(model.out, model.scale_out_cap, slice(1, model.uvcap_dim))
+            fold_conv1d_post(model.out, model.scale_out, slice(model.uvcap_dim, model.out_dim))
+        else:
+            fold_conv1d_post(model.out, model.scale_out, slice(1, 2))
+            if model.cap_dim is not None:
+                fold_conv1d_post(model.out, model.scale_out_cap, slice(3, model.out_dim))
+        model.scale_out = nn.Identity()
+        if model.cap_dim is not None:
+            model.scale_out_cap = nn.Identity()
+
+    for m in model.modules():
+        if isinstance(m, OutputConv1d) and isinstance(m.conv[-2], nn.Conv1d):
+            m.conv = nn.Sequential(*(list(m.conv)[:-2]+[fold_conv1d_post(m.conv[-2], m.conv[-1])]))
+
+    model.frozen = True
+    return model
+
+
 class LaplaceLoss(nn.Module):
     def __init__(self):
         super(LaplaceLoss, self).__init__()
@@ -2067,10 +3315,25 @@ class DSWNV(nn.Module):
         h = (1-z)*torch.tanh(x_h_[:,self.n_hidch:,:]) + z*h[:,:,-1:]
         return out_skip(h), h
 
-    def batch_fast_generate(self, audio, aux, n_samples_list, intervals=4410):
+    def batch_fast_generate(self, audio, aux, n_samples_list, intervals=4410, spc_mask=None, warmup=0):
+        """Generate waveform sample by sample
+
+        With spc_mask (B x T_frm speech frame mask), samples of silent frames are set to zero, except for warmup
+        samples before each speech region. The network is bypassed on samples silent in all utterances of the batch,
+        otherwise the silent utterances are given the zero level as their samples.
+        """
         with torch.no_grad():
             # set max length
             max_samples = max(n_samples_list)
+            if spc_mask is not None:
+                active_utt = active_sample_mask(spc_mask, self.upsampling_factor, warmup, per_utt=True)
+                active = np.any(active_utt, axis=0)
+                active_utt = torch.from_numpy(active_utt).to(aux.device)
+                silence = F.one_hot(torch.empty(aux.shape[0], dtype=torch.long, device=aux.device).fill_(self.n_quantize // 2), \
+                            num_classes=self.n_quantize).float()
+            else:
+                active = None
+                silence = None
     
             # upsampling
             x = self.upsampling(self.conv_aux(self.scale_in(aux.transpose(1,2)))) # B x C x T
@@ -2111,33 +3374,38 @@ class DSWNV(nn.Module):
             start = time.time()
             out_idx = self.kernel_size*2-1
             for i in range(max_samples):
-                start_sample = time.time()
-                samples_size = samples.size(-1)
-                if not self.audio_in_flag:
-                    x_ = x[:, :, (samples_size-1):samples_size]
+                if active is not None and i < len(active) and not active[i]:
+                    sample = silence
                 else:
-                    x_ = torch.cat((x[:, :, (samples_size-1):samples_size],samples[:,:,-1:]),1)
-                output = F.softsign(self.causal(samples[:,:,-out_idx:])[:,:,-self.kernel_size:]) # B x C x T
-                output_buffer_next = []
-                skip_connections = []
-                for l in range(len(self.dil_facts)):
-                    #start_ = time.time()
-                    skip, output = self._generate_dcrnn_forward(
-                        x_, output, self.in_x[l], self.dil_h[l],
-                        self.out_skip[l])
-                    output = torch.cat((output_buffer[l], output), 2)
-                    output_buffer_next.append(output[:, :, -buffer_size[l]:])
-                    skip_connections.append(skip)
+                    start_sample = time.time()
+                    samples_size = samples.size(-1)
+                    if not self.audio_in_flag:
+                        x_ = x[:, :, (samples_size-1):samples_size]
+                    else:
+                        x_ = torch.cat((x[:, :, (samples_size-1):samples_size],samples[:,:,-1:]),1)
+                    output = F.softsign(self.causal(samples[:,:,-out_idx:])[:,:,-self.kernel_size:]) # B x C x T
+                    output_buffer_next = []
+                    skip_connections = []
+                    for l in range(len(self.dil_facts)):
+                        #start_ = time.time()
+                        skip, output = self._generate_dcrnn_forward(
+                            x_, output, self.in_x[l], self.dil_h[l],
+                            self.out_skip[l])
+                        output = torch.cat((output_buffer[l], output), 2)
+                        output_buffer_next.append(output[:, :, -buffer_size[l]:])
+                        skip_connections.append(skip)
     
-                # update buffer
-                output_buffer = output_buffer_next
+                    # update buffer
+                    output_buffer = output_buffer_next
     
-                # get predicted sample
-                output = self.out_2(F.relu(self.out_1(F.relu(sum(skip_connections))))).transpose(1,2)[:,-1]
-
-                posterior = F.softmax(output, dim=-1)
-                dist = torch.distributions.OneHotCategorical(posterior)
-                sample = dist.sample().data  # B
+                    # get predicted sample
+                    output = self.out_2(F.relu(self.out_1(F.relu(sum(skip_connections))))).transpose(1,2)[:,-1]
+
+                    posterior = F.softmax(output, dim=-1)
+                    dist = torch.distributions.OneHotCategorical(posterior)
+                    sample = dist.sample().data  # B
+                    if active is not None and i < len(active):
+                        sample = torch.where(active_utt[:,i:i+1], sample, silence)
                 if i > 0:
                     out_samples = torch.cat((out_samples, torch.argmax(sample, dim=--1).unsqueeze(1)), 1)
                 else:
@@ -2149,7 +3417,8 @@ class DSWNV(nn.Module):
                     samples = torch.cat((samples, sample.unsqueeze(2)), 2)
     
                 # show progress
-                time_sample.append(time.time()-start_sample)
+                if sample is not silence:
+                    time_sample.append(time.time()-start_sample)
                 #if intervals is not None and (i + 1) % intervals == 0:
                 if (i + 1) % intervals == 0:
                     logging.info("%d/%d estimated time = %.6f sec (%.6f sec / sample)" % (
@@ -2164,6 +3433,9 @@ class DSWNV(nn.Module):
             logging.info("average throughput / sample = %.6f sec (%ld samples * %ld) [%.3f kHz/s]" % (\
                         sum(time_sample)/(len(time_sample)*len(n_samples_list)), len(time_sample), \
                         len(n_samples_list), len(time_sample)*len(n_samples_list)/(1000*sum(time_sample))))
+            if active is not None:
+                n_skip = max_samples - len(time_sample)
+                logging.info("skipped silence samples = %ld/%ld (%.2f %%)" % (n_skip, max_samples, 100*n_skip/max_samples))
             samples = out_samples
     
             # devide into each waveform
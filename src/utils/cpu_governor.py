@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+
+import logging
+import os
+import sys
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# thread pools of BLAS/OpenMP (numpy, scipy, sklearn, torch) and numba (librosa)
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS", \
+                    "VECLIB_MAXIMUM_THREADS", "NUMBA_NUM_THREADS"]
+
+
+def available_cores():
+    """FUNCTION TO LIST THE CPU CORES AVAILABLE TO THE PROCESS
+
+    Return:
+        (list): sorted list of core ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def partition_cores(n_jobs, cpus_per_job=None, cores=None):
+    """FUNCTION TO PARTITION THE AVAILABLE CPU CORES ACROSS PARALLEL JOBS
+
+    Args:
+        n_jobs (int): number of parallel jobs
+        cpus_per_job (int): number of cores of each job (if None, the available cores are divided evenly)
+        cores (list): list of core ids to be partitioned (if None, all available cores)
+
+    Return:
+        (list): list of core sets of the jobs, disjoint as long as n_jobs*cpus_per_job does not exceed the cores
+    """
+    if cores is None:
+        cores = available_cores()
+    if cpus_per_job is None:
+        cpus_per_job = max(len(cores) // max(n_jobs, 1), 1)
+    if n_jobs*cpus_per_job > len(cores):
+        logging.warning("%d jobs x %d cpus oversubscribe %d cores, core sets are shared round-robin" % (n_jobs, \
+                            cpus_per_job, len(cores)))
+    return [set(cores[(i*cpus_per_job+j) % len(cores)] for j in range(cpus_per_job)) for i in range(n_jobs)]
+
+
+def limit_threads(n_threads):
+    """FUNCTION TO LIMIT THE NUMBER OF COMPUTE THREADS OF THE CURRENT PROCESS
+
+    The environment variables only take effect for libraries loaded afterwards, so the thread pools of already
+    loaded BLAS/OpenMP libraries are limited with threadpoolctl (if installed), and that of torch (if imported)
+    with torch.set_num_threads.
+
+    Arg:
+        n_threads (int): number of threads
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(n_threads)
+    if threadpool_limits is not None:
+        threadpool_limits(limits=n_threads)
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(n_threads)
+
+
+def govern_worker(core_set):
+    """FUNCTION TO PIN A WORKER PROCESS TO ITS CORE SET AND LIMIT ITS THREADS ACCORDINGLY
+
+    Arg:
+        core_set (set): core ids of the worker (if None, nothing is changed)
+    """
+    if core_set is None:
+        return
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, core_set)
+    limit_threads(len(core_set))
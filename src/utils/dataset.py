@@ -9,6 +9,7 @@ import torch
 import os
 import logging
 from utils import read_hdf5, check_hdf5, write_hdf5
+from utils import read_hdf5_multi, IndexedFeatureReader
 from torch.utils.data import Dataset
 import soundfile as sf
 
@@ -79,6 +80,7 @@ class FeatureDatasetNeuVoco(Dataset):
         self.wav_transform = wav_transform
         self.wav_transform_in = wav_transform_in
         self.wav_transform_out = wav_transform_out
+        self.feat_reader = IndexedFeatureReader()
 
     def __len__(self):
         return len(self.wav_list)
@@ -88,10 +90,7 @@ class FeatureDatasetNeuVoco(Dataset):
         featfile = self.feat_list[idx]
         
         x, _ = sf.read(wavfile, dtype=np.float32)
-        if check_hdf5(featfile, self.string_path):
-            h = read_hdf5(featfile, self.string_path)
-        else:
-            h = read_hdf5(featfile, self.string_path_org)
+        h = self.feat_reader.read(featfile, self.string_path, self.string_path_org)
 
         x, h = validate_length(x, h, self.upsampling_factor)
 
@@ -182,14 +181,16 @@ class FeatureDatasetCycMceplf0WavVAE(Dataset):
         #    logging.info('%s %s' % (featfile, self.string_path))
         if self.mel:
             if self.excit_dim is not None:
-                feat = np.c_[read_hdf5(featfile, '/feat_mceplf0cap')[:,:self.excit_dim], read_hdf5(featfile, self.string_path)]
+                feat_org, feat = read_hdf5_multi(featfile, ['/feat_mceplf0cap', self.string_path])
+                feat = np.c_[feat_org[:,:self.excit_dim], feat]
             else:
                 feat = read_hdf5(featfile, self.string_path)
         else:
             if self.cap_exc_dim is None:
                 feat = read_hdf5(featfile, self.string_path)
             else:
-                feat = np.c_[read_hdf5(featfile, '/feat_mceplf0cap')[:,:2], read_hdf5(featfile, '/feat_mceplf0cap')[:,self.cap_exc_dim:]]
+                feat = read_hdf5(featfile, '/feat_mceplf0cap')
+                feat = np.c_[feat[:,:2], feat[:,self.cap_exc_dim:]]
         featfile_spk = os.path.basename(os.path.dirname(featfile))
         src_idx = self.spk_list.index(featfile_spk)
 
@@ -404,6 +405,14 @@ class FeatureDatasetEvalCycMceplf0WavVAE(Dataset):
         #logging.info(self.wav_list_src)
         #logging.info(self.file_list_src)
 
+    def shard(self, rank, world_size):
+        """Keep the conv. pairs of a rank in data-parallel evaluation"""
+        self.file_list_src = self.file_list_src[rank::world_size]
+        self.file_list_src_trg = self.file_list_src_trg[rank::world_size]
+        self.list_src_trg_flag = self.list_src_trg_flag[rank::world_size]
+        if self.wav_list is not None:
+            self.wav_list_src = self.wav_list_src[rank::world_size]
+
     def __len__(self):
         return len(self.file_list_src)
 
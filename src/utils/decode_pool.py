@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+
+import contextlib
+import logging
+import os
+import queue as queue_lib
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from cpu_governor import govern_worker, partition_cores
+from utils import check_hdf5, shape_hdf5
+
+
+def worker_devices(n_gpus, n_cpu_workers=0, cpus_per_job=None):
+    """FUNCTION TO LIST THE DEVICES OF DECODING WORKERS
+
+    Args:
+        n_gpus (int): number of gpu workers, one per gpu
+        n_cpu_workers (int): number of cpu workers
+        cpus_per_job (int): number of cpu cores of each (gpu or cpu) worker (if None, the available cores are divided)
+
+    Return:
+        (list): list of (torch.device, cpu core set) of the workers
+    """
+    core_sets = partition_cores(n_gpus+n_cpu_workers, cpus_per_job=cpus_per_job)
+    devices = [torch.device("cuda", i) for i in range(n_gpus)] + [torch.device("cpu")]*n_cpu_workers
+    return list(zip(devices, core_sets))
+
+
+def device_scope(device):
+    """FUNCTION TO GET THE CONTEXT OF A WORKER DEVICE (CURRENT CUDA DEVICE, NOTHING FOR CPU)
+
+    Arg:
+        device (torch.device): device
+
+    Return:
+        (context manager): device context
+    """
+    if device.type == "cuda":
+        return torch.cuda.device(device)
+    return contextlib.suppress()
+
+
+def file_lengths(file_list, hdf5_path):
+    """FUNCTION TO GET THE NUMBER OF FRAMES OF FEATURE FILES (FILE SIZE IF THE DATASET DOES NOT EXIST)
+
+    Args:
+        file_list (list): list of hdf5 feature files
+        hdf5_path (str): dataset name in hdf5 file
+
+    Return:
+        (list): list of lengths
+    """
+    return [shape_hdf5(x, hdf5_path)[0] if check_hdf5(x, hdf5_path) else os.path.getsize(x) for x in file_list]
+
+
+def longest_first(file_list, lengths, batch_size=None):
+    """FUNCTION TO SORT FILES LONGEST-FIRST, OPTIONALLY GROUPED INTO BATCHES OF SIMILAR LENGTHS
+
+    Args:
+        file_list (list): list of files
+        lengths (list): list of lengths of the files
+        batch_size (int): number of files per batch (if None, files are not grouped)
+
+    Return:
+        (list): list of files (or of lists of files)
+    """
+    file_list = [file_list[i] for i in np.argsort(-np.array(lengths), kind="stable")]
+    if batch_size is None:
+        return file_list
+    return [file_list[i:i+batch_size] for i in range(0, len(file_list), batch_size)]
+
+
+class _ResultQueue(object):
+    """Put results of a worker to the central result queue, tagged with its rank"""
+
+    def __init__(self, result_queue, rank):
+        self.result_queue = result_queue
+        self.rank = rank
+
+    def put(self, result):
+        self.result_queue.put(("result", self.rank, result))
+
+
+def _task_iter(task_queue, result_queue, rank, current):
+    """Iterate tasks of the central queue, keeping the index of the current task and reporting each finished task
+
+    The index is kept in shared memory, which is written synchronously, unlike the queue feeding a crashing worker.
+    """
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+        current[rank], task = item
+        yield task
+        current[rank] = -1
+        result_queue.put(("task", rank, task))
+
+
+def _worker(target, rank, device, core_set, task_queue, result_queue, current, models):
+    """Run decoding function of a worker on its device"""
+    govern_worker(core_set)
+    target(_task_iter(task_queue, result_queue, rank, current), device, _ResultQueue(result_queue, rank), \
+            models=models)
+    result_queue.put(("done", rank, None))
+
+
+def run_pool(target, tasks, devices, load_models=None):
+    """FUNCTION TO RUN DECODING TASKS ON PERSISTENT WORKERS PULLING FROM A CENTRAL QUEUE
+
+    Each worker runs target(task_iter, device, queue, models=models) once: it loads its models once (or uses the
+    given ones), iterates the tasks pulled from the central queue, and puts its results (e.g., MetricStats) to queue.
+    Models of cpu workers are loaded once with load_models(cpu) in the main process and shared by all of them.
+    Finished tasks are streamed back and logged while decoding, and the workers are checked after every message
+    (or 10 s without one), so that a crashed worker is reported with its unfinished task as soon as it exits.
+
+    Args:
+        target (function): decoding function of a worker
+        tasks (list): list of tasks (e.g., feature files sorted longest-first) in the order to be decoded
+        devices (list): list of (torch.device, cpu core set) of the workers from worker_devices
+        load_models (function): function to define and load models on a device (for cpu workers sharing them)
+
+    Return:
+        (list): list of results put by the workers
+    """
+    task_queue = mp.Queue()
+    result_queue = mp.Queue()
+    for i, task in enumerate(tasks):
+        task_queue.put((i, task))
+    for i in range(len(devices)):
+        task_queue.put(None)
+    # index of the current task of each worker (-1 if none)
+    current = mp.Array("l", [-1]*len(devices), lock=False)
+
+    # gpu workers are forked first, as loading the shared models may initialize cuda in the main process
+    processes = [None]*len(devices)
+    shared_models = None
+    for rank, (device, core_set) in sorted(enumerate(devices), key=lambda x: x[1][0].type == "cpu"):
+        if device.type == "cpu" and shared_models is None and load_models is not None:
+            shared_models = load_models(device)
+            for model in shared_models:
+                if isinstance(model, torch.nn.Module):
+                    model.share_memory()
+        logging.info("worker %d: %s %s" % (rank, device, "" if core_set is None else sorted(core_set)))
+        models = shared_models if device.type == "cpu" else None
+        p = mp.Process(target=_worker, args=(target, rank, device, core_set, task_queue, result_queue, current, \
+                        models,))
+        p.start()
+        processes[rank] = p
+
+    # stream finished tasks and results until all workers are done
+    results = []
+    done = [False]*len(processes)
+    count = 0
+    while not all(done):
+        try:
+            tag, rank, item = result_queue.get(timeout=10)
+            if tag == "task":
+                count += 1
+                logging.info("worker %d finished %d/%d: %s" % (rank, count, len(tasks), item))
+            elif tag == "result":
+                results.append(item)
+            else:
+                done[rank] = True
+        except queue_lib.Empty:
+            pass
+        for rank, p in enumerate(processes):
+            # a worker exits after its done message, which may still be in the queue if it exited with 0
+            if not done[rank] and not p.is_alive() and p.exitcode != 0:
+                for p_ in processes:
+                    if p_.is_alive():
+                        p_.terminate()
+                raise RuntimeError("decoding worker %d (%s) exited with code %d, unfinished task: %s" % (rank, \
+                                    devices[rank][0], p.exitcode, tasks[current[rank]] if current[rank] >= 0 else None))
+
+    # wait for all process
+    for p in processes:
+        p.join()
+
+    return results
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import firwin, lfilter, oaconvolve
+import librosa
+
+# FIR filters of at least this number of taps are applied with overlap-add FFT convolution
+FFT_MIN_TAPS = 64
+
+
+def _read_only(arr):
+    """Mark a cached array as read-only, so that callers cannot modify the cache"""
+    arr.flags.writeable = False
+    return arr
+
+
+@lru_cache(maxsize=None)
+def fir_design(fs, cutoff, numtaps, pass_zero=True):
+    """FUNCTION TO DESIGN A WINDOWED-SINC FIR FILTER (CACHED PER fs, cutoff, numtaps, AND pass_zero)
+
+    Args:
+        fs (int): sampling frequency
+        cutoff (float): cutoff frequency
+        numtaps (int): number of taps
+        pass_zero (bool): low pass if True, high pass (low cut) if False
+
+    Return:
+        (ndarray): read-only filter coefficients
+    """
+    return _read_only(firwin(numtaps, cutoff / (fs // 2), pass_zero=pass_zero))
+
+
+def fir_filter(x, fil, zero_phase=False):
+    """FUNCTION TO APPLY AN FIR FILTER, WITH OVERLAP-ADD FFT CONVOLUTION FOR LONG FILTERS
+
+    Args:
+        x (ndarray): input sequence
+        fil (ndarray): filter coefficients
+        zero_phase (bool): compensate the group delay of a linear-phase (symmetric, odd-length) filter,
+            instead of the causal output of lfilter(fil, 1, x)
+
+    Return:
+        (ndarray): filtered sequence with the same length as x
+    """
+    if len(fil) >= FFT_MIN_TAPS:
+        y = oaconvolve(x, fil)
+    else:
+        y = np.convolve(x, fil)
+    if zero_phase:
+        delay = (len(fil) - 1) // 2
+        return y[delay:delay+len(x)]
+    return y[:len(x)]
+
+
+@lru_cache(maxsize=None)
+def mel_basis(fs, n_fft, n_mels):
+    """FUNCTION TO GET MEL FILTERBANK (CACHED)
+
+    Args:
+        fs (int): sampling frequency
+        n_fft (int): FFT length
+        n_mels (int): number of mel bands
+
+    Return:
+        (ndarray): read-only n_mels x (n_fft//2+1) mel filterbank
+    """
+    return _read_only(librosa.filters.mel(fs, n_fft, n_mels=n_mels))
+
+
+@lru_cache(maxsize=None)
+def mel_basis_pinv(fs, n_fft, n_mels):
+    """FUNCTION TO GET PSEUDO-INVERSE OF MEL FILTERBANK (CACHED)
+
+    Args:
+        fs (int): sampling frequency
+        n_fft (int): FFT length
+        n_mels (int): number of mel bands
+
+    Return:
+        (ndarray): read-only (n_fft//2+1) x n_mels pseudo-inverse
+    """
+    return _read_only(np.linalg.pinv(mel_basis(fs, n_fft, n_mels)))
+
+
+def preemphasis(x, alpha):
+    """FUNCTION TO APPLY FIRST-ORDER PRE-EMPHASIS FILTER
+
+    Args:
+        x (ndarray): waveform sequence
+        alpha (float): coefficient of pre-emphasis
+
+    Return:
+        (ndarray): pre-emphasized waveform sequence
+    """
+    y = np.copy(x)
+    y[1:] -= alpha * x[:-1]
+    return y
+
+
+def deemphasis(x, alpha):
+    """FUNCTION TO APPLY FIRST-ORDER DE-EMPHASIS (INVERSE OF PRE-EMPHASIS) FILTER
+
+    Args:
+        x (ndarray): pre-emphasized waveform sequence
+        alpha (float): coefficient of pre-emphasis
+
+    Return:
+        (ndarray): de-emphasized waveform sequence
+    """
+    b = np.array([1.], x.dtype)
+    a = np.array([1., -alpha], x.dtype)
+    return lfilter(b, a, x)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+from __future__ import division
+
+import json
+import logging
+
+import numpy as np
+
+MCD_CONST = 10.0 / np.log(10.0) * np.sqrt(2.0)
+
+
+def _concat(arr_list):
+    """Concatenate list of utterance trajectories along frames, returning frames and segment start indices"""
+    lengths = np.array([len(x) for x in arr_list])
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    return np.concatenate([np.asarray(x, dtype=np.float64) for x in arr_list], 0), starts, lengths
+
+
+def _seg_mean(x, starts, lengths):
+    """Mean of each utterance segment of concatenated frames (sum_T x ...) --> (N x ...)"""
+    return np.add.reduceat(x, starts, axis=0) / lengths.reshape((-1,)+(1,)*(x.ndim-1))
+
+
+def calc_mcd_frames(mcep_ref, mcep_est):
+    """FUNCTION TO CALCULATE FRAME-WISE MEL-CEPSTRAL DISTORTION
+
+    Args:
+        mcep_ref (ndarray): T x D reference mel-cepstrum
+        mcep_est (ndarray): T x D estimated mel-cepstrum
+
+    Return:
+        (ndarray): T mcd in dB
+    """
+    return MCD_CONST * np.sqrt(np.sum((mcep_ref - mcep_est)**2, axis=-1))
+
+
+def calc_metrics(mcep_ref=None, mcep_est=None, f0_ref=None, f0_est=None, codeap_ref=None, codeap_est=None, \
+        mcdpow_frames=None, mcd_frames=None, gv_est=None):
+    """FUNCTION TO CALCULATE OBJECTIVE METRICS OF A BATCH OF ALIGNED TRAJECTORIES
+
+    The frames of all utterances are concatenated, so that each metric is computed in one vectorized call
+    and reduced per utterance.
+
+    Args:
+        mcep_ref (list): list of T_i x D reference mel-cepstrum (with power at 0-th dim.)
+        mcep_est (list): list of T_i x D estimated mel-cepstrum
+        f0_ref (list): list of T_i reference F0 (0 for unvoiced frames)
+        f0_est (list): list of T_i estimated F0
+        codeap_ref (list): list of T_i x D_cap reference coded aperiodicity
+        codeap_est (list): list of T_i x D_cap estimated coded aperiodicity
+        mcdpow_frames (list): list of frame-wise mcd with power of DTW-aligned utterances, instead of mcep_ref/mcep_est
+        mcd_frames (list): list of frame-wise mcd without power of DTW-aligned utterances
+        gv_est (list): list of T_i x D estimated mel-cepstrum to compute the global variance of dims. 1 to D-1
+
+    Return:
+        (dict): per-utterance metrics (N or N x D) of mcdpow, mcdpowstd, mcd, mcdstd, f0rmse, f0corr, uverr,
+            caprmse, and gv
+    """
+    metrics = {}
+    if mcep_ref is not None:
+        mcep_ref, starts, lengths = _concat(mcep_ref)
+        mcep_est = _concat(mcep_est)[0]
+        diff2 = (mcep_ref - mcep_est)**2
+        mcdpow_frames = MCD_CONST * np.sqrt(np.sum(diff2, axis=-1))
+        mcd_frames = MCD_CONST * np.sqrt(np.sum(diff2[:,1:], axis=-1))
+    elif mcdpow_frames is not None:
+        mcdpow_frames, starts, lengths = _concat(mcdpow_frames)
+        mcd_frames = _concat(mcd_frames)[0]
+    if mcdpow_frames is not None:
+        for name, frames in [("mcdpow", mcdpow_frames), ("mcd", mcd_frames)]:
+            mean = _seg_mean(frames, starts, lengths)
+            metrics[name] = mean
+            metrics[name+"std"] = np.sqrt(np.maximum(_seg_mean(frames**2, starts, lengths) - mean**2, 0))
+
+    if f0_ref is not None:
+        f0_ref, starts, lengths = _concat(f0_ref)
+        f0_est = _concat(f0_est)[0]
+        metrics["f0rmse"] = np.sqrt(_seg_mean((f0_est - f0_ref)**2, starts, lengths))
+        f0_ref_c = f0_ref - np.repeat(_seg_mean(f0_ref, starts, lengths), lengths)
+        f0_est_c = f0_est - np.repeat(_seg_mean(f0_est, starts, lengths), lengths)
+        metrics["f0corr"] = np.add.reduceat(f0_est_c*f0_ref_c, starts) \
+                            / (np.sqrt(np.add.reduceat(f0_est_c**2, starts))*np.sqrt(np.add.reduceat(f0_ref_c**2, starts)))
+        metrics["uverr"] = 100*_seg_mean(((f0_ref > 0) != (f0_est > 0)).astype(np.float64), starts, lengths)
+
+    if codeap_ref is not None:
+        codeap_ref, starts, lengths = _concat(codeap_ref)
+        codeap_est = _concat(codeap_est)[0]
+        metrics["caprmse"] = np.sqrt(_seg_mean((codeap_est - codeap_ref)**2, starts, lengths))
+
+    if gv_est is not None:
+        gv_est, starts, lengths = _concat(gv_est)
+        gv_est = gv_est[:,1:]
+        mean = _seg_mean(gv_est, starts, lengths)
+        metrics["gv"] = _seg_mean(gv_est**2, starts, lengths) - mean**2
+
+    return metrics
+
+
+def merge_moments(moments_list):
+    """Merge accumulated (count, sum, sum of squares) moments, None entries are skipped"""
+    merged = None
+    for moments in moments_list:
+        if moments is None:
+            continue
+        if merged is None:
+            merged = (moments[0], np.copy(moments[1]), np.copy(moments[2]))
+        else:
+            merged = (merged[0]+moments[0], merged[1]+moments[1], merged[2]+moments[2])
+    return merged
+
+
+def moments_mean_var(moments):
+    """Mean and variance from accumulated (count, sum, sum of squares) moments"""
+    count, sum_, sum2 = moments
+    mean = sum_ / count
+    return mean, np.maximum(sum2 / count - mean**2, 0)
+
+
+class MetricStats(object):
+    """Mergeable accumulator of per-utterance metrics
+
+    The count, sum, and sum of squares of each metric are accumulated per evaluation group (e.g., rec., cyc., cv.)
+    and per speaker, so that the accumulators of parallel workers can be sent to the main process and merged,
+    giving the same mean and std as over the list of all utterances.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, group, metrics, spk="all"):
+        """Add per-utterance metrics (dict of N or N x D values) of a group and speaker"""
+        stats = self.stats.setdefault(group, {}).setdefault(spk, {})
+        for name, values in metrics.items():
+            values = np.asarray(values, dtype=np.float64)
+            if values.ndim == 0:
+                values = values.reshape(1)
+            if name in stats:
+                stats[name][0] += values.shape[0]
+                stats[name][1] += np.sum(values, axis=0)
+                stats[name][2] += np.sum(values**2, axis=0)
+            else:
+                stats[name] = [values.shape[0], np.sum(values, axis=0), np.sum(values**2, axis=0)]
+
+    def merge(self, other):
+        """Merge accumulated statistics of other MetricStats"""
+        for group, group_stats in other.stats.items():
+            for spk, stats in group_stats.items():
+                for name, (count, sum_, sum2) in stats.items():
+                    own = self.stats.setdefault(group, {}).setdefault(spk, {})
+                    if name in own:
+                        own[name][0] += count
+                        own[name][1] = own[name][1] + sum_
+                        own[name][2] = own[name][2] + sum2
+                    else:
+                        own[name] = [count, np.copy(sum_), np.copy(sum2)]
+
+    def count(self, group, name, spk=None):
+        """Number of accumulated utterances of a metric"""
+        return self.moments(group, spk).get(name, (0, None, None))[0]
+
+    def moments(self, group, spk=None):
+        """Accumulated (count, sum, sum of squares) of each metric of a group (or list of groups),
+            over all speakers if spk is None"""
+        moments = {}
+        for group_ in (group if isinstance(group, list) else [group]):
+            group_stats = self.stats.get(group_, {})
+            for spk_ in (list(group_stats.keys()) if spk is None else [spk]):
+                for name, (count, sum_, sum2) in group_stats.get(spk_, {}).items():
+                    if name in moments:
+                        moments[name] = (moments[name][0]+count, moments[name][1]+sum_, moments[name][2]+sum2)
+                    else:
+                        moments[name] = (count, sum_, sum2)
+        return moments
+
+    def summary(self, group, spk=None):
+        """Mean and std of each metric of a group (or list of groups) over utterances, over all speakers if spk is None"""
+        summary = {}
+        for name, moments in self.moments(group, spk).items():
+            mean, var = moments_mean_var(moments)
+            summary[name] = (mean, np.sqrt(var))
+        return summary
+
+    def log_summary(self, group):
+        """Log mean and std of the metrics of a group in the format of eval. summary"""
+        summary = self.summary(group)
+        for name in ["mcdpow", "mcd"]:
+            if name in summary:
+                logging.info("%s_%s: %.6f dB (+- %.6f) +- %.6f (+- %.6f)" % (name, group, summary[name][0], \
+                    summary[name][1], summary[name+"std"][0], summary[name+"std"][1]))
+        if "f0rmse" in summary:
+            logging.info("f0rmse_%s: %.6f Hz (+- %.6f)" % (group, summary["f0rmse"][0], summary["f0rmse"][1]))
+        if "f0corr" in summary:
+            logging.info("f0corr_%s: %.6f (+- %.6f)" % (group, summary["f0corr"][0], summary["f0corr"][1]))
+        if "uverr" in summary:
+            logging.info("uverr_%s: %.6f %% (+- %.6f)" % (group, summary["uverr"][0], summary["uverr"][1]))
+        if "caprmse" in summary:
+            for i in range(summary["caprmse"][0].shape[-1]):
+                logging.info("caprmse-%d_%s: %.6f dB (+- %.6f)" % (i+1, group, summary["caprmse"][0][i], \
+                    summary["caprmse"][1][i]))
+        for name in summary.keys():
+            if name not in ["mcdpow", "mcdpowstd", "mcd", "mcdstd", "f0rmse", "f0corr", "uverr", "caprmse", "gv"]:
+                logging.info("%s_%s: %.6f (+- %.6f)" % (name, group, summary[name][0], summary[name][1]))
+
+    def write_json(self, json_name):
+        """Write mean, std, and count of each metric per group, overall and per speaker, to json file"""
+        def _to_dict(moments):
+            summary = {}
+            for name, moments_ in moments.items():
+                mean, var = moments_mean_var(moments_)
+                summary[name] = {"mean": np.asarray(mean).tolist(), "std": np.sqrt(var).tolist(), "n": int(moments_[0])}
+            return summary
+
+        out = {}
+        for group, group_stats in self.stats.items():
+            out[group] = {"all": _to_dict(self.moments(group))}
+            out[group]["spk"] = {spk: _to_dict(self.moments(group, spk)) for spk in group_stats.keys()}
+        with open(json_name, "w") as f:
+            json.dump(out, f, indent=4, sort_keys=True)
+        logging.info("wrote metrics summary to %s" % (json_name))
+
+
+class MetricBatch(object):
+    """Per-utterance trajectories of a decoding worker, scored with one calc_metrics call per group
+
+    The trajectories of each utterance are appended with the calc_metrics arguments of a group (and optional
+    precomputed per-utterance metrics), and calc_metrics is called once per group and set of arguments over
+    max_utts appended utterances (and the remaining ones at flush), whose metrics are logged and added per speaker
+    to MetricStats, so that the trajectories kept by a worker are bounded.
+    """
+
+    def __init__(self, metric_stats, max_utts=128):
+        self.metric_stats = metric_stats
+        self.max_utts = max_utts
+        self.batches = {}
+
+    def append(self, group, utt, spk, metrics=None, **trajectories):
+        """Append trajectories (calc_metrics arguments) and precomputed metrics of an utterance to a group"""
+        key = (group, tuple(sorted(trajectories.keys())))
+        batch = self.batches.setdefault(key, \
+                    {"utt": [], "spk": [], "metrics": [], "trajectories": {name: [] for name in trajectories}})
+        batch["utt"].append(utt)
+        batch["spk"].append(spk)
+        batch["metrics"].append(metrics if metrics is not None else {})
+        for name, trajectory in trajectories.items():
+            batch["trajectories"][name].append(trajectory)
+        if len(batch["utt"]) >= self.max_utts:
+            self._score(key)
+
+    def flush(self):
+        """Score the remaining appended utterances of each group"""
+        for key in list(self.batches.keys()):
+            self._score(key)
+
+    def _score(self, key):
+        group = key[0]
+        batch = self.batches.pop(key)
+        metrics = calc_metrics(**batch["trajectories"])
+        for name in batch["metrics"][0].keys():
+            metrics[name] = np.array([utt_metrics[name] for utt_metrics in batch["metrics"]])
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            names = [name for name in sorted(metrics.keys()) if name != "gv"]
+            for i, utt in enumerate(batch["utt"]):
+                logging.info("%s %s: %s" % (group, utt, ", ".join(["%s = %s" % (name, \
+                    " ".join(["%.6f" % x for x in np.ravel(metrics[name][i])])) for name in names])))
+        spks = np.array(batch["spk"])
+        for spk in sorted(set(batch["spk"])):
+            idx = np.nonzero(spks == spk)[0]
+            self.metric_stats.add(group, {name: values[idx] for name, values in metrics.items()}, spk)
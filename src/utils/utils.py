@@ -6,7 +6,9 @@
 from __future__ import division
 from __future__ import print_function
 
+import fcntl
 import fnmatch
+import json
 import os
 import sys
 import threading
@@ -38,6 +40,9 @@ def check_hdf5(hdf5_name, hdf5_path):
 def read_hdf5(hdf5_name, hdf5_path):
     """FUNCTION TO READ HDF5 DATASET
 
+    Floating-point data stored with lower precision (e.g., float32 of HDF5Writer) are returned as float64,
+    as the WORLD/SPTK analysis-synthesis functions (pyworld, pysptk) only accept double buffers.
+
     Args:
         hdf5_name (str): filename of hdf5 file
         hdf5_path (str): dataset name in hdf5 file
@@ -61,6 +66,9 @@ def read_hdf5(hdf5_name, hdf5_path):
     hdf5_data = hdf5_file[hdf5_path][()]
     hdf5_file.close()
 
+    if isinstance(hdf5_data, np.ndarray) and np.issubdtype(hdf5_data.dtype, np.floating):
+        hdf5_data = hdf5_data.astype(np.float64, copy=False)
+
     return hdf5_data
 
 
@@ -83,6 +91,47 @@ def shape_hdf5(hdf5_name, hdf5_path):
         sys.exit(-1)
 
 
+def read_spc_mask(hdf5_name, n_frames, power_threshold=-20):
+    """FUNCTION TO READ SPEECH FRAME MASK OF FEATURE FILE
+
+    Args:
+        hdf5_name (str): filename of hdf5 feature file
+        n_frames (int): number of frames of the mask
+        power_threshold (float): threshold of normalized power if only /npow is stored
+
+    Return:
+        (ndarray): n_frames speech frame mask from /spcidx_range or /npow, all ones if none of them exists
+    """
+    spc_mask = np.zeros(n_frames)
+    if check_hdf5(hdf5_name, "/spcidx_range"):
+        spcidx = read_hdf5(hdf5_name, "/spcidx_range")[0]
+        spc_mask[spcidx[spcidx < n_frames]] = 1
+    elif check_hdf5(hdf5_name, "/npow"):
+        npow = read_hdf5(hdf5_name, "/npow")[:n_frames]
+        spc_mask[:len(npow)] = npow > power_threshold
+    else:
+        print("WARNING: There is no spcidx_range or npow in hdf5 file, all frames are speech. (%s)" % hdf5_name)
+        spc_mask[:] = 1
+
+    return spc_mask
+
+
+def pad_edge_batch(arr_list):
+    """FUNCTION TO STACK UTTERANCES INTO A BATCH PADDED BY REPEATING THEIR LAST FRAMES
+
+    Args:
+        arr_list (list): list of T_i x D feature arrays
+
+    Return:
+        (ndarray): B x max(T_i) x D batch
+        (ndarray): B lengths T_i
+    """
+    lengths = np.array([len(x) for x in arr_list])
+    max_len = np.max(lengths)
+
+    return np.stack([np.pad(x, [(0, max_len-len(x))]+[(0, 0)]*(x.ndim-1), "edge") for x in arr_list], 0), lengths
+
+
 def write_hdf5(hdf5_name, hdf5_path, write_data, is_overwrite=True):
     """FUNCTION TO WRITE DATASET TO HDF5
 
@@ -126,6 +175,315 @@ def write_hdf5(hdf5_name, hdf5_path, write_data, is_overwrite=True):
     return 1
 
 
+def read_hdf5_multi(hdf5_name, hdf5_paths):
+    """FUNCTION TO READ MULTIPLE HDF5 DATASETS IN ONE OPEN
+
+    Args:
+        hdf5_name (str): filename of hdf5 file
+        hdf5_paths (list): list of dataset names in hdf5 file
+
+    Return:
+        (list): list of dataset values in the order of hdf5_paths
+    """
+    if not os.path.exists(hdf5_name):
+        print("ERROR: There is no such a hdf5 file. (%s)" % hdf5_name)
+        print("Please check the hdf5 file path.")
+        sys.exit(-1)
+
+    hdf5_data = []
+    with h5py.File(hdf5_name, "r") as hdf5_file:
+        for hdf5_path in hdf5_paths:
+            if hdf5_path not in hdf5_file:
+                print("ERROR: There is no such a data in hdf5 file. (%s)" % hdf5_path)
+                print("Please check the data path in hdf5 file.")
+                sys.exit(-1)
+            hdf5_data.append(hdf5_file[hdf5_path][()])
+
+    return hdf5_data
+
+
+class HDF5Writer(object):
+    """HDF5 WRITER CONTEXT TO WRITE ALL DATASETS OF A FEATURE FILE IN ONE OPEN
+
+    Floating-point data are stored with dtype (float32 by default), integer data are kept as is.
+    read_hdf5 returns floating-point data as float64 for the WORLD/SPTK consumers.
+    Chunking is applied along the time (first) axis, and is required if compression is used.
+
+    Args:
+        hdf5_name (str): hdf5 dataset filename
+        dtype (numpy.dtype): storage dtype of floating-point data, if None keep the input dtype
+        chunk_frames (int): number of frames per chunk, if None contiguous (or auto-chunked with compression)
+        compression (str): None, "lzf", or "gzip"
+        compression_opts (int): compression level for gzip
+        is_overwrite (bool): flag to decide whether to overwrite dataset
+    """
+
+    def __init__(self, hdf5_name, dtype=np.float32, chunk_frames=None, compression=None, compression_opts=None,
+            is_overwrite=True):
+        self.hdf5_name = hdf5_name
+        self.dtype = dtype
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        if self.compression == "gzip" and compression_opts is None:
+            self.compression_opts = 4
+        else:
+            self.compression_opts = compression_opts
+        self.is_overwrite = is_overwrite
+        self.hdf5_file = None
+
+    def __enter__(self):
+        # check folder existence
+        folder_name, _ = os.path.split(self.hdf5_name)
+        if not os.path.exists(folder_name) and len(folder_name) != 0:
+            os.makedirs(folder_name)
+
+        # open with a mode, create if not exists
+        self.hdf5_file = h5py.File(self.hdf5_name, "a")
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.hdf5_file.flush()
+        self.hdf5_file.close()
+        self.hdf5_file = None
+
+    def chunks(self, shape):
+        """Get chunk shape of dataset with the given shape."""
+        if len(shape) == 0:
+            return None
+        if self.chunk_frames is None:
+            if self.compression is not None:
+                return True
+            return None
+        return (max(min(self.chunk_frames, shape[0]), 1),)+tuple(max(x, 1) for x in shape[1:])
+
+    def write(self, hdf5_path, write_data):
+        """Write dataset to the opened hdf5 file.
+
+        Args:
+            hdf5_path (str): dataset path in hdf5
+            write_data (ndarray): data to write
+        """
+        # convert to numpy array
+        write_data = np.asarray(write_data)
+        if self.dtype is not None and np.issubdtype(write_data.dtype, np.floating):
+            write_data = write_data.astype(self.dtype, copy=False)
+
+        # check dataset existence
+        if hdf5_path in self.hdf5_file:
+            if not self.is_overwrite:
+                print("ERROR: there is already dataset.")
+                print("if you want to overwrite, please set is_overwrite = True.")
+                self.hdf5_file.close()
+                sys.exit(1)
+            hdf5_data = self.hdf5_file[hdf5_path]
+            if hdf5_data.shape == write_data.shape and hdf5_data.dtype == write_data.dtype:
+                # overwrite in place to avoid growing the file
+                hdf5_data[...] = write_data
+                return 1
+            print("Warning: data in hdf5 file already exists. recreate dataset in hdf5.")
+            self.hdf5_file.__delitem__(hdf5_path)
+
+        if len(write_data.shape) > 0:
+            self.hdf5_file.create_dataset(hdf5_path, data=write_data, chunks=self.chunks(write_data.shape),
+                compression=self.compression, compression_opts=self.compression_opts)
+        else:
+            self.hdf5_file.create_dataset(hdf5_path, data=write_data)
+
+        return 1
+
+
+def convert_hdf5(hdf5_name, dtype=np.float32, chunk_frames=None, compression=None, compression_opts=None):
+    """FUNCTION TO CONVERT EXISTING HDF5 FILE TO THE STORAGE FORMAT OF HDF5Writer
+
+    All datasets are rewritten into a new file which atomically replaces the original,
+    so that the space of deleted/recreated datasets is also reclaimed.
+
+    Args:
+        hdf5_name (str): hdf5 filename
+        dtype (numpy.dtype): storage dtype of floating-point data
+        chunk_frames (int): number of frames per chunk
+        compression (str): None, "lzf", or "gzip"
+        compression_opts (int): compression level for gzip
+
+    Return:
+        (tuple): file size in bytes before and after conversion
+    """
+    size_org = os.path.getsize(hdf5_name)
+    hdf5_paths = []
+    with h5py.File(hdf5_name, "r") as hdf5_file:
+        hdf5_file.visititems(lambda name, obj: hdf5_paths.append(name) if isinstance(obj, h5py.Dataset) else None)
+    tmp_name = hdf5_name + ".tmp"
+    if os.path.exists(tmp_name):
+        os.remove(tmp_name)
+    hdf5_data = read_hdf5_multi(hdf5_name, hdf5_paths)
+    with HDF5Writer(tmp_name, dtype=dtype, chunk_frames=chunk_frames, compression=compression,
+            compression_opts=compression_opts) as f:
+        for hdf5_path, write_data in zip(hdf5_paths, hdf5_data):
+            f.write(hdf5_path, write_data)
+    os.replace(tmp_name, hdf5_name)
+
+    return size_org, os.path.getsize(hdf5_name)
+
+
+INDEX_NAME = "feat_index.json"
+
+
+def write_shard(shard_name, hdf5_name, hdf5_path, write_data, dtype=np.float32):
+    """FUNCTION TO WRITE GENERATED FEATURE TO A SIDECAR SHARD
+
+    Each worker owns its shard, so that the feature store is never opened for writing by workers.
+    The target feature file and dataset path are kept as attributes to be committed by merge_shards.
+
+    Args:
+        shard_name (str): filename of shard hdf5 owned by the worker
+        hdf5_name (str): filename of target hdf5 feature file
+        hdf5_path (str): dataset path in target hdf5 feature file
+        write_data (ndarray): data to write
+        dtype (numpy.dtype): storage dtype of floating-point data
+    """
+    with HDF5Writer(shard_name, dtype=dtype) as f:
+        shard_path = "/%d" % len(f.hdf5_file)
+        f.write(shard_path, write_data)
+        f.hdf5_file[shard_path].attrs["hdf5_name"] = hdf5_name
+        f.hdf5_file[shard_path].attrs["hdf5_path"] = hdf5_path
+
+    return 1
+
+
+def read_index(feat_dir):
+    """FUNCTION TO READ INDEX OF COMMITTED DATASETS IN A FEATURE DIRECTORY
+
+    Args:
+        feat_dir (str): directory of hdf5 feature files
+
+    Return:
+        (dict): basename of feature file --> committed dataset paths ("paths") and the size and mtime of the file
+            at the commit ("size", "mtime_ns"), None if there is no index
+    """
+    index_name = os.path.join(feat_dir, INDEX_NAME)
+    if not os.path.exists(index_name):
+        return None
+    with open(index_name, "r") as f:
+        return json.load(f)
+
+
+def merge_shards(shard_list, remove_shard=True):
+    """FUNCTION TO COMMIT SIDECAR SHARDS INTO THE FEATURE STORE
+
+    Every target feature file is rewritten to a temporary file together with its existing datasets,
+    which then atomically replaces the original, so that concurrent readers see either the old or the new file
+    and the file does not grow. The index of each feature directory is updated after the files are committed.
+
+    Args:
+        shard_list (list): list of shard hdf5 filenames
+        remove_shard (bool): flag to remove shards after commit
+
+    Return:
+        (int): number of committed datasets
+    """
+    # collect entries of shards, the later write of the same dataset is kept
+    entries = {}
+    for shard_name in shard_list:
+        with h5py.File(shard_name, "r") as shard_file:
+            for shard_path in shard_file:
+                attrs = shard_file[shard_path].attrs
+                hdf5_name = attrs["hdf5_name"]
+                feat_dir = os.path.dirname(hdf5_name)
+                if feat_dir not in entries:
+                    entries[feat_dir] = {}
+                if hdf5_name not in entries[feat_dir]:
+                    entries[feat_dir][hdf5_name] = {}
+                entries[feat_dir][hdf5_name][attrs["hdf5_path"]] = (shard_name, shard_path)
+
+    count = 0
+    for feat_dir in sorted(entries.keys()):
+        if not os.path.exists(feat_dir):
+            os.makedirs(feat_dir)
+        # serialize commits of concurrent merges into the same feature directory
+        with open(os.path.join(feat_dir, INDEX_NAME+".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = read_index(feat_dir)
+            if index is None:
+                index = {}
+            for hdf5_name in sorted(entries[feat_dir].keys()):
+                write_paths = entries[feat_dir][hdf5_name]
+                hdf5_paths = []
+                if os.path.exists(hdf5_name):
+                    with h5py.File(hdf5_name, "r") as hdf5_file:
+                        hdf5_file.visititems(lambda name, obj: hdf5_paths.append("/"+name) \
+                            if isinstance(obj, h5py.Dataset) else None)
+                hdf5_paths = [x for x in hdf5_paths if x not in write_paths]
+                tmp_name = hdf5_name + ".tmp"
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+                with HDF5Writer(tmp_name, dtype=None) as f:
+                    for hdf5_path, write_data in zip(hdf5_paths, read_hdf5_multi(hdf5_name, hdf5_paths) \
+                            if len(hdf5_paths) > 0 else []):
+                        f.write(hdf5_path, write_data)
+                    # shards keep their storage dtype (read_hdf5 would upcast to float64)
+                    for hdf5_path, (shard_name, shard_path) in write_paths.items():
+                        f.write(hdf5_path, read_hdf5_multi(shard_name, [shard_path])[0])
+                        count += 1
+                os.replace(tmp_name, hdf5_name)
+                stat = os.stat(hdf5_name)
+                index[os.path.basename(hdf5_name)] = {"paths": sorted(hdf5_paths + list(write_paths.keys())), \
+                                                        "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            # atomically update the index after the feature files are committed
+            index_name = os.path.join(feat_dir, INDEX_NAME)
+            with open(index_name + ".tmp", "w") as f:
+                json.dump(index, f)
+            os.replace(index_name + ".tmp", index_name)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    if remove_shard:
+        for shard_name in shard_list:
+            os.remove(shard_name)
+
+    return count
+
+
+class IndexedFeatureReader(object):
+    """READER TO RESOLVE DATASETS OF FEATURE FILES THROUGH THE INDEX OF MERGED WRITE-BACK
+
+    The index of each feature directory is loaded once, and is reloaded when it has been updated by merge_shards.
+    If a feature file is not indexed, or its size or mtime differs from the index (i.e., it has been rewritten
+    outside of merge_shards), the existence is checked in the hdf5 file itself.
+    """
+
+    def __init__(self):
+        self.indices = {}
+
+    def index(self, hdf5_name):
+        """Get index of the directory of the feature file."""
+        feat_dir = os.path.dirname(hdf5_name)
+        index_name = os.path.join(feat_dir, INDEX_NAME)
+        if not os.path.exists(index_name):
+            return None
+        mtime = os.path.getmtime(index_name)
+        if feat_dir not in self.indices or self.indices[feat_dir][0] != mtime:
+            self.indices[feat_dir] = (mtime, read_index(feat_dir))
+        return self.indices[feat_dir][1]
+
+    def check(self, hdf5_name, hdf5_path):
+        """Check whether the dataset has been committed to the feature file."""
+        index = self.index(hdf5_name)
+        basename = os.path.basename(hdf5_name)
+        if index is None or not isinstance(index.get(basename), dict):
+            return check_hdf5(hdf5_name, hdf5_path)
+        entry = index[basename]
+        stat = os.stat(hdf5_name)
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime_ns"]:
+            return check_hdf5(hdf5_name, hdf5_path)
+        return hdf5_path in entry["paths"]
+
+    def read(self, hdf5_name, hdf5_path, hdf5_path_org=None):
+        """Read the dataset, fall back to hdf5_path_org if it has not been committed."""
+        if hdf5_path_org is not None and not self.check(hdf5_name, hdf5_path):
+            return read_hdf5(hdf5_name, hdf5_path_org)
+        return read_hdf5(hdf5_name, hdf5_path)
+
+
 def find_files(directory, pattern="*.wav", use_dir_name=True):
     """FUNCTION TO FIND FILES RECURSIVELY
 
@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Latency of the optimized paths against the reference paths they replace
+
+The parity of each of them is checked by the tests, this only reports the max. abs. difference of the outputs
+of the benchmarked setting along with the time of both paths, e.g.,
+
+    python tests/benchmark.py encoder_pair --n_threads 1
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+# same module path as egs/*/path.sh
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "src", "nets"), os.path.join(ROOT, "src", "utils")]
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """Register a benchmark, returning (max. abs. diff., reference function, optimized function, setting)"""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def max_abs_diff(outputs, outputs_opt):
+    if isinstance(outputs, (tuple, list)):
+        return max([max_abs_diff(x, y) for x, y in zip(outputs, outputs_opt)] + [0])
+    if torch.is_tensor(outputs):
+        return torch.max(torch.abs(outputs.double() - outputs_opt.double())).item()
+    return abs(float(outputs) - float(outputs_opt))
+
+
+def saved_bytes(func):
+    """Number of bytes of the tensors saved for backward by func, of each storage once (e.g., the weights and
+    the input of a GRU on cpu are saved at every time step)"""
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        func()
+    return sum(storages.values())
+
+
+def timing(func, n_iter, n_repeat=3):
+    """Minimum over repeats of the mean time of n_iter calls"""
+    func()
+    times = []
+    for i in range(n_repeat):
+        start = time.time()
+        for j in range(n_iter):
+            func()
+        times.append((time.time() - start) / n_iter)
+    return min(times)
+
+
+def wave_decoder():
+    """Waveform model of vcc18 configs, 22.05 kHz with 5 ms shift, for generation"""
+    import logging
+    from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT
+
+    logging.disable(logging.INFO)
+    model_waveform = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=55, upsampling_factor=110, hidden_units=384, \
+                        hidden_units_2=16, lpc=4, kernel_size=7, dilation_size=1).eval()
+    model_waveform.remove_weight_norm()
+    return model_waveform
+
+
+@benchmark
+def cpu_governor(args):
+    import multiprocessing as mp
+    import numpy as np
+    from cpu_governor import available_cores, govern_worker, partition_cores
+
+    ctx = mp.get_context("fork")
+
+    # blas (matmul) and fft work as in feature extraction and decoding
+    def job(idx, core_set, queue):
+        govern_worker(core_set)
+        rng = np.random.RandomState(idx)
+        x = rng.randn(512, 512)
+        sig = rng.randn(512, 2048)
+        for i in range(10):
+            y = np.dot(x, x)
+            spec = np.abs(np.fft.rfft(sig, axis=-1))
+            x = y / np.max(np.abs(y)) + spec[:, :512] * 1e-6
+        queue.put((idx, np.sum(x)))
+
+    def run(core_sets):
+        queue = ctx.Queue()
+        processes = [ctx.Process(target=job, args=(idx, core_set, queue)) for idx, core_set in enumerate(core_sets)]
+        for p in processes:
+            p.start()
+        results = dict(queue.get() for p in processes)
+        for p in processes:
+            p.join()
+        return [results[idx] for idx in range(len(core_sets))]
+
+    core_sets = partition_cores(args.n_jobs)
+    run_default = lambda: run([None]*args.n_jobs)
+    run_governed = lambda: run(core_sets)
+    return max_abs_diff(run_default(), run_governed()), run_default, run_governed, \
+            "%d jobs on %d cores" % (args.n_jobs, len(available_cores()))
+
+
+@benchmark
+def decode_pool(args):
+    import multiprocessing as mp
+    import tempfile
+    import numpy as np
+    from decode_pool import longest_first, run_pool, worker_devices
+
+    ctx = mp.get_context("fork")
+    checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.pkl")
+    torch.save({"model_waveform": wave_decoder().state_dict()}, checkpoint)
+
+    # utterances of 100-700 frames in file list order, device-bound decoding (e.g., on gpu) is stood in by
+    # sleeping 1 ms per frame, which does not compete for the cpu cores
+    rng = np.random.RandomState(0)
+    n_utt = 4*args.n_jobs
+    lengths = list(rng.randint(100, 700, n_utt))
+    tasks = ["utt%03d" % i for i in range(n_utt)]
+    length_of = dict(zip(tasks, lengths))
+
+    def load_models(device):
+        model_waveform = wave_decoder()
+        model_waveform.load_state_dict(torch.load(checkpoint)["model_waveform"])
+        return [model_waveform]
+
+    def decode(task_iter, device, queue, models=None):
+        if models is None:
+            models = load_models(device)
+        decoded = []
+        for task in task_iter:
+            time.sleep(length_of[task] / 1000)
+            decoded.append((task, models[0].logits.weight.sum().item()))
+        queue.put(decoded)
+
+    # each job loads the models and decodes its split of the file list, as before the pool
+    def run_split():
+        queue = ctx.Queue()
+        processes = [ctx.Process(target=decode, args=(iter(split.tolist()), torch.device("cpu"), queue)) \
+                        for split in np.array_split(tasks, args.n_jobs)]
+        for p in processes:
+            p.start()
+        results = [queue.get() for p in processes]
+        for p in processes:
+            p.join()
+        return sorted(sum(results, []))
+
+    run_longest_first = lambda: sorted(sum(run_pool(decode, longest_first(tasks, lengths), \
+                                        worker_devices(0, args.n_jobs), load_models=load_models), []))
+    outputs = run_split()
+    outputs_pool = run_longest_first()
+    assert [task for task, _ in outputs] == [task for task, _ in outputs_pool]
+    return max_abs_diff([x for _, x in outputs], [x for _, x in outputs_pool]), run_split, run_longest_first, \
+            "%d utt. on %d cpu workers" % (n_utt, args.n_jobs)
+
+
+@benchmark
+def encoder_pair(args):
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_VAE_ENCODER_PAIR
+
+    # mcep/excit. encoders of vcc18 models
+    encoders = []
+    for lat_dim in [32, 32]:
+        encoder = GRU_VAE_ENCODER(in_dim=56, n_spk=12, lat_dim=lat_dim, hidden_units=args.hidden_units, \
+                    kernel_size=7, dilation_size=1)
+        encoder.remove_weight_norm()
+        encoder.eval()
+        for param in encoder.parameters():
+            param.requires_grad = False
+        encoders.append(encoder)
+    model_encoder_pair = GRU_VAE_ENCODER_PAIR(encoders[0], encoders[1]).eval()
+    x = torch.randn(1, args.n_frames+model_encoder_pair.pad_left+model_encoder_pair.pad_right, 56)
+
+    run_separate = lambda: [encoder(x, sampling=False) for encoder in encoders]
+    run_fused = lambda: model_encoder_pair(x, sampling=False)
+    return max_abs_diff(run_separate(), run_fused()), run_separate, run_fused, \
+            "%d frames, %d hidden units" % (args.n_frames, args.hidden_units)
+
+
+@benchmark
+def fir(args):
+    import numpy as np
+    from scipy.signal import firwin, lfilter
+    from dsp import fir_design, fir_filter
+
+    # low cut filter of a 24 kHz waveform and low pass filter of its 5 ms-shift contour, as in feature_extract.py
+    fs, fs_f0, numtaps = 24000, 200, 255
+    rng = np.random.RandomState(0)
+    x = np.clip(rng.randn(int(fs*args.dur))*0.1, -1, 1)
+    contour = np.log1p(np.abs(rng.randn(int(fs_f0*args.dur))))
+
+    def run_direct():
+        x_lcf = lfilter(firwin(1023, 65 / (fs // 2), pass_zero=False), 1, x)
+        contour_pad = np.pad(contour, (numtaps, numtaps), 'edge')
+        contour_lpf = lfilter(firwin(numtaps, 20 / (fs_f0 // 2)), 1, contour_pad)[numtaps + numtaps // 2: -numtaps // 2]
+        return x_lcf, contour_lpf
+
+    def run_fft():
+        x_lcf = fir_filter(x, fir_design(fs, 65, 1023, pass_zero=False))
+        contour_pad = np.pad(contour, (numtaps, numtaps), 'edge')
+        contour_lpf = fir_filter(contour_pad, fir_design(fs_f0, 20, numtaps), zero_phase=True)[numtaps:-numtaps]
+        return x_lcf, contour_lpf
+
+    diff = max([np.max(np.abs(y - y_fft)) for y, y_fft in zip(run_direct(), run_fft())])
+    return diff, run_direct, run_fft, "%.1f sec utterance" % (args.dur)
+
+
+@benchmark
+def fold(args):
+    model_waveform = wave_decoder()
+    c = torch.randn(1, args.n_frames, model_waveform.feat_dim)
+
+    def run(fold_len):
+        torch.manual_seed(1)
+        with torch.no_grad():
+            return torch.from_numpy(model_waveform.generate(c, fold_len=fold_len, fold_overlap=args.fold_overlap))
+
+    run_sequential = lambda: run(None)
+    run_folded = lambda: run(args.fold_len)
+    # the folded samples are not expected to be equal, their hidden states are warmed up on fold_overlap frames
+    return max_abs_diff(run_sequential(), run_folded()), run_sequential, run_folded, \
+            "%d frames, fold %d+2*%d" % (args.n_frames, args.fold_len, args.fold_overlap)
+
+
+@benchmark
+def frame_rate_cond(args):
+    from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT
+
+    # training forward/backward of the waveform model of vcc18 configs on batch_size_wave frames of 8 utterances,
+    # the upsampled path is kept for dropout, which is the identity in eval mode
+    model_waveform = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=55, upsampling_factor=110, hidden_units=384, \
+                        hidden_units_2=16, lpc=4, kernel_size=7, dilation_size=1, do_prob=0.5).eval()
+    B, T_frm = 8, 33
+    T = T_frm*model_waveform.upsampling_factor
+    c = torch.randn(B, T_frm, 55)
+    x_prev = torch.randint(model_waveform.n_quantize, (B, T))
+    x_lpc = torch.randint(model_waveform.n_quantize, (B, T+model_waveform.lpc-1))
+    params = [param for param in model_waveform.parameters() if param.requires_grad]
+
+    def forward(upsampled):
+        return model_waveform(c, x_prev, do=upsampled, x_lpc=x_lpc)[0]
+
+    def run(upsampled):
+        out = forward(upsampled)
+        return (out,) + torch.autograd.grad(out.mean(), params)
+
+    run_upsampled = lambda: run(True)
+    run_frame_rate = lambda: run(False)
+    mbytes_upsampled = saved_bytes(lambda: forward(True)) / 2**20
+    mbytes_frame_rate = saved_bytes(lambda: forward(False)) / 2**20
+    return max_abs_diff(run_upsampled(), run_frame_rate()), run_upsampled, run_frame_rate, \
+            "%dx%d frames, saved %.1f -> %.1f MB" % (B, T_frm, mbytes_upsampled, mbytes_frame_rate)
+
+
+@benchmark
+def freeze(args):
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, copy_model, freeze_model
+
+    # weight-normed encoder and mcep/excit. decoders of vcc18 models, as loaded by the decoding scripts
+    models = [
+        GRU_VAE_ENCODER(in_dim=56, n_spk=12, lat_dim=32, hidden_units=args.hidden_units, kernel_size=7, \
+            dilation_size=1),
+        GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=12, hidden_units=args.hidden_units, excit_dim=6, \
+            kernel_size=7, dilation_size=1),
+        GRU_EXCIT_DECODER(feat_dim=32, n_spk=12, hidden_units=args.hidden_units, cap_dim=3, kernel_size=7, \
+            dilation_size=1)]
+    for model in models:
+        model.eval()
+    models_frozen = [freeze_model(copy_model(model)) for model in models]
+    for param in [param for model in models+models_frozen for param in model.parameters()]:
+        param.requires_grad = False
+    x = torch.randn(1, args.n_frames, 56)
+    y = torch.randint(12, (1, args.n_frames))
+
+    def run(model_encoder, model_decoder_mcep, model_decoder_excit):
+        with torch.no_grad():
+            outputs = model_encoder(x, sampling=False)
+            z = outputs[2]
+            outputs_excit = model_decoder_excit(y[:,:z.shape[1]], z)
+            outputs_mcep = model_decoder_mcep(y[:,:z.shape[1]], z, e=x[:,:z.shape[1],:6])
+            return outputs[:3] + outputs_excit[:1] + outputs_mcep[:1]
+
+    run_weight_norm = lambda: run(*models)
+    run_frozen = lambda: run(*models_frozen)
+    return max_abs_diff(run_weight_norm(), run_frozen()), run_weight_norm, run_frozen, \
+            "%d frames, %d hidden units" % (args.n_frames, args.hidden_units)
+
+
+@benchmark
+def gate_tables(args):
+    model_waveform = wave_decoder()
+    c = torch.randn(1, args.n_frames, model_waveform.feat_dim)
+
+    def run(tables):
+        torch.manual_seed(1)
+        with torch.no_grad():
+            return torch.from_numpy(model_waveform.generate(c, tables=tables))
+
+    run_matmul = lambda: run(False)
+    run_tables = lambda: run(True)
+    return max_abs_diff(run_matmul(), run_tables()), run_matmul, run_tables, \
+            "%d frames, %d samples" % (args.n_frames, args.n_frames*model_waveform.upsampling_factor)
+
+
+@benchmark
+def grad_checkpoint(args):
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, checkpoint_forward, copy_model
+
+    # training forward/backward of n_half_cyc half-cycles of the encoder and mcep decoder of vcc18 models,
+    # batch_size frames of batch_size_utt utterances
+    model_encoder = GRU_VAE_ENCODER(in_dim=50, n_spk=12, lat_dim=32, hidden_units=args.hidden_units, kernel_size=7, \
+                        dilation_size=1)
+    model_decoder = GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=12, hidden_units=args.hidden_units, \
+                        kernel_size=7, dilation_size=1)
+    models = (model_encoder, model_decoder)
+    models_ckpt = tuple(checkpoint_forward(copy_model(model)) for model in models)
+    B, T_frm = 6, 30
+    x = torch.randn(B, T_frm+model_encoder.pad_left+model_encoder.pad_right, 50)
+    y = torch.randint(12, (B, 1)).repeat(1, x.shape[1])
+
+    def forward(model_encoder, model_decoder):
+        outputs = []
+        x_in = x
+        for i in range(args.n_half_cyc):
+            qz_alpha = model_encoder(x_in)[1]
+            x_rec = model_decoder(y[:,:qz_alpha.shape[1]], qz_alpha[:,:,:32])[0]
+            outputs += [qz_alpha, x_rec]
+            x_in = torch.cat((x_rec, x_rec[:,-1:].expand(-1, x.shape[1]-x_rec.shape[1], -1)), 1)
+        return outputs
+
+    def run(models):
+        outputs = forward(*models)
+        params = [param for model in models for param in model.parameters()]
+        return torch.autograd.grad(sum([output.mean() for output in outputs]), params)
+
+    run_plain = lambda: run(models)
+    run_ckpt = lambda: run(models_ckpt)
+    mbytes_plain = saved_bytes(lambda: forward(*models)) / 2**20
+    mbytes_ckpt = saved_bytes(lambda: forward(*models_ckpt)) / 2**20
+    return max_abs_diff(run_plain(), run_ckpt()), run_plain, run_ckpt, \
+            "%d half-cyc., saved %.1f -> %.1f MB" % (args.n_half_cyc, mbytes_plain, mbytes_ckpt)
+
+
+@benchmark
+def lpc_logits(args):
+    from vcneuvoco import lpc_logits
+
+    # 12 frames of 110 samples of 8 utterances, with 6 lpc coefficients
+    B, T, K, V = 8, 12*110, 6, 256
+    lpc = torch.randn(B, T, K, requires_grad=True)
+    x_lpc = torch.randint(V, (B, T+K-1)).unfold(1, K, 1)
+    weight = torch.randn(V, V, requires_grad=True)
+    grad_out = torch.randn(B, T, V)
+
+    def run(func):
+        out = func()
+        grads = torch.autograd.grad(out, (lpc, weight), grad_out)
+        return (out,) + grads
+
+    run_dense = lambda: run(lambda: torch.sum(lpc.unsqueeze(-1)*weight[x_lpc], -2))
+    run_chunk = lambda: run(lambda: lpc_logits(lpc, x_lpc, weight, args.lpc_chunk))
+    mbytes_dense = saved_bytes(lambda: torch.sum(lpc.unsqueeze(-1)*weight[x_lpc], -2)) / 2**20
+    mbytes_chunk = saved_bytes(lambda: lpc_logits(lpc, x_lpc, weight, args.lpc_chunk)) / 2**20
+    return max_abs_diff(run_dense(), run_chunk()), run_dense, run_chunk, \
+            "chunk %d, saved %.1f -> %.1f MB" % (args.lpc_chunk, mbytes_dense, mbytes_chunk)
+
+
+@benchmark
+def lpcseg(args):
+    from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+
+    # per-sample loop of the waveform model without segments, which the segment generation was a copy of
+    model_waveform = wave_decoder()
+    model_waveform_seg = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(feat_dim=55, upsampling_factor=110, hidden_units=384, \
+                            hidden_units_2=16, lpc=4, kernel_size=7, dilation_size=1, seg=args.seg).eval()
+    model_waveform_seg.remove_weight_norm()
+    c = torch.randn(1, args.n_frames, 55)
+
+    def run(model):
+        torch.manual_seed(1)
+        with torch.no_grad():
+            return model.generate(c)
+
+    run_sample = lambda: run(model_waveform)
+    run_seg = lambda: run(model_waveform_seg)
+    # of different models, the parity of the segment generation with teacher forcing is in the tests
+    return float("nan"), run_sample, run_seg, "%d frames, seg %d" % (args.n_frames, args.seg)
+
+
+@benchmark
+def metrics(args):
+    import logging
+    import numpy as np
+    from metrics import MetricBatch, MetricStats, calc_metrics
+
+    logging.disable(logging.INFO)
+    rng = np.random.RandomState(0)
+    n_utts = 200
+    utts = []
+    for i in range(n_utts):
+        n_frames = rng.randint(args.n_frames//2, args.n_frames*3//2)
+        f0 = np.where(rng.rand(n_frames) > 0.3, 100+50*rng.rand(n_frames), 0)
+        utts.append((["SF1", "TM1"][i % 2], dict(mcep_ref=rng.randn(n_frames, 50), mcep_est=rng.randn(n_frames, 50), \
+                        f0_ref=f0, f0_est=f0*1.1, codeap_ref=rng.randn(n_frames, 3), codeap_est=rng.randn(n_frames, 3))))
+
+    # as in the decoding scripts, gv, f0/codeap, and mcd of each utterance
+    groups = [["mcep_est"], ["f0_ref", "f0_est", "codeap_ref", "codeap_est"], ["mcep_ref", "mcep_est"]]
+
+    def run_per_utt():
+        metric_stats = MetricStats()
+        for spk, utt in utts:
+            for names in groups:
+                if names == ["mcep_est"]:
+                    metric_stats.add("cv", calc_metrics(gv_est=[utt["mcep_est"]]), spk)
+                else:
+                    metric_stats.add("cv", calc_metrics(**{name: [utt[name]] for name in names}), spk)
+        return [metric_stats.summary("cv")[name][0] for name in sorted(metric_stats.summary("cv").keys())]
+
+    def run_batch():
+        metric_stats = MetricStats()
+        metric_batch = MetricBatch(metric_stats)
+        for i, (spk, utt) in enumerate(utts):
+            for names in groups:
+                if names == ["mcep_est"]:
+                    metric_batch.append("cv", "utt%d" % i, spk, gv_est=utt["mcep_est"])
+                else:
+                    metric_batch.append("cv", "utt%d" % i, spk, **{name: utt[name] for name in names})
+        metric_batch.flush()
+        return [metric_stats.summary("cv")[name][0] for name in sorted(metric_stats.summary("cv").keys())]
+
+    diff = max([np.max(np.abs(x - y)) for x, y in zip(run_per_utt(), run_batch())])
+    return diff, run_per_utt, run_batch, "%d utterances of ~%d frames" % (n_utts, args.n_frames)
+
+
+@benchmark
+def radam(args):
+    from radam import RAdam
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, copy_model
+
+    # weight-normed modules as in the mcep-lf0cap trainers
+    models = torch.nn.ModuleList([
+        GRU_VAE_ENCODER(n_spk=12, hidden_units=args.hidden_units),
+        GRU_VAE_ENCODER(n_spk=12, hidden_units=args.hidden_units),
+        GRU_SPEC_DECODER(n_spk=12, hidden_units=args.hidden_units, excit_dim=6),
+        GRU_EXCIT_DECODER(n_spk=12, hidden_units=args.hidden_units, cap_dim=3)])
+    models_foreach = copy_model(models)
+    params = list(models.parameters())
+    params_foreach = list(models_foreach.parameters())
+    for p, p_foreach in zip(params, params_foreach):
+        p.grad = torch.randn_like(p)
+        p_foreach.grad = p.grad.clone()
+    optimizer = RAdam(params, weight_decay=1e-5, foreach=False)
+    optimizer_foreach = RAdam(params_foreach, weight_decay=1e-5, foreach=True)
+
+    optimizer.step()
+    optimizer_foreach.step()
+    return max_abs_diff(params, params_foreach), optimizer.step, optimizer_foreach.step, \
+            "%d tensors, %d hidden units" % (len(params), args.hidden_units)
+
+
+@benchmark
+def rec_cv(args):
+    from vcneuvoco import GRU_SPEC_DECODER, GRU_EXCIT_DECODER, decode_rec_cv
+
+    # training forward/backward of the mcep/excit. decoders of a half-cycle of vcc18 models,
+    # batch_size frames of batch_size_utt utterances
+    models = [
+        GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=12, hidden_units=args.hidden_units, kernel_size=7, \
+            dilation_size=1),
+        GRU_EXCIT_DECODER(feat_dim=32, n_spk=12, hidden_units=args.hidden_units, cap_dim=3, kernel_size=7, \
+            dilation_size=1)]
+    B, T_frm = 6, 30
+    n_frames = T_frm+models[0].pad_left+models[0].pad_right
+    y = torch.randint(12, (B, 1)).repeat(1, n_frames)
+    y_cv = (y + torch.randint(1, 12, (B, 1))) % 12
+    zs = [torch.randn(B, n_frames, 32, requires_grad=True) for model in models]
+    params = [param for model in models for param in model.parameters()]
+
+    def run_separate():
+        outputs = []
+        for model, z in zip(models, zs):
+            outputs += [model(y, z)[0], model(y_cv, z)[0]]
+        return outputs + list(torch.autograd.grad(sum([output.mean() for output in outputs]), zs+params))
+
+    def run_batched():
+        outputs = []
+        for model, z in zip(models, zs):
+            outputs_rec, outputs_cv = decode_rec_cv(model, y, y_cv, z)
+            outputs += [outputs_rec[0], outputs_cv[0]]
+        return outputs + list(torch.autograd.grad(sum([output.mean() for output in outputs]), zs+params))
+
+    return max_abs_diff(run_separate(), run_batched()), run_separate, run_batched, \
+            "%dx%d frames, %d hidden units" % (B, T_frm, args.hidden_units)
+
+
+@benchmark
+def mixed_precision(args):
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, MixedPrecision, copy_model
+
+    # training forward/backward of a half-cycle of the encoder and mcep decoder of vcc18 models, fp32 vs bf16 autocast
+    model_encoder = GRU_VAE_ENCODER(in_dim=50, n_spk=12, lat_dim=32, hidden_units=args.hidden_units, kernel_size=7, \
+                        dilation_size=1)
+    model_decoder = GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=12, hidden_units=args.hidden_units, \
+                        kernel_size=7, dilation_size=1)
+    models = (model_encoder, model_decoder)
+    amp = MixedPrecision("bf16", torch.device("cpu"))
+    models_amp = tuple(amp.apply(copy_model(model)) for model in models)
+    B, T_frm = 6, 30
+    x = torch.randn(B, T_frm+model_encoder.pad_left+model_encoder.pad_right, 50)
+    y = torch.randint(12, (B, 1)).repeat(1, x.shape[1])
+
+    def run(model_encoder, model_decoder):
+        qz_alpha = model_encoder(x, sampling=False)[1]
+        x_rec = model_decoder(y[:,:qz_alpha.shape[1]], qz_alpha[:,:,:32])[0]
+        params = list(model_encoder.parameters()) + list(model_decoder.parameters())
+        return [x_rec] + list(torch.autograd.grad(x_rec.abs().mean(), params))
+
+    run_fp32 = lambda: run(*models)
+    run_bf16 = lambda: run(*models_amp)
+    return max_abs_diff(run_fp32(), run_bf16()), run_fp32, run_bf16, "bf16 autocast on cpu"
+
+
+@benchmark
+def rand_shift(args):
+    from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+
+    # training forward/backward of the first chunk of batch_size_wave frames of 8 utterances,
+    # with all seg 1-shift segment groupings stacked in the batch, or a random one of them
+    model_waveform = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(feat_dim=55, upsampling_factor=110, hidden_units=384, \
+                        hidden_units_2=16, lpc=4, kernel_size=7, dilation_size=1, seg=args.seg)
+    seg = model_waveform.seg
+    B, T_frm = 8, 33
+    T_seg = T_frm*model_waveform.upsampling_factor // seg
+    c = torch.randn(B, T_frm, 55)
+    x_prev = torch.randint(model_waveform.n_quantize, (B, T_seg*seg+model_waveform.seg_1))
+    x = torch.randint(model_waveform.n_quantize, (B, T_seg*seg+model_waveform.lpc_offset-1))
+    x_lpc = [x[:,i:x.shape[1]-model_waveform.seg_1+i].unfold(1, model_waveform.lpc, 1).unfold(1, seg, seg).permute(0,1,3,2) \
+                for i in range(seg)]
+    params = [param for param in model_waveform.parameters() if param.requires_grad]
+    shift = torch.randint(seg, (1,)).item()
+
+    def forward(shifts):
+        return model_waveform(c, x_prev, x_lpc=torch.cat([x_lpc[i] for i in shifts], 0), first=True, shifts=shifts)[0]
+
+    def run(shifts):
+        out = forward(shifts)
+        return out[(shifts.index(shift))*B:(shifts.index(shift)+1)*B], torch.autograd.grad(out.mean(), params)
+
+    run_all = lambda: run(list(range(seg)))
+    run_rand = lambda: run([shift])
+    mbytes_all = saved_bytes(lambda: forward(list(range(seg)))) / 2**20
+    mbytes_rand = saved_bytes(lambda: forward([shift])) / 2**20
+    # the gradients of the mean loss of one grouping are not those of all groupings, only its outputs are compared
+    return max_abs_diff(run_all()[0], run_rand()[0]), run_all, run_rand, \
+            "%dx%d frames, seg %d, saved %.1f -> %.1f MB" % (B, T_frm, seg, mbytes_all, mbytes_rand)
+
+
+@benchmark
+def skip_silence(args):
+    import numpy as np
+
+    model_waveform = wave_decoder()
+    c = torch.randn(1, args.n_frames, model_waveform.feat_dim)
+    # leading and trailing silences of a quarter of the utterance each
+    spc_mask = np.zeros((1, args.n_frames))
+    spc_mask[:,args.n_frames//4:args.n_frames-args.n_frames//4] = 1
+
+    def run(spc_mask):
+        torch.manual_seed(1)
+        with torch.no_grad():
+            return torch.from_numpy(model_waveform.generate(c, spc_mask=spc_mask, warmup=240))
+
+    run_full = lambda: run(None)
+    run_skip = lambda: run(spc_mask)
+    # the samples are not expected to be equal, those of silent frames are set to zero
+    return max_abs_diff(run_full(), run_skip()), run_full, run_skip, \
+            "%d frames, %d%% silence" % (args.n_frames, 100*(1-np.mean(spc_mask)))
+
+
+@benchmark
+def spk_interp(args):
+    from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER
+
+    # sweep of n_interp interpolated spk-codes of decode_gru-cycle-mceplf0capvae-vq.py with vcc18 models,
+    # decoding and speaker-posterior re-encoding of all deltas at once vs one delta at a time
+    model_decoder_mcep = GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=12, hidden_units=args.hidden_units, \
+                            kernel_size=7, dilation_size=1, spkidtr_dim=2, pad_first=True).eval()
+    model_decoder_excit = GRU_EXCIT_DECODER(feat_dim=32, cap_dim=3, n_spk=12, hidden_units=args.hidden_units, \
+                            kernel_size=7, dilation_size=1, spkidtr_dim=2, pad_first=True).eval()
+    model_encoders = [GRU_VAE_ENCODER(in_dim=50+model_decoder_excit.out_dim, n_spk=12, lat_dim=32, \
+                        hidden_units=args.hidden_units, kernel_size=7, dilation_size=1, cont=False, \
+                        pad_first=True).eval() for i in range(2)]
+    lat_src = torch.randn(1, args.n_frames, 32)
+    lat_src_e = torch.randn(1, args.n_frames, 32)
+    z_src, z_trg = torch.randn(2, 1, 1, 2)
+    n_steps = torch.arange(1, args.n_interp+1).float().unsqueeze(-1).unsqueeze(-1) # n_delta x 1 x 1
+    cv_code = torch.repeat_interleave((n_steps*(z_trg-z_src)/args.n_interp)+z_src, args.n_frames, dim=1)
+
+    def sweep(cv_code):
+        n_delta = cv_code.shape[0]
+        cvmcep = model_decoder_mcep(cv_code, lat_src.expand(n_delta,-1,-1))[0]
+        cvlf0 = model_decoder_excit(cv_code, lat_src_e.expand(n_delta,-1,-1))[0]
+        return [cvmcep, cvlf0] + [model_encoder(torch.cat((cvlf0, cvmcep), 2))[0] for model_encoder in model_encoders]
+
+    def run_loop():
+        with torch.no_grad():
+            outputs = [sweep(cv_code[i:i+1]) for i in range(args.n_interp)]
+        return [torch.cat(output, 0) for output in zip(*outputs)]
+
+    def run_batch():
+        with torch.no_grad():
+            return sweep(cv_code)
+
+    return max_abs_diff(run_loop(), run_batch()), run_loop, run_batch, \
+            "%d deltas x %d frames" % (args.n_interp, args.n_frames)
+
+
+@benchmark
+def spk_cond(args):
+    import torch.nn.functional as F
+    from vcneuvoco import GRU_SPEC_DECODER
+
+    # mcep decoder of vcc18 models, with many speakers
+    model_decoder = GRU_SPEC_DECODER(feat_dim=32, out_dim=50, n_spk=args.n_spk, hidden_units=args.hidden_units, \
+                        kernel_size=7, dilation_size=1).eval()
+    for param in model_decoder.parameters():
+        param.requires_grad = False
+    n_frames = args.n_frames+model_decoder.pad_left+model_decoder.pad_right
+    spk = torch.randint(args.n_spk, (1, 1)).repeat(1, n_frames)
+    lat = torch.randn(1, n_frames, 32)
+
+    def run_onehot():
+        with torch.no_grad():
+            return model_decoder(F.one_hot(spk, num_classes=args.n_spk).float(), lat)[0]
+
+    def run_table():
+        with torch.no_grad():
+            return model_decoder(spk, lat)[0]
+
+    model_decoder.precompute_spk_table()
+    return max_abs_diff(run_onehot(), run_table()), run_onehot, run_table, \
+            "%d speakers, %d frames, %d hidden units" % (args.n_spk, args.n_frames, args.hidden_units)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="latency of optimized paths against their reference paths")
+    parser.add_argument("names", nargs="*", default=sorted(BENCHMARKS.keys()),
+                        help="benchmarks to run (%s)" % (", ".join(sorted(BENCHMARKS.keys()))))
+    parser.add_argument("--n_frames", default=400,
+                        type=int, help="number of frames of the input")
+    parser.add_argument("--hidden_units", default=1024,
+                        type=int, help="number of hidden units of the GRUs")
+    parser.add_argument("--n_interp", default=10,
+                        type=int, help="number of interpolated spk-codes")
+    parser.add_argument("--n_half_cyc", default=2,
+                        type=int, help="number of half-cycles of VC training")
+    parser.add_argument("--dur", default=5.0,
+                        type=float, help="duration in sec of the waveform")
+    parser.add_argument("--n_spk", default=1024,
+                        type=int, help="number of speakers of the decoder")
+    parser.add_argument("--lpc_chunk", default=440,
+                        type=int, help="number of time steps in a chunk of lpc logits")
+    parser.add_argument("--fold_len", default=40,
+                        type=int, help="number of frames in each folded segment")
+    parser.add_argument("--fold_overlap", default=4,
+                        type=int, help="number of frames of warm-up and crossfade between folded segments")
+    parser.add_argument("--seg", default=2,
+                        type=int, help="number of samples in a segment of the LPCSEG waveform model")
+    parser.add_argument("--n_jobs", default=4,
+                        type=int, help="number of parallel jobs")
+    parser.add_argument("--n_iter", default=5,
+                        type=int, help="number of timed iterations")
+    parser.add_argument("--n_threads", default=None,
+                        type=int, help="number of torch threads (if None, torch default)")
+    args = parser.parse_args()
+
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+    torch.manual_seed(0)
+    print("%-16s %-40s %12s %12s %8s %10s" % ("benchmark", "setting", "ref. (ms)", "opt. (ms)", "speedup", "max diff"))
+    for name in args.names:
+        diff, func_ref, func_opt, setting = BENCHMARKS[name](args)
+        time_ref = timing(func_ref, args.n_iter)
+        time_opt = timing(func_opt, args.n_iter)
+        print("%-16s %-40s %12.3f %12.3f %7.2fx %10.2e" % (name, setting, time_ref*1000, time_opt*1000, \
+                time_ref/max(time_opt, 1e-9), diff))
+
+
+if __name__ == "__main__":
+    main()
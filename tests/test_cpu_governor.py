@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import multiprocessing as mp
+import os
+
+import pytest
+
+from cpu_governor import THREAD_ENV_VARS, available_cores, govern_worker, partition_cores
+
+CORES = list(range(8))
+
+
+def test_partition_cores_divides_evenly():
+    core_sets = partition_cores(3, cores=CORES)
+    assert core_sets == [{0, 1}, {2, 3}, {4, 5}]
+    assert partition_cores(2, cpus_per_job=3, cores=CORES) == [{0, 1, 2}, {3, 4, 5}]
+    # at least one core for each job
+    assert partition_cores(10, cores=CORES[:4]) == [{i % 4} for i in range(10)]
+
+
+def test_partition_cores_oversubscription_is_round_robin(caplog):
+    core_sets = partition_cores(3, cpus_per_job=3, cores=CORES)
+    assert core_sets == [{0, 1, 2}, {3, 4, 5}, {6, 7, 0}]
+    assert "oversubscribe" in caplog.text
+
+
+def governed_state(core_set, queue):
+    import torch
+    govern_worker(core_set)
+    affinity = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+    queue.put((affinity, {name: os.environ.get(name) for name in THREAD_ENV_VARS}, torch.get_num_threads()))
+
+
+def run_governed(core_set):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=governed_state, args=(core_set, queue))
+    p.start()
+    state = queue.get(timeout=60)
+    p.join()
+    return state
+
+
+def test_govern_worker_pins_and_limits_threads():
+    core_set = set(available_cores()[:1])
+    affinity, env, n_threads = run_governed(core_set)
+    if affinity is not None:
+        assert affinity == sorted(core_set)
+    assert env == {name: "1" for name in THREAD_ENV_VARS}
+    assert n_threads == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="no cpu affinity")
+def test_ungoverned_worker_is_unchanged():
+    affinity, env, n_threads = run_governed(None)
+    assert affinity == available_cores()
+    assert env == {name: os.environ.get(name) for name in THREAD_ENV_VARS}
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import os
+import socket
+
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from vcneuvoco import DataParallel
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_rank(rank, world_size, port, file_list, lat_dim):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size))
+    dp = DataParallel("gloo")
+    shard = dp.shard(file_list)
+    assert len(shard) == -(-len(file_list) // world_size)
+    # K-means init: only rank 0 checks the stats, all ranks decode latents of their shards
+    assert dp.any(dp.rank == 0)
+    z_list = np.full((3+rank, lat_dim), rank, dtype=np.float32)
+    z_all = dp.gather_rows(z_list)
+    assert z_all.shape == (3*world_size+sum(range(world_size)), lat_dim)
+    np.testing.assert_array_equal(z_all[:, 0], np.concatenate([np.full(3+i, i) for i in range(world_size)]))
+    assert sorted(sum(dp.gather(shard), [])) == sorted(file_list + file_list[:-len(file_list) % world_size])
+    dist.destroy_process_group()
+
+
+def test_shards_and_gathered_latents():
+    world_size = 3
+    mp.spawn(run_rank, args=(world_size, free_port(), ["utt%d" % i for i in range(10)], 4), nprocs=world_size)
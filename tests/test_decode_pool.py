@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import os
+import time
+
+import pytest
+
+from decode_pool import longest_first, run_pool, worker_devices
+
+
+def decode_tasks(task_iter, device, queue, models=None):
+    decoded = []
+    for task in task_iter:
+        if task == "crash":
+            os._exit(3)
+        time.sleep(0.05)
+        decoded.append(task)
+    queue.put(decoded)
+
+
+def test_longest_first():
+    assert longest_first(["a", "b", "c"], [1, 3, 2]) == ["b", "c", "a"]
+    assert longest_first(["a", "b", "c"], [1, 3, 2], batch_size=2) == [["b", "c"], ["a"]]
+
+
+def test_run_pool_decodes_all_tasks():
+    tasks = ["%d" % i for i in range(20)]
+    results = run_pool(decode_tasks, tasks, worker_devices(0, 2))
+    assert len(results) == 2
+    assert sorted(sum(results, [])) == sorted(tasks)
+
+
+def test_run_pool_reports_crashed_worker_while_others_stream():
+    # the other worker keeps streaming finished tasks for ~5 s after the crash
+    tasks = ["crash"] + ["%d" % i for i in range(100)]
+    start = time.time()
+    with pytest.raises(RuntimeError, match="exited with code 3, unfinished task: crash"):
+        run_pool(decode_tasks, tasks, worker_devices(0, 2))
+    assert time.time() - start < 3
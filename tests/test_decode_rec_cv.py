@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_SPEC_DECODER, GRU_EXCIT_DECODER, decode_rec_cv
+
+B = 3
+T = 20
+N_SPK = 5
+LAT_DIM = 6
+HIDDEN_UNITS = 16
+
+
+def decoder(name, ar):
+    torch.manual_seed(0)
+    if name == "mcep":
+        return GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=8, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, kernel_size=3, \
+                    dilation_size=2, ar=ar).double()
+    return GRU_EXCIT_DECODER(feat_dim=LAT_DIM, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, kernel_size=3, \
+                dilation_size=2, cap_dim=3, ar=ar).double()
+
+
+@pytest.mark.parametrize("name", ["mcep", "excit"])
+@pytest.mark.parametrize("ar", [False, True])
+@pytest.mark.parametrize("with_h", [False, True])
+def test_batched_rec_cv_matches_separate_calls(name, ar, with_h):
+    model = decoder(name, ar)
+    torch.manual_seed(1)
+    n_frames = T+model.pad_left+model.pad_right
+    y = torch.randint(N_SPK, (B, 1)).repeat(1, n_frames)
+    y_cv = (y + torch.randint(1, N_SPK, (B, 1))) % N_SPK
+    z = torch.randn(B, n_frames, LAT_DIM, dtype=torch.double, requires_grad=True)
+    out_dim = model.out_dim
+    x_in = torch.randn(B, 1, out_dim, dtype=torch.double) if ar else None
+    x_in_cv = torch.randn(B, 1, out_dim, dtype=torch.double) if ar else None
+    h = torch.randn(1, B, HIDDEN_UNITS, dtype=torch.double) if with_h else None
+    h_cv = torch.randn(1, B, HIDDEN_UNITS, dtype=torch.double) if with_h else None
+    args = (x_in,) if ar else ()
+    args_cv = (x_in_cv,) if ar else ()
+
+    outputs_rec, outputs_cv = decode_rec_cv(model, y, y_cv, z, x_in, x_in_cv, h=h, h_cv=h_cv, outpad_right=2)
+    outputs_rec_ref = model(y, z, *args, h=h, outpad_right=2)
+    outputs_cv_ref = model(y_cv, z, *args_cv, h=h_cv, outpad_right=2)
+    assert len(outputs_rec) == len(outputs_rec_ref)
+    for output, output_ref in zip(outputs_rec + outputs_cv, outputs_rec_ref + outputs_cv_ref):
+        assert_close(output, output_ref)
+
+    # gradients of the latent and parameters through both outputs
+    inputs = [z] + [param for param in model.parameters() if param.requires_grad]
+    grads = torch.autograd.grad(outputs_rec[0].sum() + 2*outputs_cv[0].sum(), inputs, allow_unused=True)
+    grads_ref = torch.autograd.grad(outputs_rec_ref[0].sum() + 2*outputs_cv_ref[0].sum(), inputs, allow_unused=True)
+    for grad, grad_ref in zip(grads, grads_ref):
+        if grad_ref is None:
+            assert grad is None
+        else:
+            assert_close(grad, grad_ref)
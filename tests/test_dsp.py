@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+import pytest
+from scipy.signal import firwin, lfilter
+
+librosa = pytest.importorskip("librosa")
+
+from dsp import FFT_MIN_TAPS, deemphasis, fir_design, fir_filter, mel_basis, mel_basis_pinv, preemphasis
+
+FS = 24000
+FS_F0 = 200
+
+
+def signal(n_samples, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.clip(rng.randn(n_samples)*0.1, -1, 1)
+
+
+def low_cut_filter_direct(x, fs, cutoff=65):
+    """Low cut filter of feature_extract.py before dsp.py"""
+    fil = firwin(1023, cutoff / (fs // 2), pass_zero=False)
+    return lfilter(fil, 1, x)
+
+
+def low_pass_filter_direct(x, fs, cutoff=20):
+    """Low pass filter of feature_extract.py before dsp.py"""
+    numtaps = 255
+    fil = firwin(numtaps, cutoff / (fs // 2))
+    x_pad = np.pad(x, (numtaps, numtaps), 'edge')
+    return lfilter(fil, 1, x_pad)[numtaps + numtaps // 2: -numtaps // 2]
+
+
+# shorter, as long as, and longer than the filters
+@pytest.mark.parametrize("n_samples", [100, 1023, 5*FS+17])
+def test_fft_low_cut_filter_matches_lfilter(n_samples):
+    x = signal(n_samples)
+    y = fir_filter(x, fir_design(FS, 65, 1023, pass_zero=False))
+    y_direct = low_cut_filter_direct(x, FS)
+    assert y.shape == x.shape
+    np.testing.assert_allclose(y, y_direct, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("n_samples", [10, 255, 1000])
+def test_zero_phase_low_pass_filter_matches_sliced_lfilter(n_samples):
+    x = np.log1p(np.abs(signal(n_samples, seed=1)))
+    numtaps = 255
+    x_pad = np.pad(x, (numtaps, numtaps), 'edge')
+    y = fir_filter(x_pad, fir_design(FS_F0, 20, numtaps), zero_phase=True)[numtaps:-numtaps]
+    np.testing.assert_allclose(y, low_pass_filter_direct(x, FS_F0), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("zero_phase", [False, True])
+def test_short_filter_direct_convolution(zero_phase):
+    numtaps = FFT_MIN_TAPS - 1
+    x = signal(500, seed=2)
+    fil = fir_design(FS, 4000, numtaps)
+    y = fir_filter(x, fil, zero_phase=zero_phase)
+    y_direct = lfilter(fil, 1, np.concatenate((x, np.zeros(numtaps))))
+    if zero_phase:
+        y_direct = y_direct[numtaps//2:]
+    np.testing.assert_allclose(y, y_direct[:len(x)], rtol=0, atol=1e-12)
+
+
+def test_cached_designs_are_read_only():
+    fil = fir_design(FS, 65, 1023, pass_zero=False)
+    assert fir_design(FS, 65, 1023, pass_zero=False) is fil
+    np.testing.assert_array_equal(fil, firwin(1023, 65 / (FS // 2), pass_zero=False))
+    melfb = mel_basis(FS, 2048, 80)
+    assert mel_basis(FS, 2048, 80) is melfb
+    np.testing.assert_allclose(mel_basis_pinv(FS, 2048, 80), np.linalg.pinv(melfb))
+    for arr in [fil, melfb, mel_basis_pinv(FS, 2048, 80)]:
+        with pytest.raises(ValueError):
+            arr[0] = 0
+
+
+def test_emphasis_matches_lfilter_and_is_inverted():
+    x = signal(1000, seed=3)
+    alpha = 0.85
+    x_emph = preemphasis(x, alpha)
+    np.testing.assert_allclose(x_emph, lfilter(np.array([1., -alpha]), np.array([1.]), x), rtol=0, atol=1e-15)
+    np.testing.assert_allclose(deemphasis(x_emph, alpha), x, rtol=0, atol=1e-12)
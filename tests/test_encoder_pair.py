@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_VAE_ENCODER_PAIR, copy_model, freeze_model
+
+B = 2
+T = 30
+IN_DIM = 12
+N_SPK = 4
+
+
+def encoder_pair(use_weight_norm=True, remove_weight_norm=False, frozen=False, **kwargs):
+    torch.manual_seed(0)
+    encoders = []
+    # mcep and excit. encoders of different latent dims.
+    for lat_dim in [8, 3]:
+        encoder = GRU_VAE_ENCODER(in_dim=IN_DIM, n_spk=N_SPK, lat_dim=lat_dim, hidden_units=32, kernel_size=3, \
+                    dilation_size=2, use_weight_norm=use_weight_norm, **kwargs)
+        with torch.no_grad():
+            # normalization-like scale_in, not the identity-like random init
+            encoder.scale_in.bias.normal_()
+        if remove_weight_norm:
+            encoder.remove_weight_norm()
+        encoder.eval()
+        if frozen:
+            encoder = freeze_model(copy_model(encoder))
+        for param in encoder.parameters():
+            param.requires_grad = False
+        encoders.append(encoder)
+    return encoders, GRU_VAE_ENCODER_PAIR(encoders[0], encoders[1]).eval()
+
+
+VARIANTS = [
+    ("weight-norm", dict()),
+    ("removed-weight-norm", dict(remove_weight_norm=True)),
+    ("no-weight-norm", dict(use_weight_norm=False)),
+    ("frozen", dict(frozen=True)),
+    ("causal", dict(causal_conv=True)),
+    ("vq", dict(cont=False)),
+    ("onehot-lat", dict(onehot_lat=True)),
+]
+
+
+@pytest.mark.parametrize("name,kwargs", VARIANTS)
+@pytest.mark.parametrize("sampling", [True, False])
+def test_fused_pair_matches_separate_encoders(name, kwargs, sampling):
+    encoders, pair = encoder_pair(**kwargs)
+    assert pair.fused
+    x = torch.randn(B, T+pair.pad_left+pair.pad_right, IN_DIM)
+    with torch.no_grad():
+        for outputs, outputs_fused in zip([encoder(x, sampling=sampling) for encoder in encoders], \
+                                            pair(x, sampling=sampling)):
+            assert len(outputs) == len(outputs_fused)
+            for output, output_fused in zip(outputs, outputs_fused):
+                assert_close(output_fused, output, rtol=1e-5, atol=1e-5)
+
+
+def test_fused_pair_hidden_states_and_right_padding():
+    encoders, pair = encoder_pair()
+    x = torch.randn(B, T+pair.pad_left+pair.pad_right, IN_DIM)
+    x_next = torch.randn(B, T+pair.pad_left+pair.pad_right, IN_DIM)
+    with torch.no_grad():
+        outputs = [encoder(x, outpad_right=3) for encoder in encoders]
+        outputs_fused = pair(x, outpad_right=3)
+        h = (outputs[0][-1], outputs[1][-1])
+        h_fused = (outputs_fused[0][-1], outputs_fused[1][-1])
+        assert_close(h_fused, h, rtol=1e-5, atol=1e-5)
+        # continued from the hidden states of the previous segment
+        for outputs, outputs_fused in zip([encoder(x_next, h=h_) for encoder, h_ in zip(encoders, h)], \
+                                            pair(x_next, h=h_fused)):
+            for output, output_fused in zip(outputs, outputs_fused):
+                assert_close(output_fused, output, rtol=1e-5, atol=1e-5)
+
+
+def test_unfusable_pairs_run_separately():
+    x = torch.randn(B, T+8, IN_DIM)
+    for kwargs in [dict(bi=True), dict(frozen=True, pad_first=False)]:
+        encoders, pair = encoder_pair(**kwargs)
+        assert not pair.fused
+        with torch.no_grad():
+            for outputs, outputs_pair in zip([encoder(x, sampling=False) for encoder in encoders], \
+                                                pair(x, sampling=False)):
+                for output, output_pair in zip(outputs, outputs_pair):
+                    assert_close(output_pair, output)
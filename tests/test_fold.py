@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import vcneuvoco
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT
+
+B = 2
+T_FRM = 23
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+
+
+class ArgmaxSampling(object):
+    """Deterministic stand-in of OneHotCategorical, so that generated samples are a function of the network"""
+
+    def __init__(self, probs):
+        self.probs = probs
+
+    def sample(self):
+        return F.one_hot(self.probs.argmax(-1), self.probs.shape[-1]).to(self.probs.dtype)
+
+
+@pytest.fixture(autouse=True)
+def argmax_sampling(monkeypatch):
+    monkeypatch.setattr(vcneuvoco, "OneHotCategorical", ArgmaxSampling)
+
+
+def wave_decoder():
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, hidden_units=32, \
+                hidden_units_2=8, lpc=4, kernel_size=3, dilation_size=2).double().eval()
+    torch.nn.init.normal_(model.logits.weight)
+    return model
+
+
+def frame_samples(model):
+    """Memoryless generation loop, each sample is quantized from the conditioning of its frame"""
+
+    def generate_samples(c, intervals=4000, tables=True, active=None):
+        x = ((torch.tanh(c[:,:,0]) + 1) * (model.n_quantize // 2 - 0.5)).long()
+        return x.repeat_interleave(model.upsampling_factor, 1)
+
+    return generate_samples
+
+
+# shorter and longer segments than the utterance, with and without overlap
+@pytest.mark.parametrize("fold_len,fold_overlap", [(5, 2), (7, 0), (4, 4), (30, 3)])
+def test_unfolding_recovers_sequential_frames(monkeypatch, fold_len, fold_overlap):
+    model = wave_decoder()
+    monkeypatch.setattr(model, "_generate_samples", frame_samples(model))
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = model.generate(c)
+        x_fold = model.generate(c, fold_len=fold_len, fold_overlap=fold_overlap)
+    assert x_fold.shape == (B, T_FRM*UPSAMPLING_FACTOR)
+    # the crossfade of equal overlaps sums to the sequential samples
+    np.testing.assert_allclose(x_fold, x, rtol=0, atol=1e-12)
+
+
+def test_folded_segments_are_generated_from_their_conditioning(monkeypatch):
+    fold_len, fold_overlap = 6, 2
+    model = wave_decoder()
+    c = torch.randn(1, T_FRM, FEAT_DIM, dtype=torch.double)
+    segments = []
+    generate_samples = model._generate_samples
+
+    def batch_samples(c_fold, intervals=4000, tables=True, active=None):
+        segments.append(c_fold)
+        return generate_samples(c_fold, intervals, tables, active)
+
+    monkeypatch.setattr(model, "_generate_samples", batch_samples)
+    with torch.no_grad():
+        x_fold = model.generate(c, fold_len=fold_len, fold_overlap=fold_overlap)
+        c_fold = segments[0]
+        N = c_fold.shape[0]
+        assert N == (T_FRM + fold_len - 1) // fold_len
+        # each folded segment is generated as if it were alone in the batch
+        x_seg = torch.cat([generate_samples(c_fold[n:n+1]) for n in range(N)], 0)
+        c_full = model.conv_s_c(model.conv(model.scale_in(c.transpose(1,2)))).transpose(1,2)
+    np.testing.assert_array_equal(generate_samples(c_fold).numpy(), x_seg.numpy())
+    # conditioning of the whole utterance, windowed with replicated edges
+    c_pad = F.pad(c_full.transpose(1,2), (fold_overlap, N*fold_len+fold_overlap-T_FRM), "replicate").transpose(1,2)
+    for n in range(N):
+        torch.testing.assert_close(c_fold[n], c_pad[0,n*fold_len:n*fold_len+fold_len+2*fold_overlap])
+    # samples of the first segment after its warm-up are kept up to its crossfade
+    L = fold_len*UPSAMPLING_FACTOR
+    O = fold_overlap*UPSAMPLING_FACTOR
+    np.testing.assert_allclose(x_fold[0,:L], vcneuvoco.decode_mu_law(x_seg[0,O:L+O].numpy()), rtol=0, atol=1e-12)
+
+
+def test_crossfade_is_linear_from_each_segment_to_the_next(monkeypatch):
+    fold_len, fold_overlap = 5, 2
+    model = wave_decoder()
+    levels = [40, 200, 90, 160, 128]
+
+    def segment_levels(c_fold, intervals=4000, tables=True, active=None):
+        T = c_fold.shape[1]*model.upsampling_factor
+        return torch.LongTensor(levels[:c_fold.shape[0]]).unsqueeze(1).repeat(1, T)
+
+    monkeypatch.setattr(model, "_generate_samples", segment_levels)
+    with torch.no_grad():
+        x_fold = model.generate(torch.randn(1, T_FRM, FEAT_DIM, dtype=torch.double), fold_len=fold_len, \
+                    fold_overlap=fold_overlap)
+    x = vcneuvoco.decode_mu_law(np.array(levels))
+    L = fold_len*UPSAMPLING_FACTOR
+    O = fold_overlap*UPSAMPLING_FACTOR
+    fade_in = np.arange(O) / O
+    for n in range((T_FRM + fold_len - 1) // fold_len):
+        np.testing.assert_allclose(x_fold[0,n*L+O*(n>0):n*L+L], x[n], rtol=0, atol=1e-12)
+        if (n+1)*L < x_fold.shape[1]:
+            np.testing.assert_allclose(x_fold[0,(n+1)*L:(n+1)*L+O], x[n]*(1-fade_in) + x[n+1]*fade_in, rtol=0, \
+                atol=1e-12)
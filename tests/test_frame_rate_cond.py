@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+
+B = 2
+T_FRM = 6
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+LPC = 4
+
+
+def test_frame_rate_conditioning_matches_upsampled_path():
+    torch.manual_seed(0)
+    # the upsampled path is kept for dropout, which is the identity in eval mode
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, hidden_units=32, \
+                hidden_units_2=8, lpc=LPC, kernel_size=3, dilation_size=2, do_prob=0.5).double().eval()
+    T = T_FRM*UPSAMPLING_FACTOR
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    x_prev = torch.randint(model.n_quantize, (B, T))
+    x_lpc = torch.randint(model.n_quantize, (B, T+LPC-1))
+    h = torch.randn(1, B, 32, dtype=torch.double)
+    params = [param for param in model.parameters() if param.requires_grad]
+
+    outputs = {}
+    grads = {}
+    for do in [True, False]:
+        outputs[do] = model(c, x_prev, h=h, do=do, x_lpc=x_lpc)
+        grads[do] = torch.autograd.grad(outputs[do][0].sum(), params)
+    for output, output_upsampled in zip(outputs[False], outputs[True]):
+        assert_close(output, output_upsampled)
+    for grad, grad_upsampled in zip(grads[False], grads[True]):
+        assert_close(grad, grad_upsampled)
+
+
+def cond_seg_upsampled(model, c, first, shift):
+    """Segment conditioning of the upsampled tensor, as in the forward before frame-rate conditioning"""
+    c = torch.repeat_interleave(c.transpose(1,2), model.upsampling_factor, dim=-1)
+    if not first:
+        c = c[:,:,model.upsampling_factor-model.seg_1:].transpose(1,2)
+    else:
+        c = F.pad(c, (model.seg_1, 0), "replicate").transpose(1,2)
+    if shift < model.seg_1:
+        c = c[:,shift:c.shape[1]-model.seg_1+shift]
+    else:
+        c = c[:,shift:]
+    return c.unfold(1, model.seg, model.seg).permute(0,1,3,2).reshape(c.shape[0], -1, model.cond_dim_seg)
+
+
+# segments within one frame, and segments across frame boundaries
+@pytest.mark.parametrize("seg", [2, 4, 5])
+@pytest.mark.parametrize("first", [True, False])
+def test_segment_conditioning_matches_upsampled_path(seg, first):
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, \
+                hidden_units=32, hidden_units_2=8, lpc=LPC, kernel_size=3, dilation_size=2, seg=seg)
+    c = torch.randn(B, T_FRM, model.cond_dim)
+    T = T_FRM*UPSAMPLING_FACTOR
+    if first:
+        offset, T_seg = -model.seg_1, T // seg
+    else:
+        offset = UPSAMPLING_FACTOR-model.seg_1
+        T_seg = (T-offset-model.seg_1) // seg
+    for shift in range(seg):
+        cs = cond_seg_upsampled(model, c, first, shift)
+        assert cs.shape[1] == T_seg
+        assert torch.equal(model._cond_seg(c, offset+shift, T_seg), cs)
+    # unshifted segment grouping of validation
+    assert torch.equal(model._cond_seg(c, 0, T // seg), torch.repeat_interleave(c, UPSAMPLING_FACTOR, dim=1).unfold(1, \
+                seg, seg).permute(0,1,3,2).reshape(B, -1, model.cond_dim_seg))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER, EdgePaddedConv1d
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+from vcneuvoco import conv_stack_layers, copy_model, freeze_model
+
+B = 2
+T = 40
+N_SPK = 4
+
+
+def init_scale_in(model, seed=1):
+    """Normalization-like scale_in (non-trivial mean and scale) instead of the random init."""
+    torch.manual_seed(seed)
+    dim = model.scale_in.in_channels
+    with torch.no_grad():
+        scale = torch.rand(dim)+0.5
+        model.scale_in.weight.copy_(torch.diag(scale).unsqueeze(-1))
+        model.scale_in.bias.copy_(-torch.randn(dim)*scale)
+
+
+def frozen_pair(model):
+    model.eval()
+    model_frozen = freeze_model(copy_model(model))
+    # frozen checkpoint is loaded by freezing a newly defined model
+    model_loaded = freeze_model(copy_model(model))
+    model_loaded.load_state_dict(model_frozen.state_dict())
+    for param in list(model.parameters()) + list(model_loaded.parameters()):
+        param.requires_grad = False
+    return model_loaded
+
+
+VOCODERS = [
+    ("causal", dict(causal_conv=True)),
+    ("two-sided", dict(causal_conv=False)),
+    ("skewed", dict(right_size=2)),
+    ("nonlinear", dict(causal_conv=True, nonlinear_conv=True)),
+]
+
+
+@pytest.mark.parametrize("name,kwargs", VOCODERS)
+@pytest.mark.parametrize("model_class", [GRU_WAVE_DECODER_DUALGRU_COMPACT, GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG])
+def test_vocoder_padded_scale_in_is_folded(model_class, name, kwargs):
+    torch.manual_seed(0)
+    if model_class is GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG and "right_size" not in kwargs:
+        kwargs = dict(kwargs, right_size=0)
+    model = model_class(feat_dim=12, upsampling_factor=10, hidden_units=32, hidden_units_2=16, kernel_size=3, \
+                dilation_size=2, **kwargs)
+    init_scale_in(model)
+    model_frozen = frozen_pair(model)
+    assert isinstance(model_frozen.scale_in, torch.nn.Identity)
+    assert isinstance(conv_stack_layers(model_frozen.conv)[0], EdgePaddedConv1d)
+
+    c = torch.randn(B, T, model.in_dim)
+    run = lambda m: m.conv_s_c(m.conv(m.scale_in(c.transpose(1,2))))
+    with torch.no_grad():
+        # edge frames included
+        assert_close(run(model_frozen), run(model), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("pad_first", [True, False])
+def test_encoder_scale_in_is_folded(pad_first):
+    torch.manual_seed(0)
+    model = GRU_VAE_ENCODER(in_dim=12, n_spk=N_SPK, lat_dim=8, hidden_units=32, kernel_size=3, dilation_size=2, \
+                pad_first=pad_first)
+    init_scale_in(model)
+    model_frozen = frozen_pair(model)
+    assert isinstance(model_frozen.scale_in, torch.nn.Identity)
+    assert isinstance(conv_stack_layers(model_frozen.conv)[0], EdgePaddedConv1d) != pad_first
+
+    x = torch.randn(B, T+model.pad_left+model.pad_right, model.in_dim)
+    with torch.no_grad():
+        for output, output_frozen in zip(model(x, sampling=False), model_frozen(x, sampling=False)):
+            assert_close(output_frozen, output, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("pad_first", [True, False])
+def test_decoders_are_folded(pad_first):
+    torch.manual_seed(0)
+    model_mcep = GRU_SPEC_DECODER(feat_dim=8, out_dim=12, excit_dim=6, n_spk=N_SPK, hidden_units=32, \
+                    kernel_size=3, dilation_size=2, pad_first=pad_first)
+    model_excit = GRU_EXCIT_DECODER(feat_dim=8, cap_dim=3, n_spk=N_SPK, hidden_units=32, kernel_size=3, \
+                    dilation_size=2, pad_first=pad_first)
+    init_scale_in(model_mcep)
+    model_mcep_frozen = frozen_pair(model_mcep)
+    model_excit_frozen = frozen_pair(model_excit)
+    assert isinstance(model_mcep_frozen.scale_in, torch.nn.Identity)
+
+    n_frames = T+model_mcep.pad_left+model_mcep.pad_right
+    # time-varying speaker indices through the speaker table, and the concatenated one-hot path
+    y = torch.randint(N_SPK, (B, n_frames))
+    y_onehot = torch.nn.functional.one_hot(y, N_SPK).float()
+    z = torch.randn(B, n_frames, 8)
+    e = torch.randn(B, n_frames, 6)
+    with torch.no_grad():
+        for y_ in [y, y_onehot]:
+            for output, output_frozen in zip(model_mcep(y_, z, e=e), model_mcep_frozen(y_, z, e=e)):
+                assert_close(output_frozen, output, rtol=1e-5, atol=1e-5)
+            for output, output_frozen in zip(model_excit(y_, z), model_excit_frozen(y_, z)):
+                assert_close(output_frozen, output, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.testing import assert_close
+
+import vcneuvoco
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT, encode_mu_law, gru_cell
+
+B = 2
+T_FRM = 12
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+
+
+class ArgmaxSampling(object):
+    """Deterministic stand-in of OneHotCategorical, so that generated samples are a function of the network"""
+
+    def __init__(self, probs):
+        self.probs = probs
+
+    def sample(self):
+        return F.one_hot(self.probs.argmax(-1), self.probs.shape[-1]).to(self.probs.dtype)
+
+
+@pytest.fixture(autouse=True)
+def argmax_sampling(monkeypatch):
+    monkeypatch.setattr(vcneuvoco, "OneHotCategorical", ArgmaxSampling)
+
+
+def wave_decoder(lpc=4):
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, hidden_units=32, \
+                hidden_units_2=8, lpc=lpc, kernel_size=3, dilation_size=2).double().eval()
+    if lpc > 0:
+        # instead of the +-9 initialization, so that the samples do not just follow the previous ones
+        torch.nn.init.normal_(model.logits.weight)
+    return model
+
+
+def test_gru_cell_matches_nn_gru():
+    torch.manual_seed(0)
+    gru = torch.nn.GRU(5, 7, 1, batch_first=True).double()
+    x = torch.randn(3, 1, 5, dtype=torch.double)
+    h = torch.randn(1, 3, 7, dtype=torch.double)
+    _, h_ref = gru(x, h)
+    h_cell = gru_cell(F.linear(x[:,0], gru.weight_ih_l0, gru.bias_ih_l0), h[0], gru.weight_hh_l0, gru.bias_hh_l0)
+    assert_close(h_cell, h_ref[0])
+
+
+@pytest.mark.parametrize("lpc", [0, 4])
+def test_gate_tables_match_gru_input_matmul(lpc):
+    model = wave_decoder(lpc)
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = model.generate(c, tables=True)
+        x_matmul = model.generate(c, tables=False)
+    assert x.shape == (B, T_FRM*UPSAMPLING_FACTOR)
+    assert len(np.unique(x)) > 10
+    np.testing.assert_array_equal(x, x_matmul)
+
+
+def test_generated_samples_are_argmax_of_teacher_forced_forward():
+    K = 4
+    model = wave_decoder(K)
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = torch.from_numpy(encode_mu_law(model.generate(c, tables=True))).long()
+        # previous samples after the zero-level left padding of generation
+        x_buf = torch.cat((torch.full((B, K), model.n_quantize // 2, dtype=torch.long), x), 1)
+        T = x.shape[1]
+        logits = model(c, x_buf[:,K-1:K-1+T], x_lpc=x_buf[:,:T+K-1])[0]
+    assert torch.equal(logits.argmax(-1), x)
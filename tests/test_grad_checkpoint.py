@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, checkpoint_forward, copy_model
+
+B = 2
+T = 20
+N_SPK = 4
+IN_DIM = 8
+LAT_DIM = 5
+HIDDEN_UNITS = 16
+
+
+def models(do_prob=0.3):
+    torch.manual_seed(0)
+    model_encoder = GRU_VAE_ENCODER(in_dim=IN_DIM, n_spk=N_SPK, lat_dim=LAT_DIM, hidden_units=HIDDEN_UNITS, \
+                        kernel_size=3, dilation_size=2, do_prob=do_prob)
+    model_decoder = GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=IN_DIM, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, \
+                        kernel_size=3, dilation_size=2, do_prob=do_prob)
+    return model_encoder, model_decoder
+
+
+def cycle(model_encoder, model_decoder, x, y, h):
+    """Two half-cycles, the decoder output of the first is encoded by the second, with dropout"""
+    outputs = []
+    for i in range(2):
+        qy_logits, qz_alpha, h_enc = model_encoder(x, h=h, do=True)[:3]
+        z = qz_alpha[:,:,:LAT_DIM]
+        n_frames = z.shape[1]
+        x_rec, h_dec = model_decoder(y[:,:n_frames], z, do=True)[:2]
+        outputs += [qy_logits, qz_alpha, x_rec, h_enc, h_dec]
+        x = torch.cat((x_rec, x_rec[:,-1:].expand(-1, x.shape[1]-x_rec.shape[1], -1)), 1)
+    return outputs
+
+
+def test_checkpointed_half_cycles_match_plain_forward():
+    model_encoder, model_decoder = models()
+    model_encoder_ckpt = checkpoint_forward(copy_model(model_encoder))
+    model_decoder_ckpt = checkpoint_forward(copy_model(model_decoder))
+    torch.manual_seed(1)
+    x = torch.randn(B, T, IN_DIM)
+    y = torch.randint(N_SPK, (B, 1)).repeat(1, T)
+    # hidden state given as keyword argument, as in the trainers
+    h = torch.randn(1, B, HIDDEN_UNITS, requires_grad=True)
+    params = list(model_encoder.parameters()) + list(model_decoder.parameters())
+    params_ckpt = list(model_encoder_ckpt.parameters()) + list(model_decoder_ckpt.parameters())
+
+    torch.manual_seed(2)
+    outputs = cycle(model_encoder, model_decoder, x, y, h)
+    torch.manual_seed(2)
+    outputs_ckpt = cycle(model_encoder_ckpt, model_decoder_ckpt, x, y, h)
+    for output, output_ckpt in zip(outputs, outputs_ckpt):
+        assert_close(output_ckpt, output)
+
+    # dropout masks are reproduced in recomputation
+    loss = sum([output.sum() for output in outputs[:3]+outputs[5:8]])
+    loss_ckpt = sum([output.sum() for output in outputs_ckpt[:3]+outputs_ckpt[5:8]])
+    grads = torch.autograd.grad(loss, [h]+params, allow_unused=True)
+    grads_ckpt = torch.autograd.grad(loss_ckpt, [h]+params_ckpt, allow_unused=True)
+    for grad, grad_ckpt in zip(grads, grads_ckpt):
+        if grad is None:
+            assert grad_ckpt is None
+        else:
+            assert_close(grad_ckpt, grad)
+
+
+def test_checkpointed_forward_keeps_fewer_tensors():
+    model_encoder, model_decoder = models(do_prob=0)
+    model_encoder_ckpt = checkpoint_forward(copy_model(model_encoder))
+    model_decoder_ckpt = checkpoint_forward(copy_model(model_decoder))
+    x = torch.randn(B, T, IN_DIM)
+    y = torch.randint(N_SPK, (B, 1)).repeat(1, T)
+    n_saved = {}
+    for name, modules in [("plain", (model_encoder, model_decoder)), ("ckpt", (model_encoder_ckpt, model_decoder_ckpt))]:
+        saved = []
+        with torch.autograd.graph.saved_tensors_hooks(lambda t: saved.append(t.numel()) or t, lambda t: t):
+            cycle(*modules, x, y, None)
+        n_saved[name] = sum(saved)
+    assert n_saved["ckpt"] < n_saved["plain"] / 4
+
+
+def test_checkpointed_forward_without_grad_is_plain_forward():
+    model_encoder, _ = models()
+    model_encoder_ckpt = checkpoint_forward(copy_model(model_encoder).eval())
+    x = torch.randn(B, T, IN_DIM)
+    with torch.no_grad():
+        for output, output_ckpt in zip(model_encoder.eval()(x, sampling=False), model_encoder_ckpt(x, sampling=False)):
+            assert_close(output_ckpt, output)
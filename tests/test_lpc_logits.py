@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import LPCLogits, lpc_logits
+
+B = 2
+T = 12
+K = 3
+V = 8
+
+
+def dense_lpc_logits(lpc, x_lpc, weight):
+    """Data-driven LPC logits with the B x T x K x V embedding expansion, as before LPCLogits"""
+    return torch.sum(lpc.unsqueeze(-1)*weight[x_lpc], -2)
+
+
+def lpc_inputs(dtype=torch.float64):
+    torch.manual_seed(0)
+    lpc = torch.randn(B, T, K, dtype=dtype, requires_grad=True)
+    # few embedding rows, so that each is gathered by several samples
+    x_lpc = torch.randint(V, (B, T+K-1)).unfold(1, K, 1)
+    weight = torch.randn(V, V, dtype=dtype, requires_grad=True)
+    return lpc, x_lpc, weight
+
+
+# chunks dividing T, not dividing T, one step, and longer than T
+CHUNKS = [None, 1, 4, 5, 7, T, 2*T]
+
+
+@pytest.mark.parametrize("chunk", CHUNKS)
+def test_lpc_logits_match_dense(chunk):
+    lpc, x_lpc, weight = lpc_inputs()
+    out = lpc_logits(lpc, x_lpc, weight, chunk)
+    out_dense = dense_lpc_logits(lpc, x_lpc, weight)
+    assert_close(out, out_dense)
+
+    grad_out = torch.randn_like(out)
+    grads = torch.autograd.grad(out, (lpc, weight), grad_out)
+    grads_dense = torch.autograd.grad(out_dense, (lpc, weight), grad_out)
+    for grad, grad_dense in zip(grads, grads_dense):
+        assert_close(grad, grad_dense)
+
+
+@pytest.mark.parametrize("chunk", [4, 5])
+def test_lpc_logits_gradcheck(chunk):
+    lpc, x_lpc, weight = lpc_inputs()
+    assert torch.autograd.gradcheck(lambda lpc, weight: LPCLogits.apply(lpc, x_lpc, weight, chunk), (lpc, weight))
+    # embedding not trained
+    assert torch.autograd.gradcheck(lambda lpc: LPCLogits.apply(lpc, x_lpc, weight.detach(), chunk), (lpc,))
+
+
+def test_lpc_logits_float32_match_dense():
+    lpc, x_lpc, weight = lpc_inputs(torch.float32)
+    out = lpc_logits(lpc, x_lpc, weight, 5)
+    out_dense = dense_lpc_logits(lpc, x_lpc, weight)
+    assert_close(out, out_dense)
+    grads = torch.autograd.grad(out.sum(), (lpc, weight))
+    grads_dense = torch.autograd.grad(out_dense.sum(), (lpc, weight))
+    for grad, grad_dense in zip(grads, grads_dense):
+        assert_close(grad, grad_dense)
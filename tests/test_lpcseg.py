@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import vcneuvoco
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG, encode_mu_law
+
+B = 2
+T_FRM = 12
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+LPC = 4
+
+
+class ArgmaxSampling(object):
+    """Deterministic stand-in of OneHotCategorical, so that generated samples are a function of the network"""
+
+    def __init__(self, probs):
+        self.probs = probs
+
+    def sample(self):
+        return F.one_hot(self.probs.argmax(-1), self.probs.shape[-1]).to(self.probs.dtype)
+
+
+@pytest.fixture(autouse=True)
+def argmax_sampling(monkeypatch):
+    monkeypatch.setattr(vcneuvoco, "OneHotCategorical", ArgmaxSampling)
+
+
+def wave_decoder(seg, lpc=LPC):
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, \
+                hidden_units=32, hidden_units_2=8, lpc=lpc, kernel_size=3, dilation_size=2, seg=seg).double().eval()
+    if lpc > 0:
+        # instead of the +-9 initialization, so that the samples do not just follow the previous ones
+        torch.nn.init.normal_(model.logits.weight)
+    return model
+
+
+# segments within one frame, and segments across frame boundaries
+@pytest.mark.parametrize("seg", [2, 4, 5])
+def test_generated_samples_are_argmax_of_teacher_forced_forward(seg):
+    model = wave_decoder(seg)
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = torch.from_numpy(encode_mu_law(model.generate(c))).long()
+        assert x.shape == (B, T_FRM*UPSAMPLING_FACTOR)
+        # inputs of the unshifted segment grouping, as in the validation of the trainer
+        x_prev = F.pad(x[:,:-seg], (seg, 0), "constant", model.n_quantize // 2)
+        x_lpc = F.pad(x[:,:-1], (LPC, 0), "constant", model.n_quantize // 2).unfold(1, LPC, 1).unfold(1, seg, seg)
+        logits = model(c, x_prev, x_lpc=x_lpc.permute(0,1,3,2), shift1=False)[0]
+    assert len(np.unique(x.numpy())) > 10
+    assert torch.equal(logits.argmax(-1), x)
+
+
+def test_generated_samples_without_lpc_are_argmax_of_teacher_forced_forward():
+    seg = 2
+    model = wave_decoder(seg, lpc=0)
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = torch.from_numpy(encode_mu_law(model.generate(c))).long()
+        x_prev = F.pad(x[:,:-seg], (seg, 0), "constant", model.n_quantize // 2)
+        logits = model(c, x_prev, shift1=False)[0]
+    assert len(np.unique(x.numpy())) > 10
+    assert torch.equal(logits.argmax(-1), x)
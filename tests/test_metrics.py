@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+
+from metrics import MetricBatch, MetricStats, calc_metrics
+
+
+def utterance(rng, n_frames):
+    f0 = np.where(rng.rand(n_frames) > 0.3, 100+50*rng.rand(n_frames), 0)
+    f0_est = np.where(rng.rand(n_frames) > 0.3, f0+5*rng.randn(n_frames), 0)
+    return dict(mcep_ref=rng.randn(n_frames, 10), mcep_est=rng.randn(n_frames, 10), f0_ref=f0, f0_est=f0_est, \
+                codeap_ref=rng.randn(n_frames, 2), codeap_est=rng.randn(n_frames, 2), \
+                mcdpow_frames=rng.rand(n_frames), mcd_frames=rng.rand(n_frames), gv_est=rng.randn(n_frames, 10))
+
+
+def assert_same_stats(metric_stats, metric_stats_ref):
+    assert sorted(metric_stats.stats.keys()) == sorted(metric_stats_ref.stats.keys())
+    for group, group_stats in metric_stats_ref.stats.items():
+        assert sorted(metric_stats.stats[group].keys()) == sorted(group_stats.keys())
+        for spk, stats in group_stats.items():
+            assert sorted(metric_stats.stats[group][spk].keys()) == sorted(stats.keys())
+            for name, (count, sum_, sum2) in stats.items():
+                assert metric_stats.stats[group][spk][name][0] == count
+                np.testing.assert_allclose(metric_stats.stats[group][spk][name][1], sum_, rtol=1e-10)
+                np.testing.assert_allclose(metric_stats.stats[group][spk][name][2], sum2, rtol=1e-10)
+
+
+def test_metric_batch_matches_per_utterance_metrics():
+    rng = np.random.RandomState(0)
+    groups = {
+        "src_cv": ["mcep_ref", "mcep_est"],
+        "cyc_cv": ["f0_ref", "f0_est", "codeap_ref", "codeap_est"],
+        "cv": ["mcdpow_frames", "mcd_frames"],
+    }
+    metric_stats_ref = MetricStats()
+    metric_stats = MetricStats()
+    # scored in batches of 3 utterances, and the remaining one at flush
+    metric_batch = MetricBatch(metric_stats, max_utts=3)
+    for i in range(7):
+        utt = utterance(rng, rng.randint(20, 60))
+        spk = ["SF1", "TM1"][i % 2]
+        for group, names in groups.items():
+            trajectories = {name: utt[name] for name in names}
+            lat_dist = {"lat_dist_rmse": rng.rand()} if group == "cv" else None
+            metrics = calc_metrics(**{name: [trajectory] for name, trajectory in trajectories.items()})
+            if lat_dist is not None:
+                metrics.update(lat_dist)
+            metric_stats_ref.add(group, metrics, spk)
+            metric_batch.append(group, "utt%d" % i, spk, metrics=lat_dist, **trajectories)
+        # another set of arguments in the same group
+        metric_stats_ref.add("cv", calc_metrics(gv_est=[utt["gv_est"]]), spk)
+        metric_batch.append("cv", "utt%d" % i, spk, gv_est=utt["gv_est"])
+    metric_batch.flush()
+    assert metric_batch.batches == {}
+    assert_same_stats(metric_stats, metric_stats_ref)
+    assert metric_stats.count("cv", "lat_dist_rmse") == 7
+    assert metric_stats.count("cv", "gv", spk="SF1") == 4
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, MixedPrecision, copy_model
+
+B = 2
+T = 20
+N_SPK = 4
+IN_DIM = 8
+LAT_DIM = 5
+HIDDEN_UNITS = 32
+
+
+def models():
+    torch.manual_seed(0)
+    model_encoder = GRU_VAE_ENCODER(in_dim=IN_DIM, n_spk=N_SPK, lat_dim=LAT_DIM, hidden_units=HIDDEN_UNITS, \
+                        kernel_size=3, dilation_size=2)
+    model_decoder = GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=IN_DIM, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, \
+                        kernel_size=3, dilation_size=2)
+    return model_encoder, model_decoder
+
+
+def half_cycle(model_encoder, model_decoder, x, y):
+    qy_logits, qz_alpha = model_encoder(x, sampling=False)[:2]
+    x_rec = model_decoder(y[:,:qz_alpha.shape[1]], qz_alpha[:,:,:LAT_DIM])[0]
+    return qy_logits, qz_alpha, x_rec
+
+
+def inputs():
+    torch.manual_seed(1)
+    x = torch.randn(B, T, IN_DIM)
+    y = torch.randint(N_SPK, (B, 1)).repeat(1, T)
+    return x, y
+
+
+def test_fp32_keeps_plain_training_step():
+    model_encoder, model_decoder = models()
+    model_encoder_ref, model_decoder_ref = copy_model(model_encoder), copy_model(model_decoder)
+    amp = MixedPrecision("fp32", torch.device("cpu"))
+    assert amp.apply(model_encoder) is model_encoder
+    assert amp.apply(model_decoder) is model_decoder
+    # forward is not wrapped
+    assert "forward" not in vars(model_encoder) and "forward" not in vars(model_decoder)
+    assert amp.scaler is None
+
+    x, y = inputs()
+    params = list(model_encoder.parameters()) + list(model_decoder.parameters())
+    params_ref = list(model_encoder_ref.parameters()) + list(model_decoder_ref.parameters())
+    optimizer = torch.optim.SGD(params, lr=0.1)
+    optimizer_ref = torch.optim.SGD(params_ref, lr=0.1)
+    amp.backward(half_cycle(model_encoder, model_decoder, x, y)[2].abs().mean())
+    amp.unscale(optimizer)
+    amp.step(optimizer)
+    half_cycle(model_encoder_ref, model_decoder_ref, x, y)[2].abs().mean().backward()
+    optimizer_ref.step()
+    for param, param_ref in zip(params, params_ref):
+        assert torch.equal(param, param_ref)
+
+
+def test_bf16_outputs_are_float32_and_close_to_fp32():
+    model_encoder, model_decoder = models()
+    amp = MixedPrecision("bf16", torch.device("cpu"))
+    model_encoder_amp = amp.apply(copy_model(model_encoder))
+    model_decoder_amp = amp.apply(copy_model(model_decoder))
+    x, y = inputs()
+    params = list(model_encoder.parameters()) + list(model_decoder.parameters())
+    params_amp = list(model_encoder_amp.parameters()) + list(model_decoder_amp.parameters())
+
+    outputs = half_cycle(model_encoder, model_decoder, x, y)
+    outputs_amp = half_cycle(model_encoder_amp, model_decoder_amp, x, y)
+    # forward is run in bfloat16
+    assert not torch.equal(outputs_amp[2], outputs[2])
+    for output, output_amp in zip(outputs, outputs_amp):
+        # losses are computed outside autocast in float32
+        assert output_amp.dtype == torch.float32
+        assert_close(output_amp, output, rtol=0.05, atol=0.05)
+
+    grads = torch.autograd.grad(outputs[2].abs().mean(), params)
+    grads_amp = torch.autograd.grad(outputs_amp[2].abs().mean(), params_amp)
+    for grad, grad_amp in zip(grads, grads_amp):
+        assert grad_amp.dtype == torch.float32
+        assert torch.isfinite(grad_amp).all()
+        assert (grad_amp-grad).norm() <= 0.1*grad.norm() + 1e-4
+
+
+def test_fp16_on_cpu_exits():
+    with pytest.raises(SystemExit):
+        MixedPrecision("fp16", torch.device("cpu"))
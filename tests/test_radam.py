@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import io
+
+import pytest
+import torch
+from torch import nn
+from torch.testing import assert_close
+
+from radam import RAdam
+
+N_STEPS = 10
+
+
+def define_params():
+    torch.manual_seed(0)
+    model = nn.ModuleDict({
+        "conv": nn.Conv1d(8, 16, 3),
+        "gru": nn.GRU(16, 16, batch_first=True),
+        "out": nn.Linear(16, 4),
+        "spk": nn.Embedding(6, 4),
+    })
+    nn.utils.weight_norm(model["conv"])
+    # non-float32 parameters are updated by the per-parameter loop in both
+    model["scale"] = nn.Linear(4, 4).double()
+    return list(model.parameters())
+
+
+def optimizer_pair(weight_decay):
+    params = define_params()
+    params_foreach = [nn.Parameter(p.detach().clone()) for p in params]
+    optimizer = RAdam(params, lr=1e-2, weight_decay=weight_decay, foreach=False)
+    optimizer_foreach = RAdam(params_foreach, lr=1e-2, weight_decay=weight_decay, foreach=True)
+    assert optimizer_foreach.foreach
+    return (params, optimizer), (params_foreach, optimizer_foreach)
+
+
+def step_both(pairs, step_idx):
+    (params, optimizer), (params_foreach, optimizer_foreach) = pairs
+    torch.manual_seed(step_idx)
+    for i, (p, p_foreach) in enumerate(zip(params, params_foreach)):
+        # some parameters without grad in the first steps, so that their steps lag behind in later buckets
+        if i % 3 == 1 and step_idx < 3 + i % 4:
+            p.grad = None
+            p_foreach.grad = None
+        else:
+            p.grad = torch.randn_like(p)
+            p_foreach.grad = p.grad.clone()
+    optimizer.step()
+    optimizer_foreach.step()
+
+
+def assert_same_state(pairs, check_dtype=True):
+    (params, optimizer), (params_foreach, optimizer_foreach) = pairs
+    steps = set()
+    for p, p_foreach in zip(params, params_foreach):
+        assert_close(p_foreach, p)
+        state, state_foreach = optimizer.state[p], optimizer_foreach.state[p_foreach]
+        assert sorted(state_foreach.keys()) == sorted(state.keys())
+        if len(state) == 0:
+            continue
+        assert state_foreach["step"] == state["step"]
+        steps.add(state["step"])
+        for key in ["exp_avg", "exp_avg_sq"]:
+            assert_close(state_foreach[key], state[key], check_dtype=check_dtype)
+    return steps
+
+
+@pytest.mark.parametrize("weight_decay", [0, 1e-2])
+def test_foreach_matches_per_parameter_loop(weight_decay):
+    pairs = optimizer_pair(weight_decay)
+    for step_idx in range(N_STEPS):
+        step_both(pairs, step_idx)
+        steps = assert_same_state(pairs)
+    # buckets of several steps, through both the un-rectified (N_sma < 5) and the rectified updates
+    assert len(steps) > 1
+    assert min(steps) < 5 < max(steps)
+
+
+def test_resume_from_per_parameter_loop_checkpoint():
+    # the state of the per-parameter loop is that of the earlier RAdam (step, exp_avg, exp_avg_sq)
+    pairs = optimizer_pair(1e-2)
+    for step_idx in range(4):
+        step_both(pairs, step_idx)
+    (params, optimizer), (params_foreach, optimizer_foreach) = pairs
+    buffer = io.BytesIO()
+    torch.save(optimizer.state_dict(), buffer)
+    buffer.seek(0)
+    state_dict = torch.load(buffer)
+    assert sorted(state_dict["state"][0].keys()) == ["exp_avg", "exp_avg_sq", "step"]
+
+    params_foreach = [nn.Parameter(p.detach().clone()) for p in params]
+    optimizer_foreach = RAdam(params_foreach, lr=1e-2, weight_decay=1e-2, foreach=True)
+    optimizer_foreach.load_state_dict(state_dict)
+    pairs = (params, optimizer), (params_foreach, optimizer_foreach)
+    # loaded state is cast to the parameter dtype, float32 state of non-float32 parameters again at their next step
+    assert_same_state(pairs, check_dtype=False)
+    for step_idx in range(4, N_STEPS):
+        step_both(pairs, step_idx)
+        assert_same_state(pairs)
+    assert_close(optimizer_foreach.state_dict()["state"], optimizer.state_dict()["state"])
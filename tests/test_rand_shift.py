@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG
+
+B = 2
+T_FRM = 6
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+LPC = 4
+HIDDEN_UNITS = 32
+HIDDEN_UNITS_2 = 8
+
+
+def chunk_inputs(model, first):
+    """Inputs of a chunk as built by the trainer, the previous frame is included in the later chunks"""
+    torch.manual_seed(1)
+    c = torch.randn(B, T_FRM, FEAT_DIM, dtype=torch.double)
+    T = T_FRM*UPSAMPLING_FACTOR
+    if first:
+        T_seg = T // model.seg
+    else:
+        T_seg = (T-UPSAMPLING_FACTOR) // model.seg
+    x_prev = torch.randint(model.n_quantize, (B, T_seg*model.seg+model.seg_1))
+    x_lpc = torch.randint(model.n_quantize, (B, T_seg*model.seg+model.lpc_offset-1))
+    return c, x_prev, x_lpc
+
+
+def shift_x_lpc(model, x_lpc, shifts):
+    # B x T --> B x T x K --> B x T_seg x K x seg --> B x T_seg x seg x K, as in the trainer
+    return torch.cat([x_lpc[:,i:x_lpc.shape[1]-model.seg_1+i].unfold(1, model.lpc, 1).unfold(1, model.seg, \
+                model.seg).permute(0,1,3,2) for i in shifts], 0)
+
+
+@pytest.mark.parametrize("seg", [2, 4])
+@pytest.mark.parametrize("first", [True, False])
+def test_single_shift_grouping_matches_its_block_of_all_groupings(seg, first):
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT_LPCSEG(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, \
+                hidden_units=HIDDEN_UNITS, hidden_units_2=HIDDEN_UNITS_2, lpc=LPC, kernel_size=3, dilation_size=2, \
+                seg=seg).double()
+    c, x_prev, x_lpc = chunk_inputs(model, first)
+    # hidden states of each grouping carried over from the previous chunk
+    h = None if first else torch.randn(1, seg*B, HIDDEN_UNITS, dtype=torch.double)
+    h_2 = None if first else torch.randn(1, seg*B, HIDDEN_UNITS_2, dtype=torch.double)
+
+    out, h_out, h_2_out = model(c, x_prev, h=h, h_2=h_2, x_lpc=shift_x_lpc(model, x_lpc, range(seg)), first=first)
+    params = [param for param in model.parameters() if param.requires_grad]
+    for i in range(seg):
+        idx = slice(i*B, (i+1)*B)
+        out_i, h_out_i, h_2_out_i = model(c, x_prev, h=None if first else h[:,idx], h_2=None if first else h_2[:,idx], \
+                                        x_lpc=shift_x_lpc(model, x_lpc, [i]), first=first, shifts=[i])
+        assert_close(out_i, out[idx])
+        assert_close(h_out_i, h_out[:,idx])
+        assert_close(h_2_out_i, h_2_out[:,idx])
+        # the gradients of a grouping are those of its block of the stacked batch
+        grads_i = torch.autograd.grad(out_i.sum(), params)
+        grads = torch.autograd.grad(out[idx].sum(), params, retain_graph=True)
+        for grad, grad_i in zip(grads, grads_i):
+            assert_close(grad_i, grad)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+import vcneuvoco
+from vcneuvoco import DSWNV, GRU_WAVE_DECODER_DUALGRU_COMPACT, active_sample_mask, decode_mu_law
+
+T_FRM = 16
+FEAT_DIM = 6
+UPSAMPLING_FACTOR = 10
+WARMUP = 15
+
+# silence at the start, in the middle, and at the end
+SPC_MASK = np.array([[0]*3 + [1]*5 + [0]*3 + [1]*4 + [0],
+                     [1]*16])
+
+
+class ArgmaxSampling(object):
+    """Deterministic stand-in of OneHotCategorical, so that generated samples are a function of the network"""
+
+    def __init__(self, probs):
+        self.probs = probs
+
+    def sample(self):
+        return F.one_hot(self.probs.argmax(-1), self.probs.shape[-1]).to(self.probs.dtype)
+
+
+@pytest.fixture(autouse=True)
+def argmax_sampling(monkeypatch):
+    monkeypatch.setattr(vcneuvoco, "OneHotCategorical", ArgmaxSampling)
+    monkeypatch.setattr(torch.distributions, "OneHotCategorical", ArgmaxSampling)
+
+
+def wave_decoder():
+    torch.manual_seed(0)
+    model = GRU_WAVE_DECODER_DUALGRU_COMPACT(feat_dim=FEAT_DIM, upsampling_factor=UPSAMPLING_FACTOR, hidden_units=32, \
+                hidden_units_2=8, lpc=4, kernel_size=3, dilation_size=2).double().eval()
+    torch.nn.init.normal_(model.logits.weight)
+    return model
+
+
+def active_sample_mask_loop(spc_mask, upsampling_factor, warmup):
+    """Per-utterance mask by its definition, speech samples and warmup samples before them"""
+    speech = np.repeat(np.asarray(spc_mask) > 0, upsampling_factor, axis=1)
+    active = np.zeros_like(speech)
+    for b in range(speech.shape[0]):
+        for t in range(speech.shape[1]):
+            active[b,t] = np.any(speech[b,t:t+warmup+1])
+    return active
+
+
+@pytest.mark.parametrize("warmup", [0, 1, WARMUP, 100])
+def test_active_sample_mask(warmup):
+    active = active_sample_mask(SPC_MASK, UPSAMPLING_FACTOR, warmup, per_utt=True)
+    np.testing.assert_array_equal(active, active_sample_mask_loop(SPC_MASK, UPSAMPLING_FACTOR, warmup))
+    np.testing.assert_array_equal(active_sample_mask(SPC_MASK, UPSAMPLING_FACTOR, warmup), np.any(active, axis=0))
+
+
+def test_all_speech_mask_matches_full_generation():
+    model = wave_decoder()
+    c = torch.randn(2, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = model.generate(c)
+        x_mask = model.generate(c, spc_mask=np.ones((2, T_FRM)), warmup=WARMUP)
+        x_fold = model.generate(c, fold_len=6, fold_overlap=2)
+        x_fold_mask = model.generate(c, fold_len=6, fold_overlap=2, spc_mask=np.ones((2, T_FRM)), warmup=WARMUP)
+    np.testing.assert_array_equal(x_mask, x)
+    np.testing.assert_array_equal(x_fold_mask, x_fold)
+
+
+@pytest.mark.parametrize("tables", [True, False])
+def test_silence_is_skipped_per_utterance(tables):
+    model = wave_decoder()
+    c = torch.randn(2, T_FRM, FEAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        x = model.generate(c, tables=tables, spc_mask=SPC_MASK, warmup=WARMUP)
+        # each utterance alone
+        x_0 = model.generate(c[:1], tables=tables, spc_mask=SPC_MASK[:1], warmup=WARMUP)
+        x_1 = model.generate(c[1:], tables=tables)
+    np.testing.assert_array_equal(x[:1], x_0)
+    np.testing.assert_array_equal(x[1:], x_1)
+    active = active_sample_mask(SPC_MASK, UPSAMPLING_FACTOR, WARMUP, per_utt=True)
+    np.testing.assert_array_equal(x[~active], decode_mu_law(model.n_quantize // 2))
+    assert len(np.unique(x[0,active[0]])) > 10
+
+
+def test_wavenet_silence_is_zero_level():
+    torch.manual_seed(0)
+    model = DSWNV(n_aux=FEAT_DIM, hid_chn=8, skip_chn=8, dilation_depth=2, dilation_repeat=1, kernel_size=2, \
+                upsampling_factor=UPSAMPLING_FACTOR, use_weight_norm=False).eval()
+    # instead of the initialization, so that the argmax samples are not constant
+    for param in model.parameters():
+        torch.nn.init.normal_(param)
+    aux = torch.randn(2, T_FRM, FEAT_DIM)
+    x_prev = torch.LongTensor(2, 1).fill_(model.n_quantize // 2)
+    n_samples_list = [T_FRM*UPSAMPLING_FACTOR]*2
+    x = np.stack(model.batch_fast_generate(x_prev, aux, n_samples_list))
+    x_mask = np.stack(model.batch_fast_generate(x_prev, aux, n_samples_list, spc_mask=np.ones((2, T_FRM)), \
+                        warmup=WARMUP))
+    np.testing.assert_array_equal(x_mask, x)
+    x_skip = np.stack(model.batch_fast_generate(x_prev, aux, n_samples_list, spc_mask=SPC_MASK, warmup=WARMUP))
+    active = active_sample_mask(SPC_MASK, UPSAMPLING_FACTOR, WARMUP, per_utt=True)
+    assert np.all(x_skip[~active] == model.n_quantize // 2)
+    # the utterance without silence is unaffected by the silence of the other one
+    np.testing.assert_array_equal(x_skip[1], x[1])
+    assert len(np.unique(x_skip[0,active[0]])) > 10
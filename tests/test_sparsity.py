@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import torch
+from torch import nn
+
+from vcneuvoco import BlockSparsity, gru_recurrent_weights
+
+
+def counting_sparsity(weights):
+    sparsity = BlockSparsity(weights)
+    sparsity.n_update = 0
+    update = sparsity.update
+
+    def counted_update(*args, **kwargs):
+        sparsity.n_update += 1
+        update(*args, **kwargs)
+
+    sparsity.update = counted_update
+    return sparsity
+
+
+def test_masks_after_t_end_are_computed_once():
+    torch.manual_seed(0)
+    gru = nn.GRU(32, 32, batch_first=True)
+    sparsity = counting_sparsity({"gru": gru.weight_hh_l0})
+    densities = {"gru": [0.5, 0.5, 0.5]}
+    for iter_idx in range(1, 41):
+        sparsity.step(iter_idx, 10, 20, 5, densities)
+    # schedule points 10 and 15, and the final masks at 20
+    assert sparsity.n_update == 3
+    masks = {name: mask.clone() for name, mask in sparsity.masks.items()}
+
+    # pruned weights drifting back after an update are zeroed by the cached masks
+    with torch.no_grad():
+        gru.weight_hh_l0.add_(1)
+    sparsity.step(41, 10, 20, 5, densities)
+    assert sparsity.n_update == 3
+    assert torch.equal(gru.weight_hh_l0 == 0, masks["gru"] == 0)
+
+    # schedule points 45, 50, 55, and the final masks of the next stage once at its t_end
+    for iter_idx in range(42, 80):
+        sparsity.step(iter_idx, 40, 60, 5, densities, densities_p=densities)
+    assert sparsity.n_update == 3 + 3 + 1
+
+
+def test_weight_normed_masks():
+    torch.manual_seed(0)
+    gru = nn.GRU(32, 32, batch_first=True)
+    nn.utils.weight_norm(gru, name="weight_hh_l0")
+    sparsity = BlockSparsity(gru_recurrent_weights({"model": nn.ModuleDict({"gru": gru})}))
+    sparsity.step(20, 10, 20, 5, {"model.gru.weight_hh_l0": [0.25, 0.25, 0.25]})
+    mask = sparsity.masks["model.gru.weight_hh_l0"]
+    weight = torch._weight_norm(gru.weight_hh_l0_v, gru.weight_hh_l0_g, 0)
+    assert torch.equal(weight == 0, mask == 0)
+    # diagonal of each gate block is kept
+    for k in range(3):
+        assert torch.all(torch.diag(mask[k*32:(k+1)*32]) == 1)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_VAE_ENCODER, GRU_SPEC_DECODER, GRU_EXCIT_DECODER
+
+T = 30
+N_SPK = 4
+MCEP_DIM = 8
+LAT_DIM = 5
+SPKIDTR_DIM = 2
+HIDDEN_UNITS = 16
+N_DELTA = 5
+
+
+def models(ar):
+    """Models of the interpolated spk-code decoding of decode_gru-cycle-mceplf0capvae-vq.py"""
+    torch.manual_seed(0)
+    model_decoder_mcep = GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=MCEP_DIM, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, \
+                            kernel_size=3, dilation_size=2, spkidtr_dim=SPKIDTR_DIM, pad_first=True, ar=ar)
+    model_decoder_excit = GRU_EXCIT_DECODER(feat_dim=LAT_DIM, cap_dim=3, n_spk=N_SPK, hidden_units=HIDDEN_UNITS, \
+                            kernel_size=3, dilation_size=2, spkidtr_dim=SPKIDTR_DIM, pad_first=True, ar=ar)
+    in_dim = MCEP_DIM+model_decoder_excit.out_dim
+    model_encoder_mcep = GRU_VAE_ENCODER(in_dim=in_dim, n_spk=N_SPK, lat_dim=LAT_DIM, hidden_units=HIDDEN_UNITS, \
+                            kernel_size=3, dilation_size=2, cont=False, pad_first=True, ar=ar)
+    model_encoder_excit = GRU_VAE_ENCODER(in_dim=in_dim, n_spk=N_SPK, lat_dim=LAT_DIM, hidden_units=HIDDEN_UNITS, \
+                            kernel_size=3, dilation_size=2, cont=False, pad_first=True, ar=ar)
+    return [model.double().eval() for model in \
+                [model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit]]
+
+
+def sweep(model_encoder_mcep, model_decoder_mcep, model_encoder_excit, model_decoder_excit, cv_code, cv_e_code, \
+        lat_src, lat_src_e, ar):
+    """Decoding and speaker-posterior re-encoding of the interpolated spk-codes (n_delta x T x C) at once"""
+    n_delta = cv_code.shape[0]
+    if ar:
+        x_in = torch.zeros(1, 1, MCEP_DIM, dtype=torch.double)
+        e_in = torch.zeros(1, 1, model_decoder_excit.out_dim, dtype=torch.double)
+        yz_in = torch.zeros(1, 1, N_SPK+LAT_DIM, dtype=torch.double)
+        cvmcep = model_decoder_mcep(cv_code, lat_src.expand(n_delta,-1,-1), x_in=x_in.expand(n_delta,-1,-1))[0]
+        cvlf0 = model_decoder_excit(cv_e_code, lat_src_e.expand(n_delta,-1,-1), e_in=e_in.expand(n_delta,-1,-1))[0]
+        spk_logits, lat_cv = model_encoder_mcep(torch.cat((cvlf0, cvmcep), 2), yz_in=yz_in.expand(n_delta,-1,-1))[:2]
+        spk_logits_e, lat_cv_e = model_encoder_excit(torch.cat((cvlf0, cvmcep), 2), yz_in=yz_in.expand(n_delta,-1,-1))[:2]
+    else:
+        cvmcep = model_decoder_mcep(cv_code, lat_src.expand(n_delta,-1,-1))[0]
+        cvlf0 = model_decoder_excit(cv_e_code, lat_src_e.expand(n_delta,-1,-1))[0]
+        spk_logits, lat_cv = model_encoder_mcep(torch.cat((cvlf0, cvmcep), 2))[:2]
+        spk_logits_e, lat_cv_e = model_encoder_excit(torch.cat((cvlf0, cvmcep), 2))[:2]
+    return cvmcep, cvlf0, spk_logits, lat_cv, spk_logits_e, lat_cv_e
+
+
+@pytest.mark.parametrize("ar", [False, True])
+def test_batched_interpolation_sweep_matches_loop_over_deltas(ar):
+    models_ = models(ar)
+    model_decoder_mcep, model_decoder_excit = models_[1], models_[3]
+    torch.manual_seed(1)
+    lat_src = torch.randn(1, T, LAT_DIM, dtype=torch.double)
+    lat_src_e = torch.randn(1, T, LAT_DIM, dtype=torch.double)
+    with torch.no_grad():
+        # continuous spk-codes of source and target speakers, as in the decoding
+        spk_onehot = torch.eye(N_SPK, dtype=torch.double).unsqueeze(0).transpose(1,2) # 1 x n_spk x n_spk
+        z = model_decoder_mcep.spkidtr_conv(spk_onehot).transpose(1,2) # 1 x n_spk x C
+        z_e = model_decoder_excit.spkidtr_conv(spk_onehot).transpose(1,2)
+        z_src, z_trg = z[:,0:1], z[:,2:3] # 1 x 1 x C
+        z_e_src, z_e_trg = z_e[:,0:1], z_e[:,2:3]
+        delta_z = (z_trg - z_src)/N_DELTA
+        delta_z_e = (z_e_trg - z_e_src)/N_DELTA
+
+        n_steps = torch.arange(1, N_DELTA+1).double().unsqueeze(-1).unsqueeze(-1) # n_delta x 1 x 1
+        cv_code = torch.repeat_interleave((n_steps*delta_z)+z_src, T, dim=1) # n_delta x T x C
+        cv_e_code = torch.repeat_interleave((n_steps*delta_z_e)+z_e_src, T, dim=1)
+        outputs = sweep(*models_, cv_code, cv_e_code, lat_src, lat_src_e, ar)
+        # decoding of each delta separately, as before the batched sweep
+        for i in range(N_DELTA):
+            cv_code_i = torch.repeat_interleave(((i+1)*delta_z)+z_src, T, dim=1)
+            cv_e_code_i = torch.repeat_interleave(((i+1)*delta_z_e)+z_e_src, T, dim=1)
+            assert_close(cv_code[i:i+1], cv_code_i)
+            outputs_i = sweep(*models_, cv_code_i, cv_e_code_i, lat_src, lat_src_e, ar)
+            for output, output_i in zip(outputs, outputs_i):
+                assert_close(output[i:i+1], output_i)
+    # last delta is the target spk-code
+    assert_close(cv_code[-1:,:1], z_trg)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.testing import assert_close
+
+from vcneuvoco import GRU_SPEC_DECODER, GRU_EXCIT_DECODER
+
+B = 2
+T = 20
+N_SPK = 6
+LAT_DIM = 5
+EXCIT_DIM = 4
+
+
+def decoder(name, **kwargs):
+    torch.manual_seed(0)
+    if name == "spec-excit":
+        return GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=8, n_spk=N_SPK, hidden_units=16, kernel_size=3, \
+                    dilation_size=2, excit_dim=EXCIT_DIM, **kwargs)
+    if name == "spec":
+        return GRU_SPEC_DECODER(feat_dim=LAT_DIM, out_dim=8, n_spk=N_SPK, hidden_units=16, kernel_size=3, \
+                    dilation_size=2, **kwargs)
+    return GRU_EXCIT_DECODER(feat_dim=LAT_DIM, n_spk=N_SPK, hidden_units=16, kernel_size=3, dilation_size=2, \
+                cap_dim=3, **kwargs)
+
+
+def onehot_code(model, spk):
+    """Continuous speaker code of the concatenated path, as before the speaker table"""
+    spk_code = F.one_hot(spk, num_classes=N_SPK).float()
+    if model.spkidtr_dim > 0:
+        spk_code = model.spkidtr_conv(spk_code.transpose(1,2)).transpose(1,2)
+    return spk_code
+
+
+def decoder_inputs(name, model):
+    torch.manual_seed(1)
+    n_frames = T+model.pad_left+model.pad_right
+    # speaker changes within the utterances
+    spk = torch.randint(N_SPK, (B, 1)).repeat(1, n_frames)
+    spk[0, n_frames//2:] = (spk[0, 0] + 1) % N_SPK
+    lat = torch.randn(B, n_frames, LAT_DIM)
+    kwargs = {"e": torch.randn(B, n_frames, EXCIT_DIM)} if name == "spec-excit" else {}
+    return spk, lat, kwargs
+
+
+VARIANTS = [
+    dict(),
+    dict(spkidtr_dim=2),
+    dict(causal_conv=True),
+    dict(causal_conv=True, spkidtr_dim=2),
+    dict(pad_first=False),
+    dict(causal_conv=True, pad_first=False),
+    dict(use_weight_norm=False),
+]
+
+
+@pytest.mark.parametrize("name", ["spec-excit", "spec", "excit"])
+@pytest.mark.parametrize("kwargs", VARIANTS)
+def test_precomputed_table_matches_onehot_input(name, kwargs):
+    model = decoder(name, **kwargs).eval()
+    spk, lat, e = decoder_inputs(name, model)
+    with torch.no_grad():
+        outputs = model(onehot_code(model, spk), lat, **e)
+        outputs_table = model(spk, lat, **e)
+        model.precompute_spk_table()
+        outputs_precomputed = model(spk, lat, **e)
+    for output, output_table, output_precomputed in zip(outputs, outputs_table, outputs_precomputed):
+        assert_close(output_table, output, rtol=1e-5, atol=1e-5)
+        assert_close(output_precomputed, output_table)
+
+
+@pytest.mark.parametrize("name", ["spec-excit", "excit"])
+@pytest.mark.parametrize("kwargs", [dict(), dict(spkidtr_dim=2), dict(causal_conv=True, pad_first=False)])
+def test_training_table_grads_match_onehot_input(name, kwargs):
+    model = decoder(name, **kwargs).train()
+    # not used in training
+    model.precompute_spk_table()
+    spk, lat, e = decoder_inputs(name, model)
+    params = [param for param in model.parameters() if param.requires_grad]
+
+    out = model(onehot_code(model, spk), lat, **e)[0]
+    grads = torch.autograd.grad(out.sum(), params, allow_unused=True)
+    out_table = model(spk, lat, **e)[0]
+    grads_table = torch.autograd.grad(out_table.sum(), params, allow_unused=True)
+    assert_close(out_table, out, rtol=1e-5, atol=1e-5)
+    for grad, grad_table in zip(grads, grads_table):
+        if grad is None:
+            assert grad_table is None
+        else:
+            assert_close(grad_table, grad, rtol=1e-4, atol=1e-4)
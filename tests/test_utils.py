@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Patrick Lumban Tobing (Nagoya University)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+import os
+
+import h5py
+import numpy as np
+
+from utils import HDF5Writer, IndexedFeatureReader, merge_shards, read_hdf5, read_index, write_shard
+
+
+def write_feat(hdf5_name, feat):
+    with HDF5Writer(hdf5_name) as f:
+        f.write("/feat_org_lf0", feat)
+
+
+def test_hdf5_storage_and_read_dtype(tmp_path):
+    hdf5_name = str(tmp_path / "a.h5")
+    feat = np.random.randn(100, 8)
+    with HDF5Writer(hdf5_name, chunk_frames=32, compression="gzip") as f:
+        f.write("/feat", feat)
+        f.write("/idx", np.arange(10))
+    with h5py.File(hdf5_name, "r") as f:
+        assert f["/feat"].dtype == np.float32
+        assert f["/idx"].dtype == np.arange(10).dtype
+    # double buffers for pyworld/pysptk
+    assert read_hdf5(hdf5_name, "/feat").dtype == np.float64
+    np.testing.assert_allclose(read_hdf5(hdf5_name, "/feat"), feat.astype(np.float32))
+
+
+def test_merge_shards_keeps_float32_and_index(tmp_path):
+    feat_dir = tmp_path / "feat"
+    hdf5_names = [str(feat_dir / ("%d.h5" % i)) for i in range(2)]
+    feats = [np.random.randn(50, 4) for i in range(2)]
+    for hdf5_name, feat in zip(hdf5_names, feats):
+        write_feat(hdf5_name, feat)
+    shard_list = [str(tmp_path / ("shard-%d.h5" % i)) for i in range(2)]
+    for shard_name, hdf5_name, feat in zip(shard_list, hdf5_names, feats):
+        write_shard(shard_name, hdf5_name, "/feat_rec_spk", feat*2)
+
+    assert merge_shards(shard_list) == 2
+    assert not any([os.path.exists(x) for x in shard_list])
+    index = read_index(str(feat_dir))
+    for hdf5_name, feat in zip(hdf5_names, feats):
+        with h5py.File(hdf5_name, "r") as f:
+            assert f["/feat_rec_spk"].dtype == np.float32
+            assert f["/feat_org_lf0"].dtype == np.float32
+        assert index[os.path.basename(hdf5_name)]["paths"] == ["/feat_org_lf0", "/feat_rec_spk"]
+
+    reader = IndexedFeatureReader()
+    np.testing.assert_allclose(reader.read(hdf5_names[0], "/feat_rec_spk", "/feat_org_lf0"), \
+        (feats[0]*2).astype(np.float32))
+    assert not reader.check(hdf5_names[0], "/feat_cyc_spk")
+
+
+def test_indexed_reader_falls_back_to_rewritten_file(tmp_path):
+    feat_dir = tmp_path / "feat"
+    hdf5_name = str(feat_dir / "0.h5")
+    feat = np.random.randn(50, 4)
+    write_feat(hdf5_name, feat)
+    shard_name = str(tmp_path / "shard.h5")
+    write_shard(shard_name, hdf5_name, "/feat_rec_spk", feat)
+    merge_shards([shard_name])
+
+    reader = IndexedFeatureReader()
+    assert not reader.check(hdf5_name, "/feat_cyc_spk")
+    # written outside of merge_shards, the index is stale
+    with HDF5Writer(hdf5_name) as f:
+        f.write("/feat_cyc_spk", feat)
+    assert reader.check(hdf5_name, "/feat_cyc_spk")
+    # not indexed
+    write_feat(str(feat_dir / "1.h5"), feat)
+    assert reader.check(str(feat_dir / "1.h5"), "/feat_org_lf0")
+    assert not reader.check(str(feat_dir / "1.h5"), "/feat_rec_spk")